@@ -0,0 +1,85 @@
+"""
+Compares writing stage data items as a single JSON config map value with writing them as compressed manifest chunks.
+Run from the repository root: python benchmarks/stage_data_manifest.py [number_of_files]
+"""
+import io
+import sys
+import json
+import time
+import tracemalloc
+from unittest.mock import Mock
+from lando.common.commands import StageDataCommand
+from lando.common.manifests import write_manifest_chunks, read_manifest_chunk, DEFAULT_MAX_CHUNK_BYTES
+from lando.common.names import Paths
+from lando.server.jobapi import InputFiles
+
+DEFAULT_NUMBER_OF_FILES = 100000
+CONFIG_MAP_LIMIT_BYTES = 1024 * 1024
+
+
+def make_input_files(number_of_files):
+    dds_files = []
+    for idx in range(number_of_files):
+        dds_files.append({
+            'file_id': '9a4c28a2-ba60-4f3d-8a5a-{:012d}'.format(idx),
+            'destination_path': 'sample{}/reads_{}.fastq.gz'.format(idx % 100, idx),
+            'dds_user_credentials': 1,
+            'size': 1024 * 1024 * idx,
+        })
+    return InputFiles({'dds_files': dds_files, 'url_files': []})
+
+
+def make_stage_data_command():
+    paths = Paths(base_directory='/')
+    workflow = Mock(workflow_url='https://example.org/workflow.cwl', job_order={'threads': 2})
+    names = Mock(workflow_download_dest='/bespin/job-data/workflow/workflow.cwl', unzip_workflow_url_to_path=None,
+                 job_order_path='/bespin/job-data/job-order.json')
+    return StageDataCommand(workflow, names, paths)
+
+
+def measure(func):
+    # Time and memory are measured in separate runs since tracing allocations slows the code down
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def write_json(stage_data_command, input_files):
+    return json.dumps(stage_data_command.command_file_dict(input_files))
+
+
+def write_chunk_sizes(stage_data_command, input_files):
+    # Keeps only the size of each chunk, as the job manager sends each chunk to the cluster before making the next
+    items = stage_data_command.command_file_items(input_files)
+    return [len(chunk) for chunk in write_manifest_chunks(items, DEFAULT_MAX_CHUNK_BYTES)]
+
+
+def main():
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_FILES
+    input_files = make_input_files(number_of_files)
+    stage_data_command = make_stage_data_command()
+
+    payload, json_seconds, json_peak = measure(lambda: write_json(stage_data_command, input_files))
+    json_bytes = len(payload.encode('utf-8'))
+    chunk_sizes, chunk_seconds, chunk_peak = measure(lambda: write_chunk_sizes(stage_data_command, input_files))
+    chunks = list(write_manifest_chunks(stage_data_command.command_file_items(input_files)))
+    start = time.perf_counter()
+    item_count = sum(1 for chunk in chunks for _ in read_manifest_chunk(io.BytesIO(chunk)))
+    read_seconds = time.perf_counter() - start
+
+    print("Stage data for {} files".format(number_of_files))
+    print("  single JSON value:  {:.1f} ms, {:.1f} KiB, peak memory {:.1f} KiB, fits in a config map: {}".format(
+        json_seconds * 1000, json_bytes / 1024.0, json_peak / 1024.0, json_bytes <= CONFIG_MAP_LIMIT_BYTES))
+    print("  manifest chunks:    {:.1f} ms, {:.1f} KiB in {} chunks (largest {:.1f} KiB), peak memory {:.1f} KiB"
+          .format(chunk_seconds * 1000, sum(chunk_sizes) / 1024.0, len(chunk_sizes), max(chunk_sizes) / 1024.0,
+                  chunk_peak / 1024.0))
+    print("  read manifest:      {:.1f} ms ({} items)".format(read_seconds * 1000, item_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures time and memory used to parse a bespin stage group into InputFiles.
+Run from the repository root: python benchmarks/stage_group_parsing.py [number_of_files]
+"""
+import sys
+import json
+import time
+import tracemalloc
+from lando.server.jobapi import InputFiles, DukeDSFile
+
+DEFAULT_NUMBER_OF_FILES = 10000
+REPEAT = 5
+
+
+def make_stage_group_json(number_of_files):
+    dds_files = []
+    for idx in range(number_of_files):
+        dds_files.append({
+            'file_id': '9a4c28a2-ba60-4f3d-8a5a-{:012d}'.format(idx),
+            'destination_path': 'sample{}/reads_{}.fastq.gz'.format(idx % 100, idx),
+            'dds_user_credentials': 1,
+            'size': 1024 * 1024 * idx,
+        })
+    return json.dumps({'dds_files': dds_files, 'url_files': []})
+
+
+def measure_parse_time(stage_group_json):
+    best_seconds = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        InputFiles(json.loads(stage_group_json))
+        elapsed = time.perf_counter() - start
+        if best_seconds is None or elapsed < best_seconds:
+            best_seconds = elapsed
+    return best_seconds
+
+
+def measure_retained_bytes(stage_group_json, parse_func):
+    data = json.loads(stage_group_json)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    result = parse_func(data)
+    del data
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return after - before, result
+
+
+def main():
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER_OF_FILES
+    stage_group_json = make_stage_group_json(number_of_files)
+    parse_seconds = measure_parse_time(stage_group_json)
+    input_files_bytes, input_files = measure_retained_bytes(stage_group_json, InputFiles)
+    object_list_bytes, _ = measure_retained_bytes(
+        stage_group_json, lambda data: [DukeDSFile(item) for item in data['dds_files']])
+    start = time.perf_counter()
+    total_size = sum(dds_file.size for dds_file in input_files.dds_files)
+    iterate_seconds = time.perf_counter() - start
+
+    print("Stage group with {} files".format(number_of_files))
+    print("  parse InputFiles:          {:.1f} ms".format(parse_seconds * 1000))
+    print("  iterate DukeDS files:      {:.1f} ms (total size {})".format(iterate_seconds * 1000, total_size))
+    print("  InputFiles memory:         {:.1f} KiB".format(input_files_bytes / 1024.0))
+    print("  list of DukeDSFile memory: {:.1f} KiB".format(object_list_bytes / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
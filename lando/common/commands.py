@@ -13,12 +13,21 @@ import datetime
 import logging
 import codecs
 import tempfile
-from lando.exceptions import JobStepFailed
+from lando.exceptions import JobStepFailed, InvalidCommandFileException
 from ddsc.config import LOCAL_CONFIG_ENV as DDSCLIENT_CONFIG_ENV, Config as DukeDSConfig
 
 RUN_CWL_COMMAND = "cwltool"
 RUN_CWL_OUTDIR_ARG = "--outdir"
 JOB_STDERR_OUTPUT_MAX_LINES = 100
+NDJSON_COMMAND_FILE_FORMAT = "lando-ndjson"
+NDJSON_COMMAND_FILE_VERSION = 1
+
+
+class CommandFileFormats(object):
+    # A single JSON object
+    JSON = "json"
+    # A header record followed by one JSON item per line
+    NDJSON = "ndjson"
 
 
 class StageDataTypes(object):
@@ -42,6 +51,22 @@ def read_file(file_path):
         return ''
 
 
+def read_ndjson_file(file_path):
+    """
+    Read the items from a command file written by BaseCommand.write_ndjson_file one line at a time.
+    :param file_path: str: path to the command file
+    :return: generator of items
+    """
+    with open(file_path, 'r') as infile:
+        header = json.loads(infile.readline() or 'null')
+        if not isinstance(header, dict) or header.get("format") != NDJSON_COMMAND_FILE_FORMAT:
+            raise InvalidCommandFileException("Command file {} is missing its header.".format(file_path))
+        if header.get("version") != NDJSON_COMMAND_FILE_VERSION:
+            raise InvalidCommandFileException("Unsupported command file version {}.".format(header.get("version")))
+        for line in infile:
+            yield json.loads(line)
+
+
 class StepProcess(object):
     def __init__(self, command, stdout_path, stderr_path, env=None):
         self.command = command
@@ -86,6 +111,27 @@ class BaseCommand(object):
         with open(filename, 'w') as outfile:
             outfile.write(json.dumps(data))
 
+    @staticmethod
+    def write_ndjson_file(filename, command, items):
+        """
+        Write a header record followed by one line per item as each item is produced,
+        so large lists are never held in memory.
+        :param filename: str: path of the file to write
+        :param command: str: name of the command the file is for, stored in the header record
+        :param items: iterable of JSON serializable items
+        """
+        header = {
+            "format": NDJSON_COMMAND_FILE_FORMAT,
+            "version": NDJSON_COMMAND_FILE_VERSION,
+            "command": command,
+        }
+        with open(filename, 'w') as outfile:
+            outfile.write(json.dumps(header))
+            outfile.write("\n")
+            for item in items:
+                outfile.write(json.dumps(item))
+                outfile.write("\n")
+
     def run_command(self, command, env=None, stdout_path=None, stderr_path=None):
         # Create temp files for saving stdout and stderr if the caller didn't specify them.
         # When the process fails an exception will be raised with content from these two files
@@ -160,23 +206,28 @@ class StageDataCommand(BaseCommand):
         self.paths = paths
 
     def command_file_dict(self, input_files):
-        items = [
-            # Stages workflow that will be run. Downloads the file at the specified URL and
-            # optionally unzips downloaded file if unzip_workflow_url_to_path is not None
-            self.create_stage_data_config_item(StageDataTypes.URL,
-                                               self.workflow.workflow_url,
-                                               self.names.workflow_download_dest,
-                                               self.names.unzip_workflow_url_to_path),
-            # Create a job order file specifying inputs used when running the workflow.
-            # Writes job order data to the specified job_order_path
-            self.create_stage_data_config_item(StageDataTypes.WRITE,
-                                               self.workflow.job_order,
-                                               self.names.job_order_path)
-        ]
+        return {"items": list(self.command_file_items(input_files))}
+
+    def command_file_items(self, input_files):
+        """
+        Create the items to stage one at a time so large stage groups can be written without building a list.
+        :param input_files: InputFiles: files to be staged
+        :return: generator of dict: stage data items
+        """
+        # Stages workflow that will be run. Downloads the file at the specified URL and
+        # optionally unzips downloaded file if unzip_workflow_url_to_path is not None
+        yield self.create_stage_data_config_item(StageDataTypes.URL,
+                                                 self.workflow.workflow_url,
+                                                 self.names.workflow_download_dest,
+                                                 self.names.unzip_workflow_url_to_path)
+        # Create a job order file specifying inputs used when running the workflow.
+        # Writes job order data to the specified job_order_path
+        yield self.create_stage_data_config_item(StageDataTypes.WRITE,
+                                                 self.workflow.job_order,
+                                                 self.names.job_order_path)
         for dds_file in input_files.dds_files:
             dest = '{}/{}'.format(self.paths.JOB_DATA, dds_file.destination_path)
-            items.append(self.create_stage_data_config_item(StageDataTypes.DUKEDS, dds_file.file_id, dest))
-        return {"items": items}
+            yield self.create_stage_data_config_item(StageDataTypes.DUKEDS, dds_file.file_id, dest)
 
     @staticmethod
     def create_stage_data_config_item(workflow_type, source, dest, unzip_to=None):
@@ -185,9 +236,12 @@ class StageDataCommand(BaseCommand):
             item["unzip_to"] = unzip_to
         return item
 
-    def run(self, base_command, dds_credentials, input_files):
+    def run(self, base_command, dds_credentials, input_files, command_file_format=CommandFileFormats.JSON):
         command_filename = self.names.stage_data_command_filename
-        self.write_json_file(command_filename, self.command_file_dict(input_files))
+        if command_file_format == CommandFileFormats.NDJSON:
+            self.write_ndjson_file(command_filename, "stage_data", self.command_file_items(input_files))
+        else:
+            self.write_json_file(command_filename, self.command_file_dict(input_files))
 
         dds_config_filename = self.names.dds_config_filename
         self.write_dds_config_file(dds_config_filename, dds_credentials)
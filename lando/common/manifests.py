@@ -0,0 +1,148 @@
+"""
+Manifests hold a list of items (such as the files staged by StageDataCommand) as gzip compressed
+newline delimited JSON split into chunks of a limited size.
+Every chunk starts with a header record so a reader can check the format version before reading any items.
+Items are written and read one at a time so the whole list is never held in memory.
+"""
+import os
+import io
+import gzip
+import json
+from lando.exceptions import InvalidManifestException
+
+MANIFEST_FORMAT = "lando-manifest"
+MANIFEST_FORMAT_VERSION = 1
+MANIFEST_CHUNK_SUFFIX = ".ndjson.gz"
+# Kubernetes limits a ConfigMap or Secret to 1MiB so chunks default to half of that
+DEFAULT_MAX_CHUNK_BYTES = 512 * 1024
+# Uncompressed bytes written between flushes of the compressor, bounds the bytes not yet counted in a chunk's size
+FLUSH_BYTES = 64 * 1024
+# Room left at the end of a chunk for the flush markers and gzip trailer
+CHUNK_TRAILER_BYTES = 64
+
+
+def manifest_chunk_filename(index):
+    """
+    :param index: int: position of the chunk in the manifest
+    :return: str: filename for the chunk, chunk filenames sort in manifest order
+    """
+    return "{:05d}{}".format(index, MANIFEST_CHUNK_SUFFIX)
+
+
+def encode_manifest_record(record):
+    return (json.dumps(record) + "\n").encode("utf-8")
+
+
+class ManifestChunk(object):
+    """
+    Compresses the records of a single chunk into memory.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.item_count = 0
+        self.buffer = io.BytesIO()
+        self.gzip_file = gzip.GzipFile(fileobj=self.buffer, mode='wb', mtime=0)
+        self.unflushed_bytes = 0
+        self._write(encode_manifest_record({
+            "format": MANIFEST_FORMAT,
+            "version": MANIFEST_FORMAT_VERSION,
+            "chunk": index,
+        }))
+
+    def has_room(self, line_size, max_chunk_bytes):
+        """
+        Compressed data is never larger than its input by more than a few bytes so counting data the compressor
+        still holds at its uncompressed size keeps chunks under max_chunk_bytes.
+        :param line_size: int: size of the encoded record to be added
+        :param max_chunk_bytes: int: maximum size of the compressed chunk
+        :return: bool: True when the record fits in this chunk
+        """
+        upper_bound = self.buffer.tell() + self.unflushed_bytes + line_size + CHUNK_TRAILER_BYTES
+        return upper_bound <= max_chunk_bytes
+
+    def write_item(self, line):
+        self._write(line)
+        self.item_count += 1
+
+    def _write(self, line):
+        self.gzip_file.write(line)
+        self.unflushed_bytes += len(line)
+        if self.unflushed_bytes >= FLUSH_BYTES:
+            self.gzip_file.flush()
+            self.unflushed_bytes = 0
+
+    def close(self):
+        """
+        :return: bytes: gzip compressed records of this chunk
+        """
+        self.gzip_file.close()
+        return self.buffer.getvalue()
+
+
+def write_manifest_chunks(items, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+    """
+    Compress items into chunks as they are read from items.
+    A single item larger than max_chunk_bytes is written to a chunk of its own.
+    :param items: iterable of JSON serializable items
+    :param max_chunk_bytes: int: maximum size of each compressed chunk
+    :return: generator of bytes: gzip compressed chunks, there is always at least one chunk
+    """
+    chunk = ManifestChunk(index=0)
+    for item in items:
+        line = encode_manifest_record(item)
+        if chunk.item_count and not chunk.has_room(len(line), max_chunk_bytes):
+            yield chunk.close()
+            chunk = ManifestChunk(index=chunk.index + 1)
+        chunk.write_item(line)
+    yield chunk.close()
+
+
+def write_manifest_directory(directory, items, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+    """
+    Write the chunks of a manifest into an existing directory.
+    :param directory: str: path to the directory to write chunk files into
+    :param items: iterable of JSON serializable items
+    :param max_chunk_bytes: int: maximum size of each compressed chunk
+    :return: [str]: paths of the chunk files written
+    """
+    paths = []
+    for index, chunk in enumerate(write_manifest_chunks(items, max_chunk_bytes)):
+        path = os.path.join(directory, manifest_chunk_filename(index))
+        with open(path, 'wb') as outfile:
+            outfile.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def read_manifest_chunk(fileobj):
+    """
+    Read the items from a single compressed chunk.
+    :param fileobj: binary file like object containing a gzip compressed chunk
+    :return: generator of items
+    """
+    with gzip.GzipFile(fileobj=fileobj, mode='rb') as gzip_file:
+        header_line = gzip_file.readline()
+        if not header_line:
+            raise InvalidManifestException("Manifest chunk is empty.")
+        header = json.loads(header_line.decode("utf-8"))
+        if not isinstance(header, dict) or header.get("format") != MANIFEST_FORMAT:
+            raise InvalidManifestException("Manifest chunk is missing its header.")
+        if header.get("version") != MANIFEST_FORMAT_VERSION:
+            raise InvalidManifestException("Unsupported manifest version {}.".format(header.get("version")))
+        for line in gzip_file:
+            yield json.loads(line.decode("utf-8"))
+
+
+def read_manifest_directory(directory):
+    """
+    Read the items from all chunks in a directory in manifest order.
+    :param directory: str: path to a directory containing chunk files
+    :return: generator of items
+    """
+    filenames = sorted(filename for filename in os.listdir(directory) if filename.endswith(MANIFEST_CHUNK_SUFFIX))
+    if not filenames:
+        raise InvalidManifestException("No manifest chunks found in {}.".format(directory))
+    for filename in filenames:
+        with open(os.path.join(directory, filename), 'rb') as infile:
+            for item in read_manifest_chunk(infile):
+                yield item
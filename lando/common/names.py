@@ -68,4 +68,6 @@ class Paths(object):
         self.OUTPUT_DATA = '{}bespin/output-data'.format(base_directory)
         self.OUTPUT_RESULTS_DIR = '{}bespin/output-data/results'.format(base_directory)
         self.TMPOUT_DATA = '{}bespin/output-data/tmpout'.format(base_directory)
+        self.SCRATCH_TMPOUT_DATA = '{}bespin/scratch/tmpout'.format(base_directory)
+        self.SCRATCH_TMP_DATA = '{}bespin/scratch/tmp'.format(base_directory)
         self.REMOTE_README_FILE_PATH = 'results/docs/README.md'
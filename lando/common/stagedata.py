@@ -0,0 +1,373 @@
+"""
+Built-in stage data command that stages the items of a stage data command file on a pool of threads.
+Run: python -m lando.common.stagedata [--threads N] [--max-bytes-per-second N] [--verify-hash] \
+       <command_file> <metadata_path>
+command_file may be a JSON or NDJSON command file written by StageDataCommand or a directory of manifest chunks.
+DukeDS credentials are read from the config file named by the DDSCLIENT_CONF environment variable.
+Files are downloaded to a temporary name and renamed once complete. When staging is run again, files that are
+already present with the expected size (and md5 hash when --verify-hash is used) are not downloaded again.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import argparse
+import logging
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from ddsc.config import create_config
+from ddsc.sdk.client import DDSConnection
+from lando.common.commands import StageDataTypes, NDJSON_COMMAND_FILE_FORMAT, read_ndjson_file
+from lando.common.manifests import read_manifest_directory
+
+DEFAULT_THREADS = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+URL_REQUEST_TIMEOUT_SECONDS = 60
+TEMP_FILE_SUFFIX = ".download"
+PARTIAL_METADATA_SUFFIX = ".partial"
+# Number of characters read from the start of a command file to find an NDJSON header record
+HEADER_PEEK_SIZE = 4096
+
+
+def is_ndjson_command_file(file_path):
+    with open(file_path, 'r') as infile:
+        first_line = infile.readline(HEADER_PEEK_SIZE)
+    try:
+        header = json.loads(first_line)
+    except ValueError:
+        return False
+    return isinstance(header, dict) and header.get("format") == NDJSON_COMMAND_FILE_FORMAT
+
+
+def read_stage_data_items(path):
+    """
+    Read the stage data items from any of the formats StageDataCommand and JobManager write.
+    :param path: str: path to a JSON or NDJSON command file or a directory of manifest chunks
+    :return: iterable of dict: stage data items
+    """
+    if os.path.isdir(path):
+        return read_manifest_directory(path)
+    if is_ndjson_command_file(path):
+        return read_ndjson_file(path)
+    with open(path, 'r') as infile:
+        return json.load(infile)['items']
+
+
+def md5_for_path(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def write_file_atomically(dest, write_func):
+    """
+    Write to a temporary file next to dest and rename it to dest once write_func finishes,
+    so an interrupted write never leaves a partial file at dest.
+    :param dest: str: path of the file to create
+    :param write_func: func(file): writes the contents to the binary file passed to it
+    """
+    parent_directory = os.path.dirname(dest)
+    if parent_directory:
+        os.makedirs(parent_directory, exist_ok=True)
+    temp_path = dest + TEMP_FILE_SUFFIX
+    try:
+        with open(temp_path, 'wb') as outfile:
+            write_func(outfile)
+        os.replace(temp_path, dest)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class HostBandwidthLimiter(object):
+    """
+    Limits the combined download rate of all threads from each host.
+    """
+    def __init__(self, max_bytes_per_second, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param max_bytes_per_second: int: maximum bytes per second from a single host, None for no limit
+        """
+        self.max_bytes_per_second = max_bytes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.host_available_times = {}
+
+    def consume(self, host, num_bytes):
+        """
+        Wait until num_bytes more bytes from host fit within the limit.
+        Each call reserves the time it takes to transfer num_bytes after all earlier reservations for host.
+        :param host: str: host the bytes were downloaded from
+        :param num_bytes: int: number of bytes downloaded
+        """
+        if not self.max_bytes_per_second:
+            return
+        with self.lock:
+            now = self.clock()
+            start = max(now, self.host_available_times.get(host, now))
+            available_time = start + num_bytes / self.max_bytes_per_second
+            self.host_available_times[host] = available_time
+        delay = available_time - now
+        if delay > 0:
+            self.sleep(delay)
+
+
+class StagedFilesLog(object):
+    """
+    Records each staged file as soon as it is complete in a partial metadata file next to metadata_path.
+    A later run reads this file to skip files that were already staged.
+    Once all files are staged the DukeDS file details are written to metadata_path as {"items": [...]}.
+    Only the size and hash of each file are kept in memory, the DukeDS file details are read back from the file.
+    """
+    def __init__(self, metadata_path):
+        self.metadata_path = metadata_path
+        self.partial_path = metadata_path + PARTIAL_METADATA_SUFFIX
+        self.lock = threading.Lock()
+        self.records = {}
+        self.line_count = 0
+        self.valid_bytes = 0
+        self.outfile = None
+
+    def open(self):
+        """
+        Read the records of a previous run and open the partial metadata file to add more records.
+        """
+        if os.path.exists(self.partial_path):
+            with open(self.partial_path, 'rb') as infile:
+                for line in infile:
+                    record = self._parse_line(line)
+                    if not record:
+                        # the last line is incomplete when a previous run was stopped while writing it
+                        break
+                    self._remember(record)
+                    self.valid_bytes += len(line)
+        self.outfile = open(self.partial_path, 'ab')
+        self.outfile.truncate(self.valid_bytes)
+
+    @staticmethod
+    def _parse_line(line):
+        if not line.endswith(b'\n'):
+            return None
+        try:
+            return json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def _remember(self, record):
+        self.records[record['dest']] = (record['size'], record['md5'], self.line_count)
+        self.line_count += 1
+
+    def get(self, dest):
+        """
+        :return: (int, str): size and md5 hash of dest when it was staged by this or an earlier run, otherwise None
+        """
+        values = self.records.get(dest)
+        if values:
+            size, md5, line_number = values
+            return size, md5
+        return None
+
+    def add(self, dest, size, md5, metadata):
+        """
+        :param dest: str: path of the staged file
+        :param size: int: size of the staged file
+        :param md5: str: md5 hash of the staged file when known
+        :param metadata: dict: DukeDS file details to include in metadata_path or None
+        """
+        record = {"dest": dest, "size": size, "md5": md5, "metadata": metadata}
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        with self.lock:
+            self._remember(record)
+            self.outfile.write(line)
+            self.outfile.flush()
+
+    def close(self):
+        if self.outfile:
+            self.outfile.close()
+            self.outfile = None
+
+    def write_metadata(self):
+        """
+        Write the DukeDS file details of the latest record for each staged file to metadata_path.
+        """
+        def write_items(outfile):
+            outfile.write(b'{"items": [')
+            separator = b''
+            with open(self.partial_path, 'rb') as infile:
+                for line_number, line in enumerate(infile):
+                    record = json.loads(line.decode('utf-8'))
+                    size, md5, latest_line_number = self.records[record['dest']]
+                    if record['metadata'] is not None and line_number == latest_line_number:
+                        outfile.write(separator + json.dumps(record['metadata']).encode('utf-8'))
+                        separator = b', '
+            outfile.write(b']}')
+        write_file_atomically(self.metadata_path, write_items)
+        os.remove(self.partial_path)
+
+
+class InputStager(object):
+    """
+    Stages the items of a stage data command file using a pool of threads.
+    """
+    def __init__(self, threads=DEFAULT_THREADS, max_bytes_per_second=None, verify_hash=False,
+                 create_dds_connection=None):
+        """
+        :param threads: int: number of items staged at the same time
+        :param max_bytes_per_second: int: maximum download rate from each host, None for no limit
+        :param verify_hash: bool: compare the md5 hash of files already present instead of only their size
+        :param create_dds_connection: func(): creates a DDSConnection, called once for each thread
+        """
+        self.threads = threads
+        self.bandwidth_limiter = HostBandwidthLimiter(max_bytes_per_second)
+        self.verify_hash = verify_hash
+        self.create_dds_connection = create_dds_connection or self._create_default_dds_connection
+        self.thread_data = threading.local()
+        self.staged_files_log = None
+
+    @staticmethod
+    def _create_default_dds_connection():
+        return DDSConnection(create_config(allow_insecure_config_file=True))
+
+    def get_dds_connection(self):
+        if not hasattr(self.thread_data, 'dds_connection'):
+            self.thread_data.dds_connection = self.create_dds_connection()
+        return self.thread_data.dds_connection
+
+    def stage(self, items, metadata_path):
+        """
+        Stage items then write the details of the staged DukeDS files to metadata_path.
+        No more than threads * 2 items are waiting to be staged at any time so items may be a large iterator.
+        :param items: iterable of dict: stage data items
+        :param metadata_path: str: path where DukeDS file details will be written
+        """
+        self.staged_files_log = StagedFilesLog(metadata_path)
+        self.staged_files_log.open()
+        item_count = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                pending = set()
+                for item in items:
+                    item_count += 1
+                    pending.add(executor.submit(self.stage_item, item))
+                    if len(pending) >= self.threads * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self._raise_for_failures(done, pending)
+                done, pending = wait(pending)
+                self._raise_for_failures(done, pending)
+        finally:
+            self.staged_files_log.close()
+        self.staged_files_log.write_metadata()
+        logging.info("Staged {} items".format(item_count))
+
+    @staticmethod
+    def _raise_for_failures(done, pending):
+        for future in done:
+            if future.exception():
+                for pending_future in pending:
+                    pending_future.cancel()
+                raise future.exception()
+
+    def stage_item(self, item):
+        item_type = item['type']
+        if item_type == StageDataTypes.URL:
+            self.stage_url_item(item['source'], item['dest'], item.get('unzip_to'))
+        elif item_type == StageDataTypes.WRITE:
+            self.stage_write_item(item['source'], item['dest'])
+        elif item_type == StageDataTypes.DUKEDS:
+            self.stage_dukeds_item(item['source'], item['dest'])
+        else:
+            raise ValueError("Unsupported stage data type {}.".format(item_type))
+
+    def stage_write_item(self, source, dest):
+        content = json.dumps(source).encode('utf-8')
+        write_file_atomically(dest, lambda outfile: outfile.write(content))
+
+    def stage_url_item(self, source, dest, unzip_to):
+        staged_size_and_md5 = self.staged_files_log.get(dest)
+        if not (staged_size_and_md5 and self.is_file_present(dest, *staged_size_and_md5)):
+            response = requests.get(source, stream=True, timeout=URL_REQUEST_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            md5 = self.download_response(urlparse(source).netloc, response, dest)
+            self.staged_files_log.add(dest, os.path.getsize(dest), md5, metadata=None)
+        if unzip_to:
+            with zipfile.ZipFile(dest) as zip_file:
+                zip_file.extractall(unzip_to)
+
+    def stage_dukeds_item(self, file_id, dest):
+        staged_size_and_md5 = self.staged_files_log.get(dest)
+        if staged_size_and_md5 and self.is_file_present(dest, *staged_size_and_md5):
+            return
+        dds_connection = self.get_dds_connection()
+        # The file details are kept as DukeDS returned them since they are written to the metadata file
+        file_data = dds_connection.data_service.get_file(file_id).json()
+        upload = file_data['current_version']['upload']
+        expected_md5 = self.get_md5_hash(upload)
+        if not self.is_file_present(dest, upload['size'], expected_md5):
+            file_download = dds_connection.get_file_download(file_id)
+            response = dds_connection.data_service.receive_external(file_download.http_verb, file_download.host,
+                                                                    file_download.url, file_download.http_headers)
+            response.raise_for_status()
+            self.download_response(file_download.host, response, dest)
+        self.staged_files_log.add(dest, upload['size'], expected_md5, metadata=file_data)
+
+    @staticmethod
+    def get_md5_hash(upload):
+        for file_hash in upload.get('hashes') or []:
+            if file_hash.get('algorithm') == 'md5':
+                return file_hash.get('value')
+        return None
+
+    def is_file_present(self, dest, size, md5):
+        """
+        :return: bool: True when dest exists with size bytes and, when verify_hash is set, the md5 hash
+        """
+        if not os.path.exists(dest) or os.path.getsize(dest) != size:
+            return False
+        if self.verify_hash and md5:
+            return md5_for_path(dest) == md5
+        return True
+
+    def download_response(self, host, response, dest):
+        """
+        Save the content of a streaming response to dest limiting the rate data is read from host.
+        :return: str: md5 hash of the content
+        """
+        md5 = hashlib.md5()
+
+        def write_chunks(outfile):
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    self.bandwidth_limiter.consume(host, len(chunk))
+                    md5.update(chunk)
+                    outfile.write(chunk)
+
+        write_file_atomically(dest, write_chunks)
+        return md5.hexdigest()
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Stage the input files listed in a stage data command file.")
+    parser.add_argument("command_file", help="JSON or NDJSON command file or directory of manifest chunks")
+    parser.add_argument("metadata_path", help="path where details about the staged DukeDS files are written")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help="number of files staged at the same time")
+    parser.add_argument("--max-bytes-per-second", type=int, default=None,
+                        help="maximum download rate from each host")
+    parser.add_argument("--verify-hash", action="store_true",
+                        help="check the md5 hash of files left by a previous run instead of only their size")
+    parsed_args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    stager = InputStager(threads=parsed_args.threads,
+                         max_bytes_per_second=parsed_args.max_bytes_per_second,
+                         verify_hash=parsed_args.verify_hash)
+    stager.stage(read_stage_data_items(parsed_args.command_file), parsed_args.metadata_path)
+
+
+if __name__ == '__main__':
+    main()
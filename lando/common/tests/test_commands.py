@@ -1,8 +1,11 @@
 from unittest import TestCase
 from lando.common.commands import read_file, StepProcess, JobStepFailed, BaseCommand, StageDataCommand, \
-    RunWorkflowCommand, OrganizeOutputCommand, SaveOutputCommand
+    RunWorkflowCommand, OrganizeOutputCommand, SaveOutputCommand, CommandFileFormats, read_ndjson_file
+from lando.exceptions import InvalidCommandFileException
 from unittest.mock import patch, mock_open, call, ANY, Mock
 from dateutil.parser import parse
+import os
+import tempfile
 
 
 class TestReadFile(TestCase):
@@ -114,6 +117,39 @@ class BaseCommandTestCase(TestCase):
         fake_open.return_value.write.assert_called_with(mock_json.dumps.return_value)
         mock_json.dumps.assert_called_with({"A": "B"})
 
+    def test_write_and_read_ndjson_file(self):
+        cmd = BaseCommand()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cmd.json')
+            cmd.write_ndjson_file(filename, 'stage_data', iter([{"A": "B"}, {"C": "D"}]))
+            with open(filename) as infile:
+                lines = infile.readlines()
+            self.assertEqual(lines, [
+                '{"format": "lando-ndjson", "version": 1, "command": "stage_data"}\n',
+                '{"A": "B"}\n',
+                '{"C": "D"}\n',
+            ])
+            self.assertEqual(list(read_ndjson_file(filename)), [{"A": "B"}, {"C": "D"}])
+
+    def test_read_ndjson_file_checks_header(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'cmd.json')
+            with open(filename, 'w') as outfile:
+                outfile.write('{"items": []}')
+            with self.assertRaises(InvalidCommandFileException):
+                list(read_ndjson_file(filename))
+
+            with open(filename, 'w') as outfile:
+                outfile.write('{"format": "lando-ndjson", "version": 2, "command": "stage_data"}\n')
+            with self.assertRaises(InvalidCommandFileException) as raised_exception:
+                list(read_ndjson_file(filename))
+            self.assertEqual(raised_exception.exception.value, 'Unsupported command file version 2.')
+
+            with open(filename, 'w') as outfile:
+                outfile.write('')
+            with self.assertRaises(InvalidCommandFileException):
+                list(read_ndjson_file(filename))
+
     @patch('lando.common.commands.StepProcess')
     @patch('lando.common.commands.tempfile')
     @patch('lando.common.commands.os')
@@ -241,6 +277,22 @@ class StageDataCommandTestCase(TestCase):
         cmd.run_command_with_dds_env.assert_called_with(['downloadit', '/work/cmd.json', '/work/metadata.json'],
                                                         '/work/ddsclient.conf')
 
+    def test_run_ndjson(self):
+        cmd = StageDataCommand(self.mock_workflow, self.mock_names, self.mock_paths)
+        cmd.write_json_file = Mock()
+        cmd.write_ndjson_file = Mock()
+        cmd.run_command_with_dds_env = Mock()
+        cmd.run(base_command=['downloadit'], dds_credentials=Mock(), input_files=self.input_files,
+                command_file_format=CommandFileFormats.NDJSON)
+        args, kwargs = cmd.write_ndjson_file.call_args
+        filename, command, items = args
+        self.assertEqual(filename, "/work/cmd.json")
+        self.assertEqual(command, "stage_data")
+        self.assertEqual(list(items), cmd.command_file_dict(self.input_files)['items'])
+        cmd.write_json_file.assert_called_once_with("/work/ddsclient.conf", ANY)
+        cmd.run_command_with_dds_env.assert_called_with(['downloadit', '/work/cmd.json', '/work/metadata.json'],
+                                                        '/work/ddsclient.conf')
+
 
 class RunWorkflowCommandTestCase(TestCase):
     def setUp(self):
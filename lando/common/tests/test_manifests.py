@@ -0,0 +1,76 @@
+from unittest import TestCase
+from lando.common.manifests import write_manifest_chunks, write_manifest_directory, read_manifest_chunk, \
+    read_manifest_directory, manifest_chunk_filename, encode_manifest_record
+from lando.exceptions import InvalidManifestException
+import gzip
+import io
+import os
+import random
+import tempfile
+
+
+def make_items(count):
+    rand = random.Random(0)
+    return [{'type': 'DukeDS', 'source': '{:032x}'.format(rand.getrandbits(128)), 'dest': 'data/file{}'.format(idx)}
+            for idx in range(count)]
+
+
+class TestManifests(TestCase):
+    def test_manifest_chunk_filename(self):
+        self.assertEqual('00000.ndjson.gz', manifest_chunk_filename(0))
+        self.assertEqual('00012.ndjson.gz', manifest_chunk_filename(12))
+
+    def test_write_and_read_single_chunk(self):
+        items = make_items(3)
+        chunks = list(write_manifest_chunks(iter(items)))
+        self.assertEqual(1, len(chunks))
+        self.assertEqual(items, list(read_manifest_chunk(io.BytesIO(chunks[0]))))
+
+    def test_write_no_items(self):
+        chunks = list(write_manifest_chunks([]))
+        self.assertEqual(1, len(chunks))
+        self.assertEqual([], list(read_manifest_chunk(io.BytesIO(chunks[0]))))
+
+    def test_chunks_are_limited_to_max_chunk_bytes(self):
+        items = make_items(5000)
+        chunks = list(write_manifest_chunks(items, max_chunk_bytes=16 * 1024))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 16 * 1024)
+        read_items = []
+        for chunk in chunks:
+            read_items.extend(read_manifest_chunk(io.BytesIO(chunk)))
+        self.assertEqual(items, read_items)
+
+    def test_large_item_gets_its_own_chunk(self):
+        items = [{'source': 'a'}, {'source': 'b' * 2000}, {'source': 'c'}]
+        chunks = list(write_manifest_chunks(items, max_chunk_bytes=1000))
+        self.assertEqual(3, len(chunks))
+        self.assertEqual([items[1]], list(read_manifest_chunk(io.BytesIO(chunks[1]))))
+
+    def test_write_and_read_directory(self):
+        items = make_items(2000)
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_manifest_directory(directory, items, max_chunk_bytes=16 * 1024)
+            self.assertGreater(len(paths), 1)
+            self.assertEqual(os.path.join(directory, '00000.ndjson.gz'), paths[0])
+            self.assertEqual(items, list(read_manifest_directory(directory)))
+
+    def test_read_empty_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(InvalidManifestException):
+                list(read_manifest_directory(directory))
+
+    def test_read_chunk_checks_header(self):
+        chunk = gzip.compress(encode_manifest_record({'source': 'a'}))
+        with self.assertRaises(InvalidManifestException):
+            list(read_manifest_chunk(io.BytesIO(chunk)))
+
+        header = {'format': 'lando-manifest', 'version': 2, 'chunk': 0}
+        chunk = gzip.compress(encode_manifest_record(header))
+        with self.assertRaises(InvalidManifestException) as raised_exception:
+            list(read_manifest_chunk(io.BytesIO(chunk)))
+        self.assertEqual('Unsupported manifest version 2.', raised_exception.exception.value)
+
+        with self.assertRaises(InvalidManifestException):
+            list(read_manifest_chunk(io.BytesIO(gzip.compress(b''))))
@@ -0,0 +1,241 @@
+from unittest import TestCase
+from unittest.mock import patch, Mock, call
+from lando.common.stagedata import read_stage_data_items, write_file_atomically, HostBandwidthLimiter, \
+    StagedFilesLog, InputStager, main
+from lando.common.commands import BaseCommand
+from lando.common.manifests import write_manifest_directory
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zipfile
+
+
+def read_json(path):
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def make_dds_file_data(file_id, content):
+    return {
+        'id': file_id,
+        'current_version': {'upload': {
+            'size': len(content),
+            'hashes': [{'algorithm': 'md5', 'value': hashlib.md5(content).hexdigest()}]
+        }},
+    }
+
+
+class FakeDDSConnection(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.downloaded_file_ids = []
+        self.data_service = Mock()
+        self.data_service.get_file.side_effect = self.get_file
+        self.data_service.receive_external.side_effect = self.receive_external
+
+    def get_file(self, file_id):
+        return Mock(json=Mock(return_value=make_dds_file_data(file_id, self.contents[file_id])))
+
+    def get_file_download(self, file_id):
+        return Mock(http_verb='GET', host='https://dds.example.org', url='/' + file_id, http_headers={})
+
+    def receive_external(self, http_verb, host, url, http_headers):
+        file_id = url[1:]
+        self.downloaded_file_ids.append(file_id)
+        return Mock(iter_content=Mock(return_value=[self.contents[file_id]]))
+
+
+class TestReadStageDataItems(TestCase):
+    def setUp(self):
+        self.items = [{'type': 'DukeDS', 'source': '123', 'dest': '/data/a.txt'}]
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_json_command_file(self):
+        path = os.path.join(self.directory.name, 'stagedata.json')
+        BaseCommand.write_json_file(path, {'items': self.items})
+        self.assertEqual(self.items, list(read_stage_data_items(path)))
+
+    def test_ndjson_command_file(self):
+        path = os.path.join(self.directory.name, 'stagedata.json')
+        BaseCommand.write_ndjson_file(path, 'stage_data', self.items)
+        self.assertEqual(self.items, list(read_stage_data_items(path)))
+
+    def test_manifest_directory(self):
+        write_manifest_directory(self.directory.name, self.items)
+        self.assertEqual(self.items, list(read_stage_data_items(self.directory.name)))
+
+
+class TestWriteFileAtomically(TestCase):
+    def test_creates_parent_directory_and_renames(self):
+        with tempfile.TemporaryDirectory() as directory:
+            dest = os.path.join(directory, 'sub', 'data.txt')
+            write_file_atomically(dest, lambda outfile: outfile.write(b'abc'))
+            with open(dest, 'rb') as infile:
+                self.assertEqual(b'abc', infile.read())
+            self.assertEqual(['data.txt'], os.listdir(os.path.join(directory, 'sub')))
+
+    def test_failed_write_leaves_no_file(self):
+        def write_func(outfile):
+            outfile.write(b'abc')
+            raise IOError("Connection lost")
+
+        with tempfile.TemporaryDirectory() as directory:
+            dest = os.path.join(directory, 'data.txt')
+            with self.assertRaises(IOError):
+                write_file_atomically(dest, write_func)
+            self.assertEqual([], os.listdir(directory))
+
+
+class TestHostBandwidthLimiter(TestCase):
+    def test_consume_waits_for_each_host(self):
+        mock_sleep = Mock()
+        limiter = HostBandwidthLimiter(max_bytes_per_second=100, clock=Mock(return_value=10.0), sleep=mock_sleep)
+        limiter.consume('host1', 100)
+        limiter.consume('host1', 50)
+        limiter.consume('host2', 50)
+        mock_sleep.assert_has_calls([call(1.0), call(1.5), call(0.5)])
+
+    def test_no_limit(self):
+        mock_sleep = Mock()
+        limiter = HostBandwidthLimiter(max_bytes_per_second=None, sleep=mock_sleep)
+        limiter.consume('host1', 100)
+        mock_sleep.assert_not_called()
+
+
+class TestStagedFilesLog(TestCase):
+    def test_records_are_read_by_a_later_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            metadata_path = os.path.join(directory, 'metadata.json')
+            staged_files_log = StagedFilesLog(metadata_path)
+            staged_files_log.open()
+            staged_files_log.add('/data/a.txt', 3, 'abc', {'id': 'a'})
+            staged_files_log.add('/data/b.txt', 4, None, None)
+            staged_files_log.close()
+            # simulate a run that was stopped while writing a record
+            with open(metadata_path + '.partial', 'a') as outfile:
+                outfile.write('{"dest": "/data/c')
+
+            staged_files_log = StagedFilesLog(metadata_path)
+            staged_files_log.open()
+            self.assertEqual((3, 'abc'), staged_files_log.get('/data/a.txt'))
+            self.assertEqual((4, None), staged_files_log.get('/data/b.txt'))
+            self.assertEqual(None, staged_files_log.get('/data/c.txt'))
+            staged_files_log.add('/data/a.txt', 5, 'def', {'id': 'a2'})
+            staged_files_log.close()
+            staged_files_log.write_metadata()
+
+            self.assertEqual({'items': [{'id': 'a2'}]}, read_json(metadata_path))
+            self.assertFalse(os.path.exists(metadata_path + '.partial'))
+
+
+class TestInputStager(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dds_connection = FakeDDSConnection({
+            'file1': b'first file',
+            'file2': b'second file',
+        })
+        self.metadata_path = os.path.join(self.directory.name, 'metadata.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_path(self, filename):
+        return os.path.join(self.directory.name, filename)
+
+    def read_path(self, filename):
+        with open(self.make_path(filename), 'rb') as infile:
+            return infile.read()
+
+    def make_stager(self, **kwargs):
+        return InputStager(create_dds_connection=lambda: self.dds_connection, **kwargs)
+
+    def test_stage_dukeds_and_write_items(self):
+        items = [
+            {'type': 'write', 'source': {'threads': 2}, 'dest': self.make_path('job-order.json')},
+            {'type': 'DukeDS', 'source': 'file1', 'dest': self.make_path('data/file1.txt')},
+            {'type': 'DukeDS', 'source': 'file2', 'dest': self.make_path('data/file2.txt')},
+        ]
+        self.make_stager(threads=2).stage(iter(items), self.metadata_path)
+
+        self.assertEqual(b'{"threads": 2}', self.read_path('job-order.json'))
+        self.assertEqual(b'first file', self.read_path('data/file1.txt'))
+        self.assertEqual(b'second file', self.read_path('data/file2.txt'))
+        metadata_ids = sorted(item['id'] for item in read_json(self.metadata_path)['items'])
+        self.assertEqual(['file1', 'file2'], metadata_ids)
+
+    def test_stage_skips_files_already_present(self):
+        items = [
+            {'type': 'DukeDS', 'source': 'file1', 'dest': self.make_path('file1.txt')},
+            {'type': 'DukeDS', 'source': 'file2', 'dest': self.make_path('file2.txt')},
+        ]
+        # file1 was downloaded by an earlier run that did not record it, file2 was only partially downloaded
+        with open(self.make_path('file1.txt'), 'wb') as outfile:
+            outfile.write(b'first file')
+        with open(self.make_path('file2.txt'), 'wb') as outfile:
+            outfile.write(b'second')
+
+        self.make_stager(verify_hash=True).stage(items, self.metadata_path)
+        self.assertEqual(['file2'], self.dds_connection.downloaded_file_ids)
+        self.assertEqual(b'second file', self.read_path('file2.txt'))
+
+        # files recorded by an earlier run are skipped without looking them up
+        self.dds_connection.data_service.get_file.reset_mock()
+        os.rename(self.metadata_path, self.metadata_path + '.saved')
+        stager = self.make_stager()
+        with open(self.metadata_path + '.partial', 'w') as outfile:
+            for filename, content in [('file1.txt', b'first file'), ('file2.txt', b'second file')]:
+                outfile.write(json.dumps({'dest': self.make_path(filename), 'size': len(content), 'md5': None,
+                                          'metadata': {'id': filename}}) + '\n')
+        stager.stage(items, self.metadata_path)
+        self.dds_connection.data_service.get_file.assert_not_called()
+        self.assertEqual(2, len(read_json(self.metadata_path)['items']))
+
+    def test_stage_raises_first_failure(self):
+        items = [
+            {'type': 'DukeDS', 'source': 'file1', 'dest': self.make_path('file1.txt')},
+            {'type': 'DukeDS', 'source': 'missing', 'dest': self.make_path('missing.txt')},
+        ]
+        with self.assertRaises(KeyError):
+            self.make_stager().stage(items, self.metadata_path)
+        self.assertFalse(os.path.exists(self.metadata_path))
+        self.assertTrue(os.path.exists(self.metadata_path + '.partial'))
+
+    @patch('lando.common.stagedata.requests')
+    def test_stage_url_item_with_unzip(self, mock_requests):
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
+            zip_file.writestr('workflow/main.cwl', 'cwlVersion: v1.0')
+        mock_requests.get.return_value.iter_content.return_value = [zip_buffer.getvalue()]
+        items = [
+            {'type': 'url', 'source': 'https://example.org/workflow.zip', 'dest': self.make_path('workflow.zip'),
+             'unzip_to': self.make_path('unzipped')},
+        ]
+        stager = self.make_stager(max_bytes_per_second=1024 * 1024 * 1024)
+        stager.bandwidth_limiter = Mock()
+        stager.stage(items, self.metadata_path)
+
+        mock_requests.get.assert_called_with('https://example.org/workflow.zip', stream=True, timeout=60)
+        stager.bandwidth_limiter.consume.assert_called_with('example.org', len(zip_buffer.getvalue()))
+        self.assertEqual(b'cwlVersion: v1.0', self.read_path('unzipped/workflow/main.cwl'))
+        self.assertEqual({'items': []}, read_json(self.metadata_path))
+
+    def test_stage_unknown_type(self):
+        with self.assertRaises(ValueError):
+            self.make_stager().stage([{'type': 'ftp', 'source': 'a', 'dest': 'b'}], self.metadata_path)
+
+
+class TestMain(TestCase):
+    @patch('lando.common.stagedata.InputStager')
+    @patch('lando.common.stagedata.read_stage_data_items')
+    def test_main(self, mock_read_stage_data_items, mock_input_stager):
+        main(['--threads', '8', '--max-bytes-per-second', '1000', '/config/stagedata.json', '/data/metadata.json'])
+        mock_input_stager.assert_called_with(threads=8, max_bytes_per_second=1000, verify_hash=False)
+        mock_read_stage_data_items.assert_called_with('/config/stagedata.json')
+        mock_input_stager.return_value.stage.assert_called_with(mock_read_stage_data_items.return_value,
+                                                                '/data/metadata.json')
@@ -36,3 +36,25 @@ class JobStepFailed(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+class InvalidManifestException(Exception):
+    """
+    Raised when a manifest chunk is not in a format we can read.
+    """
+    def __init__(self, message):
+        self.value = message
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class InvalidCommandFileException(Exception):
+    """
+    Raised when a command file is not in a format we can read.
+    """
+    def __init__(self, message):
+        self.value = message
+
+    def __str__(self):
+        return repr(self.value)
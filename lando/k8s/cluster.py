@@ -1,7 +1,25 @@
 from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from lando.server.scheduler import Quota, ResourceAmounts, parse_cpus, parse_memory_gb
+import threading
+import traceback
 import logging
 
 RESTART_POLICY = "Never"
+# Seconds each cache watch request stays open before it is renewed from the last resource version
+CACHE_WATCH_TIMEOUT_SECONDS = 60
+# Seconds to wait before listing again after a cache list or watch request fails
+CACHE_RETRY_SECONDS = 5
+# Status code the API server returns when a watch resource version is too old
+GONE_STATUS_CODE = 410
+# Bytes of a pod log read from the API server at a time
+LOG_CHUNK_SIZE = 64 * 1024
+# ResourceAmounts attribute, resource quota names that limit it and function to convert a quantity
+QUOTA_RESOURCES = [
+    ('cpus', ['requests.cpu', 'cpu'], parse_cpus),
+    ('memory_gb', ['requests.memory', 'memory'], parse_memory_gb),
+    ('volume_gb', ['requests.storage'], parse_memory_gb),
+]
 
 
 class AccessModes(object):
@@ -20,24 +38,336 @@ class EventTypes(object):
     MODIFIED = "MODIFIED"
     DELETED = "DELETED"
     ERROR = "ERROR"
+    BOOKMARK = "BOOKMARK"
+
+
+class CachedKinds(object):
+    JOBS = "jobs"
+    PODS = "pods"
+    PERSISTENT_VOLUME_CLAIMS = "persistent_volume_claims"
+    CONFIG_MAPS = "config_maps"
 
 
 class ItemNotFoundException(Exception):
     pass
 
 
+def matches_label_selector(labels, label_selector):
+    """
+    Determine if labels match an equality based label selector such as "bespin-job=true,bespin-job-id=1".
+    :param labels: dict: labels of an object
+    :param label_selector: str: comma separated key=value requirements, None matches everything
+    :return: bool: True when all requirements are met
+    """
+    if not label_selector:
+        return True
+    labels = labels or {}
+    for requirement in label_selector.split(','):
+        key, value = requirement.split('=', 1)
+        if labels.get(key.strip()) != value.strip():
+            return False
+    return True
+
+
+class ResourceInformer(object):
+    """
+    Keeps an in memory copy of one kind of object by listing them once and then watching for changes.
+    The watch resumes from the last resource version seen and objects are listed again when that version is too old.
+    """
+    def __init__(self, list_func, namespace, label_selector):
+        """
+        :param list_func: func(namespace, **kwargs): kubernetes list function for the kind of object
+        :param namespace: str: namespace containing the objects
+        :param label_selector: str: selects the objects to keep
+        """
+        self.list_func = list_func
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.lock = threading.Lock()
+        self.items = {}
+        # Names deleted by this process that a late watch event should not add back
+        self.deleted_names = set()
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def list(self, label_selector):
+        """
+        :param label_selector: str: selects the objects to return
+        :return: [object]: matching objects or None if the initial list has not finished
+        """
+        if not self.synced.is_set():
+            return None
+        with self.lock:
+            return [item for item in self.items.values()
+                    if matches_label_selector(item.metadata.labels, label_selector)]
+
+    def add(self, item):
+        """
+        Record an object this process created so it can be read before its watch event arrives.
+        :param item: object returned from a kubernetes create function
+        """
+        if item is None or not matches_label_selector(item.metadata.labels, self.label_selector):
+            return
+        with self.lock:
+            self.deleted_names.discard(item.metadata.name)
+            self.items[item.metadata.name] = item
+
+    def remove(self, name):
+        """
+        Record that this process deleted an object.
+        :param name: str: name of the deleted object
+        """
+        with self.lock:
+            if self.items.pop(name, None) is not None:
+                self.deleted_names.add(name)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='informer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread = None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                resource_version = self._list_items()
+                while resource_version and not self.stopped.is_set():
+                    resource_version = self._watch_items(resource_version)
+            except:  # Keep the cache running, objects are listed again below
+                logging.error("Error updating cache for {}: {}".format(self.list_func.__name__,
+                                                                       traceback.format_exc()))
+                self.stopped.wait(CACHE_RETRY_SECONDS)
+
+    def _list_items(self):
+        """
+        Replace the cached objects with the current list from the API server.
+        :return: str: resource version to start watching from
+        """
+        result = self.list_func(self.namespace, label_selector=self.label_selector)
+        with self.lock:
+            self.items = dict((item.metadata.name, item) for item in result.items)
+            self.deleted_names = set()
+        self.synced.set()
+        return result.metadata.resource_version
+
+    def _watch_items(self, resource_version):
+        """
+        Apply changes from a single watch request.
+        :param resource_version: str: version to watch from
+        :return: str: version to continue watching from or None when objects must be listed again
+        """
+        w = watch.Watch()
+        try:
+            for event in w.stream(self.list_func, self.namespace, label_selector=self.label_selector,
+                                  resource_version=resource_version, timeout_seconds=CACHE_WATCH_TIMEOUT_SECONDS):
+                if self.stopped.is_set():
+                    w.stop()
+                    break
+                if event['type'] == EventTypes.ERROR:
+                    # Typically 410 Gone when resource_version is older than the API server keeps
+                    logging.info("Cache watch for {} ended: {}".format(self.list_func.__name__, event['raw_object']))
+                    return None
+                self._apply_event(event['type'], event['object'])
+                resource_version = event['object'].metadata.resource_version
+        except ApiException as ex:
+            if ex.status == GONE_STATUS_CODE:
+                return None
+            raise
+        return resource_version
+
+    def _apply_event(self, event_type, item):
+        name = item.metadata.name
+        with self.lock:
+            if event_type == EventTypes.DELETED:
+                self.items.pop(name, None)
+                self.deleted_names.discard(name)
+            elif name not in self.deleted_names:
+                self.items[name] = item
+
+
+class ClusterObjectCache(object):
+    """
+    In memory copies of the jobs, pods, persistent volume claims and config maps that match a label selector.
+    """
+    def __init__(self, cluster_api, label_selector):
+        """
+        :param cluster_api: ClusterApi: api used to list and watch objects
+        :param label_selector: str: selects the objects to keep
+        """
+        namespace = cluster_api.namespace
+        self.informers = {
+            CachedKinds.JOBS: ResourceInformer(cluster_api.batch.list_namespaced_job, namespace, label_selector),
+            CachedKinds.PODS: ResourceInformer(cluster_api.core.list_namespaced_pod, namespace, label_selector),
+            CachedKinds.PERSISTENT_VOLUME_CLAIMS: ResourceInformer(
+                cluster_api.core.list_namespaced_persistent_volume_claim, namespace, label_selector),
+            CachedKinds.CONFIG_MAPS: ResourceInformer(cluster_api.core.list_namespaced_config_map, namespace,
+                                                      label_selector),
+        }
+
+    def list(self, kind, label_selector):
+        return self.informers[kind].list(label_selector)
+
+    def add(self, kind, item):
+        self.informers[kind].add(item)
+
+    def remove(self, kind, name):
+        self.informers[kind].remove(name)
+
+    def start(self):
+        for informer in self.informers.values():
+            informer.start()
+
+    def stop(self):
+        for informer in self.informers.values():
+            informer.stop()
+
+
+class PodLogs(object):
+    """
+    End of a pod's log along with how much of the log that was read had to be dropped.
+    """
+    def __init__(self, text, received_bytes, truncated_bytes, tail_lines=None):
+        """
+        :param text: str: end of the log
+        :param received_bytes: int: size of the log returned by the API server
+        :param truncated_bytes: int: bytes dropped from the start of the log returned by the API server
+        :param tail_lines: int: number of lines requested from the end of the log, None for the whole log
+        """
+        self.text = text
+        self.received_bytes = received_bytes
+        self.truncated_bytes = truncated_bytes
+        self.tail_lines = tail_lines
+
+    def is_truncated(self):
+        """
+        :return: bool: True when the text may not contain the whole log
+        """
+        return self.truncated_bytes > 0 or \
+            (self.tail_lines is not None and self.text.count('\n') >= self.tail_lines)
+
+    def message(self):
+        """
+        :return: str: text prefixed with a note saying how it was truncated
+        """
+        if self.truncated_bytes:
+            return "Showing the last {} of {} bytes of the log.\n{}".format(
+                self.received_bytes - self.truncated_bytes, self.received_bytes, self.text)
+        if self.is_truncated():
+            return "Showing the last {} lines of the log.\n{}".format(self.tail_lines, self.text)
+        return self.text
+
+
+def read_stream_tail(stream, max_bytes, chunk_size=LOG_CHUNK_SIZE):
+    """
+    Read a byte stream keeping at most max_bytes from the end of it.
+    :param stream: urllib3.HTTPResponse: stream to read
+    :param max_bytes: int: maximum number of bytes to keep
+    :param chunk_size: int: bytes to read at a time
+    :return: (bytes, int): end of the stream and number of bytes read
+    """
+    tail = bytearray()
+    received_bytes = 0
+    for chunk in stream.stream(chunk_size):
+        received_bytes += len(chunk)
+        tail.extend(chunk)
+        if len(tail) > max_bytes:
+            del tail[:len(tail) - max_bytes]
+    return bytes(tail), received_bytes
+
+
+def decode_log_tail(data, truncated):
+    """
+    Decode the end of a utf-8 log, dropping a character that was cut in half by truncation.
+    :param data: bytes: end of the log
+    :param truncated: bool: True when the start of data was dropped
+    :return: str
+    """
+    if truncated:
+        # Skip continuation bytes (10xxxxxx) left over from a multi-byte character
+        start = 0
+        while start < len(data) and start < 3 and (data[start] & 0xC0) == 0x80:
+            start += 1
+        data = data[start:]
+    return data.decode("utf-8", errors="replace")
+
+
 class ClusterApi(object):
+    # One ApiClient(and connection pool) per cluster and token shared by all ClusterApi objects in the process
+    _shared_api_clients = {}
+    _shared_api_clients_lock = threading.Lock()
+
     def __init__(self, host, token, namespace, verify_ssl=True, ssl_ca_cert=None):
-        configuration = client.Configuration()
-        configuration.host = host
-        configuration.api_key = {"authorization": "Bearer " + token}
-        configuration.verify_ssl = verify_ssl
-        if ssl_ca_cert:
-            configuration.ssl_ca_cert = ssl_ca_cert
-        self.api_client = client.ApiClient(configuration)
+        self.api_client = self.get_shared_api_client(host, token, verify_ssl, ssl_ca_cert)
         self.core = client.CoreV1Api(self.api_client)
         self.batch = client.BatchV1Api(self.api_client)
         self.namespace = namespace
+        # Lists are read from memory once start_cache has been called
+        self.cache = None
+
+    @classmethod
+    def get_shared_api_client(cls, host, token, verify_ssl, ssl_ca_cert):
+        """
+        Return the ApiClient for these settings creating it the first time they are used.
+        :return: client.ApiClient
+        """
+        key = (host, token, verify_ssl, ssl_ca_cert)
+        with cls._shared_api_clients_lock:
+            api_client = cls._shared_api_clients.get(key)
+            if not api_client:
+                configuration = client.Configuration()
+                configuration.host = host
+                configuration.api_key = {"authorization": "Bearer " + token}
+                configuration.verify_ssl = verify_ssl
+                if ssl_ca_cert:
+                    configuration.ssl_ca_cert = ssl_ca_cert
+                api_client = client.ApiClient(configuration)
+                cls._shared_api_clients[key] = api_client
+            return api_client
+
+    @classmethod
+    def clear_shared(cls):
+        with cls._shared_api_clients_lock:
+            cls._shared_api_clients = {}
+
+    def start_cache(self, label_selector):
+        """
+        Keep in memory copies of jobs, pods, persistent volume claims and config maps matching label_selector.
+        The list_* methods read from memory for these objects once the cache has loaded.
+        :param label_selector: str: selects the objects to keep
+        """
+        self.cache = ClusterObjectCache(self, label_selector)
+        self.cache.start()
+
+    def stop_cache(self):
+        if self.cache:
+            self.cache.stop()
+            self.cache = None
+
+    def _cache_add(self, kind, item):
+        if self.cache:
+            self.cache.add(kind, item)
+        return item
+
+    def _cache_remove(self, kind, name):
+        if self.cache:
+            self.cache.remove(kind, name)
+
+    def _cache_remove_matching(self, kind, label_selector):
+        if self.cache:
+            for item in self.cache.list(kind, label_selector) or []:
+                self.cache.remove(kind, item.metadata.name)
+
+    def _list(self, kind, list_func, label_selector):
+        if self.cache:
+            items = self.cache.list(kind, label_selector)
+            if items is not None:
+                return items
+        return list_func(self.namespace, label_selector=label_selector).items
 
     def create_persistent_volume_claim(self, name, storage_size_in_g, storage_class_name,
                                        access_modes=[AccessModes.READ_WRITE_MANY],
@@ -49,10 +379,22 @@ class ClusterApi(object):
         pvc.spec = client.V1PersistentVolumeClaimSpec(access_modes=access_modes,
                                                       resources=resources,
                                                       storage_class_name=storage_class_name)
-        return self.core.create_namespaced_persistent_volume_claim(self.namespace, pvc)
+        return self._cache_add(CachedKinds.PERSISTENT_VOLUME_CLAIMS,
+                               self.core.create_namespaced_persistent_volume_claim(self.namespace, pvc))
 
     def delete_persistent_volume_claim(self, name):
         self.core.delete_namespaced_persistent_volume_claim(name, self.namespace, client.V1DeleteOptions())
+        self._cache_remove(CachedKinds.PERSISTENT_VOLUME_CLAIMS, name)
+
+    def delete_persistent_volume_claims(self, label_selector):
+        """
+        Delete all persistent volume claims that match label_selector with a single request.
+        :param label_selector: str: selects the volume claims to delete
+        :return: int: number of API requests made
+        """
+        self.core.delete_collection_namespaced_persistent_volume_claim(self.namespace, label_selector=label_selector)
+        self._cache_remove_matching(CachedKinds.PERSISTENT_VOLUME_CLAIMS, label_selector)
+        return 1
 
     def create_secret(self, name, string_value_dict, labels={}):
         body = client.V1Secret(string_data=string_value_dict,
@@ -66,63 +408,206 @@ class ClusterApi(object):
         body = client.V1Job(
             metadata=client.V1ObjectMeta(name=name, labels=labels),
             spec=batch_job_spec.create())
-        return self.batch.create_namespaced_job(self.namespace, body)
+        return self._cache_add(CachedKinds.JOBS, self.batch.create_namespaced_job(self.namespace, body))
 
-    def wait_for_job_events(self, callback, label_selector=None):
+    def wait_for_job_events(self, callback, label_selector=None, resource_version=None, timeout_seconds=None):
         """
         Run callback for job events that match the specified label selector and event types.
-        This function will loop forever unless an exception is raised by the callback.
+        Without timeout_seconds this function will loop forever unless an exception is raised by the callback.
         :param callback: function: receives single parameter of the event: dict with 'type' and 'object' keys
         :param label_selector: label to filter by
+        :param resource_version: str: only send events after this version, when None existing jobs are sent as ADDED
+        :param timeout_seconds: int: seconds before the watch request ends and this function returns
         """
+        kwargs = {'label_selector': label_selector}
+        if resource_version:
+            kwargs['resource_version'] = resource_version
+        if timeout_seconds:
+            kwargs['timeout_seconds'] = timeout_seconds
         w = watch.Watch()
-        for event in w.stream(self.batch.list_namespaced_job, self.namespace, label_selector=label_selector):
+        for event in w.stream(self.batch.list_namespaced_job, self.namespace, **kwargs):
             callback(event)
 
+    def wait_for_pod_events(self, callback, label_selector=None, timeout_seconds=None):
+        """
+        Run callback for pod events that match the specified label selector.
+        Without timeout_seconds this function will loop forever unless an exception is raised by the callback.
+        :param callback: function: receives single parameter of the event: dict with 'type' and 'object' keys
+        :param label_selector: label to filter by
+        :param timeout_seconds: int: seconds before the watch request ends and this function returns
+        """
+        kwargs = {'label_selector': label_selector}
+        if timeout_seconds:
+            kwargs['timeout_seconds'] = timeout_seconds
+        w = watch.Watch()
+        for event in w.stream(self.core.list_namespaced_pod, self.namespace, **kwargs):
+            callback(event)
+
+    def list_jobs_and_resource_version(self, label_selector):
+        """
+        List jobs from the API server along with the version a watch should start from to see later changes.
+        :param label_selector: str: selects the jobs to return
+        :return: ([V1Job], str): jobs and resource version of the list
+        """
+        result = self.batch.list_namespaced_job(self.namespace, label_selector=label_selector)
+        return result.items, result.metadata.resource_version
+
     def delete_job(self, name, propagation_policy='Background'):
         body = client.V1DeleteOptions(propagation_policy=propagation_policy)
         self.batch.delete_namespaced_job(name, self.namespace, body=body)
+        self._cache_remove(CachedKinds.JOBS, name)
 
-    def create_config_map(self, name, data, labels={}):
+    def delete_jobs(self, label_selector):
+        """
+        Delete all jobs that match label_selector and their pods.
+        A collection delete cannot set a propagation policy and would leave the pods behind,
+        so pods with the same labels are deleted with a second request.
+        :param label_selector: str: selects the jobs and pods to delete
+        :return: int: number of API requests made
+        """
+        self.batch.delete_collection_namespaced_job(self.namespace, label_selector=label_selector)
+        self._cache_remove_matching(CachedKinds.JOBS, label_selector)
+        self.core.delete_collection_namespaced_pod(self.namespace, label_selector=label_selector)
+        self._cache_remove_matching(CachedKinds.PODS, label_selector)
+        return 2
+
+    def create_config_map(self, name, data, labels={}, binary_data=None):
+        """
+        :param binary_data: dict: optional base64 encoded values stored as binaryData
+        """
         body = client.V1ConfigMap(
             metadata=client.V1ObjectMeta(name=name, labels=labels),
-            data=data
+            data=data,
+            binary_data=binary_data
         )
-        return self.core.create_namespaced_config_map(self.namespace, body)
+        return self._cache_add(CachedKinds.CONFIG_MAPS, self.core.create_namespaced_config_map(self.namespace, body))
 
     def delete_config_map(self, name):
         self.core.delete_namespaced_config_map(name, self.namespace, body=client.V1DeleteOptions())
+        self._cache_remove(CachedKinds.CONFIG_MAPS, name)
 
-    def read_pod_logs(self, name):
+    def delete_config_maps(self, label_selector):
+        """
+        Delete all config maps that match label_selector with a single request.
+        :param label_selector: str: selects the config maps to delete
+        :return: int: number of API requests made
+        """
+        self.core.delete_collection_namespaced_config_map(self.namespace, label_selector=label_selector)
+        self._cache_remove_matching(CachedKinds.CONFIG_MAPS, label_selector)
+        return 1
+
+    def read_pod_logs(self, name, request_timeout=None):
         # The read_namespaced_pod_log method by default performs some formatting on the data
         # This can cause double quotes to change to single quotes and other unexpected formatting.
         # So instead we are using the _preload_content flag and calling read() based on the following comment:
         # https://github.com/kubernetes/kubernetes/issues/37881#issuecomment-264366664
         # This changes the returned value so we must add an additional call to read()
-        stream = self.core.read_namespaced_pod_log(name, self.namespace, _preload_content=False)
+        kwargs = {}
+        if request_timeout:
+            kwargs['_request_timeout'] = request_timeout
+        stream = self.core.read_namespaced_pod_log(name, self.namespace, _preload_content=False, **kwargs)
         return stream.read().decode("utf-8")
 
-    def list_pods(self, label_selector):
-        return self.core.list_namespaced_pod(self.namespace, label_selector=label_selector).items
+    def read_pod_log_tail(self, name, tail_lines=None, max_bytes=None, request_timeout=None, container=None):
+        """
+        Read the end of a pod's log without holding the whole log in memory.
+        The API server only sends the last tail_lines lines and at most max_bytes of them are kept.
+        :param name: str: name of the pod
+        :param tail_lines: int: number of lines to read from the end of the log, None reads every line
+        :param max_bytes: int: maximum bytes of the log to keep, None keeps everything read
+        :param request_timeout: float: seconds to wait for the logs, None waits until they are read
+        :param container: str: container to read logs for, required when the pod has more than one
+        :return: PodLogs
+        """
+        kwargs = {}
+        if container:
+            kwargs['container'] = container
+        if tail_lines:
+            kwargs['tail_lines'] = tail_lines
+        if request_timeout:
+            kwargs['_request_timeout'] = request_timeout
+        # _preload_content=False for the reason given in read_pod_logs, it also lets us read the log in chunks
+        stream = self.core.read_namespaced_pod_log(name, self.namespace, _preload_content=False, **kwargs)
+        try:
+            if max_bytes:
+                data, received_bytes = read_stream_tail(stream, max_bytes)
+            else:
+                data = stream.read()
+                received_bytes = len(data)
+        finally:
+            stream.release_conn()
+        truncated_bytes = received_bytes - len(data)
+        return PodLogs(decode_log_tail(data, truncated_bytes > 0), received_bytes, truncated_bytes, tail_lines)
+
+    def list_pods(self, label_selector, cached=True):
+        """
+        :param label_selector: str: selects the pods to return
+        :param cached: bool: read from the cache when it has been started, False always asks the API server
+        :return: [V1Pod]
+        """
+        if not cached:
+            return self.core.list_namespaced_pod(self.namespace, label_selector=label_selector).items
+        return self._list(CachedKinds.PODS, self.core.list_namespaced_pod, label_selector)
 
     def list_persistent_volume_claims(self, label_selector=None):
-        return self.core.list_namespaced_persistent_volume_claim(self.namespace, label_selector=label_selector).items
+        return self._list(CachedKinds.PERSISTENT_VOLUME_CLAIMS, self.core.list_namespaced_persistent_volume_claim,
+                          label_selector)
 
     def list_jobs(self, label_selector):
-        return self.batch.list_namespaced_job(self.namespace, label_selector=label_selector).items
+        return self._list(CachedKinds.JOBS, self.batch.list_namespaced_job, label_selector)
 
     def list_config_maps(self, label_selector):
-        return self.core.list_namespaced_config_map(self.namespace, label_selector=label_selector).items
+        return self._list(CachedKinds.CONFIG_MAPS, self.core.list_namespaced_config_map, label_selector)
 
-    def read_job_logs(self, job_name):
+    def get_quota(self):
+        """
+        Read the cpu, memory and storage requests allowed by resource quotas in the namespace and the amounts used.
+        When several quotas limit the same resource the one with the least remaining is used.
+        :return: Quota: limits are None for resources without a quota
+        """
+        limit = ResourceAmounts(cpus=None, memory_gb=None, volume_gb=None)
+        used = ResourceAmounts()
+        for resource_quota in self.core.list_namespaced_resource_quota(self.namespace).items:
+            if not resource_quota.status:
+                continue
+            quota_hard = resource_quota.status.hard or {}
+            quota_used = resource_quota.status.used or {}
+            for attribute, names, parse_func in QUOTA_RESOURCES:
+                for name in names:
+                    if name in quota_hard:
+                        hard_value = parse_func(quota_hard[name])
+                        used_value = parse_func(quota_used.get(name, '0'))
+                        current_limit = getattr(limit, attribute)
+                        if current_limit is None or \
+                                hard_value - used_value < current_limit - getattr(used, attribute):
+                            setattr(limit, attribute, hard_value)
+                            setattr(used, attribute, used_value)
+        return Quota(limit, used)
+
+    def read_job_logs(self, job_name, request_timeout=None):
         """
         Reads logs from the most recent pod created by the specified job.
         Raises ItemNotFoundException when no pod is found with the job-name label selector.
         :param job_name: str: name of the job we want to read logs for
+        :param request_timeout: float: seconds to wait for the logs, None waits until they are read
         :return: str: logs
         """
         pod = self.get_most_recent_pod_for_job(job_name)
-        return self.read_pod_logs(pod.metadata.name)
+        return self.read_pod_logs(pod.metadata.name, request_timeout=request_timeout)
+
+    def read_job_log_tail(self, job_name, tail_lines=None, max_bytes=None, request_timeout=None):
+        """
+        Reads the end of the logs from the most recent pod created by the specified job.
+        Raises ItemNotFoundException when no pod is found with the job-name label selector.
+        :param job_name: str: name of the job we want to read logs for
+        :param tail_lines: int: number of lines to read from the end of the log, None reads every line
+        :param max_bytes: int: maximum bytes of the log to keep, None keeps everything read
+        :param request_timeout: float: seconds to wait for the logs, None waits until they are read
+        :return: PodLogs
+        """
+        pod = self.get_most_recent_pod_for_job(job_name)
+        return self.read_pod_log_tail(pod.metadata.name, tail_lines=tail_lines, max_bytes=max_bytes,
+                                      request_timeout=request_timeout)
 
     def get_most_recent_pod_for_job(self, job_name):
         """
@@ -280,14 +765,40 @@ class ConfigMapVolume(VolumeBase):
                                               items=items)
 
 
+class ProjectedConfigMapVolume(VolumeBase):
+    def __init__(self, name, mount_path, config_map_items):
+        """
+        Mounts keys from several config maps into a single directory.
+        :param config_map_items: [(str, str, str)]: config map name, key and path of each file in the directory
+        """
+        super(ProjectedConfigMapVolume, self).__init__(name, mount_path)
+        self.config_map_items = config_map_items
+
+    def create_volume(self):
+        sources = []
+        for config_map_name, source_key, source_path in self.config_map_items:
+            items = [client.V1KeyToPath(key=source_key, path=source_path)]
+            sources.append(client.V1VolumeProjection(
+                config_map=client.V1ConfigMapProjection(name=config_map_name, items=items)))
+        return client.V1Volume(
+            name=self.name,
+            projected=client.V1ProjectedVolumeSource(sources=sources))
+
+
 class EmptyDirVolume(VolumeBase):
-    def __init__(self, name, mount_path):
+    def __init__(self, name, mount_path, medium=None, size_limit=None):
+        """
+        :param medium: str: "Memory" to keep the volume in RAM, None uses the node's disk
+        :param size_limit: str: maximum size of the volume such as "10Gi", None has no limit
+        """
         super(EmptyDirVolume, self).__init__(name, mount_path)
+        self.medium = medium
+        self.size_limit = size_limit
 
     def create_volume(self):
         return client.V1Volume(
                 name=self.name,
-                empty_dir=client.V1EmptyDirVolumeSource())
+                empty_dir=client.V1EmptyDirVolumeSource(medium=self.medium, size_limit=self.size_limit))
 
 
 class BatchJobSpec(object):
@@ -320,3 +831,30 @@ class BatchJobSpec(object):
 
     def create_volumes(self):
         return self.container.create_volumes()
+
+
+class PipelineJobSpec(BatchJobSpec):
+    """
+    Job whose pod runs several steps in order: each init container runs to completion before the next one starts
+    and the main container runs last. Volumes used by more than one container are shared.
+    """
+    def __init__(self, name, init_containers, container, service_account_name=None, labels={}):
+        super(PipelineJobSpec, self).__init__(name, container, service_account_name=service_account_name,
+                                              labels=labels)
+        self.init_containers = init_containers
+
+    def create_pod_spec(self):
+        pod_spec = super(PipelineJobSpec, self).create_pod_spec()
+        pod_spec.init_containers = [init_container.create() for init_container in self.init_containers]
+        return pod_spec
+
+    def create_volumes(self):
+        volumes = []
+        volume_names = set()
+        for container in self.init_containers + [self.container]:
+            for volume in container.volumes:
+                # The first container to use a volume decides how it is mounted
+                if volume.name not in volume_names:
+                    volume_names.add(volume.name)
+                    volumes.append(volume.create_volume())
+        return volumes
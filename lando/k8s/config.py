@@ -1,7 +1,11 @@
 import yaml
 import logging
 from lando.exceptions import get_or_raise_config_exception, InvalidConfigException
-from lando.server.config import WorkQueue, BespinApiSettings
+from lando.server.config import WorkQueue, BespinApiSettings, AdmissionSchedulerSettings
+from lando.common.manifests import DEFAULT_MAX_CHUNK_BYTES
+
+# Largest manifest chunk that still fits in a 1MiB config map once it is base64 encoded
+MAX_MANIFEST_CHUNK_BYTES = 768 * 1024
 
 
 def create_server_config(filename):
@@ -39,6 +43,30 @@ class ServerConfig(object):
         self.storage_class_name = data.get('storage_class_name', None)
         # Controls the amount of storage reserved for storing the workflow, job order, downloaded file metadata, etc.
         self.base_stage_data_volume_size_in_g = data.get('base_stage_data_volume_size_in_g', 1)
+        # Number of threads used to handle messages, messages for the same job are always handled in order
+        self.message_handler_threads = data.get('message_handler_threads', 1)
+        # File the watcher saves its position in the job event stream to so a restart only replays missed events
+        self.watcher_checkpoint_filename = data.get('watcher_checkpoint_filename', None)
+        # Number of threads the watcher uses to read the logs of failed jobs
+        self.watcher_log_threads = data.get('watcher_log_threads', 4)
+        # Seconds a failed job waits for its logs before the error is sent without them
+        self.watcher_log_timeout_seconds = data.get('watcher_log_timeout_seconds', 60)
+        # Number of lines read from the end of a failed job's log to send as its error message
+        self.watcher_log_tail_lines = data.get('watcher_log_tail_lines', 1000)
+        # Maximum bytes of a failed job's log kept in memory and sent as its error message
+        self.watcher_log_max_bytes = data.get('watcher_log_max_bytes', 1024 * 1024)
+        # Run stage data, run workflow, organize output and save output in one pod instead of a job for each step
+        self.fused_pipeline = data.get('fused_pipeline', False)
+        # Keep in memory copies of bespin jobs, pods, volume claims and config maps instead of listing them each time
+        self.cache_cluster_objects = data.get('cache_cluster_objects', True)
+        # Queues jobs until the namespace resource quota has room for them when present
+        self.admission_scheduler_settings = None
+        if 'admission_scheduler' in data:
+            self.admission_scheduler_settings = AdmissionSchedulerSettings(data['admission_scheduler'] or {})
+        # Stage data items are written as compressed chunks across several config maps when present
+        self.stage_data_manifest_settings = None
+        if 'stage_data_manifest' in data:
+            self.stage_data_manifest_settings = StageDataManifestSettings(data['stage_data_manifest'] or {})
 
 
 class ClusterApiSettings(object):
@@ -62,6 +90,12 @@ class RunWorkflowSettings(object):
             self.system_data_volume = SystemDataVolume(
                 get_or_raise_config_exception(data, 'system_data_volume')
             )
+        # Volumes for the workflow's intermediate files, when None they are kept on the output data volume
+        self.scratch_volume = None
+        if 'scratch_volume' in data:
+            self.scratch_volume = ScratchVolume(
+                get_or_raise_config_exception(data, 'scratch_volume')
+            )
 
 
 class SystemDataVolume(object):
@@ -70,6 +104,35 @@ class SystemDataVolume(object):
         self.mount_path = get_or_raise_config_exception(data, 'mount_path')
 
 
+class ScratchVolumeTypes(object):
+    EMPTY_DIR = "empty_dir"
+    PERSISTENT_VOLUME_CLAIM = "persistent_volume_claim"
+
+
+class ScratchVolume(object):
+    def __init__(self, data):
+        self.volume_type = data.get('type', ScratchVolumeTypes.EMPTY_DIR)
+        if self.volume_type not in [ScratchVolumeTypes.EMPTY_DIR, ScratchVolumeTypes.PERSISTENT_VOLUME_CLAIM]:
+            raise InvalidConfigException("Invalid scratch_volume type {}.".format(self.volume_type))
+        # Set to "Memory" to keep an empty_dir scratch volume in RAM
+        self.medium = data.get('medium', None)
+        # Size of each persistent volume claim or maximum size of each empty_dir
+        self.size_in_g = data.get('size_in_g', None)
+        if self.volume_type == ScratchVolumeTypes.PERSISTENT_VOLUME_CLAIM:
+            self.size_in_g = get_or_raise_config_exception(data, 'size_in_g')
+        # Storage class for persistent volume claims, typically one that provides node local storage
+        self.storage_class_name = data.get('storage_class_name', None)
+
+
+class StageDataManifestSettings(object):
+    def __init__(self, data):
+        # Maximum compressed size of the chunk stored in each config map, kubernetes limits config maps to 1MiB
+        self.max_chunk_bytes = data.get('max_chunk_bytes', DEFAULT_MAX_CHUNK_BYTES)
+        if self.max_chunk_bytes > MAX_MANIFEST_CHUNK_BYTES:
+            raise InvalidConfigException("stage_data_manifest max_chunk_bytes must not be larger than {}.".format(
+                MAX_MANIFEST_CHUNK_BYTES))
+
+
 class DataStoreSettings(object):
     def __init__(self, data):
         self.secret_name = get_or_raise_config_exception(data, 'secret_name')
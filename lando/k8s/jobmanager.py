@@ -1,8 +1,13 @@
-from lando.k8s.cluster import BatchJobSpec, SecretVolume, PersistentClaimVolume, \
-    ConfigMapVolume, Container, FieldRefEnvVar
+from lando.k8s.cluster import BatchJobSpec, PipelineJobSpec, SecretVolume, PersistentClaimVolume, \
+    ConfigMapVolume, ProjectedConfigMapVolume, EmptyDirVolume, Container, FieldRefEnvVar, AccessModes
+from lando.k8s.config import ScratchVolumeTypes
 from lando.common.commands import StageDataCommand, OrganizeOutputCommand, SaveOutputCommand
+from lando.common.manifests import write_manifest_chunks, manifest_chunk_filename
 from lando.common.names import BaseNames, Paths
+from concurrent.futures import ThreadPoolExecutor
+import base64
 import json
+import logging
 import os
 
 
@@ -22,6 +27,16 @@ class JobStepTypes(object):
     ORGANIZE_OUTPUT = "organize_output"
     SAVE_OUTPUT = "save_output"
     RECORD_OUTPUT_PROJECT = "record_output_project"
+    PIPELINE = "pipeline"
+
+
+# Steps run by a pipeline job in the order they run and the name of the container that runs each one
+PIPELINE_STEP_CONTAINER_NAMES = [
+    (JobStepTypes.STAGE_DATA, "stage-data"),
+    (JobStepTypes.RUN_WORKFLOW, "run-workflow"),
+    (JobStepTypes.ORGANIZE_OUTPUT, "organize-output"),
+    (JobStepTypes.SAVE_OUTPUT, "save-output"),
+]
 
 
 class JobManager(object):
@@ -45,6 +60,9 @@ class JobManager(object):
         labels[JobLabels.STEP_TYPE] = job_step_type
         return labels
 
+    def make_job_step_label_selector(self, job_step_type):
+        return '{},{}={}'.format(self.label_selector, JobLabels.STEP_TYPE, job_step_type)
+
     def create_job_data_persistent_volume(self, stage_data_size_in_g):
         self.cluster_api.create_persistent_volume_claim(
             self.names.job_data,
@@ -65,39 +83,51 @@ class JobManager(object):
         self.create_job_data_persistent_volume(stage_data_size_in_g)
 
     def create_stage_data_job(self, input_files):
+        container = self._create_stage_data_container(input_files)
+        labels = self.make_job_labels(JobStepTypes.STAGE_DATA)
+        job_spec = BatchJobSpec(self.names.stage_data,
+                                container=container,
+                                labels=labels)
+        return self.cluster_api.create_job(self.names.stage_data, job_spec, labels=labels)
+
+    def _create_stage_data_container(self, input_files):
         stage_data_config = StageDataConfig(self.job, self.config, self.paths)
-        self._create_stage_data_config_map(name=self.names.stage_data,
-                                           filename=stage_data_config.filename,
-                                           workflow=self.job.workflow,
-                                           input_files=input_files)
+        if self.config.stage_data_manifest_settings:
+            config_volume = self._create_stage_data_manifest_config_maps(
+                mount_path=stage_data_config.manifest_directory,
+                workflow=self.job.workflow,
+                input_files=input_files)
+            command_file_path = stage_data_config.manifest_directory
+        else:
+            self._create_stage_data_config_map(name=self.names.stage_data,
+                                               filename=stage_data_config.filename,
+                                               workflow=self.job.workflow,
+                                               input_files=input_files)
+            config_volume = ConfigMapVolume(self.names.stage_data,
+                                            mount_path=self.paths.CONFIG_DIR,
+                                            config_map_name=self.names.stage_data,
+                                            source_key=stage_data_config.filename,
+                                            source_path=stage_data_config.filename)
+            command_file_path = stage_data_config.path
         volumes = [
             PersistentClaimVolume(self.names.job_data,
                                   mount_path=self.paths.JOB_DATA,
                                   volume_claim_name=self.names.job_data,
                                   read_only=False),
-            ConfigMapVolume(self.names.stage_data,
-                            mount_path=self.paths.CONFIG_DIR,
-                            config_map_name=self.names.stage_data,
-                            source_key=stage_data_config.filename,
-                            source_path=stage_data_config.filename),
+            config_volume,
             SecretVolume(self.names.data_store_secret,
                          mount_path=stage_data_config.data_store_secret_path,
                          secret_name=stage_data_config.data_store_secret_name),
         ]
-        container = Container(
+        return Container(
             name=self.names.stage_data,
             image_name=stage_data_config.image_name,
             command=stage_data_config.command,
-            args=[stage_data_config.path, self.names.workflow_input_files_metadata_path],
+            args=[command_file_path, self.names.workflow_input_files_metadata_path],
             env_dict=stage_data_config.env_dict,
             requested_cpu=stage_data_config.requested_cpu,
             requested_memory=stage_data_config.requested_memory,
             volumes=volumes)
-        labels = self.make_job_labels(JobStepTypes.STAGE_DATA)
-        job_spec = BatchJobSpec(self.names.stage_data,
-                                container=container,
-                                labels=labels)
-        return self.cluster_api.create_job(self.names.stage_data, job_spec, labels=labels)
 
     def _create_stage_data_config_map(self, name, filename, workflow, input_files):
         stage_data_command = StageDataCommand(workflow, self.names, self.paths)
@@ -107,16 +137,102 @@ class JobManager(object):
         }
         self.cluster_api.create_config_map(name=name, data=payload, labels=self.default_metadata_labels)
 
+    def _create_stage_data_manifest_config_maps(self, mount_path, workflow, input_files):
+        """
+        Store the stage data items as compressed manifest chunks with one config map per chunk.
+        :return: ProjectedConfigMapVolume: volume that mounts every chunk into mount_path
+        """
+        stage_data_command = StageDataCommand(workflow, self.names, self.paths)
+        items = stage_data_command.command_file_items(input_files)
+        max_chunk_bytes = self.config.stage_data_manifest_settings.max_chunk_bytes
+        labels = self.make_job_labels(JobStepTypes.STAGE_DATA)
+        config_map_items = []
+        for index, chunk in enumerate(write_manifest_chunks(items, max_chunk_bytes)):
+            name = '{}-{}'.format(self.names.stage_data_manifest, index)
+            filename = manifest_chunk_filename(index)
+            binary_data = {
+                filename: base64.b64encode(chunk).decode('ascii')
+            }
+            self.cluster_api.create_config_map(name=name, data={}, binary_data=binary_data, labels=labels)
+            config_map_items.append((name, filename, filename))
+        return ProjectedConfigMapVolume(self.names.stage_data, mount_path=mount_path,
+                                        config_map_items=config_map_items)
+
+    def cleanup_stage_data_config_maps(self):
+        if self.config.stage_data_manifest_settings:
+            self.cluster_api.delete_config_maps(self.make_job_step_label_selector(JobStepTypes.STAGE_DATA))
+        else:
+            self.cluster_api.delete_config_map(self.names.stage_data)
+
     def cleanup_stage_data_job(self):
         self.cluster_api.delete_job(self.names.stage_data)
-        self.cluster_api.delete_config_map(self.names.stage_data)
+        self.cleanup_stage_data_config_maps()
 
     def create_run_workflow_persistent_volumes(self):
         self.create_output_data_persistent_volume()
+        self.create_scratch_persistent_volumes()
+
+    def _scratch_volume_names_and_paths(self):
+        return [
+            (self.names.tmpout, self.paths.SCRATCH_TMPOUT_DATA),
+            (self.names.tmp, self.paths.SCRATCH_TMP_DATA),
+        ]
+
+    def _uses_scratch_persistent_volumes(self):
+        scratch_volume = self.config.run_workflow_settings.scratch_volume
+        return scratch_volume and scratch_volume.volume_type == ScratchVolumeTypes.PERSISTENT_VOLUME_CLAIM
+
+    def create_scratch_persistent_volumes(self):
+        """
+        Create volume claims for the workflow's intermediate files when scratch_volume uses persistent volume claims.
+        They are only mounted by one pod at a time so node local storage classes can be used.
+        """
+        if self._uses_scratch_persistent_volumes():
+            scratch_volume = self.config.run_workflow_settings.scratch_volume
+            for name, mount_path in self._scratch_volume_names_and_paths():
+                self.cluster_api.create_persistent_volume_claim(
+                    name,
+                    storage_size_in_g=scratch_volume.size_in_g,
+                    storage_class_name=scratch_volume.storage_class_name,
+                    access_modes=[AccessModes.READ_WRITE_ONCE],
+                    labels=self.default_metadata_labels,
+                )
+
+    def cleanup_scratch_persistent_volumes(self):
+        if self._uses_scratch_persistent_volumes():
+            for name, mount_path in self._scratch_volume_names_and_paths():
+                self.cluster_api.delete_persistent_volume_claim(name)
+
+    def _create_scratch_volumes(self, scratch_volume):
+        volumes = []
+        for name, mount_path in self._scratch_volume_names_and_paths():
+            if scratch_volume.volume_type == ScratchVolumeTypes.PERSISTENT_VOLUME_CLAIM:
+                volumes.append(PersistentClaimVolume(name,
+                                                     mount_path=mount_path,
+                                                     volume_claim_name=name,
+                                                     read_only=False))
+            else:
+                size_limit = None
+                if scratch_volume.size_in_g:
+                    size_limit = "{}Gi".format(scratch_volume.size_in_g)
+                volumes.append(EmptyDirVolume(name,
+                                              mount_path=mount_path,
+                                              medium=scratch_volume.medium,
+                                              size_limit=size_limit))
+        return volumes
 
     def create_run_workflow_job(self):
+        container = self._create_run_workflow_container()
+        labels = self.make_job_labels(JobStepTypes.RUN_WORKFLOW)
+        job_spec = BatchJobSpec(self.names.run_workflow,
+                                container=container,
+                                labels=labels)
+        return self.cluster_api.create_job(self.names.run_workflow, job_spec, labels=labels)
+
+    def _create_run_workflow_container(self):
         run_workflow_config = RunWorkflowConfig(self.job, self.config)
         system_data_volume = run_workflow_config.system_data_volume
+        scratch_volume = run_workflow_config.scratch_volume
         volumes = [
             PersistentClaimVolume(self.names.job_data,
                                   mount_path=self.paths.JOB_DATA,
@@ -133,18 +249,25 @@ class JobManager(object):
                 mount_path=system_data_volume.mount_path,
                 volume_claim_name=system_data_volume.volume_claim_name,
                 read_only=True))
+        cachedir = self.paths.TMPOUT_DATA
+        if scratch_volume:
+            # Keep intermediate files off the output data volume, only final outputs are written to --outdir
+            volumes.extend(self._create_scratch_volumes(scratch_volume))
+            cachedir = self.paths.SCRATCH_TMPOUT_DATA
         command = run_workflow_config.command
-        command.extend(["--cachedir", self.paths.TMPOUT_DATA + "/",
+        command.extend(["--cachedir", cachedir + "/",
                         "--outdir", self.paths.OUTPUT_RESULTS_DIR + "/",
                         "--max-ram", self.job.job_flavor_memory,
                         "--max-cores", str(self.job.job_flavor_cpus),
                         "--usage-report", self.names.usage_report_path,
                         "--stdout", self.names.run_workflow_stdout_path,
                         "--stderr", self.names.run_workflow_stderr_path,
-                        self.names.workflow_to_run,
-                        self.names.job_order_path,
                         ])
-        container = Container(
+        if scratch_volume:
+            command.extend(["--tmp-outdir-prefix", self.paths.SCRATCH_TMPOUT_DATA + "/",
+                            "--tmpdir-prefix", self.paths.SCRATCH_TMP_DATA + "/"])
+        command.extend([self.names.workflow_to_run, self.names.job_order_path])
+        return Container(
             name=self.names.run_workflow,
             image_name=run_workflow_config.image_name,
             command=command,
@@ -155,16 +278,20 @@ class JobManager(object):
             requested_memory=run_workflow_config.requested_memory,
             volumes=volumes
         )
-        labels = self.make_job_labels(JobStepTypes.RUN_WORKFLOW)
-        job_spec = BatchJobSpec(self.names.run_workflow,
-                                container=container,
-                                labels=labels)
-        return self.cluster_api.create_job(self.names.run_workflow, job_spec, labels=labels)
 
     def cleanup_run_workflow_job(self):
         self.cluster_api.delete_job(self.names.run_workflow)
+        self.cleanup_scratch_persistent_volumes()
 
     def create_organize_output_project_job(self, methods_document_content):
+        container = self._create_organize_output_container(methods_document_content)
+        labels = self.make_job_labels(JobStepTypes.ORGANIZE_OUTPUT)
+        job_spec = BatchJobSpec(self.names.organize_output,
+                                container=container,
+                                labels=labels)
+        return self.cluster_api.create_job(self.names.organize_output, job_spec, labels=labels)
+
+    def _create_organize_output_container(self, methods_document_content):
         organize_output_config = OrganizeOutputConfig(self.job, self.config, self.paths)
         self._create_organize_output_config_map(name=self.names.organize_output,
                                                 filename=organize_output_config.filename,
@@ -184,7 +311,7 @@ class JobManager(object):
                             source_key=organize_output_config.filename,
                             source_path=organize_output_config.filename),
         ]
-        container = Container(
+        return Container(
             name=self.names.organize_output,
             image_name=organize_output_config.image_name,
             command=organize_output_config.command,
@@ -192,11 +319,6 @@ class JobManager(object):
             requested_cpu=organize_output_config.requested_cpu,
             requested_memory=organize_output_config.requested_memory,
             volumes=volumes)
-        labels = self.make_job_labels(JobStepTypes.ORGANIZE_OUTPUT)
-        job_spec = BatchJobSpec(self.names.organize_output,
-                                container=container,
-                                labels=labels)
-        return self.cluster_api.create_job(self.names.organize_output, job_spec, labels=labels)
 
     def _create_organize_output_config_map(self, name, filename, methods_document_content):
         organize_output_command = OrganizeOutputCommand(self.job, self.names, self.paths)
@@ -211,6 +333,14 @@ class JobManager(object):
         self.cluster_api.delete_job(self.names.organize_output)
 
     def create_save_output_job(self, share_dds_ids):
+        container = self._create_save_output_container(share_dds_ids, config_volume_name=self.names.stage_data)
+        labels = self.make_job_labels(JobStepTypes.SAVE_OUTPUT)
+        job_spec = BatchJobSpec(self.names.save_output,
+                                container=container,
+                                labels=labels)
+        return self.cluster_api.create_job(self.names.save_output, job_spec, labels=labels)
+
+    def _create_save_output_container(self, share_dds_ids, config_volume_name):
         save_output_config = SaveOutputConfig(self.job, self.config, self.paths)
         self._create_save_output_config_map(name=self.names.save_output,
                                             filename=save_output_config.filename,
@@ -226,7 +356,7 @@ class JobManager(object):
                                   mount_path=self.paths.OUTPUT_DATA,
                                   volume_claim_name=self.names.output_data,
                                   read_only=False),  # writable so we can write project_details file
-            ConfigMapVolume(self.names.stage_data,
+            ConfigMapVolume(config_volume_name,
                             mount_path=self.paths.CONFIG_DIR,
                             config_map_name=self.names.save_output,
                             source_key=save_output_config.filename,
@@ -235,7 +365,7 @@ class JobManager(object):
                          mount_path=save_output_config.data_store_secret_path,
                          secret_name=save_output_config.data_store_secret_name),
         ]
-        container = Container(
+        return Container(
             name=self.names.save_output,
             image_name=save_output_config.image_name,
             command=save_output_config.command,
@@ -245,11 +375,6 @@ class JobManager(object):
             requested_cpu=save_output_config.requested_cpu,
             requested_memory=save_output_config.requested_memory,
             volumes=volumes)
-        labels = self.make_job_labels(JobStepTypes.SAVE_OUTPUT)
-        job_spec = BatchJobSpec(self.names.save_output,
-                                container=container,
-                                labels=labels)
-        return self.cluster_api.create_job(self.names.save_output, job_spec, labels=labels)
 
     def _create_save_output_config_map(self, name, filename, share_dds_ids, activity_name, activity_description):
         save_output_command = SaveOutputCommand(self.names, self.paths, activity_name, activity_description)
@@ -264,6 +389,51 @@ class JobManager(object):
         self.cluster_api.delete_config_map(self.names.save_output)
         self.cluster_api.delete_persistent_volume_claim(self.names.job_data)
 
+    def create_pipeline_persistent_volumes(self, stage_data_size_in_g):
+        self.create_job_data_persistent_volume(stage_data_size_in_g)
+        self.create_output_data_persistent_volume()
+        self.create_scratch_persistent_volumes()
+
+    def create_pipeline_job(self, input_files, methods_document_content, share_dds_ids):
+        """
+        Create a single job whose pod stages data, runs the workflow, organizes output and saves output in order.
+        Stage data, run workflow and organize output run as init containers so each waits for the one before it.
+        :param input_files: InputFiles: files to stage
+        :param methods_document_content: str: markdown methods document for the output project or None
+        :param share_dds_ids: [str]: DukeDS user ids to share the output project with
+        :return: V1Job
+        """
+        init_containers = [
+            self._create_stage_data_container(input_files),
+            self._create_run_workflow_container(),
+            self._create_organize_output_container(methods_document_content),
+        ]
+        container = self._create_save_output_container(share_dds_ids, config_volume_name=self.names.save_output)
+        for (step_type, container_name), step_container in zip(PIPELINE_STEP_CONTAINER_NAMES,
+                                                               init_containers + [container]):
+            step_container.name = container_name
+        labels = self.make_job_labels(JobStepTypes.PIPELINE)
+        job_spec = PipelineJobSpec(self.names.pipeline,
+                                   init_containers=init_containers,
+                                   container=container,
+                                   labels=labels)
+        return self.cluster_api.create_job(self.names.pipeline, job_spec, labels=labels)
+
+    def has_pipeline_job(self):
+        """
+        :return: bool: True when this job's steps were started as a single pipeline job
+        """
+        job_step_selector = self.make_job_step_label_selector(JobStepTypes.PIPELINE)
+        return bool(self.cluster_api.list_jobs(label_selector=job_step_selector))
+
+    def cleanup_pipeline_job(self):
+        self.cluster_api.delete_job(self.names.pipeline)
+        self.cleanup_stage_data_config_maps()
+        self.cluster_api.delete_config_map(self.names.organize_output)
+        self.cluster_api.delete_config_map(self.names.save_output)
+        self.cluster_api.delete_persistent_volume_claim(self.names.job_data)
+        self.cleanup_scratch_persistent_volumes()
+
     def create_record_output_project_job(self):
         config = RecordOutputProjectConfig(self.job, self.config)
         volumes = [
@@ -293,6 +463,9 @@ class JobManager(object):
         job_step_selector='{},{}={}'.format(self.label_selector,
                                             JobLabels.STEP_TYPE, JobStepTypes.RECORD_OUTPUT_PROJECT)
         pods = self.cluster_api.list_pods(label_selector=job_step_selector)
+        if not self._has_project_annotations(pods):
+            # The cached pod may not have the annotations added just before the job completed
+            pods = self.cluster_api.list_pods(label_selector=job_step_selector, cached=False)
         if len(pods) != 1:
             raise ValueError("Incorrect number of pods for record output step: {}".format(len(pods)))
         annotations = pods[0].metadata.annotations
@@ -304,25 +477,41 @@ class JobManager(object):
             raise ValueError("Missing readme_file_id in pod annotations: {}".format(pods[0].metadata.name))
         return project_id, readme_file_id
 
+    @staticmethod
+    def _has_project_annotations(pods):
+        if len(pods) != 1:
+            return False
+        annotations = pods[0].metadata.annotations or {}
+        return bool(annotations.get('project_id') and annotations.get('readme_file_id'))
+
     def cleanup_record_output_project_job(self):
         self.cluster_api.delete_job(self.names.record_output_project)
         self.cluster_api.delete_persistent_volume_claim(self.names.output_data)
 
     def cleanup_all(self):
-        self.cleanup_jobs_and_config_maps()
-
-        # Delete all PVC
-        for pvc in self.cluster_api.list_persistent_volume_claims(label_selector=self.label_selector):
-            self.cluster_api.delete_persistent_volume_claim(pvc.metadata.name)
+        return self._delete_collections([
+            self.cluster_api.delete_jobs,
+            self.cluster_api.delete_config_maps,
+            self.cluster_api.delete_persistent_volume_claims,
+        ])
 
     def cleanup_jobs_and_config_maps(self):
-        # Delete all Jobs
-        for job in self.cluster_api.list_jobs(label_selector=self.label_selector):
-            self.cluster_api.delete_job(job.metadata.name)
-
-        # Delete all config maps
-        for config_map in self.cluster_api.list_config_maps(label_selector=self.label_selector):
-            self.cluster_api.delete_config_map(config_map.metadata.name)
+        return self._delete_collections([
+            self.cluster_api.delete_jobs,
+            self.cluster_api.delete_config_maps,
+        ])
+
+    def _delete_collections(self, delete_funcs):
+        """
+        Delete each kind of object labeled with this job's id at the same time.
+        :param delete_funcs: [func(label_selector)]: ClusterApi functions that delete one kind of object by label
+        :return: int: number of API requests made
+        """
+        with ThreadPoolExecutor(max_workers=len(delete_funcs)) as executor:
+            futures = [executor.submit(delete_func, self.label_selector) for delete_func in delete_funcs]
+        api_calls = sum(future.result() for future in futures)
+        logging.info("Cleaned up job {} with {} API requests".format(self.job.id, api_calls))
+        return api_calls
 
 
 class Names(BaseNames):
@@ -337,10 +526,12 @@ class Names(BaseNames):
 
         # Job Names
         self.stage_data = 'stage-data-{}'.format(self.suffix)
+        self.stage_data_manifest = 'stage-data-manifest-{}'.format(self.suffix)
         self.run_workflow = 'run-workflow-{}'.format(self.suffix)
         self.organize_output = 'organize-output-{}'.format(self.suffix)
         self.save_output = 'save-output-{}'.format(self.suffix)
         self.record_output_project = 'record-output-project-{}'.format(self.suffix)
+        self.pipeline = 'pipeline-{}'.format(self.suffix)
 
         self.user_data = 'user-data-{}'.format(self.suffix)
         self.data_store_secret = 'data-store-{}'.format(self.suffix)
@@ -354,6 +545,7 @@ class StageDataConfig(object):
     def __init__(self, job, config, paths):
         self.filename = "stagedata.json"
         self.path = '{}/{}'.format(paths.CONFIG_DIR, self.filename)
+        self.manifest_directory = '{}/stagedata-manifest'.format(paths.CONFIG_DIR)
         self.data_store_secret_name = config.data_store_settings.secret_name
         self.data_store_secret_path = DDSCLIENT_CONFIG_MOUNT_PATH
         self.env_dict = {"DDSCLIENT_CONF": "{}/config".format(DDSCLIENT_CONFIG_MOUNT_PATH)}
@@ -375,6 +567,7 @@ class RunWorkflowConfig(object):
 
         run_workflow_settings = config.run_workflow_settings
         self.system_data_volume = run_workflow_settings.system_data_volume
+        self.scratch_volume = run_workflow_settings.scratch_volume
 
 
 class OrganizeOutputConfig(object):
@@ -3,13 +3,25 @@ import sys
 import math
 from lando.server.lando import Lando, JobStates, JobSteps, JobSettings, BaseJobActions
 from lando.k8s.cluster import ClusterApi
-from lando.k8s.jobmanager import JobManager
+from lando.k8s.jobmanager import JobManager, JobLabels, BESPIN_JOB_LABEL_VALUE
 from lando.k8s.config import create_server_config
 from lando_messaging.messaging import MessageRouter
 
 
 class K8sJobSettings(JobSettings):
+    def __init__(self, job_id, config, scheduler=None, cluster_api=None):
+        """
+        :param job_id: int: unique id for the job
+        :param config: ServerConfig
+        :param scheduler: AdmissionScheduler: queues jobs until there is quota to run them, when None jobs start now
+        :param cluster_api: ClusterApi: api shared by all jobs, when None a ClusterApi is created for each job
+        """
+        super(K8sJobSettings, self).__init__(job_id, config, scheduler=scheduler)
+        self.cluster_api = cluster_api
+
     def get_cluster_api(self):
+        if self.cluster_api:
+            return self.cluster_api
         settings = self.config.cluster_api_settings
         return ClusterApi(settings.host, settings.token, settings.namespace, verify_ssl=settings.verify_ssl,
                           ssl_ca_cert=settings.ssl_ca_cert)
@@ -43,17 +55,25 @@ class K8sJobActions(BaseJobActions):
         Request from user to start running a job. This starts a job to stage user input data into a volume.
         :param payload:StartJobPayload contains job_id we should start
         """
-        self._set_job_state(JobStates.RUNNING)
-        self._set_job_step(JobSteps.CREATE_VM)
+        if self._wait_for_admission(payload):
+            # start_job is called again with an AdmitJobPayload once there is quota to run the job
+            return
+        with self._job_update():
+            self._set_job_state(JobStates.RUNNING)
+            self._set_job_step(JobSteps.CREATE_VM)
 
         input_files = self.job_api.get_input_files()
         input_files_size_in_g = self._calculate_input_data_size_in_g(input_files)
         # The stage data volume contains the workflow, job order, file metadata, and the user's input files.
         stage_data_volume_size_in_g = self.config.base_stage_data_volume_size_in_g + input_files_size_in_g
-        self._show_status("Creating stage data persistent volumes")
-        self.manager.create_stage_data_persistent_volumes(stage_data_volume_size_in_g)
-
-        self.perform_staging_step(input_files)
+        if self.config.fused_pipeline:
+            self._show_status("Creating pipeline persistent volumes")
+            self.manager.create_pipeline_persistent_volumes(stage_data_volume_size_in_g)
+            self.perform_pipeline(input_files)
+        else:
+            self._show_status("Creating stage data persistent volumes")
+            self.manager.create_stage_data_persistent_volumes(stage_data_volume_size_in_g)
+            self.perform_staging_step(input_files)
 
     @staticmethod
     def _calculate_input_data_size_in_g(input_files):
@@ -70,6 +90,34 @@ class K8sJobActions(BaseJobActions):
         job = self.manager.create_stage_data_job(input_files)
         self._show_status("Launched stage data job: {}".format(job.metadata.name))
 
+    def perform_pipeline(self, input_files):
+        """
+        Start a single job that runs the stage data, run workflow, organize output and save output steps in one pod.
+        The watcher sends the usual step complete message as each step finishes so the job step stays up to date.
+        :param input_files: InputFiles: files to stage
+        """
+        self._set_job_step(JobSteps.STAGING)
+        methods_document = self.job_api.get_workflow_methods_document(self.bespin_job.workflow.methods_document)
+        methods_content = None
+        if methods_document:
+            methods_content = methods_document.content
+        store_output_data = self.job_api.get_store_output_job_data()
+        self._show_status("Creating pipeline job")
+        job = self.manager.create_pipeline_job(input_files, methods_content, store_output_data.share_dds_ids)
+        self._show_status("Launched pipeline job: {}".format(job.metadata.name))
+
+    def _advance_pipeline_step(self, step):
+        """
+        Record that the pipeline job moved on to step when this job's steps run as a pipeline.
+        :param step: str: JobSteps value of the step the pipeline is now running
+        :return: bool: True when the job is running as a pipeline
+        """
+        if not self.manager.has_pipeline_job():
+            return False
+        self._set_job_step(step)
+        self._show_status("Pipeline job moved to step {}".format(step))
+        return True
+
     def stage_job_complete(self, payload):
         """
         Message from worker that a the staging job step is complete and successful.
@@ -80,6 +128,8 @@ class K8sJobActions(BaseJobActions):
             # ignore request to perform incompatible step
             logging.info("Ignoring request to run job:{} wrong step/state".format(self.job_id))
             return
+        if self._advance_pipeline_step(JobSteps.RUNNING):
+            return
         self._set_job_step(JobSteps.RUNNING)
         self._show_status("Cleaning up after stage data")
         self.manager.cleanup_stage_data_job()
@@ -104,6 +154,8 @@ class K8sJobActions(BaseJobActions):
             # ignore request to perform incompatible step
             logging.info("Ignoring request to store output for job:{} wrong step/state".format(self.job_id))
             return
+        if self._advance_pipeline_step(JobSteps.ORGANIZE_OUTPUT_PROJECT):
+            return
         self.manager.cleanup_run_workflow_job()
         self.organize_output_project()
 
@@ -122,6 +174,8 @@ class K8sJobActions(BaseJobActions):
             # ignore request to perform incompatible step
             logging.info("Ignoring request to organize output project for job:{} wrong step/state".format(self.job_id))
             return
+        if self._advance_pipeline_step(JobSteps.STORING_JOB_OUTPUT):
+            return
         self.manager.cleanup_organize_output_project_job()
         self.save_output()
 
@@ -144,7 +198,10 @@ class K8sJobActions(BaseJobActions):
             logging.info("Ignoring request to cleanup for job:{} wrong step/state".format(self.job_id))
             return
 
-        self.manager.cleanup_save_output_job()
+        if self.manager.has_pipeline_job():
+            self.manager.cleanup_pipeline_job()
+        else:
+            self.manager.cleanup_save_output_job()
         self._set_job_step(JobSteps.RECORD_OUTPUT_PROJECT)
         self._show_status("Creating record output project job")
         job = self.manager.create_record_output_project_job()
@@ -164,8 +221,9 @@ class K8sJobActions(BaseJobActions):
         self.manager.cleanup_record_output_project_job()
 
         self._show_status("Marking job finished")
-        self._set_job_step(JobSteps.NONE)
-        self._set_job_state(JobStates.FINISHED)
+        with self._job_update():
+            self._set_job_step(JobSteps.NONE)
+            self._set_job_state(JobStates.FINISHED)
 
     def restart_job(self, payload):
         """
@@ -175,8 +233,10 @@ class K8sJobActions(BaseJobActions):
         """
         full_restart = False
         if self.bespin_job.state != JobStates.CANCELED:
+            # A pipeline job resumes with a job for each remaining step since its volumes already exist
+            ran_pipeline = self.manager.has_pipeline_job()
             self.manager.cleanup_jobs_and_config_maps()
-            if self.bespin_job.step == JobSteps.STAGING:
+            if self.bespin_job.step == JobSteps.STAGING and not ran_pipeline:
                 self._set_job_state(JobStates.RUNNING)
                 input_files = self.job_api.get_input_files()
                 self.perform_staging_step(input_files)
@@ -206,8 +266,9 @@ class K8sJobActions(BaseJobActions):
         Sets status to canceled and terminates the associated jobs, configmaps and pvcs
         :param payload: CancelJobPayload: contains job id we should cancel
         """
-        self._set_job_step(JobSteps.NONE)
-        self._set_job_state(JobStates.CANCELED)
+        with self._job_update():
+            self._set_job_step(JobSteps.NONE)
+            self._set_job_state(JobStates.CANCELED)
         self._show_status("Canceling job")
         self.manager.cleanup_all()
 
@@ -249,12 +310,53 @@ class K8sJobActions(BaseJobActions):
 
 
 def create_job_actions(lando, job_id):
-    return K8sJobActions(K8sJobSettings(job_id, lando.config))
+    return K8sJobActions(K8sJobSettings(job_id, lando.config, scheduler=lando.scheduler,
+                                        cluster_api=lando.cluster_api))
+
+
+class ClusterQuotaReader(object):
+    """
+    Reads the resource quota of the namespace all jobs run in.
+    """
+    def __init__(self, job_settings):
+        """
+        :param job_settings: K8sJobSettings: creates cluster api for reading quota
+        """
+        self.job_settings = job_settings
+
+    def get_quota_key(self, job):
+        return self.job_settings.config.cluster_api_settings.namespace
+
+    def read_quota(self, job):
+        return self.job_settings.get_cluster_api().get_quota()
 
 
 class K8sLando(Lando):
     def __init__(self, config):
         super(K8sLando, self).__init__(config, create_job_actions)
+        # ClusterApi shared by all jobs while listening for messages
+        self.cluster_api = None
+
+    def listen_for_messages(self):
+        """
+        Blocks and waits for messages on the queue specified in config.
+        While listening all jobs share one ClusterApi that caches bespin objects when cache_cluster_objects is set.
+        """
+        self.cluster_api = K8sJobSettings(None, self.config).get_cluster_api()
+        if self.config.cache_cluster_objects:
+            self.cluster_api.start_cache("{}={}".format(JobLabels.BESPIN_JOB, BESPIN_JOB_LABEL_VALUE))
+        try:
+            super(K8sLando, self).listen_for_messages()
+        finally:
+            self.cluster_api.stop_cache()
+            self.cluster_api = None
+
+    def _make_provisioner(self):
+        # Jobs run in the cluster so there are no VMs to provision
+        return None
+
+    def _make_quota_reader(self):
+        return ClusterQuotaReader(K8sJobSettings(None, self.config, cluster_api=self.cluster_api))
 
     def _make_router(self):
         work_queue_config = self.config.work_queue_config
@@ -2,8 +2,10 @@ from unittest import TestCase
 from unittest.mock import patch, Mock, call
 from lando.k8s.cluster import ClusterApi, AccessModes, Container, SecretVolume, SecretEnvVar, EnvVarSource, \
     FieldRefEnvVar, VolumeBase, SecretVolume, PersistentClaimVolume, ConfigMapVolume, BatchJobSpec, \
-    ItemNotFoundException
+    ItemNotFoundException, ResourceInformer, CachedKinds, matches_label_selector, EmptyDirVolume, \
+    ProjectedConfigMapVolume
 from kubernetes import client
+from kubernetes.client.rest import ApiException
 from dateutil.parser import parse
 
 
@@ -21,6 +23,48 @@ class TestClusterApi(TestCase):
         self.assertEqual(configuration.api_key, {"authorization": "Bearer myToken"})
         self.assertEqual(configuration.verify_ssl, False)
 
+    def test_constructor_shares_api_client(self):
+        cluster_api = ClusterApi(host='somehost', token='myToken', namespace='other', verify_ssl=False)
+        self.assertEqual(self.cluster_api.api_client, cluster_api.api_client)
+        cluster_api = ClusterApi(host='somehost', token='otherToken', namespace='other', verify_ssl=False)
+        self.assertNotEqual(self.cluster_api.api_client, cluster_api.api_client)
+
+    def test_list_reads_from_cache(self):
+        self.cluster_api.cache = Mock()
+        self.cluster_api.cache.list.return_value = ['job1']
+        self.assertEqual(['job1'], self.cluster_api.list_jobs(label_selector='bespin-job-id=1'))
+        self.cluster_api.cache.list.assert_called_with(CachedKinds.JOBS, 'bespin-job-id=1')
+        self.mock_batch_api.list_namespaced_job.assert_not_called()
+
+    def test_list_before_cache_loaded(self):
+        self.cluster_api.cache = Mock()
+        self.cluster_api.cache.list.return_value = None
+        self.mock_core_api.list_namespaced_config_map.return_value.items = ['config1']
+        self.assertEqual(['config1'], self.cluster_api.list_config_maps(label_selector='bespin-job-id=1'))
+
+    def test_list_pods_uncached(self):
+        self.cluster_api.cache = Mock()
+        self.mock_core_api.list_namespaced_pod.return_value.items = ['pod1']
+        self.assertEqual(['pod1'], self.cluster_api.list_pods(label_selector='bespin-job-id=1', cached=False))
+        self.cluster_api.cache.list.assert_not_called()
+
+    def test_create_and_delete_update_cache(self):
+        self.cluster_api.cache = Mock()
+        self.cluster_api.create_config_map(name='myconfig', data={})
+        self.cluster_api.cache.add.assert_called_with(CachedKinds.CONFIG_MAPS,
+                                                      self.mock_core_api.create_namespaced_config_map.return_value)
+        self.cluster_api.delete_job('myjob')
+        self.cluster_api.cache.remove.assert_called_with(CachedKinds.JOBS, 'myjob')
+
+    @patch('lando.k8s.cluster.ClusterObjectCache')
+    def test_start_and_stop_cache(self, mock_cluster_object_cache):
+        self.cluster_api.start_cache('bespin-job=true')
+        mock_cluster_object_cache.assert_called_with(self.cluster_api, 'bespin-job=true')
+        mock_cluster_object_cache.return_value.start.assert_called_with()
+        self.cluster_api.stop_cache()
+        mock_cluster_object_cache.return_value.stop.assert_called_with()
+        self.assertIsNone(self.cluster_api.cache)
+
     def test_constructor_verify_with_ca(self):
         cluster_api = ClusterApi(host='somehost', token='myToken', namespace='lando-job-runner',
                                  verify_ssl=True, ssl_ca_cert='/tmp/myfile.crt')
@@ -113,6 +157,57 @@ class TestClusterApi(TestCase):
         self.assertEqual(args[1], 'lando-job-runner')
         self.assertEqual(kwargs['label_selector'], 'name=mypod')
 
+    @patch('lando.k8s.cluster.watch')
+    def test_wait_for_job_events_with_resource_version(self, mock_watch):
+        mock_watch.Watch.return_value.stream.return_value = []
+        self.cluster_api.wait_for_job_events(Mock(), resource_version='100', timeout_seconds=300)
+        args, kwargs = mock_watch.Watch.return_value.stream.call_args
+        self.assertEqual(kwargs['resource_version'], '100')
+        self.assertEqual(kwargs['timeout_seconds'], 300)
+
+    @patch('lando.k8s.cluster.watch')
+    def test_wait_for_pod_events(self, mock_watch):
+        callback = Mock()
+        mock_watch.Watch.return_value.stream.return_value = [{'object': 'pod1', 'type': 'ADDED'}]
+        self.cluster_api.wait_for_pod_events(callback, label_selector='bespin-job-step=pipeline', timeout_seconds=60)
+        callback.assert_called_with({'object': 'pod1', 'type': 'ADDED'})
+        args, kwargs = mock_watch.Watch.return_value.stream.call_args
+        self.assertEqual(args, (self.mock_core_api.list_namespaced_pod, 'lando-job-runner'))
+        self.assertEqual(kwargs, {'label_selector': 'bespin-job-step=pipeline', 'timeout_seconds': 60})
+
+    def test_list_jobs_and_resource_version(self):
+        self.mock_batch_api.list_namespaced_job.return_value.items = ['job1']
+        self.mock_batch_api.list_namespaced_job.return_value.metadata.resource_version = '100'
+        items, resource_version = self.cluster_api.list_jobs_and_resource_version(label_selector='bespin-job=true')
+        self.assertEqual(['job1'], items)
+        self.assertEqual('100', resource_version)
+        self.mock_batch_api.list_namespaced_job.assert_called_with('lando-job-runner',
+                                                                  label_selector='bespin-job=true')
+
+    def test_delete_jobs(self):
+        self.assertEqual(2, self.cluster_api.delete_jobs('bespin-job-id=1'))
+        self.mock_batch_api.delete_collection_namespaced_job.assert_called_with('lando-job-runner',
+                                                                                label_selector='bespin-job-id=1')
+        self.mock_core_api.delete_collection_namespaced_pod.assert_called_with('lando-job-runner',
+                                                                               label_selector='bespin-job-id=1')
+
+    def test_delete_config_maps_and_volume_claims(self):
+        self.assertEqual(1, self.cluster_api.delete_config_maps('bespin-job-id=1'))
+        self.mock_core_api.delete_collection_namespaced_config_map.assert_called_with(
+            'lando-job-runner', label_selector='bespin-job-id=1')
+        self.assertEqual(1, self.cluster_api.delete_persistent_volume_claims('bespin-job-id=1'))
+        self.mock_core_api.delete_collection_namespaced_persistent_volume_claim.assert_called_with(
+            'lando-job-runner', label_selector='bespin-job-id=1')
+
+    def test_delete_jobs_updates_cache(self):
+        job = Mock()
+        job.metadata.name = 'job1'
+        self.cluster_api.cache = Mock()
+        self.cluster_api.cache.list.side_effect = \
+            lambda kind, label_selector: [job] if kind == CachedKinds.JOBS else None
+        self.cluster_api.delete_jobs('bespin-job-id=1')
+        self.cluster_api.cache.remove.assert_called_once_with(CachedKinds.JOBS, 'job1')
+
     def test_delete_job(self):
         self.cluster_api.delete_job(name='myjob')
         args, kwargs = self.mock_batch_api.delete_namespaced_job.call_args
@@ -136,6 +231,11 @@ class TestClusterApi(TestCase):
         self.assertEqual(args[1].metadata.name, 'myconfig')
         self.assertEqual(args[1].metadata.labels, {"bespin": "true"})
         self.assertEqual(args[1].data, {'threads': 2})
+        self.assertEqual(args[1].binary_data, None)
+
+        self.cluster_api.create_config_map(name='myconfig', data={}, binary_data={'chunk': 'H4sI'})
+        args, kwargs = self.mock_core_api.create_namespaced_config_map.call_args
+        self.assertEqual(args[1].binary_data, {'chunk': 'H4sI'})
 
     def test_delete_config_map(self):
         self.cluster_api.delete_config_map(name='myconfig')
@@ -153,6 +253,57 @@ class TestClusterApi(TestCase):
         self.mock_core_api.read_namespaced_pod_log.assert_called_with('mypod', 'lando-job-runner',
                                                                       _preload_content=False)
 
+    def test_read_pod_logs_with_timeout(self):
+        self.cluster_api.read_pod_logs('mypod', request_timeout=30)
+        self.mock_core_api.read_namespaced_pod_log.assert_called_with('mypod', 'lando-job-runner',
+                                                                      _preload_content=False,
+                                                                      _request_timeout=30)
+
+    def test_read_pod_log_tail(self):
+        log_stream = self.mock_core_api.read_namespaced_pod_log.return_value
+        log_stream.stream.return_value = [b'line1\n', b'line2\n']
+        logs = self.cluster_api.read_pod_log_tail('mypod', tail_lines=100, max_bytes=1000, request_timeout=30)
+        self.assertEqual('line1\nline2\n', logs.text)
+        self.assertEqual(12, logs.received_bytes)
+        self.assertEqual(0, logs.truncated_bytes)
+        self.assertFalse(logs.is_truncated())
+        self.assertEqual('line1\nline2\n', logs.message())
+        self.mock_core_api.read_namespaced_pod_log.assert_called_with('mypod', 'lando-job-runner',
+                                                                      _preload_content=False, tail_lines=100,
+                                                                      _request_timeout=30)
+        log_stream.release_conn.assert_called_with()
+
+    def test_read_pod_log_tail_keeps_end_of_log(self):
+        log_stream = self.mock_core_api.read_namespaced_pod_log.return_value
+        log_stream.stream.return_value = [b'aaaa\n', b'bb\xc3\xa9\n', b'cc\n']
+        logs = self.cluster_api.read_pod_log_tail('mypod', max_bytes=5)
+        # the first byte of the two byte character is truncated so its second byte is dropped
+        self.assertEqual('\ncc\n', logs.text)
+        self.assertEqual(13, logs.received_bytes)
+        self.assertEqual(8, logs.truncated_bytes)
+        self.assertTrue(logs.is_truncated())
+        self.assertEqual('Showing the last 5 of 13 bytes of the log.\n\ncc\n', logs.message())
+
+    def test_read_pod_log_tail_line_limit_reached(self):
+        log_stream = self.mock_core_api.read_namespaced_pod_log.return_value
+        log_stream.stream.return_value = [b'line1\nline2\n']
+        logs = self.cluster_api.read_pod_log_tail('mypod', tail_lines=2, max_bytes=1000, container='main')
+        self.mock_core_api.read_namespaced_pod_log.assert_called_with('mypod', 'lando-job-runner',
+                                                                      _preload_content=False, tail_lines=2,
+                                                                      container='main')
+        self.assertTrue(logs.is_truncated())
+        self.assertEqual('Showing the last 2 lines of the log.\nline1\nline2\n', logs.message())
+
+    def test_read_job_log_tail(self):
+        mock_pod = Mock()
+        mock_pod.metadata.name = 'myjob-abcd'
+        self.cluster_api.get_most_recent_pod_for_job = Mock(return_value=mock_pod)
+        self.cluster_api.read_pod_log_tail = Mock()
+        logs = self.cluster_api.read_job_log_tail('myjob', tail_lines=10, max_bytes=100)
+        self.assertEqual(logs, self.cluster_api.read_pod_log_tail.return_value)
+        self.cluster_api.read_pod_log_tail.assert_called_with('myjob-abcd', tail_lines=10, max_bytes=100,
+                                                              request_timeout=None)
+
     def test_list_pods(self):
         resp = self.cluster_api.list_pods(label_selector='bespin=true')
         self.mock_core_api.list_namespaced_pod.assert_called_with(
@@ -194,7 +345,30 @@ class TestClusterApi(TestCase):
         logs = self.cluster_api.read_job_logs('myjob')
         self.assertEqual(logs, self.cluster_api.read_pod_logs.return_value)
         self.cluster_api.get_most_recent_pod_for_job.assert_called_with('myjob')
-        self.cluster_api.read_pod_logs.assert_called_with('myjob-abcd')
+        self.cluster_api.read_pod_logs.assert_called_with('myjob-abcd', request_timeout=None)
+
+    def test_get_quota(self):
+        self.mock_core_api.list_namespaced_resource_quota.return_value = Mock(items=[
+            Mock(status=Mock(hard={'requests.cpu': '16', 'requests.memory': '64Gi', 'cpu': '10'},
+                             used={'requests.cpu': '2', 'requests.memory': '8Gi', 'cpu': '500m'})),
+            Mock(status=Mock(hard={'requests.storage': '500Gi'}, used={})),
+            Mock(status=None),
+        ])
+        quota = self.cluster_api.get_quota()
+        self.mock_core_api.list_namespaced_resource_quota.assert_called_with('lando-job-runner')
+        self.assertEqual(10, quota.limit.cpus)
+        self.assertEqual(0.5, quota.used.cpus)
+        self.assertEqual(64, quota.limit.memory_gb)
+        self.assertEqual(8, quota.used.memory_gb)
+        self.assertEqual(500, quota.limit.volume_gb)
+        self.assertEqual(0, quota.used.volume_gb)
+
+    def test_get_quota_without_resource_quotas(self):
+        self.mock_core_api.list_namespaced_resource_quota.return_value = Mock(items=[])
+        quota = self.cluster_api.get_quota()
+        self.assertEqual(None, quota.limit.cpus)
+        self.assertEqual(None, quota.limit.memory_gb)
+        self.assertEqual(None, quota.limit.volume_gb)
 
     def test_get_most_recent_pod_for_job_name__no_pods_found(self):
         self.cluster_api.list_pods = Mock()
@@ -217,6 +391,76 @@ class TestClusterApi(TestCase):
         pod = self.cluster_api.get_most_recent_pod_for_job('myjob')
         self.assertEqual(pod, pod2)
 
+def make_item(name, labels=None, resource_version='1'):
+    item = Mock()
+    item.metadata.name = name
+    item.metadata.labels = labels if labels is not None else {'bespin-job': 'true', 'bespin-job-id': '1'}
+    item.metadata.resource_version = resource_version
+    return item
+
+
+class TestMatchesLabelSelector(TestCase):
+    def test_matches_label_selector(self):
+        labels = {'bespin-job': 'true', 'bespin-job-id': '1'}
+        self.assertTrue(matches_label_selector(labels, None))
+        self.assertTrue(matches_label_selector(labels, 'bespin-job=true,bespin-job-id=1'))
+        self.assertFalse(matches_label_selector(labels, 'bespin-job=true,bespin-job-id=2'))
+        self.assertFalse(matches_label_selector(None, 'bespin-job=true'))
+
+
+class TestResourceInformer(TestCase):
+    def setUp(self):
+        self.list_func = Mock(__name__='list_namespaced_job')
+        self.list_func.return_value = Mock(items=[make_item('job1')])
+        self.list_func.return_value.metadata.resource_version = '100'
+        self.informer = ResourceInformer(self.list_func, 'lando-job-runner', 'bespin-job=true')
+
+    def test_list_before_sync(self):
+        self.assertIsNone(self.informer.list('bespin-job=true'))
+
+    def test_list_items(self):
+        self.assertEqual('100', self.informer._list_items())
+        self.list_func.assert_called_with('lando-job-runner', label_selector='bespin-job=true')
+        self.assertEqual(['job1'], [item.metadata.name for item in self.informer.list('bespin-job-id=1')])
+        self.assertEqual([], self.informer.list('bespin-job-id=2'))
+
+    @patch('lando.k8s.cluster.watch')
+    def test_watch_items(self, mock_watch):
+        self.informer._list_items()
+        mock_watch.Watch.return_value.stream.return_value = [
+            {'type': 'ADDED', 'object': make_item('job2', resource_version='101')},
+            {'type': 'DELETED', 'object': make_item('job1', resource_version='102')},
+        ]
+        self.assertEqual('102', self.informer._watch_items('100'))
+        args, kwargs = mock_watch.Watch.return_value.stream.call_args
+        self.assertEqual('100', kwargs['resource_version'])
+        self.assertEqual(['job2'], [item.metadata.name for item in self.informer.list(None)])
+
+    @patch('lando.k8s.cluster.watch')
+    def test_watch_items_gone(self, mock_watch):
+        mock_watch.Watch.return_value.stream.return_value = [
+            {'type': 'ERROR', 'object': None, 'raw_object': {'code': 410}},
+        ]
+        self.assertIsNone(self.informer._watch_items('100'))
+        mock_watch.Watch.return_value.stream.side_effect = ApiException(status=410)
+        self.assertIsNone(self.informer._watch_items('100'))
+        mock_watch.Watch.return_value.stream.side_effect = ApiException(status=500)
+        with self.assertRaises(ApiException):
+            self.informer._watch_items('100')
+
+    def test_add_and_remove(self):
+        self.informer._list_items()
+        self.informer.add(make_item('job2'))
+        self.informer.add(make_item('other', labels={}))
+        self.informer.remove('job1')
+        self.assertEqual(['job2'], [item.metadata.name for item in self.informer.list(None)])
+        # A late event for the deleted job does not add it back
+        self.informer._apply_event('MODIFIED', make_item('job1'))
+        self.assertEqual(['job2'], [item.metadata.name for item in self.informer.list(None)])
+        self.informer._apply_event('DELETED', make_item('job1'))
+        self.assertEqual(set(), self.informer.deleted_names)
+
+
 class TestContainer(TestCase):
     def test_minimal_create(self):
         container = Container(
@@ -381,6 +625,30 @@ class TestPersistentClaimVolume(TestCase):
                          {'claim_name': 'mypvc', 'read_only': False})
 
 
+class TestProjectedConfigMapVolume(TestCase):
+    def test_create_volume(self):
+        volume = ProjectedConfigMapVolume(name='myvolume', mount_path='/data/manifest', config_map_items=[
+            ('manifest-0', '00000.ndjson.gz', '00000.ndjson.gz'),
+            ('manifest-1', '00001.ndjson.gz', '00001.ndjson.gz'),
+        ])
+        volume_dict = volume.create_volume().to_dict()
+        sources = volume_dict['projected']['sources']
+        self.assertEqual(['manifest-0', 'manifest-1'], [source['config_map']['name'] for source in sources])
+        self.assertEqual([{'key': '00001.ndjson.gz', 'mode': None, 'path': '00001.ndjson.gz'}],
+                         sources[1]['config_map']['items'])
+
+
+class TestEmptyDirVolume(TestCase):
+    def test_create_volume(self):
+        volume = EmptyDirVolume(name='myvolume', mount_path='/scratch')
+        volume_dict = volume.create_volume().to_dict()
+        self.assertEqual(volume_dict['empty_dir'], {'medium': None, 'size_limit': None})
+
+        volume = EmptyDirVolume(name='myvolume', mount_path='/scratch', medium='Memory', size_limit='2Gi')
+        volume_dict = volume.create_volume().to_dict()
+        self.assertEqual(volume_dict['empty_dir'], {'medium': 'Memory', 'size_limit': '2Gi'})
+
+
 class TestConfigMapVolume(TestCase):
     def test_create_volume(self):
         volume = ConfigMapVolume(name='myvolume', mount_path='/data/config.dat',
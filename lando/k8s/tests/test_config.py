@@ -1,5 +1,6 @@
 from unittest import TestCase
-from lando.k8s.config import create_server_config, InvalidConfigException, ServerConfig
+from lando.k8s.config import create_server_config, InvalidConfigException, ServerConfig, ScratchVolume, \
+    StageDataManifestSettings
 from unittest.mock import patch
 import logging
 
@@ -58,13 +59,24 @@ FULL_CONFIG = {
         'system_data_volume': {
             'mount_path': '/system/data',
             'volume_claim_name': 'system-data',
-        }
+        },
+        'scratch_volume': {
+            'type': 'persistent_volume_claim',
+            'size_in_g': 20,
+            'storage_class_name': 'local-ssd',
+        },
     },
     'record_output_project_settings': {
         'service_account_name': 'annotation-writer-sa',
     },
     'storage_class_name': 'gluster',
-    'base_stage_data_volume_size_in_g': 3
+    'base_stage_data_volume_size_in_g': 3,
+    'admission_scheduler': {
+        'retry_seconds': 120,
+    },
+    'stage_data_manifest': {
+        'max_chunk_bytes': 262144,
+    },
 }
 
 
@@ -96,16 +108,45 @@ class TestServerConfig(TestCase):
         self.assertIsNotNone(config.bespin_api_settings)
         self.assertEqual(config.data_store_settings.secret_name, 'ddsclient-secret')
         self.assertEqual(config.run_workflow_settings.system_data_volume, None)
+        self.assertEqual(config.run_workflow_settings.scratch_volume, None)
         self.assertEqual(config.record_output_project_settings.service_account_name, 'annotation-writer-sa')
 
         self.assertEqual(config.storage_class_name, None)
         self.assertEqual(config.base_stage_data_volume_size_in_g, 1)
+        self.assertEqual(config.message_handler_threads, 1)
+        self.assertEqual(config.admission_scheduler_settings, None)
+        self.assertEqual(config.stage_data_manifest_settings, None)
 
     def test_optional_config(self):
         config = ServerConfig(FULL_CONFIG)
         self.assertEqual(config.log_level, logging.DEBUG)
         self.assertEqual(config.run_workflow_settings.system_data_volume.mount_path, '/system/data')
         self.assertEqual(config.run_workflow_settings.system_data_volume.volume_claim_name, 'system-data')
+        self.assertEqual(config.run_workflow_settings.scratch_volume.volume_type, 'persistent_volume_claim')
+        self.assertEqual(config.run_workflow_settings.scratch_volume.size_in_g, 20)
+        self.assertEqual(config.run_workflow_settings.scratch_volume.storage_class_name, 'local-ssd')
         self.assertEqual(config.cluster_api_settings.verify_ssl, False)
         self.assertEqual(config.base_stage_data_volume_size_in_g, 3)
         self.assertEqual(config.cluster_api_settings.ssl_ca_cert, '/tmp/mycert.crt')
+        self.assertEqual(config.admission_scheduler_settings.retry_seconds, 120)
+        self.assertEqual(config.stage_data_manifest_settings.max_chunk_bytes, 262144)
+
+    def test_stage_data_manifest_config(self):
+        self.assertEqual(StageDataManifestSettings({}).max_chunk_bytes, 512 * 1024)
+        with self.assertRaises(InvalidConfigException):
+            StageDataManifestSettings({'max_chunk_bytes': 1024 * 1024})
+
+    def test_scratch_volume_config(self):
+        scratch_volume = ScratchVolume({})
+        self.assertEqual(scratch_volume.volume_type, 'empty_dir')
+        self.assertEqual(scratch_volume.medium, None)
+        self.assertEqual(scratch_volume.size_in_g, None)
+
+        scratch_volume = ScratchVolume({'medium': 'Memory', 'size_in_g': 4})
+        self.assertEqual(scratch_volume.medium, 'Memory')
+        self.assertEqual(scratch_volume.size_in_g, 4)
+
+        with self.assertRaises(InvalidConfigException):
+            ScratchVolume({'type': 'hostPath'})
+        with self.assertRaises(InvalidConfigException):
+            ScratchVolume({'type': 'persistent_volume_claim'})
@@ -3,6 +3,9 @@ from unittest.mock import Mock, call, patch
 from lando.k8s.jobmanager import JobManager, JobStepTypes, StageDataConfig, RunWorkflowConfig, \
     OrganizeOutputConfig, SaveOutputConfig, RecordOutputProjectConfig, Names, Paths
 from lando.common.names import WorkflowTypes
+from lando.common.manifests import read_manifest_chunk
+import base64
+import io
 import json
 
 
@@ -77,7 +80,7 @@ class TestJobManager(TestCase):
 
     def test_create_stage_data_job_packed_workflow(self):
         mock_cluster_api = Mock()
-        mock_config = Mock()
+        mock_config = Mock(stage_data_manifest_settings=None)
         manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
         mock_input_files = Mock(dds_files=[
             Mock(destination_path='file1.txt', file_id='myid')
@@ -155,7 +158,7 @@ class TestJobManager(TestCase):
 
     def test_create_stage_data_job_zipped_workflow(self):
         mock_cluster_api = Mock()
-        mock_config = Mock()
+        mock_config = Mock(stage_data_manifest_settings=None)
         self.mock_job.workflow.workflow_type = WorkflowTypes.ZIPPED
         self.mock_job.workflow.workflow_url = 'someurl.zip'
         self.mock_job.workflow.workflow_path = 'workflows/some.cwl'
@@ -237,7 +240,7 @@ class TestJobManager(TestCase):
 
     def test_cleanup_stage_data_job(self):
         mock_cluster_api = Mock()
-        mock_config = Mock()
+        mock_config = Mock(stage_data_manifest_settings=None)
         manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
 
         manager.cleanup_stage_data_job()
@@ -245,6 +248,61 @@ class TestJobManager(TestCase):
         mock_cluster_api.delete_job.assert_called_with('stage-data-51-jpb')
         mock_cluster_api.delete_config_map.assert_called_with('stage-data-51-jpb')
 
+    def test_create_stage_data_job_with_manifest(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(stage_data_manifest_settings=Mock(max_chunk_bytes=4096))
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+        mock_input_files = Mock(dds_files=[
+            Mock(destination_path='sample{}/reads.fastq'.format(idx), file_id='{:08d}-bd8b-4b4b'.format(idx))
+            for idx in range(500)
+        ])
+
+        manager.create_stage_data_job(input_files=mock_input_files)
+
+        # items are split into compressed chunks with a config map for each chunk
+        items = []
+        config_map_names = []
+        for create_call in mock_cluster_api.create_config_map.call_args_list:
+            kwargs = create_call[1]
+            config_map_names.append(kwargs['name'])
+            self.assertEqual({}, kwargs['data'])
+            self.assertEqual('stage_data', kwargs['labels']['bespin-job-step'])
+            self.assertEqual(1, len(kwargs['binary_data']))
+            chunk = base64.b64decode(list(kwargs['binary_data'].values())[0])
+            self.assertLessEqual(len(chunk), 4096)
+            items.extend(read_manifest_chunk(io.BytesIO(chunk)))
+        self.assertGreater(len(config_map_names), 1)
+        self.assertEqual('stage-data-manifest-51-jpb-0', config_map_names[0])
+        self.assertEqual(502, len(items))
+        self.assertEqual({'type': 'url', 'source': 'someurl.cwl', 'dest': '/bespin/job-data/workflow/someurl.cwl'},
+                         items[0])
+        self.assertEqual({'type': 'DukeDS', 'source': '00000499-bd8b-4b4b',
+                          'dest': '/bespin/job-data/sample499/reads.fastq'}, items[-1])
+
+        # the chunks are mounted into one directory that is passed to the stage data command
+        args, kwargs = mock_cluster_api.create_job.call_args
+        name, batch_spec = args
+        job_container = batch_spec.container
+        self.assertEqual(['/bespin/config/stagedata-manifest', '/bespin/job-data/workflow-input-files-metadata.json'],
+                         job_container.args)
+        manifest_volume = job_container.volumes[1]
+        self.assertEqual('/bespin/config/stagedata-manifest', manifest_volume.mount_path)
+        sources = manifest_volume.create_volume().projected.sources
+        self.assertEqual(config_map_names, [source.config_map.name for source in sources])
+        self.assertEqual('00000.ndjson.gz', sources[0].config_map.items[0].path)
+
+    def test_cleanup_stage_data_job_with_manifest(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(stage_data_manifest_settings=Mock(max_chunk_bytes=4096))
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+
+        manager.cleanup_stage_data_job()
+
+        mock_cluster_api.delete_job.assert_called_with('stage-data-51-jpb')
+        mock_cluster_api.delete_config_maps.assert_called_with(
+            'bespin-job=true,bespin-job-id=51,bespin-job-step=stage_data')
+        mock_cluster_api.delete_config_map.assert_not_called()
+
     def test_create_run_workflow_persistent_volumes(self):
         mock_cluster_api = Mock()
         mock_config = Mock(storage_class_name='nfs')
@@ -258,6 +316,7 @@ class TestJobManager(TestCase):
     def test_create_run_workflow_job(self):
         mock_cluster_api = Mock()
         mock_config = Mock(storage_class_name='nfs')
+        mock_config.run_workflow_settings.scratch_volume = None
         manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
 
         manager.create_run_workflow_job()
@@ -325,6 +384,71 @@ class TestJobManager(TestCase):
         mock_cluster_api.delete_job.assert_called_with('run-workflow-51-jpb')
         mock_cluster_api.delete_persistent_volume_claim.assert_not_called()
 
+    def test_create_run_workflow_job_with_empty_dir_scratch_volume(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(storage_class_name='nfs')
+        mock_config.run_workflow_settings.system_data_volume = None
+        mock_config.run_workflow_settings.scratch_volume = Mock(volume_type='empty_dir', medium='Memory',
+                                                                size_in_g=5)
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+
+        manager.create_run_workflow_job()
+
+        args, kwargs = mock_cluster_api.create_job.call_args
+        name, batch_spec = args
+        job_container = batch_spec.container
+        expected_bash_command = 'cwltool --cachedir /bespin/scratch/tmpout/ ' \
+                                '--outdir /bespin/output-data/results/ ' \
+                                '--max-ram 1G --max-cores 2 ' \
+                                '--usage-report /bespin/output-data/job-51-jpb-resource-usage.json ' \
+                                '--stdout /bespin/output-data/bespin-workflow-output.json ' \
+                                '--stderr /bespin/output-data/bespin-workflow-output.log ' \
+                                '--tmp-outdir-prefix /bespin/scratch/tmpout/ ' \
+                                '--tmpdir-prefix /bespin/scratch/tmp/ ' \
+                                '/bespin/job-data/workflow/someurl.cwl#main ' \
+                                '/bespin/job-data/job-order.json'.split(' ')
+        self.assertEqual(job_container.command, expected_bash_command,
+                         'intermediate files should be written to the scratch volumes')
+        self.assertEqual(['job-data-51-jpb', 'output-data-51-jpb', 'tmpout-51-jpb', 'tmp-51-jpb'],
+                         [volume.name for volume in job_container.volumes])
+        volumes = {volume.name: volume.create_volume() for volume in job_container.volumes}
+        self.assertEqual('Memory', volumes['tmpout-51-jpb'].empty_dir.medium)
+        self.assertEqual('5Gi', volumes['tmpout-51-jpb'].empty_dir.size_limit)
+        self.assertEqual('Memory', volumes['tmp-51-jpb'].empty_dir.medium)
+
+    def test_create_run_workflow_job_with_pvc_scratch_volume(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(storage_class_name='nfs')
+        mock_config.run_workflow_settings.system_data_volume = None
+        mock_config.run_workflow_settings.scratch_volume = Mock(volume_type='persistent_volume_claim',
+                                                                size_in_g=20, storage_class_name='local-ssd')
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+
+        manager.create_run_workflow_persistent_volumes()
+        manager.create_run_workflow_job()
+
+        mock_cluster_api.create_persistent_volume_claim.assert_has_calls([
+            call('output-data-51-jpb', storage_class_name='nfs', storage_size_in_g=3,
+                 labels=self.expected_metadata_labels),
+            call('tmpout-51-jpb', storage_class_name='local-ssd', storage_size_in_g=20,
+                 access_modes=['ReadWriteOnce'], labels=self.expected_metadata_labels),
+            call('tmp-51-jpb', storage_class_name='local-ssd', storage_size_in_g=20,
+                 access_modes=['ReadWriteOnce'], labels=self.expected_metadata_labels),
+        ])
+        args, kwargs = mock_cluster_api.create_job.call_args
+        name, batch_spec = args
+        volumes = batch_spec.container.volumes
+        self.assertEqual(['tmpout-51-jpb', 'tmp-51-jpb'], [volume.volume_claim_name for volume in volumes[2:]])
+        self.assertEqual(['/bespin/scratch/tmpout', '/bespin/scratch/tmp'],
+                         [volume.mount_path for volume in volumes[2:]])
+
+        manager.cleanup_run_workflow_job()
+
+        mock_cluster_api.delete_persistent_volume_claim.assert_has_calls([
+            call('tmpout-51-jpb'),
+            call('tmp-51-jpb'),
+        ])
+
     def test_create_organize_output_project_job(self):
         mock_cluster_api = Mock()
         mock_config = Mock(storage_class_name='nfs')
@@ -539,6 +663,23 @@ class TestJobManager(TestCase):
         mock_cluster_api.list_pods.assert_called_with(
             label_selector='bespin-job=true,bespin-job-id=51,bespin-job-step=record_output_project')
 
+    def test_read_record_output_project_details_refreshes_cached_pod(self):
+        mock_cluster_api = Mock()
+        cached_pod = Mock()
+        cached_pod.metadata.annotations = None
+        mock_pod = Mock()
+        mock_pod.metadata.annotations = {'project_id': '123', 'readme_file_id': '456'}
+        mock_cluster_api.list_pods.side_effect = [[cached_pod], [mock_pod]]
+        mock_config = Mock(storage_class_name='nfs')
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+
+        project_id, readme_file_id = manager.read_record_output_project_details()
+
+        self.assertEqual(project_id, '123')
+        self.assertEqual(readme_file_id, '456')
+        mock_cluster_api.list_pods.assert_called_with(
+            label_selector='bespin-job=true,bespin-job-id=51,bespin-job-step=record_output_project', cached=False)
+
     def test_read_record_output_project_details_pod_not_found(self):
         mock_cluster_api = Mock()
         mock_cluster_api.list_pods.return_value = []
@@ -585,33 +726,123 @@ class TestJobManager(TestCase):
             call('output-data-51-jpb')
         ])
 
+    def test_create_pipeline_persistent_volumes(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(storage_class_name='nfs')
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+
+        manager.create_pipeline_persistent_volumes(stage_data_size_in_g=10)
+
+        mock_cluster_api.create_persistent_volume_claim.assert_has_calls([
+            call('job-data-51-jpb', storage_class_name='nfs', storage_size_in_g=10,
+                 labels=self.expected_metadata_labels),
+            call('output-data-51-jpb', storage_class_name='nfs', storage_size_in_g=3,
+                 labels=self.expected_metadata_labels),
+        ])
+
+    def test_create_pipeline_job(self):
+        mock_cluster_api = Mock()
+        mock_config = Mock(storage_class_name='nfs')
+        mock_config.run_workflow_settings.system_data_volume = None
+        mock_config.run_workflow_settings.scratch_volume = None
+        mock_config.stage_data_manifest_settings = None
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+        mock_input_files = Mock(dds_files=[
+            Mock(destination_path='file1.txt', file_id='myid')
+        ])
+
+        manager.create_pipeline_job(mock_input_files, methods_document_content='markdown', share_dds_ids=['123'])
+
+        config_map_names = [call_args[1]['name'] for call_args in mock_cluster_api.create_config_map.call_args_list]
+        self.assertEqual(['stage-data-51-jpb', 'organize-output-51-jpb', 'save-output-51-jpb'], config_map_names)
+        args, kwargs = mock_cluster_api.create_job.call_args
+        name, job_spec = args
+        self.assertEqual(name, 'pipeline-51-jpb')
+        self.assertEqual(job_spec.labels['bespin-job-step'], 'pipeline')
+        self.assertEqual(['stage-data', 'run-workflow', 'organize-output'],
+                         [container.name for container in job_spec.init_containers])
+        self.assertEqual(['image1', 'image2', 'image3'],
+                         [container.image_name for container in job_spec.init_containers])
+        self.assertEqual('save-output', job_spec.container.name)
+        self.assertEqual('image4', job_spec.container.image_name)
+
+        pod_spec = job_spec.create_pod_spec()
+        self.assertEqual(['stage-data', 'run-workflow', 'organize-output'],
+                         [container.name for container in pod_spec.init_containers])
+        self.assertEqual(['save-output'], [container.name for container in pod_spec.containers])
+        volumes = {volume.name: volume for volume in pod_spec.volumes}
+        self.assertEqual(['job-data-51-jpb', 'stage-data-51-jpb', 'data-store-51-jpb', 'output-data-51-jpb',
+                          'organize-output-51-jpb', 'save-output-51-jpb'], [volume.name for volume in pod_spec.volumes])
+        # stage data writes to the job data volume
+        self.assertEqual(False, volumes['job-data-51-jpb'].persistent_volume_claim.read_only)
+        self.assertEqual('save-output-51-jpb', volumes['save-output-51-jpb'].config_map.name)
+
+    def test_has_pipeline_job(self):
+        mock_cluster_api = Mock()
+        manager = JobManager(cluster_api=mock_cluster_api, config=Mock(), job=self.mock_job)
+        mock_cluster_api.list_jobs.return_value = []
+        self.assertFalse(manager.has_pipeline_job())
+        mock_cluster_api.list_jobs.return_value = [Mock()]
+        self.assertTrue(manager.has_pipeline_job())
+        mock_cluster_api.list_jobs.assert_called_with(
+            label_selector='bespin-job=true,bespin-job-id=51,bespin-job-step=pipeline')
+
+    def test_cleanup_pipeline_job(self):
+        mock_cluster_api = Mock()
+        manager = JobManager(cluster_api=mock_cluster_api, config=Mock(stage_data_manifest_settings=None),
+                             job=self.mock_job)
+
+        manager.cleanup_pipeline_job()
+
+        mock_cluster_api.delete_job.assert_called_with('pipeline-51-jpb')
+        mock_cluster_api.delete_config_map.assert_has_calls([
+            call('stage-data-51-jpb'),
+            call('organize-output-51-jpb'),
+            call('save-output-51-jpb'),
+        ])
+        mock_cluster_api.delete_persistent_volume_claim.assert_called_with('job-data-51-jpb')
+
     def test_cleanup_all(self):
         self.mock_job.id = 1
-        self.mock_job.metadata.name = 'job_1'
-        mock_config_map = Mock()
-        mock_config_map.metadata.name = 'config_map_1'
-        mock_pvc = Mock()
-        mock_pvc.metadata.name = 'pvc_1'
+        mock_cluster_api = Mock()
+        mock_cluster_api.delete_jobs.return_value = 2
+        mock_cluster_api.delete_config_maps.return_value = 1
+        mock_cluster_api.delete_persistent_volume_claims.return_value = 1
+        mock_config = Mock(storage_class_name='nfs')
 
+        manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
+        self.assertEqual(4, manager.cleanup_all())
+
+        mock_cluster_api.delete_jobs.assert_called_with('bespin-job=true,bespin-job-id=1')
+        mock_cluster_api.delete_config_maps.assert_called_with('bespin-job=true,bespin-job-id=1')
+        mock_cluster_api.delete_persistent_volume_claims.assert_called_with('bespin-job=true,bespin-job-id=1')
+        mock_cluster_api.delete_job.assert_not_called()
+        mock_cluster_api.list_jobs.assert_not_called()
+
+    def test_cleanup_jobs_and_config_maps(self):
+        self.mock_job.id = 1
         mock_cluster_api = Mock()
-        mock_cluster_api.list_jobs.return_value = [self.mock_job]
-        mock_cluster_api.list_config_maps.return_value = [mock_config_map]
-        mock_cluster_api.list_persistent_volume_claims.return_value = [mock_pvc]
+        mock_cluster_api.delete_jobs.return_value = 2
+        mock_cluster_api.delete_config_maps.return_value = 1
         mock_config = Mock(storage_class_name='nfs')
 
         manager = JobManager(cluster_api=mock_cluster_api, config=mock_config, job=self.mock_job)
-        manager.cleanup_all()
+        self.assertEqual(3, manager.cleanup_jobs_and_config_maps())
 
-        mock_cluster_api.delete_job.assert_called_with('job_1')
-        mock_cluster_api.delete_config_map.assert_called_with('config_map_1')
-        mock_cluster_api.delete_persistent_volume_claim.assert_called_with('pvc_1')
+        mock_cluster_api.delete_jobs.assert_called_with('bespin-job=true,bespin-job-id=1')
+        mock_cluster_api.delete_config_maps.assert_called_with('bespin-job=true,bespin-job-id=1')
+        mock_cluster_api.delete_persistent_volume_claims.assert_not_called()
 
-        mock_cluster_api.list_persistent_volume_claims.assert_called_with(
-            label_selector='bespin-job=true,bespin-job-id=1')
-        mock_cluster_api.list_jobs.assert_called_with(
-            label_selector='bespin-job=true,bespin-job-id=1')
-        mock_cluster_api.list_config_maps.assert_called_with(
-            label_selector='bespin-job=true,bespin-job-id=1')
+    def test_cleanup_all_raises_delete_error(self):
+        mock_cluster_api = Mock()
+        mock_cluster_api.delete_jobs.return_value = 2
+        mock_cluster_api.delete_config_maps.side_effect = ValueError("denied")
+        mock_cluster_api.delete_persistent_volume_claims.return_value = 1
+        manager = JobManager(cluster_api=mock_cluster_api, config=Mock(), job=self.mock_job)
+
+        with self.assertRaises(ValueError):
+            manager.cleanup_all()
+        mock_cluster_api.delete_persistent_volume_claims.assert_called_with(manager.label_selector)
 
 
 class TestNames(TestCase):
@@ -1,7 +1,7 @@
 from lando.k8s.lando import K8sJobSettings, K8sJobActions, K8sLando, JobStates, JobSteps
 from lando.server.jobapi import InputFiles
 from unittest import TestCase
-from unittest.mock import patch, Mock, call
+from unittest.mock import patch, Mock, MagicMock, call
 
 
 class TestK8sJobSettings(TestCase):
@@ -19,11 +19,19 @@ class TestK8sJobSettings(TestCase):
             ssl_ca_cert=mock_config.cluster_api_settings.ssl_ca_cert
         )
 
+    @patch('lando.k8s.lando.ClusterApi')
+    def test_get_shared_cluster_api(self, mock_cluster_api):
+        shared_cluster_api = Mock()
+        settings = K8sJobSettings(job_id=1, config=Mock(), cluster_api=shared_cluster_api)
+        self.assertEqual(shared_cluster_api, settings.get_cluster_api())
+        mock_cluster_api.assert_not_called()
+
 
 class TestK8sJobActions(TestCase):
     def setUp(self):
-        self.mock_config = Mock(base_stage_data_volume_size_in_g=1)
-        self.mock_settings = Mock(job_id='49', config=self.mock_config)
+        self.mock_config = Mock(base_stage_data_volume_size_in_g=1, fused_pipeline=False)
+        self.mock_settings = MagicMock(job_id='49', config=self.mock_config)
+        self.mock_settings.scheduler = None
         self.mock_job = Mock(state=JobStates.AUTHORIZED, step=JobSteps.NONE, created='2019-03-11T12:30',
                              workflow=Mock(workflow_url='someurl.cwl', version='2'))
         self.mock_job.name = 'myjob'
@@ -112,6 +120,7 @@ class TestK8sJobActions(TestCase):
     @patch('lando.k8s.lando.JobManager')
     def test_stage_job_complete_with_valid_state_and_step(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = False
         self.mock_job.state = JobStates.RUNNING
         self.mock_job.step = JobSteps.STAGING
         actions = self.create_actions()
@@ -150,6 +159,7 @@ class TestK8sJobActions(TestCase):
     @patch('lando.k8s.lando.JobManager')
     def test_run_job_complete_valid_state_step(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = False
         self.mock_job.state = JobStates.RUNNING
         self.mock_job.step = JobSteps.RUNNING
         actions = self.create_actions()
@@ -188,6 +198,7 @@ class TestK8sJobActions(TestCase):
     @patch('lando.k8s.lando.JobManager')
     def test_organize_output_complete_valid_state_step(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = False
         self.mock_job.state = JobStates.RUNNING
         self.mock_job.step = JobSteps.ORGANIZE_OUTPUT_PROJECT
         actions = self.create_actions()
@@ -222,6 +233,7 @@ class TestK8sJobActions(TestCase):
     @patch('lando.k8s.lando.JobManager')
     def test_store_job_output_complete_valid_state_step(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = False
         self.mock_job.state = JobStates.RUNNING
         self.mock_job.step = JobSteps.STORING_JOB_OUTPUT
         actions = self.create_actions()
@@ -282,6 +294,7 @@ class TestK8sJobActions(TestCase):
     @patch('lando.k8s.lando.JobManager')
     def test_restart_job_continues_staging(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = False
         self.mock_job.state = JobStates.ERRORED
         self.mock_job.step = JobSteps.STAGING
         actions = self.create_actions()
@@ -307,6 +320,80 @@ class TestK8sJobActions(TestCase):
         self.mock_job_api.set_job_state.assert_called_with(JobStates.RUNNING)
         mock_manager.create_run_workflow_job.assert_called_with()
 
+    @patch('lando.k8s.lando.JobManager', autospec=True)
+    def test_start_job_fused_pipeline(self, mock_job_manager):
+        self.mock_config.fused_pipeline = True
+        self.mock_job_api.get_input_files.return_value = InputFiles({'dds_files': [], 'url_files': []})
+        self.mock_job_api.get_workflow_methods_document.return_value = Mock(content='markdown')
+        self.mock_job_api.get_store_output_job_data.return_value = Mock(share_dds_ids=['123'])
+        mock_manager = mock_job_manager.return_value
+        k8s_job = Mock()
+        k8s_job.metadata.name = 'pipeline1'
+        mock_manager.create_pipeline_job.return_value = k8s_job
+        actions = self.create_actions()
+        actions._show_status = Mock()
+
+        actions.start_job(None)
+
+        mock_manager.create_pipeline_persistent_volumes.assert_called_with(1)
+        mock_manager.create_pipeline_job.assert_called_with(self.mock_job_api.get_input_files.return_value,
+                                                            'markdown', ['123'])
+        mock_manager.create_stage_data_job.assert_not_called()
+        self.mock_job_api.set_job_step.assert_called_with(JobSteps.STAGING)
+        actions._show_status.assert_called_with('Launched pipeline job: pipeline1')
+
+    @patch('lando.k8s.lando.JobManager')
+    def test_pipeline_step_complete_messages_advance_step(self, mock_job_manager):
+        mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = True
+        self.mock_job.state = JobStates.RUNNING
+        self.mock_job.step = JobSteps.STAGING
+        actions = self.create_actions()
+        actions._show_status = Mock()
+
+        actions.stage_job_complete(None)
+        actions.run_job_complete(None)
+        actions.organize_output_complete(None)
+        self.assertEqual(JobSteps.STORING_JOB_OUTPUT, self.mock_job.step)
+        mock_manager.cleanup_stage_data_job.assert_not_called()
+        mock_manager.create_run_workflow_job.assert_not_called()
+        mock_manager.create_organize_output_project_job.assert_not_called()
+        mock_manager.create_save_output_job.assert_not_called()
+
+        actions.store_job_output_complete(None)
+        mock_manager.cleanup_pipeline_job.assert_called_with()
+        mock_manager.cleanup_save_output_job.assert_not_called()
+        mock_manager.create_record_output_project_job.assert_called_with()
+        self.assertEqual(JobSteps.RECORD_OUTPUT_PROJECT, self.mock_job.step)
+
+    @patch('lando.k8s.lando.JobManager')
+    def test_restart_pipeline_job_staging_starts_from_beginning(self, mock_job_manager):
+        mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = True
+        self.mock_job.state = JobStates.ERRORED
+        self.mock_job.step = JobSteps.STAGING
+        actions = self.create_actions()
+        actions.start_job = Mock()
+
+        actions.restart_job(None)
+
+        mock_manager.cleanup_all.assert_called_with()
+        actions.start_job.assert_called_with(None)
+        mock_manager.create_stage_data_job.assert_not_called()
+
+    @patch('lando.k8s.lando.JobManager')
+    def test_restart_pipeline_job_continues_running_as_separate_job(self, mock_job_manager):
+        mock_manager = mock_job_manager.return_value
+        mock_manager.has_pipeline_job.return_value = True
+        self.mock_job.state = JobStates.ERRORED
+        self.mock_job.step = JobSteps.RUNNING
+        actions = self.create_actions()
+
+        actions.restart_job(None)
+
+        mock_manager.cleanup_jobs_and_config_maps.assert_called_with()
+        mock_manager.create_run_workflow_job.assert_called_with()
+
     @patch('lando.k8s.lando.JobManager')
     def test_restart_job_continues_organizing_output_project(self, mock_job_manager):
         mock_manager = mock_job_manager.return_value
@@ -398,11 +485,23 @@ class TestK8sLando(TestCase):
         job_actions = lando._make_actions(job_id=2)
         self.assertEqual(job_actions.__class__.__name__, 'K8sJobActions')
 
+    @patch('lando.k8s.lando.ClusterApi')
     @patch('lando.k8s.lando.MessageRouter')
-    def test_listen_for_messages(self, mock_message_router):
-        mock_config = Mock()
+    def test_listen_for_messages(self, mock_message_router, mock_cluster_api):
+        mock_config = Mock(message_handler_threads=2, admission_scheduler_settings=None)
         lando = K8sLando(mock_config)
         lando.listen_for_messages()
         mock_message_router.make_k8s_lando_router.assert_called_with(
             mock_config, lando, mock_config.work_queue_config.listen_queue
         )
+        mock_cluster_api.return_value.start_cache.assert_called_with('bespin-job=true')
+        mock_cluster_api.return_value.stop_cache.assert_called_with()
+        self.assertEqual(None, lando.cluster_api)
+
+    @patch('lando.k8s.lando.ClusterApi')
+    @patch('lando.k8s.lando.MessageRouter')
+    def test_listen_for_messages_without_cache(self, mock_message_router, mock_cluster_api):
+        mock_config = Mock(message_handler_threads=2, admission_scheduler_settings=None, cache_cluster_objects=False)
+        lando = K8sLando(mock_config)
+        lando.listen_for_messages()
+        mock_cluster_api.return_value.start_cache.assert_not_called()
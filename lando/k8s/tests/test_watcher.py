@@ -1,23 +1,234 @@
 from unittest import TestCase
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, patch, ANY, call
 from lando.k8s.watcher import JobWatcher, JobLabels, JobStepTypes, JobCommands, JobConditionType, ApiException, \
-    EventTypes
+    EventTypes, WatcherCheckpoint
+from lando.k8s.cluster import PodLogs
+import os
+import tempfile
+import threading
+import time
+from urllib3.exceptions import ReadTimeoutError
+
+
+def make_job(name, resource_version, job_id='32', step_type=JobStepTypes.STAGE_DATA):
+    job = Mock()
+    job.metadata.name = name
+    job.metadata.resource_version = resource_version
+    job.metadata.labels = {
+        JobLabels.JOB_ID: job_id,
+        JobLabels.STEP_TYPE: step_type,
+    }
+    job.status.conditions = [Mock(type=JobConditionType.COMPLETE, status="True")]
+    return job
+
+
+class TestWatcherCheckpoint(TestCase):
+    def test_in_memory(self):
+        checkpoint = WatcherCheckpoint(None)
+        checkpoint.resource_version = '100'
+        checkpoint.save()
+        self.assertEqual({'resource_version': '100', 'job_versions': {}, 'transitions': [], 'unsent_failures': [],
+                          'suppressed_duplicates': 0}, checkpoint.to_dict())
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'checkpoint.json')
+            checkpoint = WatcherCheckpoint(filename)
+            self.assertEqual(None, checkpoint.resource_version)
+            checkpoint.resource_version = '100'
+            checkpoint.job_versions['job1'] = '99'
+            checkpoint.save()
+            checkpoint = WatcherCheckpoint(filename)
+            self.assertEqual('100', checkpoint.resource_version)
+            self.assertEqual({'job1': '99'}, checkpoint.job_versions)
+
+
+    def test_transitions_are_bounded(self):
+        checkpoint = WatcherCheckpoint(None, max_transitions=2)
+        checkpoint.add_transition('uid1', JobStepTypes.STAGE_DATA, JobConditionType.COMPLETE)
+        checkpoint.add_transition('uid2', JobStepTypes.STAGE_DATA, JobConditionType.COMPLETE)
+        checkpoint.add_transition('uid3', JobStepTypes.STAGE_DATA, JobConditionType.FAILED)
+        self.assertFalse(checkpoint.has_transition('uid1', JobStepTypes.STAGE_DATA))
+        self.assertTrue(checkpoint.has_transition('uid2', JobStepTypes.STAGE_DATA))
+        self.assertTrue(checkpoint.has_transition('uid3', JobStepTypes.STAGE_DATA))
+        checkpoint.remove_transition('uid3', JobStepTypes.STAGE_DATA)
+        self.assertFalse(checkpoint.has_transition('uid3', JobStepTypes.STAGE_DATA))
+
+    def test_transitions_are_saved(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'checkpoint.json')
+            checkpoint = WatcherCheckpoint(filename)
+            checkpoint.add_transition('uid1', JobStepTypes.STAGE_DATA, JobConditionType.COMPLETE)
+            checkpoint.add_transition('uid2', JobStepTypes.RUN_WORKFLOW, JobConditionType.FAILED)
+            checkpoint.suppressed_duplicates = 3
+            checkpoint.save()
+            checkpoint = WatcherCheckpoint(filename)
+            self.assertEqual(['uid1/stage_data', 'uid2/run_workflow'], list(checkpoint.transitions.keys()))
+            self.assertEqual(3, checkpoint.suppressed_duplicates)
+
+    def test_unsent_failures_are_saved(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'checkpoint.json')
+            checkpoint = WatcherCheckpoint(filename)
+            checkpoint.add_unsent_failure('uid1', JobStepTypes.STAGE_DATA)
+            checkpoint.add_unsent_failure('uid2', JobStepTypes.STAGE_DATA)
+            checkpoint.failure_sent('uid2', JobStepTypes.STAGE_DATA)
+            checkpoint.save()
+            checkpoint = WatcherCheckpoint(filename)
+            self.assertTrue(checkpoint.has_unsent_failure('uid1', JobStepTypes.STAGE_DATA))
+            self.assertFalse(checkpoint.has_unsent_failure('uid2', JobStepTypes.STAGE_DATA))
+            self.assertTrue(checkpoint.has_transition('uid2', JobStepTypes.STAGE_DATA))
 
 
 class TestJobWatcher(TestCase):
+    def setUp(self):
+        self.config = Mock(watcher_checkpoint_filename=None, watcher_log_threads=2,
+                           watcher_log_timeout_seconds=60, watcher_log_tail_lines=1000,
+                           watcher_log_max_bytes=4096, fused_pipeline=False)
+
     @patch('lando.k8s.watcher.ClusterApi')
     def test_run(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [], '100'
+        watcher = JobWatcher(config=self.config)
+        wait_for_job_events = mock_cluster_api.return_value.wait_for_job_events
+        wait_for_job_events.side_effect = lambda *args, **kwargs: watcher.stop()
         watcher.run()
 
-        wait_for_job_events = mock_cluster_api.return_value.wait_for_job_events
+        mock_cluster_api.return_value.list_jobs_and_resource_version.assert_called_with('bespin-job=true')
         wait_for_job_events.assert_called_with(
             watcher.on_job_change,
-            label_selector='bespin-job=true')
+            label_selector='bespin-job=true',
+            resource_version='100',
+            timeout_seconds=300)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_run_resumes_from_checkpoint(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.checkpoint.resource_version = '200'
+        wait_for_job_events = mock_cluster_api.return_value.wait_for_job_events
+        wait_for_job_events.side_effect = lambda *args, **kwargs: watcher.stop()
+        watcher.run()
+
+        mock_cluster_api.return_value.list_jobs_and_resource_version.assert_not_called()
+        args, kwargs = wait_for_job_events.call_args
+        self.assertEqual('200', kwargs['resource_version'])
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_run_relists_when_resource_version_gone(self, mock_cluster_api):
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [], '300'
+        watcher = JobWatcher(config=self.config)
+        watcher.checkpoint.resource_version = '200'
+        resource_versions = []
+
+        def wait_for_job_events(callback, label_selector, resource_version, timeout_seconds):
+            resource_versions.append(resource_version)
+            if len(resource_versions) == 1:
+                callback({'type': EventTypes.ERROR, 'object': None, 'raw_object': {'code': 410}})
+            elif len(resource_versions) == 2:
+                raise ApiException(status=410)
+            else:
+                watcher.stop()
+        mock_cluster_api.return_value.wait_for_job_events.side_effect = wait_for_job_events
+        watcher.run()
+
+        self.assertEqual(['200', '300', '300'], resource_versions)
+        self.assertEqual(2, mock_cluster_api.return_value.list_jobs_and_resource_version.call_count)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_relist_jobs_handles_changed_jobs(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_added_or_modified = Mock()
+        watcher.checkpoint.job_versions = {'job1': '10', 'job2': '20', 'job3': '30'}
+        job1 = make_job('job1', '10')
+        job2 = make_job('job2', '21')
+        job4 = make_job('job4', '40')
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [job1, job2, job4], '50'
+
+        watcher.relist_jobs('bespin-job=true')
+
+        self.assertEqual([job2, job4], [call[0][0] for call in watcher.on_job_added_or_modified.call_args_list])
+        self.assertEqual({'job1': '10', 'job2': '21', 'job4': '40'}, watcher.checkpoint.job_versions)
+        self.assertEqual('50', watcher.checkpoint.resource_version)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_run_relists_to_resend_unsent_failures(self, mock_cluster_api):
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [], '300'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.config.watcher_checkpoint_filename = os.path.join(temp_dir, 'checkpoint.json')
+            checkpoint = WatcherCheckpoint(self.config.watcher_checkpoint_filename)
+            checkpoint.resource_version = '200'
+            checkpoint.add_unsent_failure('uid1', JobStepTypes.STAGE_DATA)
+            checkpoint.save()
+            watcher = JobWatcher(config=self.config)
+            wait_for_job_events = mock_cluster_api.return_value.wait_for_job_events
+            wait_for_job_events.side_effect = lambda *args, **kwargs: watcher.stop()
+            watcher.run()
+
+        mock_cluster_api.return_value.list_jobs_and_resource_version.assert_called_with('bespin-job=true')
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_relist_jobs_handles_unsent_failures(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_added_or_modified = Mock()
+        job1 = make_job('job1', '10')
+        job1.metadata.uid = 'uid1'
+        watcher.checkpoint.job_versions = {'job1': '10'}
+        watcher.checkpoint.add_unsent_failure('uid1', JobStepTypes.STAGE_DATA)
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [job1], '50'
+
+        watcher.relist_jobs('bespin-job=true')
+
+        watcher.on_job_added_or_modified.assert_called_once_with(job1)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_job_change_records_resource_version(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_added_or_modified = Mock()
+        watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': make_job('job1', '10')})
+        self.assertEqual('10', watcher.checkpoint.resource_version)
+        self.assertEqual({'job1': '10'}, watcher.checkpoint.job_versions)
+        watcher.on_job_change({'type': EventTypes.BOOKMARK, 'object': make_job(None, '15')})
+        self.assertEqual('15', watcher.checkpoint.resource_version)
+        watcher.on_job_change({'type': EventTypes.DELETED, 'object': make_job('job1', '20')})
+        self.assertEqual('20', watcher.checkpoint.resource_version)
+        self.assertEqual({}, watcher.checkpoint.job_versions)
+        self.assertEqual(1, watcher.on_job_added_or_modified.call_count)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_job_change_sends_each_transition_once(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_succeeded = Mock()
+        job = make_job('job1', '10')
+        job.metadata.uid = 'uid1'
+        watcher.on_job_change({'type': EventTypes.ADDED, 'object': job})
+        job.metadata.resource_version = '11'
+        watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': job})
+        watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': job})
+
+        watcher.on_job_succeeded.assert_called_once_with('32', JobStepTypes.STAGE_DATA)
+        self.assertEqual(2, watcher.checkpoint.suppressed_duplicates)
+
+        # a job recreated with the same name has a new uid
+        job = make_job('job1', '20')
+        job.metadata.uid = 'uid2'
+        watcher.on_job_change({'type': EventTypes.ADDED, 'object': job})
+        self.assertEqual(2, watcher.on_job_succeeded.call_count)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_job_change_failed_send_is_retried(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_succeeded = Mock(side_effect=[ValueError("unavailable"), None])
+        job = make_job('job1', '10')
+        job.metadata.uid = 'uid1'
+        with self.assertRaises(ValueError):
+            watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': job})
+        watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': job})
+        self.assertEqual(2, watcher.on_job_succeeded.call_count)
+        self.assertEqual(0, watcher.checkpoint.suppressed_duplicates)
 
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_change_with_failed_job(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.on_job_succeeded = Mock()
         watcher.on_job_failed = Mock()
         job = Mock()
@@ -35,9 +246,51 @@ class TestJobWatcher(TestCase):
         watcher.on_job_succeeded.assert_not_called()
         watcher.on_job_failed.assert_called_with('job1', '32', JobStepTypes.STAGE_DATA)
 
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_failed_transition_is_recorded_after_error_is_sent(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+        sending = threading.Event()
+        mock_cluster_api.return_value.read_job_log_tail.side_effect = lambda *args, **kwargs: \
+            sending.wait(5) and PodLogs("Error details", 13, 0, 1000)
+        job = make_job('job1', '10')
+        job.metadata.uid = 'uid1'
+        job.status.conditions = [Mock(type=JobConditionType.FAILED, status="True")]
+
+        watcher.on_job_change({'type': EventTypes.ADDED, 'object': job})
+        self.assertFalse(watcher.checkpoint.has_transition('uid1', JobStepTypes.STAGE_DATA))
+        self.assertTrue(watcher.checkpoint.has_unsent_failure('uid1', JobStepTypes.STAGE_DATA))
+        # a repeated event while the error is being sent does not send it again
+        watcher.on_job_change({'type': EventTypes.MODIFIED, 'object': job})
+        sending.set()
+        watcher.log_executor.shutdown(wait=True)
+
+        watcher.lando_client.job_step_error.assert_called_once()
+        self.assertTrue(watcher.checkpoint.has_transition('uid1', JobStepTypes.STAGE_DATA))
+        self.assertFalse(watcher.checkpoint.has_unsent_failure('uid1', JobStepTypes.STAGE_DATA))
+        self.assertFalse(watcher.relist_requested.is_set())
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    @patch('lando.k8s.watcher.logging')
+    def test_failed_transition_is_not_recorded_when_send_fails(self, mock_logging, mock_cluster_api):
+        mock_cluster_api.return_value.read_job_log_tail.return_value = PodLogs("Error details", 13, 0, 1000)
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+        watcher.lando_client.job_step_error.side_effect = ValueError("Connection lost")
+        job = make_job('job1', '10')
+        job.metadata.uid = 'uid1'
+        job.status.conditions = [Mock(type=JobConditionType.FAILED, status="True")]
+
+        watcher.on_job_change({'type': EventTypes.ADDED, 'object': job})
+        watcher.log_executor.shutdown(wait=True)
+
+        self.assertFalse(watcher.checkpoint.has_transition('uid1', JobStepTypes.STAGE_DATA))
+        self.assertTrue(watcher.checkpoint.has_unsent_failure('uid1', JobStepTypes.STAGE_DATA))
+        self.assertTrue(watcher.relist_requested.is_set())
+
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_change_with_complete_job(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.on_job_succeeded = Mock()
         watcher.on_job_failed = Mock()
         job = Mock()
@@ -58,7 +311,7 @@ class TestJobWatcher(TestCase):
     @patch('lando.k8s.watcher.ClusterApi')
     @patch('lando.k8s.watcher.logging')
     def test_on_job_change_with_delete_event(self, mock_logging, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.on_job_succeeded = Mock()
         watcher.on_job_failed = Mock()
         job = Mock()
@@ -79,7 +332,7 @@ class TestJobWatcher(TestCase):
 
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_change_with_ignored_conditions(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.on_job_succeeded = Mock()
         watcher.on_job_failed = Mock()
         job = Mock()
@@ -103,7 +356,7 @@ class TestJobWatcher(TestCase):
 
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_change_missing_labels(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.on_job_succeeded = Mock()
         watcher.on_job_failed = Mock()
         job = Mock()
@@ -123,7 +376,7 @@ class TestJobWatcher(TestCase):
 
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_succeeded(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.lando_client = Mock()
 
         watcher.on_job_succeeded('31', JobStepTypes.STAGE_DATA)
@@ -158,7 +411,7 @@ class TestJobWatcher(TestCase):
 
     @patch('lando.k8s.watcher.ClusterApi')
     def test_on_job_succeeded_record_output(self, mock_cluster_api):
-        watcher = JobWatcher(config=Mock())
+        watcher = JobWatcher(config=self.config)
         watcher.lando_client = Mock()
 
         watcher.on_job_succeeded('31', JobStepTypes.RECORD_OUTPUT_PROJECT)
@@ -168,13 +421,14 @@ class TestJobWatcher(TestCase):
         self.assertEqual(payload.success_command, JobCommands.RECORD_OUTPUT_PROJECT_COMPLETE)
 
     @patch('lando.k8s.watcher.ClusterApi')
-    def test_on_job_failed(self, mock_cluster_api):
-        mock_cluster_api.return_value.read_job_logs.return_value = "Error details"
-        watcher = JobWatcher(config=Mock())
+    def test_send_job_failed(self, mock_cluster_api):
+        mock_cluster_api.return_value.read_job_log_tail.return_value = PodLogs("Error details", 13, 0, 1000)
+        watcher = JobWatcher(config=self.config)
         watcher.lando_client = Mock()
 
-        watcher.on_job_failed('myjob', '31', JobStepTypes.STAGE_DATA)
-        mock_cluster_api.return_value.read_job_logs.assert_called_with('myjob')
+        watcher.send_job_failed('myjob', '31', JobStepTypes.STAGE_DATA, time.time() + 60)
+        mock_cluster_api.return_value.read_job_log_tail.assert_called_with('myjob', tail_lines=1000, max_bytes=4096,
+                                                                         request_timeout=ANY)
         payload = watcher.lando_client.job_step_error.call_args[0][0]
         message = watcher.lando_client.job_step_error.call_args[0][1]
         self.assertEqual(payload.job_id, '31')
@@ -183,7 +437,7 @@ class TestJobWatcher(TestCase):
 
         watcher.lando_client.job_step_complete.reset_mock()
 
-        watcher.on_job_failed('myjob', '31', JobStepTypes.RUN_WORKFLOW)
+        watcher.send_job_failed('myjob', '31', JobStepTypes.RUN_WORKFLOW, time.time() + 60)
         payload = watcher.lando_client.job_step_error.call_args[0][0]
         message = watcher.lando_client.job_step_error.call_args[0][1]
         self.assertEqual(payload.job_id, '31')
@@ -192,7 +446,7 @@ class TestJobWatcher(TestCase):
 
         watcher.lando_client.job_step_complete.reset_mock()
 
-        watcher.on_job_failed('myjob', '31', JobStepTypes.ORGANIZE_OUTPUT)
+        watcher.send_job_failed('myjob', '31', JobStepTypes.ORGANIZE_OUTPUT, time.time() + 60)
         payload = watcher.lando_client.job_step_error.call_args[0][0]
         message = watcher.lando_client.job_step_error.call_args[0][1]
         self.assertEqual(payload.job_id, '31')
@@ -201,7 +455,7 @@ class TestJobWatcher(TestCase):
 
         watcher.lando_client.job_step_complete.reset_mock()
 
-        watcher.on_job_failed('myjob', '31', JobStepTypes.SAVE_OUTPUT)
+        watcher.send_job_failed('myjob', '31', JobStepTypes.SAVE_OUTPUT, time.time() + 60)
         payload = watcher.lando_client.job_step_error.call_args[0][0]
         message = watcher.lando_client.job_step_error.call_args[0][1]
         self.assertEqual(payload.job_id, '31')
@@ -210,14 +464,15 @@ class TestJobWatcher(TestCase):
 
     @patch('lando.k8s.watcher.ClusterApi')
     @patch('lando.k8s.watcher.logging')
-    def test_on_job_failed_reading_logs_failed(self, mock_logging, mock_cluster_api):
-            mock_cluster_api.return_value.read_job_logs.side_effect = ApiException(status=404, reason='Logs not found')
-            watcher = JobWatcher(config=Mock())
+    def test_send_job_failed_reading_logs_failed(self, mock_logging, mock_cluster_api):
+            mock_cluster_api.return_value.read_job_log_tail.side_effect = ApiException(status=404,
+                                                                                      reason='Logs not found')
+            watcher = JobWatcher(config=self.config)
             watcher.get_most_recent_pod_for_job = Mock()
             watcher.get_most_recent_pod_for_job.return_value = Mock()
             watcher.lando_client = Mock()
 
-            watcher.on_job_failed('myjob', '31', JobStepTypes.STAGE_DATA)
+            watcher.send_job_failed('myjob', '31', JobStepTypes.STAGE_DATA, time.time() + 60)
             payload = watcher.lando_client.job_step_error.call_args[0][0]
             message = watcher.lando_client.job_step_error.call_args[0][1]
             self.assertEqual(payload.job_id, '31')
@@ -225,6 +480,137 @@ class TestJobWatcher(TestCase):
             self.assertEqual(message, 'Unable to read logs.')
             mock_logging.error.assert_called_with('Unable to read logs (404)\nReason: Logs not found\n')
 
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_job_failed_reads_logs_on_log_thread(self, mock_cluster_api):
+        mock_cluster_api.return_value.read_job_log_tail.return_value = PodLogs("Error details", 13, 0, 1000)
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+        reading_logs = threading.Event()
+        mock_cluster_api.return_value.read_job_log_tail.side_effect = lambda *args, **kwargs: \
+            reading_logs.wait(5) and PodLogs("Error details", 13, 0, 1000)
+
+        watcher.on_job_failed('myjob', '31', JobStepTypes.STAGE_DATA)
+        watcher.lando_client.job_step_error.assert_not_called()
+        reading_logs.set()
+        watcher.log_executor.shutdown(wait=True)
+
+        message = watcher.lando_client.job_step_error.call_args[0][1]
+        self.assertEqual(message, 'Error details')
+        args, kwargs = mock_cluster_api.return_value.read_job_log_tail.call_args
+        self.assertTrue(0 < kwargs['request_timeout'] <= 60)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_send_job_failed_truncated_logs(self, mock_cluster_api):
+        mock_cluster_api.return_value.read_job_log_tail.return_value = PodLogs("end of log", 5000, 4990, 1000)
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+
+        watcher.send_job_failed('myjob', '31', JobStepTypes.STAGE_DATA, time.time() + 60)
+
+        message = watcher.lando_client.job_step_error.call_args[0][1]
+        self.assertEqual(message, 'Showing the last 10 of 5000 bytes of the log.\nend of log')
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_send_job_failed_after_deadline(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+
+        watcher.send_job_failed('myjob', '31', JobStepTypes.STAGE_DATA, time.time() - 1)
+
+        mock_cluster_api.return_value.read_job_log_tail.assert_not_called()
+        message = watcher.lando_client.job_step_error.call_args[0][1]
+        self.assertEqual(message, 'Unable to read logs.')
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_send_job_failed_read_timeout(self, mock_cluster_api):
+        mock_cluster_api.return_value.read_job_log_tail.side_effect = ReadTimeoutError(None, None, 'Read timed out.')
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+
+        watcher.send_job_failed('myjob', '31', JobStepTypes.STAGE_DATA, time.time() + 60)
+
+        message = watcher.lando_client.job_step_error.call_args[0][1]
+        self.assertEqual(message, 'Unable to read logs.')
+
+    def make_pipeline_pod(self, statuses):
+        pod = Mock()
+        pod.metadata.name = 'pipeline-32-joe-abcd'
+        pod.metadata.uid = 'uid1'
+        pod.metadata.labels = {JobLabels.JOB_ID: '32', JobLabels.STEP_TYPE: JobStepTypes.PIPELINE}
+        container_statuses = []
+        for name, exit_code in statuses:
+            container_status = Mock()
+            container_status.name = name
+            if exit_code is None:
+                container_status.state.terminated = None
+            else:
+                container_status.state.terminated.exit_code = exit_code
+            container_statuses.append(container_status)
+        pod.status.init_container_statuses = container_statuses[:3]
+        pod.status.container_statuses = container_statuses[3:]
+        return pod
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_pipeline_pod_change_sends_finished_steps(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_succeeded = Mock()
+        pod = self.make_pipeline_pod([('stage-data', 0), ('run-workflow', None), ('organize-output', None),
+                                      ('save-output', None)])
+        watcher.on_pipeline_pod_change({'type': EventTypes.MODIFIED, 'object': pod})
+        watcher.on_job_succeeded.assert_called_once_with('32', JobStepTypes.STAGE_DATA)
+
+        pod = self.make_pipeline_pod([('stage-data', 0), ('run-workflow', 0), ('organize-output', 0),
+                                      ('save-output', 0)])
+        watcher.on_pipeline_pod_change({'type': EventTypes.MODIFIED, 'object': pod})
+        self.assertEqual([
+            call('32', JobStepTypes.STAGE_DATA),
+            call('32', JobStepTypes.RUN_WORKFLOW),
+            call('32', JobStepTypes.ORGANIZE_OUTPUT),
+            call('32', JobStepTypes.SAVE_OUTPUT),
+        ], watcher.on_job_succeeded.call_args_list)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_pipeline_pod_change_failed_container(self, mock_cluster_api):
+        mock_cluster_api.return_value.read_pod_log_tail.return_value = PodLogs("Workflow failed", 15, 0, 1000)
+        watcher = JobWatcher(config=self.config)
+        watcher.lando_client = Mock()
+        pod = self.make_pipeline_pod([('stage-data', 0), ('run-workflow', 1), ('organize-output', None),
+                                      ('save-output', None)])
+        watcher.on_pipeline_pod_change({'type': EventTypes.MODIFIED, 'object': pod})
+        watcher.on_pipeline_pod_change({'type': EventTypes.DELETED, 'object': pod})
+        watcher.log_executor.shutdown(wait=True)
+
+        watcher.lando_client.job_step_complete.assert_called_once()
+        payload, message = watcher.lando_client.job_step_error.call_args[0]
+        self.assertEqual(payload.error_command, JobCommands.RUN_JOB_ERROR)
+        self.assertEqual(message, 'Workflow failed')
+        mock_cluster_api.return_value.read_pod_log_tail.assert_called_with(
+            'pipeline-32-joe-abcd', container='run-workflow', tail_lines=1000, max_bytes=4096, request_timeout=ANY)
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_on_job_change_ignores_pipeline_job(self, mock_cluster_api):
+        watcher = JobWatcher(config=self.config)
+        watcher.on_job_succeeded = Mock()
+        watcher.on_job_change({'type': EventTypes.MODIFIED,
+                               'object': make_job('pipeline-32-joe', '10', step_type=JobStepTypes.PIPELINE)})
+        watcher.on_job_succeeded.assert_not_called()
+
+    @patch('lando.k8s.watcher.ClusterApi')
+    def test_run_watches_pipeline_pods(self, mock_cluster_api):
+        self.config.fused_pipeline = True
+        mock_cluster_api.return_value.list_jobs_and_resource_version.return_value = [], '100'
+        watcher = JobWatcher(config=self.config)
+        pods_watched = threading.Event()
+        mock_cluster_api.return_value.wait_for_pod_events.side_effect = lambda *args, **kwargs: pods_watched.set()
+        mock_cluster_api.return_value.wait_for_job_events.side_effect = \
+            lambda *args, **kwargs: pods_watched.wait(5) and watcher.stop()
+        watcher.run()
+
+        mock_cluster_api.return_value.wait_for_pod_events.assert_called_with(
+            watcher.on_pipeline_pod_change, label_selector='bespin-job=true,bespin-job-step=pipeline',
+            timeout_seconds=300)
+        self.assertIsNone(watcher.pipeline_thread)
+
     def test_get_cluster_api(self):
         mock_config = Mock()
         mock_config.cluster_api_settings.token = 'Secret123'
@@ -1,11 +1,19 @@
-from lando.k8s.cluster import ClusterApi, JobConditionType, EventTypes, ItemNotFoundException
+from lando.k8s.cluster import ClusterApi, JobConditionType, EventTypes, ItemNotFoundException, GONE_STATUS_CODE
 from lando.k8s.config import create_server_config
-from lando.k8s.jobmanager import JobLabels, JobStepTypes
+from lando.k8s.jobmanager import JobLabels, JobStepTypes, PIPELINE_STEP_CONTAINER_NAMES
 from lando_messaging.clients import LandoClient
 from lando_messaging.messaging import JobCommands
 from kubernetes.client.rest import ApiException
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import traceback
 import logging
+import json
+import os
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 JOB_STEP_TO_COMMANDS = {
     JobStepTypes.STAGE_DATA: (JobCommands.STAGE_JOB_COMPLETE, JobCommands.STAGE_JOB_ERROR),
@@ -15,6 +23,23 @@ JOB_STEP_TO_COMMANDS = {
     JobStepTypes.RECORD_OUTPUT_PROJECT:
         (JobCommands.RECORD_OUTPUT_PROJECT_COMPLETE, JobCommands.RECORD_OUTPUT_PROJECT_ERROR),
 }
+# Job step run by each container of a pipeline job's pod
+PIPELINE_CONTAINER_STEPS = {container_name: step_type for step_type, container_name in PIPELINE_STEP_CONTAINER_NAMES}
+# Seconds each watch request stays open before it is renewed from the last resource version
+WATCH_TIMEOUT_SECONDS = 300
+# Seconds to wait before listing jobs again after a watch fails
+WATCH_RETRY_SECONDS = 5
+# Number of job step transitions remembered so repeated events for a finished job step are not sent again
+MAX_JOB_TRANSITIONS = 10000
+# Sent as the error message for a failed job when its logs could not be read in time
+LOGS_UNAVAILABLE_MESSAGE = "Unable to read logs."
+
+
+class ResourceVersionGoneException(Exception):
+    """
+    The API server no longer has events for the resource version we are watching from.
+    """
+    pass
 
 
 def check_condition_status(job, condition_type):
@@ -38,11 +63,124 @@ class JobStepPayload(object):
         self.error_command = commands[1]
 
 
+class WatcherCheckpoint(object):
+    """
+    Position of the watcher in the stream of job events saved to a file so a restarted watcher resumes from it.
+    Contains the last resource version seen, the resource version of each job that has been handled and
+    the terminal condition sent for each (job uid, step) so each transition is only sent once.
+    Failed job steps whose error has not been sent yet are kept so a restarted watcher sends them.
+    """
+    def __init__(self, filename, max_transitions=MAX_JOB_TRANSITIONS):
+        """
+        :param filename: str: path of the checkpoint file, when None the checkpoint is only kept in memory
+        :param max_transitions: int: number of transitions to remember, the oldest are forgotten first
+        """
+        self.filename = filename
+        self.max_transitions = max_transitions
+        # Transitions are added and saved from the log threads as well as the watch thread
+        self.lock = threading.RLock()
+        self.resource_version = None
+        self.job_versions = {}
+        self.transitions = OrderedDict()
+        self.unsent_failures = set()
+        self.suppressed_duplicates = 0
+        if filename and os.path.exists(filename):
+            with open(filename) as infile:
+                data = json.load(infile)
+            self.resource_version = data.get('resource_version')
+            self.job_versions = data.get('job_versions', {})
+            self.transitions = OrderedDict(data.get('transitions', []))
+            self.unsent_failures = set(data.get('unsent_failures', []))
+            self.suppressed_duplicates = data.get('suppressed_duplicates', 0)
+
+    @staticmethod
+    def transition_key(job_uid, job_step):
+        return '{}/{}'.format(job_uid, job_step)
+
+    def has_transition(self, job_uid, job_step):
+        """
+        :param job_uid: str: unique id kubernetes assigned to the job
+        :param job_step: str: bespin job step the job ran
+        :return: bool: True when a terminal condition has already been sent for this job step
+        """
+        with self.lock:
+            return self.transition_key(job_uid, job_step) in self.transitions
+
+    def add_transition(self, job_uid, job_step, condition_type):
+        """
+        Remember that a terminal condition was sent for a job step, forgetting the oldest when full.
+        :param job_uid: str: unique id kubernetes assigned to the job
+        :param job_step: str: bespin job step the job ran
+        :param condition_type: str: JobConditionType that was sent
+        """
+        with self.lock:
+            self.transitions[self.transition_key(job_uid, job_step)] = condition_type
+            while len(self.transitions) > self.max_transitions:
+                self.transitions.popitem(last=False)
+
+    def remove_transition(self, job_uid, job_step):
+        with self.lock:
+            self.transitions.pop(self.transition_key(job_uid, job_step), None)
+            self.unsent_failures.discard(self.transition_key(job_uid, job_step))
+
+    def has_unsent_failure(self, job_uid, job_step):
+        with self.lock:
+            return self.transition_key(job_uid, job_step) in self.unsent_failures
+
+    def add_unsent_failure(self, job_uid, job_step):
+        with self.lock:
+            self.unsent_failures.add(self.transition_key(job_uid, job_step))
+
+    def failure_sent(self, job_uid, job_step):
+        """
+        Record the FAILED transition of a job step once its error has been sent.
+        """
+        with self.lock:
+            self.unsent_failures.discard(self.transition_key(job_uid, job_step))
+            self.add_transition(job_uid, job_step, JobConditionType.FAILED)
+
+    def save(self):
+        if self.filename:
+            with self.lock:
+                temp_filename = '{}.tmp'.format(self.filename)
+                with open(temp_filename, 'w') as outfile:
+                    json.dump(self.to_dict(), outfile)
+                os.replace(temp_filename, self.filename)
+
+    def to_dict(self):
+        with self.lock:
+            transitions = list(self.transitions.items())
+            unsent_failures = sorted(self.unsent_failures)
+        return {
+            'resource_version': self.resource_version,
+            'job_versions': dict(self.job_versions),
+            'transitions': transitions,
+            'unsent_failures': unsent_failures,
+            'suppressed_duplicates': self.suppressed_duplicates,
+        }
+
+
 class JobWatcher(object):
     def __init__(self, config):
         self.config = config
         self.cluster_api = self.get_cluster_api(config)
         self.lando_client = LandoClient(config, config.work_queue_config.listen_queue)
+        self.checkpoint = WatcherCheckpoint(config.watcher_checkpoint_filename)
+        self.stopped = threading.Event()
+        # Logs of failed jobs are read on these threads so reading them does not hold up the watch
+        self.log_executor = ThreadPoolExecutor(max_workers=config.watcher_log_threads)
+        # Messages are sent from the watch, pipeline and log threads but lando_client is not thread safe
+        self.send_lock = threading.Lock()
+        # Steps of pipeline pods that have been sent, only kept in memory since lando ignores repeated steps
+        self.pipeline_transitions = WatcherCheckpoint(None)
+        self.pipeline_thread = None
+        # Keys of failed job steps whose error is being sent, the transition is recorded once the send succeeds
+        self.failures_being_sent = set()
+        self.failures_lock = threading.Lock()
+        # Set when an error could not be sent so jobs are listed again and the error is resent
+        self.relist_requested = threading.Event()
+        if self.checkpoint.unsent_failures:
+            self.relist_requested.set()
 
     @staticmethod
     def get_cluster_api(config):
@@ -51,49 +189,273 @@ class JobWatcher(object):
                           ssl_ca_cert=settings.ssl_ca_cert)
 
     def run(self):
-        # run on_job_change for jobs that have the bespin job label
+        """
+        Watch jobs that have the bespin job label until stop is called.
+        Each watch resumes from the last resource version seen so only missed events are sent after a restart.
+        When the API server no longer has that version jobs are listed and only the changed ones are handled.
+        """
         bespin_job_label_selector = "{}={}".format(JobLabels.BESPIN_JOB, "true")
-        self.cluster_api.wait_for_job_events(self.on_job_change,
-                                             label_selector=bespin_job_label_selector)
+        if self.config.fused_pipeline:
+            self.start_pipeline_watch()
+        while not self.stopped.is_set():
+            try:
+                if not self.checkpoint.resource_version or self.relist_requested.is_set():
+                    self.relist_requested.clear()
+                    self.relist_jobs(bespin_job_label_selector)
+                self.cluster_api.wait_for_job_events(self.on_job_change,
+                                                     label_selector=bespin_job_label_selector,
+                                                     resource_version=self.checkpoint.resource_version,
+                                                     timeout_seconds=WATCH_TIMEOUT_SECONDS)
+            except ResourceVersionGoneException:
+                logging.info("Resource version {} is too old, listing jobs".format(self.checkpoint.resource_version))
+                self.checkpoint.resource_version = None
+            except ApiException as ex:
+                if ex.status != GONE_STATUS_CODE:
+                    self._watch_failed()
+                self.checkpoint.resource_version = None
+            except:  # Keep watching, jobs whose events were not handled are found when jobs are listed
+                self._watch_failed()
+                self.checkpoint.resource_version = None
+        if self.pipeline_thread:
+            self.pipeline_thread.join()
+            self.pipeline_thread = None
+        # Send errors for failed jobs whose logs are still being read
+        self.log_executor.shutdown(wait=True)
+
+    def _watch_failed(self):
+        logging.error("Watching jobs failed: {}".format(traceback.format_exc()))
+        self.stopped.wait(WATCH_RETRY_SECONDS)
+
+    def stop(self):
+        self.stopped.set()
+
+    def start_pipeline_watch(self):
+        self.pipeline_thread = threading.Thread(target=self._watch_pipeline_pods, name='pipeline-watcher')
+        self.pipeline_thread.daemon = True
+        self.pipeline_thread.start()
+
+    def _watch_pipeline_pods(self):
+        """
+        Watch the pods of pipeline jobs until stop is called.
+        """
+        label_selector = "{}={},{}={}".format(JobLabels.BESPIN_JOB, "true", JobLabels.STEP_TYPE, JobStepTypes.PIPELINE)
+        while not self.stopped.is_set():
+            try:
+                self.cluster_api.wait_for_pod_events(self.on_pipeline_pod_change, label_selector=label_selector,
+                                                     timeout_seconds=WATCH_TIMEOUT_SECONDS)
+            except:  # Keep watching, each new watch resends the state of every pipeline pod
+                self._watch_failed()
+
+    def on_pipeline_pod_change(self, event):
+        """
+        Send a step complete or step error message for each container of a pipeline pod that has finished.
+        Containers run one after another so the messages are sent in the order of the steps.
+        """
+        if event['type'] not in [EventTypes.ADDED, EventTypes.MODIFIED]:
+            return
+        pod = event['object']
+        bespin_job_id = pod.metadata.labels.get(JobLabels.JOB_ID)
+        container_statuses = (pod.status.init_container_statuses or []) + (pod.status.container_statuses or [])
+        for container_status in container_statuses:
+            bespin_job_step = PIPELINE_CONTAINER_STEPS.get(container_status.name)
+            terminated = container_status.state.terminated if container_status.state else None
+            if not bespin_job_step or not terminated:
+                continue
+            if self.pipeline_transitions.has_transition(pod.metadata.uid, bespin_job_step) or \
+                    self.is_failure_being_sent(pod.metadata.uid, bespin_job_step):
+                continue
+            if terminated.exit_code == 0:
+                self.on_job_succeeded(bespin_job_id, bespin_job_step)
+                self.pipeline_transitions.add_transition(pod.metadata.uid, bespin_job_step,
+                                                         JobConditionType.COMPLETE)
+            else:
+                future = self.on_pipeline_container_failed(pod.metadata.name, container_status.name,
+                                                           bespin_job_id, bespin_job_step)
+                self.record_failure_when_sent(self.pipeline_transitions, pod.metadata.uid, bespin_job_step,
+                                              future)
+
+    def relist_jobs(self, label_selector):
+        """
+        List jobs and handle those that changed since they were last handled.
+        :param label_selector: str: selects the jobs to list
+        """
+        jobs, resource_version = self.cluster_api.list_jobs_and_resource_version(label_selector)
+        job_names = set()
+        for job in jobs:
+            job_names.add(job.metadata.name)
+            if self.checkpoint.job_versions.get(job.metadata.name) != job.metadata.resource_version or \
+                    self.is_unsent_failure(job):
+                self.on_job_added_or_modified(job)
+                self.checkpoint.job_versions[job.metadata.name] = job.metadata.resource_version
+        for job_name in list(self.checkpoint.job_versions.keys()):
+            if job_name not in job_names:
+                del self.checkpoint.job_versions[job_name]
+        self.checkpoint.resource_version = resource_version
+        self.checkpoint.save()
 
     def on_job_change(self, event):
         # We only want ADDED or MODIFIED events. We need ADDED to pick up jobs that have 'Failed' or 'Completed'
         # before we started watching. We need MODIFIED for jobs that 'Failed' or 'Completed' while we are watching.
-        if event['type'] in [EventTypes.ADDED, EventTypes.MODIFIED]:
-            self.on_job_added_or_modified(event['object'])
+        event_type = event['type']
+        if event_type == EventTypes.ERROR:
+            status = event.get('raw_object') or {}
+            if status.get('code') == GONE_STATUS_CODE:
+                raise ResourceVersionGoneException()
+            raise ValueError("Error watching jobs: {}".format(status))
+        job = event['object']
+        if event_type in [EventTypes.ADDED, EventTypes.MODIFIED]:
+            self.on_job_added_or_modified(job)
+            self.checkpoint.job_versions[job.metadata.name] = job.metadata.resource_version
+        elif event_type == EventTypes.DELETED:
+            logging.debug('Ignoring event {}'.format(event_type))
+            self.checkpoint.job_versions.pop(job.metadata.name, None)
+            if job.metadata.labels:
+                self.checkpoint.remove_transition(job.metadata.uid, job.metadata.labels.get(JobLabels.STEP_TYPE))
         else:
-            logging.debug('Ignoring event {}'.format(event['type']))
+            logging.debug('Ignoring event {}'.format(event_type))
+        self.checkpoint.resource_version = job.metadata.resource_version
+        self.checkpoint.save()
 
     def on_job_added_or_modified(self, job):
         bespin_job_id = job.metadata.labels.get(JobLabels.JOB_ID)
         bespin_job_step = job.metadata.labels.get(JobLabels.STEP_TYPE)
         if bespin_job_id and bespin_job_step:
+            if bespin_job_step == JobStepTypes.PIPELINE:
+                # Steps of a pipeline job are sent as its pod's containers finish
+                return
             if bespin_job_step in JOB_STEP_TO_COMMANDS:
                 if check_condition_status(job, JobConditionType.COMPLETE):
-                    self.on_job_succeeded(bespin_job_id, bespin_job_step)
+                    if self.is_new_transition(job, bespin_job_step):
+                        self.on_job_succeeded(bespin_job_id, bespin_job_step)
+                        self.checkpoint.add_transition(job.metadata.uid, bespin_job_step, JobConditionType.COMPLETE)
                 elif check_condition_status(job, JobConditionType.FAILED):
-                    self.on_job_failed(job.metadata.name, bespin_job_id, bespin_job_step)
+                    if self.is_new_transition(job, bespin_job_step):
+                        future = self.on_job_failed(job.metadata.name, bespin_job_id, bespin_job_step)
+                        self.record_failure_when_sent(self.checkpoint, job.metadata.uid, bespin_job_step, future)
             else:
                 logging.error("Unable to find job commands:", bespin_job_step, bespin_job_id)
 
+    def is_new_transition(self, job, bespin_job_step):
+        """
+        Determine if a terminal condition for a job step still needs to be sent, counting duplicates that do not.
+        Kubernetes sends more MODIFIED events after a job finishes, for example when its metadata changes.
+        :param job: V1Job: job that has finished
+        :param bespin_job_step: str: bespin job step the job ran
+        :return: bool: True when the transition has not been sent yet
+        """
+        if self.checkpoint.has_transition(job.metadata.uid, bespin_job_step) or \
+                self.is_failure_being_sent(job.metadata.uid, bespin_job_step):
+            self.checkpoint.suppressed_duplicates += 1
+            logging.debug("Suppressed duplicate event for job {} ({} duplicates suppressed)".format(
+                job.metadata.name, self.checkpoint.suppressed_duplicates))
+            return False
+        return True
+
+    def is_unsent_failure(self, job):
+        """
+        :param job: V1Job: job to check
+        :return: bool: True when job is a failed job step whose error has not been sent and is not being sent
+        """
+        bespin_job_step = (job.metadata.labels or {}).get(JobLabels.STEP_TYPE)
+        return self.checkpoint.has_unsent_failure(job.metadata.uid, bespin_job_step) and \
+            not self.is_failure_being_sent(job.metadata.uid, bespin_job_step)
+
+    def is_failure_being_sent(self, job_uid, bespin_job_step):
+        with self.failures_lock:
+            return WatcherCheckpoint.transition_key(job_uid, bespin_job_step) in self.failures_being_sent
+
+    def record_failure_when_sent(self, transitions, job_uid, bespin_job_step, future):
+        """
+        Record the FAILED transition for a job step once the log thread has sent its error.
+        When the error could not be sent nothing is recorded and jobs are listed again so it is resent.
+        :param transitions: WatcherCheckpoint: where the transition is recorded
+        :param job_uid: str: unique id kubernetes assigned to the job or pod
+        :param bespin_job_step: str: bespin job step that failed
+        :param future: Future: log thread task that returns True once the error was sent
+        """
+        key = WatcherCheckpoint.transition_key(job_uid, bespin_job_step)
+        with self.failures_lock:
+            self.failures_being_sent.add(key)
+        transitions.add_unsent_failure(job_uid, bespin_job_step)
+
+        def on_done(done_future):
+            sent = not done_future.cancelled() and done_future.exception() is None and done_future.result()
+            if sent:
+                transitions.failure_sent(job_uid, bespin_job_step)
+                transitions.save()
+            with self.failures_lock:
+                self.failures_being_sent.discard(key)
+            if not sent:
+                self.relist_requested.set()
+
+        future.add_done_callback(on_done)
+
     def on_job_succeeded(self, bespin_job_id, bespin_job_step):
         payload = JobStepPayload(bespin_job_id, bespin_job_step)
-        if payload.success_command == JobCommands.STORE_JOB_OUTPUT_COMPLETE:
-            self.lando_client.job_step_store_output_complete(payload, None)
-        else:
-            self.lando_client.job_step_complete(payload)
+        with self.send_lock:
+            if payload.success_command == JobCommands.STORE_JOB_OUTPUT_COMPLETE:
+                self.lando_client.job_step_store_output_complete(payload, None)
+            else:
+                self.lando_client.job_step_complete(payload)
 
     def on_job_failed(self, job_name, bespin_job_id, bespin_job_step):
+        """
+        Read the logs of a failed job on a log thread and send them as the error message for the job step.
+        Returns without waiting so events for other jobs keep being handled.
+        :return: Future: returns True once the error was sent
+        """
+        deadline = time.time() + self.config.watcher_log_timeout_seconds
+        return self.log_executor.submit(self.send_job_failed, job_name, bespin_job_id, bespin_job_step, deadline)
+
+    def on_pipeline_container_failed(self, pod_name, container_name, bespin_job_id, bespin_job_step):
+        """
+        Read the logs of a failed pipeline container on a log thread and send them as the error message for its step.
+        :return: Future: returns True once the error was sent
+        """
+        deadline = time.time() + self.config.watcher_log_timeout_seconds
+        read_log_tail = partial(self.cluster_api.read_pod_log_tail, container=container_name)
+        return self.log_executor.submit(self.send_job_failed, pod_name, bespin_job_id, bespin_job_step, deadline,
+                                 read_log_tail)
+
+    def send_job_failed(self, job_name, bespin_job_id, bespin_job_step, deadline, read_log_tail=None):
+        """
+        Send the error message for a failed job step, falling back to a short message when the logs could not be
+        read before deadline.
+        :param deadline: float: time by which the error message should be sent
+        :param read_log_tail: func(name, tail_lines, max_bytes, request_timeout): reads the logs for job_name,
+        when None the logs of the most recent pod for the job named job_name are read
+        :return: bool: True when the error message was sent
+        """
+        try:
+            logs = self.read_job_logs(job_name, deadline, read_log_tail or self.cluster_api.read_job_log_tail)
+            self.send_step_error_message(bespin_job_step, bespin_job_id, message=logs)
+            return True
+        except:  # Trap all exceptions since nothing waits on the log threads
+            logging.error("Unable to send error for job {}: {}".format(job_name, traceback.format_exc()))
+            return False
+
+    def read_job_logs(self, job_name, deadline, read_log_tail):
+        remaining_seconds = deadline - time.time()
+        if remaining_seconds <= 0:
+            logging.error("Timed out waiting to read logs for job {}".format(job_name))
+            return LOGS_UNAVAILABLE_MESSAGE
         try:
-            logs = self.cluster_api.read_job_logs(job_name)
+            logs = read_log_tail(job_name, tail_lines=self.config.watcher_log_tail_lines,
+                                 max_bytes=self.config.watcher_log_max_bytes, request_timeout=remaining_seconds)
+            if logs.is_truncated():
+                logging.info("Truncated logs for job {}: kept {} of {} bytes read".format(
+                    job_name, logs.received_bytes - logs.truncated_bytes, logs.received_bytes))
+            return logs.message()
         except (ApiException, ItemNotFoundException) as ex:
             logging.error("Unable to read logs {}".format(str(ex)))
-            logs = "Unable to read logs."
-        self.send_step_error_message(bespin_job_step, bespin_job_id, message=logs)
+        except Exception as ex:  # The request timed out or the connection failed
+            logging.error("Unable to read logs for job {}: {}".format(job_name, str(ex)))
+        return LOGS_UNAVAILABLE_MESSAGE
 
     def send_step_error_message(self, bespin_job_step, bespin_job_id, message):
         payload = JobStepPayload(bespin_job_id, bespin_job_step)
-        self.lando_client.job_step_error(payload, message)
+        with self.send_lock:
+            self.lando_client.job_step_error(payload, message)
 
 
 def main():
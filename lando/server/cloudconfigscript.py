@@ -5,6 +5,7 @@ This script configures disk partitioning and places a config file for the lando_
 """
 
 from collections import defaultdict
+from lando.worker.worker import CONFIG_FILE_NAME as WORKER_CONFIG_FILE_NAME
 import yaml
 
 class CloudConfigScript(object):
@@ -68,3 +69,20 @@ class CloudConfigScript(object):
     def content(self):
         return '#cloud-config\n\n{}'.format(yaml.dump(dict(self._content_dict)))
 
+
+def make_worker_cloud_config_script(config, vm_instance_name, cwl_commands, volume_mounts):
+    """
+    Create a cloud-config script that configures lando_worker to listen on the queue named vm_instance_name.
+    :param config: ServerConfig: settings used to create the worker config file
+    :param vm_instance_name: str: name of the VM, also used as the worker's queue name
+    :param cwl_commands: CWLCommand: commands the worker will use to run workflows
+    :param volume_mounts: dict: partition -> mount point for the attached volume
+    :return: CloudConfigScript
+    """
+    worker_config_yml = config.make_worker_config_yml(vm_instance_name, cwl_commands)
+    cloud_config_script = CloudConfigScript()
+    cloud_config_script.add_write_file(content=worker_config_yml, path=WORKER_CONFIG_FILE_NAME)
+    for partition, mount_point in volume_mounts.items():
+        cloud_config_script.add_volume(partition, mount_point)
+    cloud_config_script.add_manage_etc_hosts()
+    return cloud_config_script
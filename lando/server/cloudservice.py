@@ -2,20 +2,89 @@
 Allows launching and terminating openstack virtual machines.
 """
 import shade
+import requests
+import threading
 import logging
 import uuid
+from lando.server.jobapi import ExpiringCache
+from lando.server.scheduler import Quota, ResourceAmounts, UNLIMITED_QUOTA
+
+# Seconds to reuse image, flavor and network ids looked up by name
+CLOUD_RESOURCE_CACHE_SECONDS = 600
+CLOUD_RESOURCE_CACHE_SIZE = 100
+# Maximum number of connections kept open to each openstack service endpoint
+CLOUD_CONNECTION_POOL_SIZE = 10
 
 
 class CloudClient(object):
     """
     Wraps up openstack shade operations.
+    Use get_shared so that all CloudService objects for a project share one authenticated client.
+    The client's keystone session reuses its token until it expires and is safe to use from multiple threads.
     """
+    _shared_clients = {}
+    _shared_clients_lock = threading.Lock()
+
     def __init__(self, credentials):
         """
         Setup internal client based on credentials in cloud_settings
         :credentials: dictionary of url, username, password, etc
         """
         self.cloud = shade.openstack_cloud(**credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=CLOUD_CONNECTION_POOL_SIZE)
+        self.cloud.keystone_session.session.mount('https://', adapter)
+        self.cloud.keystone_session.session.mount('http://', adapter)
+        self.resource_cache = ExpiringCache(max_size=CLOUD_RESOURCE_CACHE_SIZE)
+
+    @classmethod
+    def get_shared(cls, credentials):
+        """
+        Return the client for credentials creating it the first time it is requested.
+        Credentials differ by project_name so there is one client per project.
+        :param credentials: dictionary of url, username, password, etc
+        :return: CloudClient
+        """
+        key = tuple(sorted(credentials.items()))
+        with cls._shared_clients_lock:
+            client = cls._shared_clients.get(key)
+            if client is None:
+                client = cls(credentials)
+                cls._shared_clients[key] = client
+            return client
+
+    @classmethod
+    def clear_shared(cls):
+        with cls._shared_clients_lock:
+            cls._shared_clients = {}
+
+    def _find_resource(self, resource_type, name, find_func):
+        """
+        Look up the id of a resource by name reusing ids found in the last CLOUD_RESOURCE_CACHE_SECONDS.
+        :param resource_type: str: kind of resource, used to keep names of different kinds apart
+        :param name: str: name of the resource
+        :param find_func: func(name): returns the openstack resource or None if not found
+        :return: dict: {'id': resource id} or name if not found so shade reports the error
+        """
+        if not name:
+            return name
+        def fetch_resource_id():
+            resource = find_func(name)
+            if resource:
+                return {'id': resource['id']}
+            return None
+        resource_id = self.resource_cache.get_or_fetch((resource_type, name), CLOUD_RESOURCE_CACHE_SECONDS,
+                                                       fetch_resource_id)
+        return resource_id or name
+
+    def find_image(self, name):
+        return self._find_resource('image', name, self.cloud.get_image)
+
+    def find_flavor(self, name):
+        return self._find_resource('flavor', name, lambda flavor_name: self.cloud.get_flavor(flavor_name,
+                                                                                              get_extra=False))
+
+    def find_network(self, name):
+        return self._find_resource('network', name, self.cloud.get_network)
 
     def launch_instance(self, vm_settings, server_name, job_flavor_name, script_contents, volumes):
         """
@@ -29,10 +98,11 @@ class CloudClient(object):
         """
         instance = self.cloud.create_server(
             name=server_name,
-            image=vm_settings.image_name,
-            flavor=job_flavor_name,    # The flavor 'Root Disk' value has no effect due to using a volume for storage
+            image=self.find_image(vm_settings.image_name),
+            # The flavor 'Root Disk' value has no effect due to using a volume for storage
+            flavor=self.find_flavor(job_flavor_name),
             key_name=vm_settings.ssh_key_name,
-            network=vm_settings.network_name,
+            network=self.find_network(vm_settings.network_name),
             auto_ip=vm_settings.allocate_floating_ips,
             ip_pool=vm_settings.floating_ip_pool_name,
             userdata=script_contents,
@@ -60,6 +130,65 @@ class CloudClient(object):
         for volume in volume_names:
             self.cloud.delete_volume(volume, wait=True)
 
+    def start_create_volume(self, size, name):
+        """
+        Request creation of a volume without waiting for it to become available.
+        :param size: Size, in gigabytes, of the volume to create
+        :param name: str: unique name for this volume
+        :return: openstack volume being created
+        """
+        return self.cloud.create_volume(size, name=name, wait=False)
+
+    def start_delete_server(self, server_name, delete_floating_ip):
+        """
+        Request deletion of a VM without waiting for it to be removed.
+        :param server_name: str: name of the VM to terminate
+        :param delete_floating_ip: bool: should we try to delete an attached floating ip address
+        """
+        self.cloud.delete_server(server_name, delete_ips=delete_floating_ip, wait=False)
+
+    def start_delete_volume(self, volume_name):
+        """
+        Request deletion of a volume without waiting for it to be removed.
+        :param volume_name: str: name of the volume to delete
+        """
+        self.cloud.delete_volume(volume_name, wait=False)
+
+    def get_servers(self):
+        """
+        Fetch all servers in the project with a single request.
+        :return: dict: server name -> openstack server
+        """
+        return dict((server['name'], server) for server in self.cloud.list_servers(bare=True))
+
+    def get_volumes(self):
+        """
+        Fetch all volumes in the project with a single request.
+        :return: dict: volume name -> openstack volume
+        """
+        return dict((volume['name'], volume) for volume in self.cloud.list_volumes(cache=False))
+
+    def get_quota(self):
+        """
+        Fetch the cores, RAM and volume storage limits for the project and the amounts used.
+        :return: Quota: limits of -1 mean there is no limit and are returned as None
+        """
+        compute_limits = self.cloud.get_compute_limits()
+        volume_limits = self.cloud.get_volume_limits()['absolute']
+        limit = ResourceAmounts(cpus=self._limit_value(compute_limits['max_total_cores']),
+                                memory_gb=self._limit_value(compute_limits['max_total_ram_size'], scale=1024.0),
+                                volume_gb=self._limit_value(volume_limits['maxTotalVolumeGigabytes']))
+        used = ResourceAmounts(cpus=compute_limits['total_cores_used'],
+                               memory_gb=compute_limits['total_ram_used'] / 1024.0,
+                               volume_gb=volume_limits['totalGigabytesUsed'])
+        return Quota(limit, used)
+
+    @staticmethod
+    def _limit_value(value, scale=1.0):
+        if value < 0:
+            return None
+        return value / scale
+
 
 class CloudService(object):
     """
@@ -71,7 +200,7 @@ class CloudService(object):
         :param config: Config config settings for vm and credentials
         :param vm_settings: VMSettings object with vm_project_name, image_name, network and IP settings
         """
-        self.cloud_client = CloudClient(config.cloud_settings.credentials(vm_settings.vm_project_name))
+        self.cloud_client = CloudClient.get_shared(config.cloud_settings.credentials(vm_settings.vm_project_name))
         self.vm_settings = vm_settings
 
     def launch_instance(self, server_name, flavor_name, script_contents, volumes):
@@ -122,11 +251,86 @@ class CloudService(object):
         """
         return 'vol-job{}_{}'.format(job_id, uuid.uuid4())
 
+    def make_pool_vm_name(self):
+        """
+        Create a unique vm name for a VM kept in the warm pool
+        :return: str
+        """
+        return 'vm-pool_{}'.format(uuid.uuid4())
+
+    def make_pool_volume_name(self):
+        """
+        Create a unique volume name for a VM kept in the warm pool
+        :return: str
+        """
+        return 'vol-pool_{}'.format(uuid.uuid4())
+
+    @property
+    def project_name(self):
+        return self.vm_settings.vm_project_name
+
+    def start_create_volume(self, size, name):
+        """
+        Request creation of a volume without waiting for it to become available.
+        :param size: int: size of volume in GB we will create for this VM
+        :param name: str: unique name for the volume.
+        :return: str: id of the volume being created
+        """
+        volume = self.cloud_client.start_create_volume(size, name)
+        return volume.get('id')
+
+    def start_launch_instance(self, server_name, flavor_name, script_contents, volumes):
+        """
+        Request a new VM without waiting for it to become active.
+        :param server_name: str: unique name for the server.
+        :param flavor_name: str: name of flavor(RAM/CPUs) to use for the VM
+        :param script_contents: str: bash script to be run when VM starts.
+        :param volumes: [str]: list of volume ids to attach to the VM
+        """
+        self.cloud_client.launch_instance(self.vm_settings, server_name, flavor_name, script_contents, volumes)
+
+    def start_terminate_instance(self, server_name):
+        """
+        Request termination of the VM with server_name without waiting for it to be removed.
+        :param server_name: str: name of the VM to terminate
+        """
+        logging.info('terminating instance {}'.format(server_name))
+        self.cloud_client.start_delete_server(server_name, delete_floating_ip=self.vm_settings.allocate_floating_ips)
+
+    def start_delete_volume(self, volume_name):
+        """
+        Request deletion of a volume without waiting for it to be removed.
+        :param volume_name: str: name of the volume to delete
+        """
+        self.cloud_client.start_delete_volume(volume_name)
+
+    def get_servers(self):
+        """
+        :return: dict: server name -> server dict containing 'status' and 'accessIPv4'
+        """
+        return self.cloud_client.get_servers()
+
+    def get_volumes(self):
+        """
+        :return: dict: volume name -> volume dict containing 'id' and 'status'
+        """
+        return self.cloud_client.get_volumes()
+
+    def get_quota(self):
+        """
+        :return: Quota: cores, RAM and volume storage limits for the project and the amounts used
+        """
+        return self.cloud_client.get_quota()
+
 
 class FakeCloudService(object):
     """
     Fake cloud service so lando/lando_worker can be run locally.
     """
+    # Pretend servers and volumes shared by all FakeCloudService objects, name -> openstack style dict
+    servers = {}
+    volumes = {}
+
     def __init__(self, config, vm_settings):
         self.vm_settings = vm_settings
 
@@ -147,3 +351,39 @@ class FakeCloudService(object):
 
     def make_volume_name(self, job_id):
         return 'local_volume'
+
+    def make_pool_vm_name(self):
+        return 'local_worker'
+
+    def make_pool_volume_name(self):
+        return 'local_volume'
+
+    @property
+    def project_name(self):
+        return self.vm_settings.vm_project_name
+
+    def start_create_volume(self, size, name):
+        print("Pretend to create a {} GB volume: {}".format(size, name))
+        FakeCloudService.volumes[name] = {'id': 'volume-id', 'status': 'available'}
+        return 'volume-id'
+
+    def start_launch_instance(self, server_name, flavor_name, script_contents, volumes):
+        print("Pretend we create vm: {}".format(server_name))
+        FakeCloudService.servers[server_name] = {'status': 'ACTIVE', 'accessIPv4': '127.0.0.1'}
+
+    def start_terminate_instance(self, server_name):
+        print("Pretend we terminate: {}".format(server_name))
+        FakeCloudService.servers.pop(server_name, None)
+
+    def start_delete_volume(self, volume_name):
+        print("Pretend we delete: {}".format(volume_name))
+        FakeCloudService.volumes.pop(volume_name, None)
+
+    def get_servers(self):
+        return dict(FakeCloudService.servers)
+
+    def get_volumes(self):
+        return dict(FakeCloudService.volumes)
+
+    def get_quota(self):
+        return UNLIMITED_QUOTA
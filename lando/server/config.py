@@ -5,6 +5,7 @@ Reads configuration settings from a YAML file for use with lando
 import yaml
 from lando.exceptions import get_or_raise_config_exception, InvalidConfigException
 import logging
+from lando.server.provisioning import DEFAULT_POLL_SECONDS, DEFAULT_TIMEOUT_SECONDS
 
 
 class ServerConfig(object):
@@ -27,6 +28,23 @@ class ServerConfig(object):
             self.bespin_api_settings = self._optional_get(data, 'bespin_api', BespinApiSettings)
             self.log_level = data.get('log_level', logging.WARNING)
             self.commands = CommandsConfig(data)
+            # Number of threads used to handle messages, messages for the same job are always handled in order
+            self.message_handler_threads = data.get('message_handler_threads', 1)
+            # Seconds between checks on VMs being launched/terminated and how long they have to finish
+            self.provisioning_poll_seconds = data.get('provisioning_poll_seconds', DEFAULT_POLL_SECONDS)
+            self.provisioning_timeout_seconds = data.get('provisioning_timeout_seconds', DEFAULT_TIMEOUT_SECONDS)
+            # File VM launch/terminate requests are saved to so they are tracked again when lando restarts
+            self.provisioning_filename = data.get('provisioning_filename', None)
+            self.warm_pool_settings = self._optional_get(data, 'warm_pool', WarmPoolSettings)
+            self.admission_scheduler_settings = self._optional_get(data, 'admission_scheduler',
+                                                                   AdmissionSchedulerSettings)
+
+    @property
+    def reuse_vms(self):
+        """
+        :return: bool: True when worker VMs run more than one job
+        """
+        return bool(self.warm_pool_settings and self.warm_pool_settings.max_jobs_per_vm > 1)
 
     @staticmethod
     def _optional_get(data, name, constructor):
@@ -55,6 +73,8 @@ class ServerConfig(object):
                 'save_output_command': self.commands.save_output_command,
             },
         }
+        if self.reuse_vms:
+            data['cleanup_job_data'] = True
         if not self.fake_cloud_service:
             data['cwl_base_command'] = cwl_command.base_command
             data['cwl_post_process_command'] = cwl_command.post_process_command
@@ -109,6 +129,70 @@ class BespinApiSettings(object):
     def __init__(self, data):
         self.url = get_or_raise_config_exception(data, 'url')
         self.token = get_or_raise_config_exception(data, 'token')
+        # Settings for the HTTP connection pool shared by all BespinApi objects in a process
+        self.pool_size = data.get('pool_size', 10)
+        self.keep_alive = data.get('keep_alive', True)
+        self.connect_timeout = data.get('connect_timeout', None)
+        self.read_timeout = data.get('read_timeout', None)
+        # Number of seconds DukeDS credentials fetched from bespin are reused
+        self.credentials_cache_seconds = data.get('credentials_cache_seconds', 300)
+        # Number of seconds methods documents and share groups fetched from bespin are reused
+        self.methods_document_cache_seconds = data.get('methods_document_cache_seconds', 3600)
+        self.share_group_cache_seconds = data.get('share_group_cache_seconds', 300)
+
+    @property
+    def timeout(self):
+        """
+        Timeout to pass to requests. Returns None(wait forever) when neither timeout is configured.
+        :return: (float, float) or None: connect and read timeouts in seconds
+        """
+        if self.connect_timeout is None and self.read_timeout is None:
+            return None
+        return self.connect_timeout, self.read_timeout
+
+
+class WarmPoolSettings(object):
+    """
+    Settings for keeping booted worker VMs ready for new jobs.
+    """
+    def __init__(self, data):
+        # Number of VMs always kept for each kind of VM jobs have used
+        self.min_size = data.get('min_size', 0)
+        # Maximum number of VMs kept for each kind of VM
+        self.max_size = data.get('max_size', 2)
+        # Seconds a ready VM may sit unused before it is terminated
+        self.idle_ttl_seconds = data.get('idle_ttl_seconds', 3600)
+        # Seconds a VM has to start lando_worker before it is terminated
+        self.boot_timeout_seconds = data.get('boot_timeout_seconds', 1800)
+        # Seconds between checks that launch or terminate pool VMs
+        self.maintain_seconds = data.get('maintain_seconds', 30)
+        # Number of jobs a VM may run, when more than 1 VMs are returned to the pool after a job finishes
+        self.max_jobs_per_vm = data.get('max_jobs_per_vm', 1)
+        # Seconds after launch that a VM is terminated instead of being kept in the pool
+        self.max_vm_lifetime_seconds = data.get('max_vm_lifetime_seconds', 86400)
+        if self.min_size > self.max_size:
+            raise InvalidConfigException("warm_pool min_size must not be larger than max_size.")
+
+
+class AdmissionSchedulerSettings(object):
+    """
+    Settings for queueing jobs until there is quota to run them.
+    """
+    def __init__(self, data):
+        # Seconds between checks for quota freed by resources lando does not manage
+        self.retry_seconds = data.get('retry_seconds', 60)
+        # Relative share of admitted jobs for each username, users not listed have default_user_weight
+        self.default_user_weight = data.get('default_user_weight', 1)
+        self.user_weights = data.get('user_weights', {})
+        # Maximum admitted jobs each user may have running at once, 0 for no limit, user_max_running_jobs
+        # overrides this value for specific usernames
+        self.max_running_jobs_per_user = data.get('max_running_jobs_per_user', 0)
+        self.user_max_running_jobs = data.get('user_max_running_jobs', {})
+        # Path of a file the queue is saved to so queued jobs are requeued when lando restarts, None to not save it
+        self.queue_filename = data.get('queue_filename', None)
+        weights = [self.default_user_weight] + list(self.user_weights.values())
+        if any(weight <= 0 for weight in weights):
+            raise InvalidConfigException("admission_scheduler user weights must be larger than 0.")
 
 
 class CommandsConfig(object):
@@ -0,0 +1,85 @@
+"""
+Runs message handlers on a pool of threads while keeping messages for the same job in order.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
+import time
+import traceback
+import logging
+
+SHUTDOWN_POLL_SECONDS = 0.1
+
+
+class JobMessageDispatcher(object):
+    """
+    Runs functions for different jobs in parallel on a bounded pool of threads.
+    Functions for the same job are run one at a time in the order they were dispatched.
+    """
+    def __init__(self, max_workers):
+        """
+        :param max_workers: int: maximum number of functions to run at the same time
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        # job key -> deque of functions waiting to run, a key is present while the job has work scheduled
+        self.job_queues = {}
+        self.queue_depth = 0
+        self.in_flight = 0
+
+    def dispatch(self, job_key, func):
+        """
+        Schedule func to run after any previously dispatched functions for job_key have finished.
+        :param job_key: object: identifies the job func belongs to (typically the bespin job id)
+        :param func: func(): function to run
+        """
+        with self.lock:
+            self.queue_depth += 1
+            pending = self.job_queues.get(job_key)
+            if pending is None:
+                self.job_queues[job_key] = deque([func])
+                self.executor.submit(self._run_next, job_key)
+            else:
+                pending.append(func)
+
+    def _run_next(self, job_key):
+        """
+        Run the oldest function for job_key, then reschedule if job_key has more work.
+        Rescheduling(instead of looping) lets other jobs waiting on the pool have a turn.
+        """
+        with self.lock:
+            func = self.job_queues[job_key].popleft()
+            self.queue_depth -= 1
+            self.in_flight += 1
+        try:
+            func()
+        except:  # Trap all exceptions so the job's remaining functions still run
+            logging.error("Error running message handler for job {}: {}".format(job_key, traceback.format_exc()))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                if self.job_queues[job_key]:
+                    self.executor.submit(self._run_next, job_key)
+                else:
+                    del self.job_queues[job_key]
+
+    def stats(self):
+        """
+        Return gauges describing the work being done.
+        :return: dict: number of queued functions, running functions and jobs with work scheduled
+        """
+        with self.lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight,
+                'active_jobs': len(self.job_queues),
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting work. When wait is True blocks until all dispatched functions have finished.
+        """
+        if wait:
+            while self.stats()['active_jobs']:
+                time.sleep(SHUTDOWN_POLL_SECONDS)
+        self.executor.shutdown(wait=wait)
@@ -4,6 +4,212 @@ Allows reading and updating job information when talking to Bespin REST api.
 
 import requests
 import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DDS_USER_CREDENTIAL_CACHE_SIZE = 500
+METHODS_DOCUMENT_CACHE_SIZE = 100
+SHARE_GROUP_CACHE_SIZE = 100
+
+
+class ExpiringCache(object):
+    """
+    Thread safe dictionary whose values are discarded after a number of seconds.
+    When max_size is reached the least recently used value is discarded.
+    """
+    def __init__(self, max_size=None):
+        """
+        :param max_size: int: maximum number of values to keep or None for no limit
+        """
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the value for key or None if it was never added or has expired.
+        :param key: object: key value was added with
+        :return: object: value or None
+        """
+        with self._lock:
+            value = self._get_item(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def _get_item(self, key):
+        item = self._items.get(key)
+        if item:
+            value, expires = item
+            if time.time() < expires:
+                self._items.move_to_end(key)
+                return value
+            del self._items[key]
+        return None
+
+    def set(self, key, value, ttl_seconds):
+        """
+        Add value to the cache for ttl_seconds.
+        :param key: object: key to look up value
+        :param value: object: value to store
+        :param ttl_seconds: float: number of seconds until the value expires
+        """
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl_seconds)
+            self._items.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+                    self.evictions += 1
+
+    def get_or_fetch(self, key, ttl_seconds, fetch_func):
+        """
+        Return the value for key calling fetch_func to create it when missing.
+        Concurrent callers for the same key share a single call to fetch_func.
+        The lock for a key is kept until every caller waiting on it is done so later callers can't start a second
+        fetch, when fetch_func raises the next waiting caller tries again.
+        :param key: object: key to look up value
+        :param ttl_seconds: float: number of seconds until a fetched value expires
+        :param fetch_func: func(): returns value to store for key
+        :return: object: value
+        """
+        value = self.get(key)
+        if value is None:
+            with self._lock:
+                # [lock, number of callers using it]
+                fetch_lock_entry = self._fetch_locks.setdefault(key, [threading.Lock(), 0])
+                fetch_lock_entry[1] += 1
+            try:
+                with fetch_lock_entry[0]:
+                    with self._lock:
+                        value = self._get_item(key)
+                    if value is None:
+                        value = fetch_func()
+                        self.set(key, value, ttl_seconds)
+            finally:
+                with self._lock:
+                    fetch_lock_entry[1] -= 1
+                    if not fetch_lock_entry[1]:
+                        del self._fetch_locks[key]
+        return value
+
+    def stats(self):
+        """
+        Return counters describing how well this cache is working.
+        :return: dict: size, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._items = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# Process wide caches of resources fetched from bespin shared by all JobApi objects
+dds_user_credential_cache = ExpiringCache(max_size=DDS_USER_CREDENTIAL_CACHE_SIZE)
+methods_document_cache = ExpiringCache(max_size=METHODS_DOCUMENT_CACHE_SIZE)
+share_group_cache = ExpiringCache(max_size=SHARE_GROUP_CACHE_SIZE)
+
+
+def bespin_cache_stats():
+    """
+    Return counters for the process wide caches of resources fetched from bespin.
+    :return: dict: cache name -> dict of size, hits, misses and evictions
+    """
+    return {
+        'dds_user_credentials': dds_user_credential_cache.stats(),
+        'methods_documents': methods_document_cache.stats(),
+        'share_groups': share_group_cache.stats(),
+    }
+
+
+class BespinConnectionPool(object):
+    """
+    HTTP connection pool shared by all BespinApi objects in a process.
+    Keeps connections to bespin-api alive so each request doesn't pay for a new TCP/TLS handshake.
+    The underlying urllib3 pool manager is thread safe so a single pool can be used by multiple threads.
+    """
+    _shared_pools = {}
+    _shared_pools_lock = threading.Lock()
+
+    def __init__(self, settings):
+        """
+        :param settings: BespinApiSettings: contains pool size and keep alive settings
+        """
+        self.keep_alive = settings.keep_alive
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.pool_size)
+
+    @classmethod
+    def get_shared(cls, settings):
+        """
+        Return the connection pool for settings.url creating it the first time it is requested.
+        :param settings: BespinApiSettings: contains url and pool settings
+        :return: BespinConnectionPool
+        """
+        with cls._shared_pools_lock:
+            pool = cls._shared_pools.get(settings.url)
+            if pool is None:
+                pool = cls(settings)
+                cls._shared_pools[settings.url] = pool
+            return pool
+
+    @classmethod
+    def shared_connection_stats(cls):
+        """
+        Return connection_stats for every pool created by get_shared.
+        :return: dict: bespin url -> dict of requests, new connections and reused connections
+        """
+        with cls._shared_pools_lock:
+            pools = dict(cls._shared_pools)
+        return {url: pool.connection_stats() for url, pool in pools.items()}
+
+    def create_session(self):
+        """
+        Create a requests session that sends requests through this connection pool.
+        :return: requests.Session
+        """
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def connection_stats(self):
+        """
+        Count how many requests reused an existing connection vs opened a new one.
+        :return: dict: number of requests, new connections and reused connections
+        """
+        total_requests = 0
+        new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            host_pool = pools.get(key)
+            if host_pool:
+                total_requests += host_pool.num_requests
+                new_connections += host_pool.num_connections
+        return {
+            'requests': total_requests,
+            'new_connections': new_connections,
+            'reused_connections': max(total_requests - new_connections, 0),
+        }
 
 
 class BespinApi(object):
@@ -15,6 +221,9 @@ class BespinApi(object):
         :param config: ServerConfig: contains settings for connecting to REST api
         """
         self.settings = config.bespin_api_settings
+        self.connection_pool = BespinConnectionPool.get_shared(self.settings)
+        self.session = self.connection_pool.create_session()
+        self.timeout = self.settings.timeout
 
     def headers(self):
         """
@@ -34,7 +243,7 @@ class BespinApi(object):
         """
         path = 'jobs/{}/'.format(job_id)
         url = self._make_url(path)
-        resp = requests.get(url, headers=self.headers())
+        resp = self.session.get(url, headers=self.headers(), timeout=self.timeout)
         resp.raise_for_status()
         return resp.json()
 
@@ -42,7 +251,7 @@ class BespinApi(object):
         """
         Get list of jobs that are setup to run on vm_instance_name.
         :param vm_instance_name: str: unique name of the vm (also name of the vm's queue)
-        :return: list: list of dict: list of job info
+        :return: generator of dict: job info
         """
         path = 'jobs/?vm_instance_name={}'.format(vm_instance_name)
         url = self._make_url(path)
@@ -57,7 +266,7 @@ class BespinApi(object):
         """
         path = 'jobs/{}/'.format(job_id)
         url = self._make_url(path)
-        resp = requests.put(url, headers=self.headers(), json=data)
+        resp = self.session.put(url, headers=self.headers(), timeout=self.timeout, json=data)
         resp.raise_for_status()
         return resp.json()
 
@@ -69,7 +278,7 @@ class BespinApi(object):
         """
         path = 'job-file-stage-groups/{}'.format(stage_group)
         url = self._make_url(path)
-        return self._get_results(url)
+        return self._get_json(url)
 
     def _make_url(self, suffix):
         return '{}/admin/{}'.format(self.settings.url, suffix)
@@ -77,12 +286,22 @@ class BespinApi(object):
     def get_dds_user_credentials(self):
         """
         Get all duke data service user credentials.
-        :return: dict: credentials details
+        :return: generator of dict: credentials details
         """
         path = 'dds-user-credentials/'
         url = self._make_url(path)
         return self._get_results(url)
 
+    def get_dds_user_credential(self, credential_id):
+        """
+        Get a single duke data service user credential.
+        :param credential_id: int: unique dds user credential id
+        :return: dict: credential details
+        """
+        path = 'dds-user-credentials/{}/'.format(credential_id)
+        url = self._make_url(path)
+        return self._get_json(url)
+
     def post_error(self, job_id, job_step, content):
         """
         Record message associated with an error that occurred while running a job.
@@ -93,7 +312,7 @@ class BespinApi(object):
         """
         path = 'job-errors/'
         url = self._make_url(path)
-        resp = requests.post(url, headers=self.headers(), json={
+        resp = self.session.post(url, headers=self.headers(), timeout=self.timeout, json={
             "job": job_id,
             "job_step": job_step,
             "content": content,
@@ -101,17 +320,33 @@ class BespinApi(object):
         resp.raise_for_status()
         return resp.json()
 
-    def _get_results(self, url):
+    def _get_json(self, url):
         """
-        Given a url that returns a JSON array send a GET request and return the results
-        :param url: str: url which returns a list of items
-        :return: [dict]: items returned from request
+        Send a GET request to url and return the JSON response
+        :param url: str: url which returns a JSON object
+        :return: dict: object returned from request
         """
-        results = []
-        resp = requests.get(url, headers=self.headers())
+        resp = self.session.get(url, headers=self.headers(), timeout=self.timeout)
         resp.raise_for_status()
-        json_data = resp.json()
-        return json_data
+        return resp.json()
+
+    def _get_results(self, url):
+        """
+        Given a url that returns a JSON array send GET requests and yield the results one at a time.
+        When the response is paginated({"results": [...], "next": url}) the next pages are requested as needed.
+        :param url: str: url which returns a list of items
+        :return: generator of dict: items returned from requests
+        """
+        while url:
+            json_data = self._get_json(url)
+            if isinstance(json_data, dict):
+                results = json_data['results']
+                url = json_data.get('next')
+            else:
+                results = json_data
+                url = None
+            for item in results:
+                yield item
 
     def put_job_output_project(self, job_dds_output_project_id, data):
         """
@@ -122,7 +357,7 @@ class BespinApi(object):
         """
         path = 'job-dds-output-projects/{}/'.format(job_dds_output_project_id)
         url = self._make_url(path)
-        resp = requests.put(url, headers=self.headers(), json=data)
+        resp = self.session.put(url, headers=self.headers(), timeout=self.timeout, json=data)
         resp.raise_for_status()
         return resp.json()
 
@@ -134,7 +369,7 @@ class BespinApi(object):
         """
         path = 'share-groups/{}'.format(share_group)
         url = self._make_url(path)
-        return self._get_results(url)
+        return self._get_json(url)
 
     def get_workflow_methods_document(self, methods_document_id):
         """
@@ -144,7 +379,7 @@ class BespinApi(object):
         """
         path = 'workflow-methods-documents/{}'.format(methods_document_id)
         url = self._make_url(path)
-        return self._get_results(url)
+        return self._get_json(url)
 
 
 class JobApi(object):
@@ -158,13 +393,39 @@ class JobApi(object):
         """
         self.api = BespinApi(config)
         self.job_id = job_id
+        # Snapshot of our job kept up to date with the responses from put_job
+        self._job_data = None
+        self._job = None
+        # Job changes collected by job_update, None when we are not within a job_update block
+        self._pending_job_changes = None
 
     def get_job(self):
         """
-        Get information about our job.
+        Get information about our job. Only fetches the job from bespin when we don't have a snapshot of it.
         :return: Job: contains properties about this job
         """
-        return Job(self.api.get_job(self.job_id))
+        if self._job is None:
+            self._set_job_snapshot(self.api.get_job(self.job_id))
+        return self._job
+
+    def _get_job_data(self):
+        """
+        Get the raw job dictionary for our job, fetching it from bespin when we don't have a snapshot of it.
+        :return: dict: job values returned from bespin
+        """
+        self.get_job()
+        return self._job_data
+
+    def _set_job_snapshot(self, job_data):
+        self._job_data = job_data
+        self._job = Job(job_data)
+
+    def invalidate_job(self):
+        """
+        Discard our snapshot of the job so the next get_job will fetch it from bespin.
+        """
+        self._job_data = None
+        self._job = None
 
     def set_job_state(self, state):
         """
@@ -194,8 +455,32 @@ class JobApi(object):
         """
         self._set_job({'vm_volume_name': vm_volume_name})
 
+    @contextmanager
+    def job_update(self):
+        """
+        Collect changes made by set_job_state, set_job_step, etc within this block and send them to bespin
+        in a single request when the block exits. Changes are discarded if the block raises an exception.
+        Our job snapshot is not updated until the changes are sent.
+        """
+        if self._pending_job_changes is not None:
+            # nested blocks are sent by the outermost job_update
+            yield
+            return
+        self._pending_job_changes = {}
+        try:
+            yield
+            job_changes = self._pending_job_changes
+        finally:
+            self._pending_job_changes = None
+        if job_changes:
+            self._set_job(job_changes)
+
     def _set_job(self, params):
-        self.api.put_job(self.job_id, params)
+        if self._pending_job_changes is not None:
+            self._pending_job_changes.update(params)
+        else:
+            # put_job returns the updated job so we can refresh our snapshot without another request
+            self._set_job_snapshot(self.api.put_job(self.job_id, params))
 
     def get_input_files(self):
         """
@@ -206,19 +491,27 @@ class JobApi(object):
         stage_group = self.api.get_file_stage_group(job.stage_group)
         return InputFiles(stage_group)
 
-    def get_credentials(self):
+    def get_credentials(self, input_files=None):
         """
-        Get all bespin service account credentials.
+        Get the bespin service account credentials referenced by our job.
+        Always includes the credential used to store the output project.
+        :param input_files: InputFiles: when specified also includes credentials used to download these files
         :return: Credentials: bespin DukeDS credentials
         """
         job = self.get_job()
+        credential_ids = {job.output_project.dds_user_credentials}
+        if input_files:
+            credential_ids.update([dds_file.user_id for dds_file in input_files.dds_files])
         credentials = Credentials()
-
-        for user_credential_data in self.api.get_dds_user_credentials():
-            credentials.add_user_credential(DDSUserCredential(user_credential_data))
-
+        for credential_id in sorted(credential_ids):
+            credentials.add_user_credential(self._get_dds_user_credential(credential_id))
         return credentials
 
+    def _get_dds_user_credential(self, credential_id):
+        return dds_user_credential_cache.get_or_fetch(
+            credential_id, self.api.settings.credentials_cache_seconds,
+            lambda: DDSUserCredential(self.api.get_dds_user_credential(credential_id)))
+
     def save_error_details(self, job_step, content):
         """
         Send details about an error back to bespin-api.
@@ -260,7 +553,7 @@ class JobApi(object):
         Get Job data for use with running the job
         :return: RunJobData
         """
-        job_data = self.api.get_job(self.job_id)
+        job_data = self._get_job_data()
         methods_document = self.get_workflow_methods_document(job_data['workflow_version']['methods_document'])
         return RunJobData(job_data, methods_document)
 
@@ -269,8 +562,11 @@ class JobApi(object):
         Get Job data for use with storing output
         :return: StoreOutputJobData
         """
-        job_data = self.api.get_job(self.job_id)
-        share_group_data = self.api.get_share_dds_ids(job_data['share_group'])
+        job_data = self._get_job_data()
+        share_group = job_data['share_group']
+        share_group_data = share_group_cache.get_or_fetch(
+            share_group, self.api.settings.share_group_cache_seconds,
+            lambda: self.api.get_share_dds_ids(share_group))
         share_dds_ids = [share_user['dds_id'] for share_user in share_group_data['users']]
         return StoreOutputJobData(job_data, share_dds_ids)
 
@@ -281,19 +577,51 @@ class JobApi(object):
         :return: WorkflowMethodsDocument
         """
         if methods_document_id:
-            methods_document_data = self.api.get_workflow_methods_document(methods_document_id)
-            return WorkflowMethodsDocument(methods_document_data)
+            return methods_document_cache.get_or_fetch(
+                methods_document_id, self.api.settings.methods_document_cache_seconds,
+                lambda: WorkflowMethodsDocument(self.api.get_workflow_methods_document(methods_document_id)))
         return None
 
 
+class LazyAttribute(object):
+    """
+    Descriptor for a value built from an object's bespin data the first time it is read.
+    The value is stored in a slot named after the attribute with a leading underscore.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.slot_name = '_{}'.format(func.__name__)
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot_name)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot_name, value)
+            return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot_name, value)
+
+
 class Job(object):
     """
     Top level job information.
+    Nested sections(workflow, output project, runtime settings, etc) are parsed when first accessed.
     """
+    __slots__ = ('_data', 'id', 'user_id', 'username', 'created', 'name', 'state', 'step', 'job_flavor_name',
+                 'job_flavor_cpus', 'job_flavor_memory', 'vm_instance_name', 'vm_volume_name', 'stage_group',
+                 'volume_size', 'cleanup_vm',
+                 '_workflow', '_output_project', '_volume_mounts', '_vm_settings', '_k8s_settings')
+
     def __init__(self, data):
         """
         :param data: dict: job values returned from bespin.
         """
+        self._data = data
         self.id = data['id']
         self.user_id = data['user']['id']
         self.username = data['user']['username']
@@ -307,27 +635,43 @@ class Job(object):
         self.vm_instance_name = data['vm_instance_name']
         self.vm_volume_name = data['vm_volume_name']
         self.stage_group = data['stage_group']
-        self.workflow = Workflow(data)
-        self.output_project = OutputProject(data)
         self.volume_size = data['volume_size']
-        # Volume mounts is JSON encoded in a text field
-        self.volume_mounts = json.loads(data['vm_volume_mounts'])
         self.cleanup_vm = data.get('cleanup_vm', True)
 
-        job_settings = data['job_settings']
-        self.vm_settings = None
-        if job_settings['job_runtime_openstack']:
-            self.vm_settings = VMSettings(job_settings['job_runtime_openstack'])
+    @LazyAttribute
+    def workflow(self):
+        return Workflow(self._data)
 
-        self.k8s_settings = None
-        if job_settings['job_runtime_k8s']:
-            self.k8s_settings = K8sSettings(job_settings['job_runtime_k8s'])
+    @LazyAttribute
+    def output_project(self):
+        return OutputProject(self._data)
+
+    @LazyAttribute
+    def volume_mounts(self):
+        # Volume mounts is JSON encoded in a text field
+        return json.loads(self._data['vm_volume_mounts'])
+
+    @LazyAttribute
+    def vm_settings(self):
+        job_runtime_openstack = self._data['job_settings']['job_runtime_openstack']
+        if job_runtime_openstack:
+            return VMSettings(job_runtime_openstack)
+        return None
+
+    @LazyAttribute
+    def k8s_settings(self):
+        job_runtime_k8s = self._data['job_settings']['job_runtime_k8s']
+        if job_runtime_k8s:
+            return K8sSettings(job_runtime_k8s)
+        return None
 
 
 class RunJobData(Job):
     """
     Job data plus a workflow methods document
     """
+    __slots__ = ('workflow_methods_document',)
+
     def __init__(self, job_data, methods_document):
         super(RunJobData, self).__init__(job_data)
         self.workflow_methods_document = methods_document
@@ -337,6 +681,8 @@ class StoreOutputJobData(Job):
     """
     Job data plus a list of dds user ids to share results with
     """
+    __slots__ = ('share_dds_ids',)
+
     def __init__(self, job_data, share_dds_ids):
         super(StoreOutputJobData, self).__init__(job_data)
         self.share_dds_ids = share_dds_ids
@@ -380,17 +726,43 @@ class InputFiles(object):
         """
         :param data: dict: input file values returned from bespin.
         """
-        self.dds_files = [DukeDSFile(field) for field in data['dds_files']]
-        self.url_files = [URLFile(field) for field in data['url_files']]
+        self.dds_files = FileRecordList(data['dds_files'], DukeDSFile)
+        self.url_files = FileRecordList(data['url_files'], URLFile)
 
-    def __str__(self):
-        return 'Input file "{}" ({})'.format(self.workflow_name, self.file_type)
+
+class FileRecordList(object):
+    """
+    Read only list of file records stored as one tuple per field instead of a dictionary per file.
+    Records are created as they are accessed so iterating over large stage groups doesn't hold an object per file.
+    """
+    def __init__(self, items, record_class):
+        """
+        :param items: [dict]: file values returned from bespin
+        :param record_class: class with DATA_KEYS and a constructor that accepts a dict of those keys
+        """
+        self.record_class = record_class
+        self.length = len(items)
+        self.columns = tuple(tuple(item[key] for item in items) for key in record_class.DATA_KEYS)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        values = [column[index] for column in self.columns]
+        return self.record_class(dict(zip(self.record_class.DATA_KEYS, values)))
+
+    def __iter__(self):
+        for values in zip(*self.columns):
+            yield self.record_class(dict(zip(self.record_class.DATA_KEYS, values)))
 
 
 class DukeDSFile(object):
     """
     Information about a duke ds file that we will download during job staging.
     """
+    __slots__ = ('file_id', 'destination_path', 'user_id', 'size')
+    DATA_KEYS = ('file_id', 'destination_path', 'dds_user_credentials', 'size')
+
     def __init__(self, data):
         """
         :param data: dict: duke data service file values returned from bespin.
@@ -405,6 +777,9 @@ class URLFile(object):
     """
     Information about a url we will download during job staging.
     """
+    __slots__ = ('url', 'destination_path', 'size')
+    DATA_KEYS = ('url', 'destination_path', 'size')
+
     def __init__(self, data):
         """
         :param data: dict: url values returned from bespin.
@@ -457,6 +832,7 @@ class JobStates(object):
     RUNNING = 'R'
     FINISHED = 'F'
     ERRORED = 'E'
+    CANCELING = 'c'
     CANCELED = 'C'
 
 
@@ -3,13 +3,17 @@ Server that starts/terminates VMs based on messages received from a queue.
 """
 
 from datetime import datetime
+from contextlib import contextmanager
 import traceback
 import json
 import logging
-from lando.server.jobapi import JobApi, JobStates, JobSteps
-from lando.server.cloudconfigscript import CloudConfigScript
+from lando.server.jobapi import JobApi, JobStates, JobSteps, BespinConnectionPool, bespin_cache_stats
+from lando.server.cloudconfigscript import make_worker_cloud_config_script
 from lando.server.cloudservice import CloudService, FakeCloudService
-from lando.worker.worker import CONFIG_FILE_NAME as WORKER_CONFIG_FILE_NAME
+from lando.server.dispatcher import JobMessageDispatcher
+from lando.server.provisioning import ProvisioningTracker
+from lando.server.warmpool import WarmPool
+from lando.server.scheduler import AdmissionScheduler, AdmitJobPayload
 from lando_messaging.clients import LandoWorkerClient, StartJobPayload
 from lando_messaging.messaging import MessageRouter
 from lando_messaging.workqueue import WorkProgressQueue
@@ -23,14 +27,20 @@ class JobSettings(object):
     """
     Creates objects for external communication to be used in JobActions.
     """
-    def __init__(self, job_id, config):
+    def __init__(self, job_id, config, provisioner=None, warm_pool=None, scheduler=None):
         """
         Specifies which job and configuration settings to use
         :param job_id: int: unique id for the job
         :param config: ServerConfig
+        :param provisioner: ProvisioningTracker: tracks VM launch/terminate requests, when None these requests block
+        :param warm_pool: WarmPool: booted VMs ready for new jobs, when None every job launches a new VM
+        :param scheduler: AdmissionScheduler: queues jobs until there is quota to run them, when None jobs start now
         """
         self.job_id = job_id
         self.config = config
+        self.provisioner = provisioner
+        self.warm_pool = warm_pool
+        self.scheduler = scheduler
 
     def get_cloud_service(self, vm_settings):
         """
@@ -73,6 +83,12 @@ class BaseJobActions(object):
         self.config = settings.config
         self.job_api = settings.get_job_api()
         self.work_progress_queue = settings.get_work_progress_queue()
+        self.scheduler = settings.scheduler
+        # Queue position and wait time added to progress notifications
+        self.queue_info = {}
+        # Progress notifications are delayed while within a _job_update block
+        self._delay_progress_notification = False
+        self._progress_notification_delayed = False
 
     def cannot_restart_step_error(self, step_name):
         """
@@ -91,20 +107,73 @@ class BaseJobActions(object):
     def _set_job_state(self, state):
         self.job_api.set_job_state(state)
         self._send_job_progress_notification()
+        if self.scheduler and state in [JobStates.FINISHED, JobStates.ERRORED, JobStates.CANCELED]:
+            # Frees quota reserved for this job so queued jobs can start
+            self.scheduler.release(self.job_id)
 
     def _set_job_step(self, step):
         self.job_api.set_job_step(step)
         if step:
             self._send_job_progress_notification()
 
+    @contextmanager
+    def _job_update(self):
+        """
+        Send job changes made within this block to bespin in a single request.
+        A single progress notification is sent once the changes have been saved.
+        """
+        self._delay_progress_notification = True
+        try:
+            with self.job_api.job_update():
+                yield
+        finally:
+            self._delay_progress_notification = False
+        if self._progress_notification_delayed:
+            self._send_job_progress_notification()
+
     def _send_job_progress_notification(self):
+        if self._delay_progress_notification:
+            self._progress_notification_delayed = True
+            return
+        self._progress_notification_delayed = False
         job = self.job_api.get_job()
-        payload = json.dumps({
+        notification = {
             "job": job.id,
             "state": job.state,
             "step": job.step,
-        })
-        self.work_progress_queue.send(payload)
+        }
+        notification.update(self.queue_info)
+        self.work_progress_queue.send(json.dumps(notification))
+
+    def _wait_for_admission(self, payload):
+        """
+        Queue a job being started until the scheduler has quota to run it.
+        :param payload: StartJobPayload from the user or AdmitJobPayload once the scheduler admits the job
+        :return: bool: True when the job should not be started now
+        """
+        if not self.scheduler:
+            return False
+        job = self.job_api.get_job()
+        if isinstance(payload, AdmitJobPayload):
+            if job.state in [JobStates.CANCELING, JobStates.CANCELED, JobStates.ERRORED]:
+                # The job was stopped while it was being admitted so the resources reserved for it are freed
+                self.scheduler.release(self.job_id)
+                self._show_status("Ignoring admission of stopped job")
+                return True
+            self.queue_info = {"queue_wait_seconds": round(payload.wait_seconds)}
+            self._show_status("Admitted job after waiting {} seconds".format(self.queue_info["queue_wait_seconds"]))
+            return False
+        queue_position = self.scheduler.submit(job)
+        if not queue_position:
+            self.queue_info = {"queue_wait_seconds": 0}
+            return False
+        if job.state not in [JobStates.NEW, JobStates.AUTHORIZED]:
+            # A restarted job waits as authorized so a job stopped while queued is not started once admitted
+            self._set_job_state(JobStates.AUTHORIZED)
+        self.queue_info = {"queue_position": queue_position, "queue_wait_seconds": 0}
+        self._show_status("Waiting for quota at queue position {}".format(queue_position))
+        self._send_job_progress_notification()
+        return True
 
     def _get_cloud_service(self, job):
         return self.settings.get_cloud_service(job.vm_settings)
@@ -129,6 +198,10 @@ class JobActions(BaseJobActions):
     """
     Used by LandoRouter to handle messages at a job specific context.
     """
+    def __init__(self, settings):
+        super(JobActions, self).__init__(settings)
+        self.provisioner = settings.provisioner
+        self.warm_pool = settings.warm_pool
 
     def make_worker_client(self, vm_instance_name):
         """
@@ -145,8 +218,18 @@ class JobActions(BaseJobActions):
         Then we wait for stage data complete message.
         :param payload:StartJobPayload contains job_id we should start
         """
-        self._set_job_state(JobStates.RUNNING)
+        if self._wait_for_admission(payload):
+            # start_job is called again with an AdmitJobPayload once there is quota to run the job
+            return
+        with self._job_update():
+            self._set_job_state(JobStates.RUNNING)
+            self._set_job_step(JobSteps.CREATE_VM)
         job = self.job_api.get_job()
+        if self.warm_pool:
+            pooled_vm = self.warm_pool.acquire(job)
+            if pooled_vm:
+                self.use_pooled_vm(pooled_vm)
+                return
         cloud_service = self._get_cloud_service(job)
         vm_instance_name = cloud_service.make_vm_name(self.job_id)
         vm_volume_name = cloud_service.make_volume_name(self.job_id)
@@ -154,6 +237,17 @@ class JobActions(BaseJobActions):
         # Once the VM launches it will send us the worker_started message
         # this will cause send_stage_job_message to be run.
 
+    def use_pooled_vm(self, pooled_vm):
+        """
+        Run the job on a VM from the warm pool whose worker is already listening on its queue.
+        :param pooled_vm: PooledVM: VM removed from the warm pool for this job
+        """
+        self._show_status("Using warm pool vm {}".format(pooled_vm.vm_instance_name))
+        with self._job_update():
+            self.job_api.set_vm_instance_name(pooled_vm.vm_instance_name)
+            self.job_api.set_vm_volume_name(pooled_vm.vm_volume_name)
+        self.send_stage_job_message(pooled_vm.vm_instance_name)
+
     def restart_job(self, payload):
         """
         Request from user to resume running a job. It will resume based on the value of job.step
@@ -183,26 +277,48 @@ class JobActions(BaseJobActions):
 
     def launch_vm(self, vm_instance_name, vm_volume_name):
         """
-        Sets job state to creating vm, then creates a new VM with vm_instance_name and gives it a floating IP address.
+        Creates a new VM with vm_instance_name and gives it a floating IP address.
+        The job step should already be set to creating vm.
         :param vm_instance_name: str: name we should assign to the new vm
         :param vm_volume_name: str: name we should assign to the attached volume
         """
-        self._set_job_step(JobSteps.CREATE_VM)
         self._show_status("Creating VM")
         job = self.job_api.get_job()
-        worker_config_yml = self.config.make_worker_config_yml(vm_instance_name, job.vm_settings.cwl_commands)
-        cloud_config_script = CloudConfigScript()
-        cloud_config_script.add_write_file(content=worker_config_yml, path=WORKER_CONFIG_FILE_NAME)
-        for partition, mount_point in job.volume_mounts.items():
-            cloud_config_script.add_volume(partition, mount_point)
-        cloud_config_script.add_manage_etc_hosts()
+        cloud_config_script = make_worker_cloud_config_script(self.config, vm_instance_name,
+                                                              job.vm_settings.cwl_commands, job.volume_mounts)
         cloud_service = self._get_cloud_service(job)
-        volume, volume_id = cloud_service.create_volume(job.volume_size, vm_volume_name)
-        instance, ip_address = cloud_service.launch_instance(vm_instance_name, job.job_flavor_name, cloud_config_script.content,
-                                                             [volume_id])
-        self._show_status("Launched vm with ip {}".format(ip_address))
-        self.job_api.set_vm_instance_name(vm_instance_name)
-        self.job_api.set_vm_volume_name(vm_volume_name)
+        if self.warm_pool:
+            self.warm_pool.record_launch(vm_instance_name)
+        if self.provisioner:
+            # vm_launch_complete or vm_launch_error will be called once the VM is active or fails
+            self.provisioner.submit_launch(self.job_id, cloud_service, vm_instance_name, job.job_flavor_name,
+                                           cloud_config_script.content, vm_volume_name, job.volume_size)
+            self._show_status("Requested vm")
+        else:
+            volume, volume_id = cloud_service.create_volume(job.volume_size, vm_volume_name)
+            instance, ip_address = cloud_service.launch_instance(vm_instance_name, job.job_flavor_name,
+                                                                 cloud_config_script.content, [volume_id])
+            self._show_status("Launched vm with ip {}".format(ip_address))
+        with self._job_update():
+            self.job_api.set_vm_instance_name(vm_instance_name)
+            self.job_api.set_vm_volume_name(vm_volume_name)
+
+    def vm_launch_complete(self, payload):
+        """
+        Event from the provisioner that the VM for this job is active.
+        The VM will send us the worker_started message once lando_worker is running.
+        :param payload: ProvisioningEventPayload: contains vm_instance_name and ip_address
+        """
+        self._show_status("Launched vm with ip {}".format(payload.ip_address))
+
+    def vm_launch_error(self, payload):
+        """
+        Event from the provisioner that the VM or volume for this job could not be created.
+        :param payload: ProvisioningEventPayload: contains error message
+        """
+        self._set_job_state(JobStates.ERRORED)
+        self._show_status("Launching vm failed")
+        self._log_error(message=payload.message)
 
     def send_stage_job_message(self, vm_instance_name):
         """
@@ -211,10 +327,12 @@ class JobActions(BaseJobActions):
         """
         self._set_job_step(JobSteps.STAGING)
         self._show_status("Staging data")
-        credentials = self.job_api.get_credentials()
+        if self.warm_pool:
+            self.warm_pool.record_staging(self.job_id)
         job = self.job_api.get_job()
         worker_client = self.make_worker_client(vm_instance_name)
         input_files = self.job_api.get_input_files()
+        credentials = self.job_api.get_credentials(input_files)
         worker_client.stage_job(credentials, job, input_files, vm_instance_name)
 
     def stage_job_complete(self, payload):
@@ -282,13 +400,61 @@ class JobActions(BaseJobActions):
         """
         self._set_job_step(JobSteps.TERMINATE_VM)
         job = self.job_api.get_job()
-        cloud_service = self._get_cloud_service(job)
-        if job.cleanup_vm:
-            cloud_service.terminate_instance(job.vm_instance_name, [job.vm_volume_name])
+        if job.cleanup_vm and self.warm_pool and self.warm_pool.release(job):
+            # The worker keeps listening on its queue for the next job
+            self._show_status("Returned vm {} to the warm pool".format(job.vm_instance_name))
+            self._finish_job()
+            return
+        waiting_for_termination = self._terminate_instance(job)
         worker_client = self.make_worker_client(job.vm_instance_name)
         worker_client.delete_queue()
-        self._set_job_step(JobSteps.NONE)
-        self._set_job_state(JobStates.FINISHED)
+        if not waiting_for_termination:
+            self._finish_job()
+
+    def _terminate_instance(self, job):
+        """
+        Terminate the job's VM and volume if the job is configured to clean them up.
+        :param job: Job: job whose VM we should terminate
+        :return: bool: True when vm_terminate_complete or vm_terminate_error will be called once termination finishes
+        """
+        if not job.cleanup_vm:
+            return False
+        if self.warm_pool:
+            self.warm_pool.forget(job.vm_instance_name)
+        cloud_service = self._get_cloud_service(job)
+        if self.provisioner:
+            self.provisioner.submit_terminate(self.job_id, cloud_service, job.vm_instance_name, [job.vm_volume_name])
+            return True
+        cloud_service.terminate_instance(job.vm_instance_name, [job.vm_volume_name])
+        return False
+
+    def _finish_job(self):
+        with self._job_update():
+            self._set_job_step(JobSteps.NONE)
+            self._set_job_state(JobStates.FINISHED)
+
+    def vm_terminate_complete(self, payload):
+        """
+        Event from the provisioner that the VM and volume for this job have been deleted.
+        Finishes the job unless it was canceled.
+        :param payload: ProvisioningEventPayload: contains vm_instance_name
+        """
+        self._show_status("Terminated vm {}".format(payload.vm_instance_name))
+        job = self.job_api.get_job()
+        if job.state != JobStates.CANCELED and job.step == JobSteps.TERMINATE_VM:
+            self._finish_job()
+
+    def vm_terminate_error(self, payload):
+        """
+        Event from the provisioner that the VM or volume for this job could not be deleted.
+        Canceled jobs remain canceled and only record the error.
+        :param payload: ProvisioningEventPayload: contains error message
+        """
+        job = self.job_api.get_job()
+        if job.state != JobStates.CANCELED:
+            self._set_job_state(JobStates.ERRORED)
+        self._show_status("Terminating vm failed")
+        self._log_error(message=payload.message)
 
     def cancel_job(self, payload):
         """
@@ -296,14 +462,13 @@ class JobActions(BaseJobActions):
         Sets status to canceled and terminates the associated VM and deletes the queue.
         :param payload: CancelJobPayload: contains job id we should cancel
         """
-        self._set_job_step(JobSteps.NONE)
-        self._set_job_state(JobStates.CANCELED)
+        with self._job_update():
+            self._set_job_step(JobSteps.NONE)
+            self._set_job_state(JobStates.CANCELED)
         self._show_status("Canceling job")
         job = self.job_api.get_job()
         if job.vm_instance_name:
-            cloud_service = self._get_cloud_service(job)
-            if job.cleanup_vm:
-                cloud_service.terminate_instance(job.vm_instance_name, [job.vm_volume_name])
+            self._terminate_instance(job)
             worker_client = self.make_worker_client(job.vm_instance_name)
             worker_client.delete_queue()
 
@@ -336,7 +501,24 @@ class JobActions(BaseJobActions):
 
 
 def create_job_actions(lando, job_id):
-    return JobActions(JobSettings(job_id, lando.config))
+    return JobActions(JobSettings(job_id, lando.config, lando.provisioner, lando.warm_pool, lando.scheduler))
+
+
+class CloudQuotaReader(object):
+    """
+    Reads the quota of the OpenStack project a job's VM will run in.
+    """
+    def __init__(self, job_settings):
+        """
+        :param job_settings: JobSettings: creates cloud services for reading quota
+        """
+        self.job_settings = job_settings
+
+    def get_quota_key(self, job):
+        return job.vm_settings.vm_project_name
+
+    def read_quota(self, job):
+        return self.job_settings.get_cloud_service(job.vm_settings).get_quota()
 
 
 class Lando(object):
@@ -353,6 +535,14 @@ class Lando(object):
         """
         self.config = config
         self.job_actions_constructor = job_actions_constructor
+        # Runs actions on a pool of threads while listening for messages, otherwise actions run immediately
+        self.dispatcher = None
+        # Tracks VM launch/terminate requests while listening for messages, otherwise these requests block
+        self.provisioner = None
+        # Booted VMs ready for new jobs while listening for messages when warm_pool is configured
+        self.warm_pool = None
+        # Queues jobs until there is quota while listening for messages when admission_scheduler is configured
+        self.scheduler = None
 
     def _make_actions(self, job_id):
         """
@@ -373,14 +563,29 @@ class Lando(object):
         :return: func(payload): function that will call the appropriate JobActions method
         """
         def action_method(payload):
-            actions = self._make_actions(payload.job_id)
-            try:
-                getattr(actions, name)(payload)
-            except:  # Trap all exceptions
-                tb = traceback.format_exc()
-                self._handle_action_error(actions, name, payload, tb)
+            self._dispatch(payload.job_id, lambda: self._run_action(name, payload))
         return action_method
 
+    def _dispatch(self, job_id, func):
+        """
+        Run func now or, while listening for messages, schedule func to run after earlier work for job_id.
+        :param job_id: int: unique id for the job
+        :param func: func(): function to run
+        """
+        if self.dispatcher:
+            self.dispatcher.dispatch(job_id, func)
+            logging.debug("Message dispatcher stats: {}".format(self.dispatcher.stats()))
+        else:
+            func()
+
+    def _run_action(self, name, payload):
+        actions = self._make_actions(payload.job_id)
+        try:
+            getattr(actions, name)(payload)
+        except:  # Trap all exceptions
+            tb = traceback.format_exc()
+            self._handle_action_error(actions, name, payload, tb)
+
     def _handle_action_error(self, actions, name, payload, error_stacktrace_str):
         try:
             logging.error("Handling error that occurred during {} for job {}.".format(name, payload.job_id))
@@ -397,18 +602,116 @@ class Lando(object):
         :param worker_started_payload: WorkerStartedPayload: contains worker_queue_name for the worker
         """
         vm_instance_name = worker_started_payload.worker_queue_name
+        if self.warm_pool and self.warm_pool.worker_started(vm_instance_name):
+            return
         for job in JobApi.get_jobs_for_vm_instance_name(self.config, vm_instance_name):
             if job.state == JobStates.RUNNING and job.step == JobSteps.CREATE_VM:
-                actions = self._make_actions(job.id)
-                actions.send_stage_job_message(vm_instance_name)
+                self._dispatch(job.id, self._make_send_stage_job_message_func(job.id, vm_instance_name))
+
+    def _make_send_stage_job_message_func(self, job_id, vm_instance_name):
+        def send_stage_job_message():
+            actions = self._make_actions(job_id)
+            actions.send_stage_job_message(vm_instance_name)
+        return send_stage_job_message
 
     def listen_for_messages(self):
         """
         Blocks and waits for messages on the queue specified in config.
+        Messages are handled by a pool of message_handler_threads threads.
         """
         router = self._make_router()
+        self.dispatcher = JobMessageDispatcher(max_workers=self.config.message_handler_threads)
+        self.provisioner = self._make_provisioner()
+        if self.provisioner:
+            self.provisioner.restore(self._make_provisioning_request_context)
+            self.provisioner.start()
+            self.warm_pool = self._make_warm_pool()
+        if self.warm_pool:
+            self.warm_pool.start()
+        self.scheduler = self._make_scheduler()
+        if self.scheduler:
+            self.scheduler.restore(lambda job_id: JobApi(self.config, job_id).get_job())
+            self.scheduler.start()
         logging.info("Lando listening for messages on queue '{}'.".format(router.queue_name))
-        router.run()
+        try:
+            router.run()
+        finally:
+            self._log_stats()
+            if self.scheduler:
+                self.scheduler.stop()
+                self.scheduler = None
+            if self.warm_pool:
+                self.warm_pool.stop()
+                self.warm_pool = None
+            if self.provisioner:
+                self.provisioner.stop()
+                self.provisioner = None
+            self.dispatcher.shutdown()
+            self.dispatcher = None
+
+    def _log_stats(self):
+        """
+        Log counters describing how well the message dispatcher, bespin connections and bespin caches are working.
+        """
+        logging.info("Message dispatcher stats: {}".format(self.dispatcher.stats()))
+        logging.info("Bespin connection stats: {}".format(BespinConnectionPool.shared_connection_stats()))
+        logging.info("Bespin cache stats: {}".format(bespin_cache_stats()))
+
+    def _make_provisioner(self):
+        return ProvisioningTracker(self._send_provisioning_event,
+                                   poll_seconds=self.config.provisioning_poll_seconds,
+                                   timeout_seconds=self.config.provisioning_timeout_seconds,
+                                   filename=self.config.provisioning_filename)
+
+    def _make_provisioning_request_context(self, job_id, server_name):
+        """
+        Rebuild the parts of a job's provisioning request that are not saved when lando restarts.
+        :param job_id: int: unique id for the job
+        :param server_name: str: name of the job's VM
+        :return: (CloudService, str): service for the job's project and the cloud-init script for its VM
+        """
+        job = JobApi(self.config, job_id).get_job()
+        cloud_service = self._make_job_settings(job_id, self.config).get_cloud_service(job.vm_settings)
+        cloud_config_script = make_worker_cloud_config_script(self.config, server_name, job.vm_settings.cwl_commands,
+                                                              job.volume_mounts)
+        return cloud_service, cloud_config_script.content
+
+    def _make_warm_pool(self):
+        warm_pool_settings = self.config.warm_pool_settings
+        if not warm_pool_settings:
+            return None
+        return WarmPool(self.config, warm_pool_settings, self.provisioner,
+                        lambda vm_settings: self._make_job_settings(None, self.config).get_cloud_service(vm_settings))
+
+    def _make_scheduler(self):
+        scheduler_settings = self.config.admission_scheduler_settings
+        if not scheduler_settings:
+            return None
+        return AdmissionScheduler(self._make_quota_reader(), self._admit_job, scheduler_settings)
+
+    def _make_quota_reader(self):
+        return CloudQuotaReader(self._make_job_settings(None, self.config))
+
+    def _admit_job(self, job_id, wait_seconds):
+        """
+        Start a job the scheduler has admitted the same way as a start_job message received from the queue.
+        :param job_id: int: unique id for the job
+        :param wait_seconds: float: seconds the job waited in the queue
+        """
+        self.start_job(AdmitJobPayload(job_id, wait_seconds))
+
+    def _send_provisioning_event(self, event_name, payload):
+        """
+        Handle a provisioning event the same way as a message received from the queue.
+        Events for VMs that do not belong to a job are sent to the warm pool.
+        :param event_name: str: name of the JobActions method to run
+        :param payload: ProvisioningEventPayload: contains job_id the event is for
+        """
+        if payload.job_id is None:
+            if self.warm_pool:
+                self.warm_pool.provisioning_event(event_name, payload)
+        else:
+            getattr(self, event_name)(payload)
 
     def _make_router(self):
         work_queue_config = self.config.work_queue_config
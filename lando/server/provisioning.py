@@ -0,0 +1,449 @@
+"""
+Launches and terminates VMs without waiting on the cloud.
+Requests are recorded in a table that a background thread advances by polling the cloud.
+When a request finishes an event is sent back to lando so the job can continue.
+"""
+import threading
+import traceback
+import logging
+import json
+import os
+import time
+
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_TIMEOUT_SECONDS = 1800
+VOLUME_AVAILABLE_STATUS = 'available'
+VOLUME_DELETABLE_STATUSES = ['available', 'error']
+VOLUME_ERROR_STATUSES = ['error', 'error_deleting']
+SERVER_ACTIVE_STATUS = 'ACTIVE'
+SERVER_ERROR_STATUS = 'ERROR'
+
+
+class ProvisioningException(Exception):
+    """
+    The cloud reported a failure for a launch or terminate request.
+    """
+    pass
+
+
+class ProvisioningStates(object):
+    """
+    Values for the state of a request in the ProvisioningTracker table.
+    """
+    CREATING_VOLUME = 'creating_volume'
+    CREATING_SERVER = 'creating_server'
+    DELETING_SERVER = 'deleting_server'
+    DELETING_VOLUMES = 'deleting_volumes'
+
+
+class ProvisioningEvents(object):
+    """
+    Names of the JobActions methods called when a request finishes.
+    """
+    VM_LAUNCH_COMPLETE = 'vm_launch_complete'
+    VM_LAUNCH_ERROR = 'vm_launch_error'
+    VM_TERMINATE_COMPLETE = 'vm_terminate_complete'
+    VM_TERMINATE_ERROR = 'vm_terminate_error'
+
+
+class ProvisioningEventPayload(object):
+    """
+    Payload sent to JobActions when a launch or terminate request finishes.
+    """
+    def __init__(self, job_id, vm_instance_name, ip_address=None, message=None):
+        """
+        :param job_id: int: unique id for the job
+        :param vm_instance_name: str: name of the VM the request was for
+        :param ip_address: str: address of a launched VM
+        :param message: str: details about why the request failed
+        """
+        self.job_id = job_id
+        self.vm_instance_name = vm_instance_name
+        self.ip_address = ip_address
+        self.message = message
+
+
+class LaunchRequest(object):
+    """
+    Creates a volume, waits for it to become available and then creates a VM that uses it.
+    """
+    request_type = 'launch'
+    complete_event = ProvisioningEvents.VM_LAUNCH_COMPLETE
+    error_event = ProvisioningEvents.VM_LAUNCH_ERROR
+
+    def __init__(self, job_id, cloud_service, server_name, flavor_name, script_contents, volume_name, volume_id,
+                 settings_job_id=None):
+        self.job_id = job_id
+        self.cloud_service = cloud_service
+        self.server_name = server_name
+        self.flavor_name = flavor_name
+        self.script_contents = script_contents
+        self.volume_name = volume_name
+        self.volume_id = volume_id
+        self.settings_job_id = settings_job_id
+        self.state = ProvisioningStates.CREATING_VOLUME
+        self.submitted = time.time()
+
+    def to_dict(self):
+        """
+        :return: dict: values needed to track the request again, the cloud-init script is rebuilt instead of saved
+        """
+        return {
+            'type': self.request_type,
+            'job_id': self.job_id,
+            'server_name': self.server_name,
+            'flavor_name': self.flavor_name,
+            'volume_name': self.volume_name,
+            'volume_id': self.volume_id,
+            'settings_job_id': self.settings_job_id,
+            'state': self.state,
+            'submitted': self.submitted,
+        }
+
+    @staticmethod
+    def from_dict(data, cloud_service, script_contents):
+        request = LaunchRequest(data['job_id'], cloud_service, data['server_name'], data['flavor_name'],
+                                script_contents, data['volume_name'], data['volume_id'],
+                                settings_job_id=data.get('settings_job_id'))
+        request.state = data['state']
+        request.submitted = data['submitted']
+        return request
+
+    def make_terminate_request(self, cloud_service, volume_names):
+        """
+        Create a request that removes whatever this launch has created so far.
+        The VM is only deleted once it appears when it was requested, otherwise only the volume is left.
+        :param cloud_service: CloudService: service for the project that contains the VM
+        :param volume_names: [str]: names of other volumes to delete once the VM is gone
+        :return: TerminateRequest: request that has not sent anything to the cloud yet
+        """
+        if self.volume_name not in volume_names:
+            volume_names = list(volume_names) + [self.volume_name]
+        wait_for_server = self.state == ProvisioningStates.CREATING_SERVER
+        return TerminateRequest(self.job_id, cloud_service, self.server_name, volume_names,
+                                wait_for_server=wait_for_server, settings_job_id=self.settings_job_id)
+
+    def advance(self, servers, volumes):
+        """
+        Move to the next state based on the latest servers and volumes fetched from the cloud.
+        :param servers: dict: server name -> server dict
+        :param volumes: dict: volume name -> volume dict
+        :return: ProvisioningEventPayload: payload for complete_event once the VM is active, otherwise None
+        """
+        if self.state == ProvisioningStates.CREATING_VOLUME:
+            volume_status = volumes.get(self.volume_name, {}).get('status')
+            if volume_status in VOLUME_ERROR_STATUSES:
+                raise ProvisioningException("Volume {} has status {}.".format(self.volume_name, volume_status))
+            if volume_status == VOLUME_AVAILABLE_STATUS:
+                self.cloud_service.start_launch_instance(self.server_name, self.flavor_name, self.script_contents,
+                                                         [self.volume_id])
+                self.state = ProvisioningStates.CREATING_SERVER
+        elif self.state == ProvisioningStates.CREATING_SERVER:
+            server = servers.get(self.server_name)
+            if server:
+                server_status = server.get('status')
+                if server_status == SERVER_ERROR_STATUS:
+                    raise ProvisioningException("VM {} has status {}.".format(self.server_name, server_status))
+                if server_status == SERVER_ACTIVE_STATUS:
+                    return ProvisioningEventPayload(self.job_id, self.server_name, ip_address=server.get('accessIPv4'))
+        return None
+
+
+class TerminateRequest(object):
+    """
+    Deletes a VM, waits for it to be removed and then deletes its volumes.
+    When wait_for_server is set the VM was requested but may not be listed yet, so it is deleted once it appears.
+    """
+    request_type = 'terminate'
+    complete_event = ProvisioningEvents.VM_TERMINATE_COMPLETE
+    error_event = ProvisioningEvents.VM_TERMINATE_ERROR
+
+    def __init__(self, job_id, cloud_service, server_name, volume_names, wait_for_server=False,
+                 settings_job_id=None):
+        self.job_id = job_id
+        self.cloud_service = cloud_service
+        self.server_name = server_name
+        self.volume_names = volume_names
+        self.wait_for_server = wait_for_server
+        self.settings_job_id = settings_job_id
+        self.deleted_volume_names = set()
+        self.state = ProvisioningStates.DELETING_SERVER
+        self.submitted = time.time()
+
+    def to_dict(self):
+        """
+        :return: dict: values needed to track the request again
+        """
+        return {
+            'type': self.request_type,
+            'job_id': self.job_id,
+            'server_name': self.server_name,
+            'volume_names': self.volume_names,
+            'wait_for_server': self.wait_for_server,
+            'settings_job_id': self.settings_job_id,
+            'deleted_volume_names': sorted(self.deleted_volume_names),
+            'state': self.state,
+            'submitted': self.submitted,
+        }
+
+    @staticmethod
+    def from_dict(data, cloud_service, script_contents):
+        request = TerminateRequest(data['job_id'], cloud_service, data['server_name'], data['volume_names'],
+                                   wait_for_server=data.get('wait_for_server', False),
+                                   settings_job_id=data.get('settings_job_id'))
+        request.deleted_volume_names = set(data['deleted_volume_names'])
+        request.state = data['state']
+        request.submitted = data['submitted']
+        return request
+
+    def advance(self, servers, volumes):
+        """
+        Move to the next state based on the latest servers and volumes fetched from the cloud.
+        Volumes are only deleted once they have been detached from the deleted VM.
+        :param servers: dict: server name -> server dict
+        :param volumes: dict: volume name -> volume dict
+        :return: ProvisioningEventPayload: payload for complete_event once everything is removed, otherwise None
+        """
+        if self.state == ProvisioningStates.DELETING_SERVER:
+            if self.wait_for_server:
+                if self.server_name in servers:
+                    self.cloud_service.start_terminate_instance(self.server_name)
+                    self.wait_for_server = False
+                return None
+            if self.server_name not in servers:
+                self.state = ProvisioningStates.DELETING_VOLUMES
+        if self.state == ProvisioningStates.DELETING_VOLUMES:
+            remaining_volume_names = [name for name in self.volume_names if name in volumes]
+            for volume_name in remaining_volume_names:
+                volume_status = volumes[volume_name].get('status')
+                if volume_status == 'error_deleting':
+                    raise ProvisioningException("Volume {} has status {}.".format(volume_name, volume_status))
+                if volume_name not in self.deleted_volume_names and volume_status in VOLUME_DELETABLE_STATUSES:
+                    self.cloud_service.start_delete_volume(volume_name)
+                    self.deleted_volume_names.add(volume_name)
+            if not remaining_volume_names:
+                return ProvisioningEventPayload(self.job_id, self.server_name)
+        return None
+
+
+class ProvisioningTracker(object):
+    """
+    Table of launch and terminate requests that have been submitted to the cloud but have not finished.
+    Each poll fetches servers and volumes once per project and advances every request in that project.
+    When filename is set the table is saved to it after every change so restore can track the requests again
+    after lando restarts.
+    """
+    def __init__(self, send_event, poll_seconds=DEFAULT_POLL_SECONDS, timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 filename=None):
+        """
+        :param send_event: func(event_name, payload): called with a ProvisioningEvents name when a request finishes
+        :param poll_seconds: int: seconds to wait between polling the cloud
+        :param timeout_seconds: int: seconds a request may take before it is considered failed
+        :param filename: str: path of the file the table is saved to, when None the table is only kept in memory
+        """
+        self.send_event = send_event
+        self.poll_seconds = poll_seconds
+        self.timeout_seconds = timeout_seconds
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.requests = []
+        self.stop_polling = threading.Event()
+        self.thread = None
+
+    def submit_launch(self, job_id, cloud_service, server_name, flavor_name, script_contents, volume_name,
+                      volume_size, settings_job_id=None):
+        """
+        Request a volume for a new VM and track it until the VM is active.
+        :param job_id: int: unique id for the job
+        :param cloud_service: CloudService: service for the project that will contain the VM
+        :param server_name: str: unique name for the VM
+        :param flavor_name: str: name of flavor(RAM/CPUs) to use for the VM
+        :param script_contents: str: cloud-init script to run when the VM starts
+        :param volume_name: str: unique name for the volume attached to the VM
+        :param volume_size: int: size of the volume in GB
+        :param settings_job_id: int: for a VM that does not belong to a job, the job whose settings it was created
+        with so the request can be restored
+        """
+        volume_id = cloud_service.start_create_volume(volume_size, volume_name)
+        self._add_request(LaunchRequest(job_id, cloud_service, server_name, flavor_name, script_contents,
+                                        volume_name, volume_id, settings_job_id=settings_job_id))
+
+    def submit_terminate(self, job_id, cloud_service, server_name, volume_names, settings_job_id=None):
+        """
+        Request deletion of a VM and track it until the VM and volumes have been removed.
+        A launch of the VM that has not finished is dropped so it never creates the VM or sends vm_launch_complete.
+        :param job_id: int: unique id for the job
+        :param cloud_service: CloudService: service for the project that contains the VM
+        :param server_name: str: name of the VM to terminate
+        :param volume_names: [str]: names of volumes to delete once the VM is gone
+        :param settings_job_id: int: for a VM that does not belong to a job, the job whose settings it was created
+        with so the request can be restored
+        """
+        with self.lock:
+            launch_request = self._remove_launch_request(job_id, server_name)
+            if launch_request:
+                request = launch_request.make_terminate_request(cloud_service, volume_names)
+            else:
+                cloud_service.start_terminate_instance(server_name)
+                request = TerminateRequest(job_id, cloud_service, server_name, volume_names,
+                                           settings_job_id=settings_job_id)
+            self._add_request(request)
+
+    def _remove_launch_request(self, job_id, server_name):
+        """
+        Stop tracking the launch of a VM that is about to be terminated, must be called while holding the lock.
+        :return: LaunchRequest: the launch that was removed or None when the VM is not being launched
+        """
+        for request in self.requests:
+            if isinstance(request, LaunchRequest) and request.job_id == job_id and \
+                    request.server_name == server_name:
+                self.requests.remove(request)
+                return request
+        return None
+
+    def _add_request(self, request):
+        with self.lock:
+            self.requests.append(request)
+            self.save()
+
+    def save(self):
+        """
+        Write the requests that have not finished to filename.
+        """
+        if not self.filename:
+            return
+        with self.lock:
+            temp_filename = '{}.tmp'.format(self.filename)
+            with open(temp_filename, 'w') as outfile:
+                json.dump([request.to_dict() for request in self.requests], outfile)
+            os.replace(temp_filename, self.filename)
+
+    def restore(self, make_request_context):
+        """
+        Track the requests saved to filename by an earlier lando process again.
+        Requests for VMs that do not belong to a job use the context of the job whose settings created the VM.
+        Warm pools are not saved, so such a VM that was still being launched is terminated instead.
+        :param make_request_context: func(job_id, server_name): returns (CloudService, str) the cloud service for
+        the job's project and the cloud-init script for its VM
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        with open(self.filename) as infile:
+            saved_requests = json.load(infile)
+        request_classes = {request_class.request_type: request_class
+                           for request_class in [LaunchRequest, TerminateRequest]}
+        requests = []
+        for data in saved_requests:
+            context_job_id = data['job_id'] if data['job_id'] is not None else data.get('settings_job_id')
+            if context_job_id is None:
+                logging.error("Unable to restore provisioning request for VM without a job: {}".format(data))
+                continue
+            try:
+                cloud_service, script_contents = make_request_context(context_job_id, data['server_name'])
+                request = request_classes[data['type']].from_dict(data, cloud_service, script_contents)
+                if request.job_id is None and isinstance(request, LaunchRequest):
+                    request = request.make_terminate_request(cloud_service, [])
+                requests.append(request)
+            except:  # Skip requests for jobs that can no longer be read so the others are still tracked
+                logging.error("Unable to restore provisioning request {}: {}".format(data, traceback.format_exc()))
+        with self.lock:
+            self.requests.extend(requests)
+            logging.info("Restored {} provisioning requests from {}".format(len(requests), self.filename))
+            self.save()
+
+    def poll(self):
+        """
+        Fetch the state of servers and volumes from the cloud and send events for requests that have finished.
+        """
+        with self.lock:
+            requests = list(self.requests)
+        finished = []
+        for project_requests in self._group_by_project(requests).values():
+            cloud_service = project_requests[0].cloud_service
+            try:
+                servers = cloud_service.get_servers()
+                volumes = cloud_service.get_volumes()
+            except:  # Leave requests in place so they are retried on the next poll
+                logging.error("Unable to fetch servers and volumes for project {}: {}".format(
+                    cloud_service.project_name, traceback.format_exc()))
+                continue
+            # Requests are advanced while holding the lock so a launch replaced by submit_terminate is not advanced
+            with self.lock:
+                for request in project_requests:
+                    if request not in self.requests:
+                        continue
+                    event = self._advance_request(request, servers, volumes)
+                    if event:
+                        self.requests.remove(request)
+                        finished.append(event)
+        with self.lock:
+            if requests:
+                # Saved after every poll since requests may have moved to another state
+                self.save()
+        for event_name, payload in finished:
+            self.send_event(event_name, payload)
+
+    @staticmethod
+    def _group_by_project(requests):
+        project_requests = {}
+        for request in requests:
+            project_requests.setdefault(request.cloud_service.project_name, []).append(request)
+        return project_requests
+
+    def _advance_request(self, request, servers, volumes):
+        """
+        :return: (event_name, payload) when request has finished, otherwise None
+        """
+        try:
+            payload = request.advance(servers, volumes)
+            if payload:
+                return request.complete_event, payload
+            if time.time() - request.submitted > self.timeout_seconds:
+                message = "Timed out after {} seconds while {} {}.".format(self.timeout_seconds, request.state,
+                                                                         request.server_name)
+                return request.error_event, ProvisioningEventPayload(request.job_id, request.server_name,
+                                                                     message=message)
+        except:  # Trap all exceptions so they are reported to the job
+            return request.error_event, ProvisioningEventPayload(request.job_id, request.server_name,
+                                                                 message=traceback.format_exc())
+        return None
+
+    def stats(self):
+        """
+        :return: dict: number of requests in each ProvisioningStates state
+        """
+        counts = {}
+        with self.lock:
+            for request in self.requests:
+                counts[request.state] = counts.get(request.state, 0) + 1
+        return counts
+
+    def start(self):
+        """
+        Start polling the cloud on a background thread.
+        """
+        self.stop_polling.clear()
+        self.thread = threading.Thread(target=self._poll_loop, name='provisioning')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _poll_loop(self):
+        while not self.stop_polling.wait(self.poll_seconds):
+            try:
+                self.poll()
+            except:  # Keep polling so other requests still finish
+                logging.error("Error polling provisioning requests: {}".format(traceback.format_exc()))
+            logging.debug("Provisioning stats: {}".format(self.stats()))
+
+    def stop(self):
+        """
+        Stop polling the cloud. Requests that have not finished are no longer tracked,
+        when filename is set they are tracked again by restore.
+        """
+        self.stop_polling.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.requests and not self.filename:
+                logging.warning("Stopped tracking {} unfinished provisioning requests.".format(len(self.requests)))
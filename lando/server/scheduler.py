@@ -0,0 +1,432 @@
+"""
+Holds jobs waiting to start until there is enough quota for the cores, RAM and volume storage they need.
+"""
+import threading
+import traceback
+import logging
+import json
+import os
+import re
+import time
+from lando.server.jobapi import JobStates
+
+# Multipliers that convert memory quantities to GB. Suffixes ending in 'i' are powers of 1024.
+MEMORY_SUFFIX_GB = {
+    '': 1.0 / (1000 ** 3),
+    'K': 1.0 / (1000 ** 2), 'KB': 1.0 / (1000 ** 2), 'Ki': 1.0 / (1024 ** 2),
+    'M': 1.0 / 1000, 'MB': 1.0 / 1000, 'Mi': 1.0 / 1024,
+    'G': 1.0, 'GB': 1.0, 'Gi': 1.0,
+    'T': 1000.0, 'TB': 1000.0, 'Ti': 1024.0,
+}
+MEMORY_PATTERN = re.compile(r'^\s*([0-9.]+)\s*([A-Za-z]*)\s*$')
+
+
+def parse_memory_gb(value):
+    """
+    Convert a memory quantity such as '1G', '200MB' or '512Mi' to GB. A plain number is a number of bytes.
+    :param value: str or number: memory quantity
+    :return: float: GB
+    """
+    match = MEMORY_PATTERN.match(str(value))
+    if not match or match.group(2) not in MEMORY_SUFFIX_GB:
+        raise ValueError("Invalid memory quantity {}.".format(value))
+    number, suffix = match.groups()
+    return float(number) * MEMORY_SUFFIX_GB[suffix]
+
+
+def parse_cpus(value):
+    """
+    Convert a cpu quantity such as '4' or '500m' to a number of cores.
+    :param value: str or number: cpu quantity
+    :return: float: cores
+    """
+    value = str(value)
+    if value.endswith('m'):
+        return float(value[:-1]) / 1000
+    return float(value)
+
+
+class ResourceAmounts(object):
+    """
+    Amounts of cores, RAM and volume storage. A value of None means there is no limit.
+    """
+    def __init__(self, cpus=0, memory_gb=0, volume_gb=0):
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.volume_gb = volume_gb
+
+    @staticmethod
+    def from_job(job):
+        """
+        Resources a job will use while it runs.
+        :param job: Job: job to be run
+        :return: ResourceAmounts
+        """
+        return ResourceAmounts(cpus=job.job_flavor_cpus, memory_gb=parse_memory_gb(job.job_flavor_memory),
+                               volume_gb=job.volume_size)
+
+    def __add__(self, other):
+        return ResourceAmounts(cpus=self.cpus + other.cpus, memory_gb=self.memory_gb + other.memory_gb,
+                               volume_gb=self.volume_gb + other.volume_gb)
+
+    def fits_within(self, limit):
+        """
+        :param limit: ResourceAmounts: maximum amounts, None values have no limit
+        :return: bool: True when no amount is more than its limit
+        """
+        for name in ['cpus', 'memory_gb', 'volume_gb']:
+            limit_value = getattr(limit, name)
+            if limit_value is not None and getattr(self, name) > limit_value:
+                return False
+        return True
+
+    def __repr__(self):
+        return "ResourceAmounts(cpus={}, memory_gb={}, volume_gb={})".format(self.cpus, self.memory_gb,
+                                                                             self.volume_gb)
+
+
+class Quota(object):
+    """
+    Resource limits for a project/namespace and the amounts currently used.
+    """
+    def __init__(self, limit, used):
+        """
+        :param limit: ResourceAmounts: maximum amounts, None values have no limit
+        :param used: ResourceAmounts: amounts in use
+        """
+        self.limit = limit
+        self.used = used
+
+
+UNLIMITED_QUOTA = Quota(ResourceAmounts(cpus=None, memory_gb=None, volume_gb=None), ResourceAmounts())
+
+
+class AdmitJobPayload(object):
+    """
+    Payload for start_job sent by the scheduler once there is quota to run a job.
+    """
+    def __init__(self, job_id, wait_seconds):
+        """
+        :param job_id: int: unique id for the job
+        :param wait_seconds: float: seconds the job waited in the queue
+        """
+        self.job_id = job_id
+        self.wait_seconds = wait_seconds
+
+
+class PendingJob(object):
+    def __init__(self, job, quota_key, resources, priority, sequence):
+        self.job = job
+        self.job_id = job.id
+        self.username = job.username
+        self.quota_key = quota_key
+        self.resources = resources
+        self.priority = priority
+        self.sequence = sequence
+        self.submitted = time.time()
+        # While True the job is being submitted and submit starts it, so admit_job is not called for it
+        self.admitted_by_submit = True
+
+
+class AdmissionScheduler(object):
+    """
+    Queue of jobs that starts jobs once their resources fit the quota.
+    Jobs are ordered by priority(lower first) and then shared between users by weighted round-robin:
+    each admission advances the user's virtual time by 1/weight and the job with the lowest virtual time goes next.
+    A user that had no queued jobs starts at the current virtual time so idle time is not saved up as credit.
+    Jobs are admitted when used + reserved + job <= limit, where reserved is the resources of jobs this scheduler
+    admitted that have not finished. Since cloud usage lags behind admission, used is taken as the larger of the
+    usage reported by the cloud and the amount reserved.
+    A job that does not fit blocks later jobs for the same quota so large jobs are not starved.
+    Jobs for a user that is running its maximum number of jobs are skipped.
+    When settings.queue_filename is set the queued and admitted job ids are saved to it after every change
+    so restore can requeue them after lando restarts.
+    """
+    def __init__(self, quota_reader, admit_job, settings):
+        """
+        :param quota_reader: object with get_quota_key(job) and read_quota(job) methods
+        :param admit_job: func(job_id, wait_seconds): called to start a job once it is admitted
+        :param settings: AdmissionSchedulerSettings: retry interval, user weights and per user job limits
+        """
+        self.quota_reader = quota_reader
+        self.admit_job = admit_job
+        self.settings = settings
+        self.lock = threading.RLock()
+        self.pending = []
+        self.running = {}
+        self.sequence = 0
+        self.virtual_time = 0.0
+        self.user_virtual_times = {}
+        self.stop_retrying = threading.Event()
+        self.thread = None
+
+    def _user_weight(self, username):
+        return self.settings.user_weights.get(username, self.settings.default_user_weight)
+
+    def _user_max_running_jobs(self, username):
+        return self.settings.user_max_running_jobs.get(username, self.settings.max_running_jobs_per_user)
+
+    def submit(self, job, priority=0):
+        """
+        Add a job to the queue and admit as many queued jobs as fit.
+        Does not call admit_job for job when it is admitted before submit returns, even by another thread.
+        :param job: Job: job to be run
+        :param priority: int: lower values are admitted first
+        :return: int: 1 based position of job in the queue or 0 when job was admitted
+        """
+        pending_job = PendingJob(job, self.quota_reader.get_quota_key(job), ResourceAmounts.from_job(job),
+                                 priority, sequence=None)
+        with self.lock:
+            # A restarted job replaces any earlier entry
+            self.running.pop(job.id, None)
+            self.pending = [item for item in self.pending if item.job_id != job.id]
+            self._add_pending(pending_job)
+        admitted = self._admit_queued()
+        with self.lock:
+            pending_job.admitted_by_submit = False
+            position = self.queue_position(job.id)
+            self.save()
+        self._send_admitted(admitted)
+        return position
+
+    def _add_pending(self, pending_job):
+        self.sequence += 1
+        pending_job.sequence = self.sequence
+        if not any(item.username == pending_job.username for item in self.pending):
+            user_virtual_time = self.user_virtual_times.get(pending_job.username, 0.0)
+            self.user_virtual_times[pending_job.username] = max(user_virtual_time, self.virtual_time)
+        self.pending.append(pending_job)
+
+    def release(self, job_id):
+        """
+        Remove a job that finished, failed or was canceled and admit queued jobs that now fit.
+        :param job_id: int: unique id for the job
+        """
+        with self.lock:
+            removed = self.running.pop(job_id, None)
+            pending_count = len(self.pending)
+            self.pending = [item for item in self.pending if item.job_id != job_id]
+            if removed is None and pending_count == len(self.pending):
+                return
+            self.save()
+        self._send_admitted(self._admit_queued())
+
+    def admit(self):
+        """
+        Admit queued jobs that fit the current quota.
+        """
+        self._send_admitted(self._admit_queued())
+
+    def _admit_queued(self):
+        """
+        Read the quota for each quota key with queued jobs, then admit the queued jobs that fit.
+        Reading quota calls cloud APIs so it is done without holding the lock, jobs are only checked against
+        the quotas and reserved resources once the lock is held again.
+        :return: [PendingJob]: admitted jobs that admit_job should be called for
+        """
+        with self.lock:
+            quota_jobs = {}
+            for pending_job in self.pending:
+                quota_jobs.setdefault(pending_job.quota_key, pending_job.job)
+        quotas = {}
+        for quota_key, job in quota_jobs.items():
+            try:
+                quotas[quota_key] = self.quota_reader.read_quota(job)
+            except:  # Leave jobs queued so they are retried once the quota can be read
+                logging.error("Unable to read quota for {}: {}".format(quota_key, traceback.format_exc()))
+        with self.lock:
+            admitted = self._admit_pending(quotas)
+            if admitted:
+                self.save()
+            return admitted
+
+    def _ordered_pending(self):
+        """
+        :return: [PendingJob]: queued jobs in the order they should be admitted
+        """
+        user_job_counts = {}
+        sort_keys = {}
+        for pending_job in sorted(self.pending, key=lambda item: item.sequence):
+            username = pending_job.username
+            user_job_counts[username] = user_job_counts.get(username, 0) + 1
+            user_virtual_time = self.user_virtual_times.get(username, 0.0)
+            finish_time = user_virtual_time + float(user_job_counts[username]) / self._user_weight(username)
+            sort_keys[pending_job.job_id] = (pending_job.priority, finish_time, pending_job.sequence)
+        return sorted(self.pending, key=lambda item: sort_keys[item.job_id])
+
+    def _admit_pending(self, quotas):
+        """
+        Admit queued jobs that fit, must be called while holding the lock.
+        :param quotas: {quota_key: Quota}: quotas read for the queued jobs, jobs whose quota is missing stay queued
+        :return: [PendingJob]: admitted jobs that admit_job should be called for
+        """
+        admitted = []
+        blocked_quota_keys = set()
+        user_running_counts = self._user_running_counts()
+        for pending_job in self._ordered_pending():
+            quota_key = pending_job.quota_key
+            username = pending_job.username
+            max_running_jobs = self._user_max_running_jobs(username)
+            if max_running_jobs and user_running_counts.get(username, 0) >= max_running_jobs:
+                continue
+            if quota_key in blocked_quota_keys or quota_key not in quotas:
+                continue
+            if self._fits(pending_job, quotas[quota_key]):
+                self.pending.remove(pending_job)
+                self.running[pending_job.job_id] = pending_job
+                user_running_counts[username] = user_running_counts.get(username, 0) + 1
+                user_virtual_time = self.user_virtual_times.get(username, 0.0)
+                self.virtual_time = max(self.virtual_time, user_virtual_time)
+                self.user_virtual_times[username] = user_virtual_time + 1.0 / self._user_weight(username)
+                if not pending_job.admitted_by_submit:
+                    admitted.append(pending_job)
+            else:
+                blocked_quota_keys.add(quota_key)
+        return admitted
+
+    def _user_running_counts(self):
+        counts = {}
+        for running_job in self.running.values():
+            counts[running_job.username] = counts.get(running_job.username, 0) + 1
+        return counts
+
+    def _fits(self, pending_job, quota):
+        reserved = ResourceAmounts()
+        for running_job in self.running.values():
+            if running_job.quota_key == pending_job.quota_key:
+                reserved = reserved + running_job.resources
+        used = ResourceAmounts(cpus=max(quota.used.cpus, reserved.cpus),
+                               memory_gb=max(quota.used.memory_gb, reserved.memory_gb),
+                               volume_gb=max(quota.used.volume_gb, reserved.volume_gb))
+        return (used + pending_job.resources).fits_within(quota.limit)
+
+    def _send_admitted(self, admitted):
+        now = time.time()
+        for pending_job in admitted:
+            self.admit_job(pending_job.job_id, now - pending_job.submitted)
+
+    def queue_position(self, job_id):
+        """
+        :param job_id: int: unique id for the job
+        :return: int: 1 based position of the job in the queue or 0 if it is not queued
+        """
+        with self.lock:
+            for idx, pending_job in enumerate(self._ordered_pending()):
+                if pending_job.job_id == job_id:
+                    return idx + 1
+            return 0
+
+    def stats(self):
+        """
+        :return: dict: number of queued jobs and admitted jobs that have not finished, in total and for each user
+        """
+        with self.lock:
+            users = {}
+            for pending_job in self.pending:
+                users.setdefault(pending_job.username, {'pending': 0, 'running': 0})['pending'] += 1
+            for running_job in self.running.values():
+                users.setdefault(running_job.username, {'pending': 0, 'running': 0})['running'] += 1
+            return {
+                'pending': len(self.pending),
+                'running': len(self.running),
+                'users': users,
+            }
+
+    def start(self):
+        """
+        Periodically admit queued jobs on a background thread so quota freed outside of lando is used.
+        """
+        self.stop_retrying.clear()
+        self.thread = threading.Thread(target=self._retry_loop, name='admission-scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _retry_loop(self):
+        while not self.stop_retrying.wait(self.settings.retry_seconds):
+            try:
+                self.admit()
+            except:  # Keep retrying so queued jobs start once quota can be read again
+                logging.error("Error admitting queued jobs: {}".format(traceback.format_exc()))
+            logging.debug("Admission scheduler stats: {}".format(self.stats()))
+
+    def stop(self):
+        """
+        Stop the background thread. Queued jobs stay queued until the next submit or release.
+        Queued jobs are lost when lando exits unless queue_filename is set so they are logged.
+        """
+        self.stop_retrying.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.pending and not self.settings.queue_filename:
+                job_ids = [pending_job.job_id for pending_job in self._ordered_pending()]
+                logging.error("Jobs still queued will not be requeued when lando restarts: {}".format(job_ids))
+
+    def save(self):
+        """
+        Write the queued jobs and the admitted jobs that have not finished to queue_filename.
+        """
+        if not self.settings.queue_filename:
+            return
+        with self.lock:
+            data = {
+                'pending': [{
+                    'job_id': pending_job.job_id,
+                    'priority': pending_job.priority,
+                    'submitted': pending_job.submitted,
+                } for pending_job in sorted(self.pending, key=lambda item: item.sequence)],
+                'running': list(self.running.keys()),
+            }
+            temp_filename = '{}.tmp'.format(self.settings.queue_filename)
+            with open(temp_filename, 'w') as outfile:
+                json.dump(data, outfile)
+            os.replace(temp_filename, self.settings.queue_filename)
+
+    def restore(self, get_job):
+        """
+        Requeue the jobs saved to queue_filename by an earlier lando process then admit those that fit.
+        Queued jobs that are no longer waiting to start(not NEW or AUTHORIZED) are dropped and admitted jobs are kept
+        reserving their resources while they are still running.
+        :param get_job: func(job_id): returns the Job with the current state for a job id
+        """
+        queue_filename = self.settings.queue_filename
+        if not queue_filename or not os.path.exists(queue_filename):
+            return
+        with open(queue_filename) as infile:
+            data = json.load(infile)
+        pending_jobs = []
+        for saved_job in data.get('pending', []):
+            job = self._get_saved_job(get_job, saved_job['job_id'])
+            if job and job.state in [JobStates.NEW, JobStates.AUTHORIZED]:
+                pending_job = PendingJob(job, self.quota_reader.get_quota_key(job), ResourceAmounts.from_job(job),
+                                         saved_job['priority'], sequence=None)
+                pending_job.submitted = saved_job['submitted']
+                pending_job.admitted_by_submit = False
+                pending_jobs.append(pending_job)
+        running_jobs = []
+        for job_id in data.get('running', []):
+            job = self._get_saved_job(get_job, job_id)
+            if job and job.state == JobStates.RUNNING:
+                running_job = PendingJob(job, self.quota_reader.get_quota_key(job), ResourceAmounts.from_job(job),
+                                         priority=0, sequence=None)
+                running_job.admitted_by_submit = False
+                running_jobs.append(running_job)
+        with self.lock:
+            for running_job in running_jobs:
+                self.running.setdefault(running_job.job_id, running_job)
+            for pending_job in pending_jobs:
+                if pending_job.job_id not in self.running and self.queue_position(pending_job.job_id) == 0:
+                    self._add_pending(pending_job)
+            logging.info("Restored {} queued and {} admitted jobs from {}".format(
+                len(pending_jobs), len(running_jobs), queue_filename))
+            self.save()
+        self.admit()
+
+    @staticmethod
+    def _get_saved_job(get_job, job_id):
+        try:
+            return get_job(job_id)
+        except:  # Skip jobs that can no longer be read so the rest of the queue is restored
+            logging.error("Unable to restore queued job {}: {}".format(job_id, traceback.format_exc()))
+            return None
@@ -1,10 +1,13 @@
 
 from unittest import TestCase
-from lando.server.cloudservice import CloudService
+from lando.server.cloudservice import CloudService, CloudClient
 from unittest import mock
 
 
 class TestCloudService(TestCase):
+    def setUp(self):
+        CloudClient.clear_shared()
+
     @mock.patch('lando.server.cloudservice.CloudClient')
     def test_makes_cloud_client(self, mock_cloud_client):
         mock_credentials = mock.Mock()  # a function that returns credentials
@@ -17,8 +20,8 @@ class TestCloudService(TestCase):
         args, kwargs = mock_credentials.call_args
         self.assertEqual(args[0], 'test-project')
 
-        # Assert that CloudClient is called with the return value of credentials
-        args, kwargs = mock_cloud_client.call_args
+        # Assert that the shared CloudClient is fetched with the return value of credentials
+        args, kwargs = mock_cloud_client.get_shared.call_args
         self.assertEqual(args[0], mock_credentials.return_value)
 
     @mock.patch('lando.server.cloudservice.shade')
@@ -31,7 +34,8 @@ class TestCloudService(TestCase):
         mock_shade.openstack_cloud()
         mock_shade.openstack_cloud().create_server.assert_called()
         args, kw_args = mock_shade.openstack_cloud().create_server.call_args
-        self.assertEqual(kw_args['flavor'], 'm1.GIANT')
+        self.assertEqual(kw_args['flavor'], {'id': mock_shade.openstack_cloud().get_flavor.return_value['id']})
+        mock_shade.openstack_cloud().get_flavor.assert_called_with('m1.GIANT', get_extra=False)
 
     @mock.patch('lando.server.cloudservice.shade')
     def test_launch_instance_no_floating_ip(self, mock_shade):
@@ -116,3 +120,100 @@ class TestCloudService(TestCase):
         self.assertEqual(volume_name, 'vol-job6_uuid-1234')
         self.assertTrue(mock_uuid.uuid4.called)
 
+
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_start_create_volume(self, mock_shade):
+        mock_shade.openstack_cloud().create_volume.return_value = {'id': 'volume-id1'}
+        cloud_service = CloudService(mock.MagicMock(), mock.MagicMock())
+        volume_id = cloud_service.start_create_volume(100, 'volume1')
+        self.assertEqual('volume-id1', volume_id)
+        mock_shade.openstack_cloud().create_volume.assert_called_with(100, name='volume1', wait=False)
+
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_start_terminate_instance(self, mock_shade):
+        vm_settings = mock.MagicMock(allocate_floating_ips=True)
+        cloud_service = CloudService(mock.MagicMock(), vm_settings)
+        cloud_service.start_terminate_instance('worker1')
+        mock_shade.openstack_cloud().delete_server.assert_called_with('worker1', delete_ips=True, wait=False)
+        mock_shade.openstack_cloud().delete_volume.assert_not_called()
+
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_start_delete_volume(self, mock_shade):
+        cloud_service = CloudService(mock.MagicMock(), mock.MagicMock())
+        cloud_service.start_delete_volume('volume1')
+        mock_shade.openstack_cloud().delete_volume.assert_called_with('volume1', wait=False)
+
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_get_servers_and_volumes(self, mock_shade):
+        mock_shade.openstack_cloud().list_servers.return_value = [{'name': 'worker1', 'status': 'ACTIVE'}]
+        mock_shade.openstack_cloud().list_volumes.return_value = [{'name': 'volume1', 'status': 'in-use'}]
+        cloud_service = CloudService(mock.MagicMock(), mock.MagicMock())
+        self.assertEqual({'worker1': {'name': 'worker1', 'status': 'ACTIVE'}}, cloud_service.get_servers())
+        self.assertEqual({'volume1': {'name': 'volume1', 'status': 'in-use'}}, cloud_service.get_volumes())
+        mock_shade.openstack_cloud().list_servers.assert_called_with(bare=True)
+        mock_shade.openstack_cloud().list_volumes.assert_called_with(cache=False)
+
+
+class TestCloudClient(TestCase):
+    def setUp(self):
+        CloudClient.clear_shared()
+        self.credentials = {'auth_url': 'someurl', 'username': 'joe', 'project_name': 'project1'}
+
+    @mock.patch('lando.server.cloudservice.requests')
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_get_shared(self, mock_shade, mock_requests):
+        client = CloudClient.get_shared(self.credentials)
+        self.assertEqual(client, CloudClient.get_shared(dict(self.credentials)))
+        self.assertEqual(1, mock_shade.openstack_cloud.call_count)
+        other_credentials = dict(self.credentials, project_name='project2')
+        self.assertNotEqual(client, CloudClient.get_shared(other_credentials))
+        mock_shade.openstack_cloud.assert_called_with(**other_credentials)
+        mock_requests.adapters.HTTPAdapter.assert_called_with(pool_maxsize=10)
+
+    @mock.patch('lando.server.cloudservice.requests')
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_launch_instance_reuses_resource_ids(self, mock_shade, mock_requests):
+        mock_cloud = mock_shade.openstack_cloud.return_value
+        mock_cloud.get_image.return_value = {'id': 'image-id'}
+        mock_cloud.get_flavor.return_value = {'id': 'flavor-id'}
+        mock_cloud.get_network.return_value = {'id': 'network-id'}
+        vm_settings = mock.Mock(image_name='image1', network_name='network1')
+        client = CloudClient.get_shared(self.credentials)
+        client.launch_instance(vm_settings, 'worker1', 'flavor1', '', ['volume1'])
+        client.launch_instance(vm_settings, 'worker2', 'flavor1', '', ['volume2'])
+        args, kw_args = mock_cloud.create_server.call_args
+        self.assertEqual({'id': 'image-id'}, kw_args['image'])
+        self.assertEqual({'id': 'flavor-id'}, kw_args['flavor'])
+        self.assertEqual({'id': 'network-id'}, kw_args['network'])
+        self.assertEqual(1, mock_cloud.get_image.call_count)
+        self.assertEqual(1, mock_cloud.get_flavor.call_count)
+        self.assertEqual(1, mock_cloud.get_network.call_count)
+
+    @mock.patch('lando.server.cloudservice.requests')
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_get_quota(self, mock_shade, mock_requests):
+        mock_cloud = mock_shade.openstack_cloud.return_value
+        mock_cloud.get_compute_limits.return_value = {
+            'max_total_cores': 64, 'total_cores_used': 8, 'max_total_ram_size': -1, 'total_ram_used': 2048,
+        }
+        mock_cloud.get_volume_limits.return_value = {
+            'absolute': {'maxTotalVolumeGigabytes': 1000, 'totalGigabytesUsed': 200}
+        }
+        quota = CloudClient.get_shared(self.credentials).get_quota()
+        self.assertEqual(64, quota.limit.cpus)
+        self.assertEqual(None, quota.limit.memory_gb)
+        self.assertEqual(1000, quota.limit.volume_gb)
+        self.assertEqual(8, quota.used.cpus)
+        self.assertEqual(2, quota.used.memory_gb)
+        self.assertEqual(200, quota.used.volume_gb)
+
+    @mock.patch('lando.server.cloudservice.requests')
+    @mock.patch('lando.server.cloudservice.shade')
+    def test_find_resource_not_found(self, mock_shade, mock_requests):
+        mock_cloud = mock_shade.openstack_cloud.return_value
+        mock_cloud.get_image.return_value = None
+        client = CloudClient.get_shared(self.credentials)
+        self.assertEqual('image1', client.find_image('image1'))
+        self.assertEqual('image1', client.find_image('image1'))
+        self.assertEqual(2, mock_cloud.get_image.call_count)
+        self.assertEqual(None, client.find_network(None))
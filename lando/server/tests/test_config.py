@@ -2,7 +2,7 @@ from unittest import TestCase
 import os
 import logging
 from lando.testutil import write_temp_return_filename
-from lando.server.config import ServerConfig
+from lando.server.config import ServerConfig, BespinApiSettings
 from lando.exceptions import InvalidConfigException
 from unittest.mock import Mock
 
@@ -52,6 +52,7 @@ class TestServerConfig(TestCase):
         self.assertEqual("http://localhost:8000/api", config.bespin_api_settings.url)
         self.assertEqual("10498124091240e", config.bespin_api_settings.token)
         self.assertEqual(logging.WARNING, config.log_level)
+        self.assertEqual(1, config.message_handler_threads)
 
     def test_good_config_with_fake_cloud_service(self):
         config_data = GOOD_CONFIG.format("") + "\nfake_cloud_service: True"
@@ -147,6 +148,100 @@ username: lobot
         result = config.make_worker_config_yml('worker_1', mock_cwl_command)
         self.assertMultiLineEqual(expected.strip(), result.strip())
 
+    def test_message_handler_threads(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format('message_handler_threads: 8'))
+        config = ServerConfig(filename)
+        self.assertEqual(8, config.message_handler_threads)
+        os.unlink(filename)
+
+    def test_provisioning_settings(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format(''))
+        config = ServerConfig(filename)
+        self.assertEqual(5, config.provisioning_poll_seconds)
+        self.assertEqual(1800, config.provisioning_timeout_seconds)
+        self.assertEqual(None, config.provisioning_filename)
+        os.unlink(filename)
+        filename = write_temp_return_filename(GOOD_CONFIG.format('provisioning_poll_seconds: 10\n'
+                                                                 'provisioning_timeout_seconds: 600\n'
+                                                                 'provisioning_filename: /tmp/provisioning.json'))
+        config = ServerConfig(filename)
+        self.assertEqual(10, config.provisioning_poll_seconds)
+        self.assertEqual(600, config.provisioning_timeout_seconds)
+        self.assertEqual('/tmp/provisioning.json', config.provisioning_filename)
+        os.unlink(filename)
+
+    def test_warm_pool_settings(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format(''))
+        config = ServerConfig(filename)
+        self.assertEqual(None, config.warm_pool_settings)
+        os.unlink(filename)
+        filename = write_temp_return_filename(GOOD_CONFIG.format('warm_pool:\n'
+                                                                 '  min_size: 1\n'
+                                                                 '  max_size: 4\n'
+                                                                 '  idle_ttl_seconds: 600'))
+        config = ServerConfig(filename)
+        self.assertEqual(1, config.warm_pool_settings.min_size)
+        self.assertEqual(4, config.warm_pool_settings.max_size)
+        self.assertEqual(600, config.warm_pool_settings.idle_ttl_seconds)
+        self.assertEqual(1800, config.warm_pool_settings.boot_timeout_seconds)
+        self.assertEqual(30, config.warm_pool_settings.maintain_seconds)
+        os.unlink(filename)
+
+    def test_reuse_vms_cleans_up_worker_job_data(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format('warm_pool:\n'
+                                                                 '  max_jobs_per_vm: 5'))
+        config = ServerConfig(filename)
+        self.assertEqual(5, config.warm_pool_settings.max_jobs_per_vm)
+        self.assertEqual(86400, config.warm_pool_settings.max_vm_lifetime_seconds)
+        self.assertEqual(True, config.reuse_vms)
+        mock_cwl_command = Mock(base_command=None, post_process_command=None, pre_process_command=None)
+        self.assertIn('cleanup_job_data: true', config.make_worker_config_yml('worker_1', mock_cwl_command))
+        os.unlink(filename)
+
+    def test_admission_scheduler_settings(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format(''))
+        config = ServerConfig(filename)
+        self.assertEqual(None, config.admission_scheduler_settings)
+        os.unlink(filename)
+        filename = write_temp_return_filename(GOOD_CONFIG.format('admission_scheduler:\n'
+                                                                 '  retry_seconds: 120'))
+        config = ServerConfig(filename)
+        self.assertEqual(120, config.admission_scheduler_settings.retry_seconds)
+        self.assertEqual(1, config.admission_scheduler_settings.default_user_weight)
+        self.assertEqual({}, config.admission_scheduler_settings.user_weights)
+        self.assertEqual(0, config.admission_scheduler_settings.max_running_jobs_per_user)
+        self.assertEqual(None, config.admission_scheduler_settings.queue_filename)
+        os.unlink(filename)
+
+    def test_admission_scheduler_fair_share_settings(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format('admission_scheduler:\n'
+                                                                 '  user_weights:\n'
+                                                                 '    ann: 2\n'
+                                                                 '  max_running_jobs_per_user: 5\n'
+                                                                 '  user_max_running_jobs:\n'
+                                                                 '    joe: 1'))
+        config = ServerConfig(filename)
+        self.assertEqual({'ann': 2}, config.admission_scheduler_settings.user_weights)
+        self.assertEqual(5, config.admission_scheduler_settings.max_running_jobs_per_user)
+        self.assertEqual({'joe': 1}, config.admission_scheduler_settings.user_max_running_jobs)
+        os.unlink(filename)
+
+    def test_admission_scheduler_invalid_weight(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format('admission_scheduler:\n'
+                                                                 '  user_weights:\n'
+                                                                 '    ann: 0'))
+        with self.assertRaises(InvalidConfigException):
+            ServerConfig(filename)
+        os.unlink(filename)
+
+    def test_warm_pool_min_size_larger_than_max_size(self):
+        filename = write_temp_return_filename(GOOD_CONFIG.format('warm_pool:\n'
+                                                                 '  min_size: 3\n'
+                                                                 '  max_size: 2'))
+        with self.assertRaises(InvalidConfigException):
+            ServerConfig(filename)
+        os.unlink(filename)
+
     def test_log_level(self):
         filename = write_temp_return_filename(GOOD_CONFIG.format('log_level: INFO'))
         config = ServerConfig(filename)
@@ -160,3 +255,27 @@ username: lobot
         worker_config = config.make_worker_config_yml('worker_1', mock_cwl_command)
         self.assertIn('log_level: INFO', worker_config)
         os.unlink(filename)
+
+
+class TestBespinApiSettings(TestCase):
+    def test_pool_defaults(self):
+        settings = BespinApiSettings({'url': 'http://localhost:8000/api', 'token': 'secret'})
+        self.assertEqual(10, settings.pool_size)
+        self.assertEqual(True, settings.keep_alive)
+        self.assertEqual(None, settings.timeout)
+        self.assertEqual(300, settings.credentials_cache_seconds)
+        self.assertEqual(3600, settings.methods_document_cache_seconds)
+        self.assertEqual(300, settings.share_group_cache_seconds)
+
+    def test_pool_settings(self):
+        settings = BespinApiSettings({
+            'url': 'http://localhost:8000/api',
+            'token': 'secret',
+            'pool_size': 4,
+            'keep_alive': False,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+        })
+        self.assertEqual(4, settings.pool_size)
+        self.assertEqual(False, settings.keep_alive)
+        self.assertEqual((5, 30), settings.timeout)
@@ -0,0 +1,65 @@
+from unittest import TestCase
+from unittest.mock import patch
+from lando.server.dispatcher import JobMessageDispatcher
+import threading
+
+
+class TestJobMessageDispatcher(TestCase):
+    def test_runs_functions_for_same_job_in_order(self):
+        dispatcher = JobMessageDispatcher(max_workers=4)
+        results = []
+        for idx in range(20):
+            dispatcher.dispatch(1, lambda idx=idx: results.append(idx))
+        dispatcher.shutdown()
+        self.assertEqual(list(range(20)), results)
+
+    def test_runs_different_jobs_in_parallel(self):
+        dispatcher = JobMessageDispatcher(max_workers=2)
+        job1_started = threading.Event()
+        job2_finished = threading.Event()
+
+        def job1_func():
+            job1_started.set()
+            # Only finishes if job2 is able to run while job1 is running
+            self.assertTrue(job2_finished.wait(5))
+
+        def job2_func():
+            job1_started.wait(5)
+            job2_finished.set()
+
+        dispatcher.dispatch(1, job1_func)
+        dispatcher.dispatch(2, job2_func)
+        dispatcher.shutdown()
+        self.assertTrue(job2_finished.is_set())
+
+    @patch('lando.server.dispatcher.logging')
+    def test_error_does_not_stop_later_functions(self, mock_logging):
+        dispatcher = JobMessageDispatcher(max_workers=1)
+        results = []
+
+        def failing_func():
+            raise ValueError("Oops")
+
+        dispatcher.dispatch(1, failing_func)
+        dispatcher.dispatch(1, lambda: results.append('ok'))
+        dispatcher.shutdown()
+        self.assertEqual(['ok'], results)
+        self.assertTrue(mock_logging.error.called)
+
+    def test_stats(self):
+        dispatcher = JobMessageDispatcher(max_workers=1)
+        release = threading.Event()
+        running = threading.Event()
+
+        def blocking_func():
+            running.set()
+            release.wait(5)
+
+        dispatcher.dispatch(1, blocking_func)
+        dispatcher.dispatch(1, lambda: None)
+        dispatcher.dispatch(2, lambda: None)
+        running.wait(5)
+        self.assertEqual({'queue_depth': 2, 'in_flight': 1, 'active_jobs': 2}, dispatcher.stats())
+        release.set()
+        dispatcher.shutdown()
+        self.assertEqual({'queue_depth': 0, 'in_flight': 0, 'active_jobs': 0}, dispatcher.stats())
@@ -1,8 +1,13 @@
 
 from unittest import TestCase
 import copy
-from lando.server.jobapi import JobApi, BespinApi, Job, CWLCommand, VMSettings
-from unittest.mock import MagicMock, patch, call
+import threading
+import time
+import pickle
+from lando.server.jobapi import JobApi, BespinApi, Job, CWLCommand, VMSettings, BespinConnectionPool, \
+    ExpiringCache, dds_user_credential_cache, methods_document_cache, share_group_cache, FileRecordList, \
+    DukeDSFile, bespin_cache_stats
+from unittest.mock import MagicMock, Mock, patch, call
 
 
 @patch('lando.server.jobapi.VMSettings')
@@ -11,6 +16,9 @@ from unittest.mock import MagicMock, patch, call
 class TestJobApi(TestCase):
 
     def setUp(self):
+        dds_user_credential_cache.clear()
+        methods_document_cache.clear()
+        share_group_cache.clear()
         self.job_response_payload = {
             'id': 1,
             'user': {
@@ -57,6 +65,10 @@ class TestJobApi(TestCase):
             return {}
         mock_config = MagicMock()
         mock_config.bespin_api_settings.url = 'APIURL'
+        mock_config.bespin_api_settings.timeout = None
+        mock_config.bespin_api_settings.credentials_cache_seconds = 300
+        mock_config.bespin_api_settings.methods_document_cache_seconds = 3600
+        mock_config.bespin_api_settings.share_group_cache_seconds = 300
         job_api = JobApi(mock_config, job_id)
         job_api.api.headers = empty_headers
         return job_api
@@ -69,9 +81,9 @@ class TestJobApi(TestCase):
 
         mock_response = MagicMock()
         mock_response.json.return_value = self.job_response_payload
-        mock_requests.get.return_value = mock_response
+        mock_requests.Session.return_value.get.return_value = mock_response
         job = job_api.get_job()
-        args, kwargs = mock_requests.get.call_args
+        args, kwargs = mock_requests.Session.return_value.get.call_args
         self.assertEqual(args[0], 'APIURL/admin/jobs/1/')
 
         self.assertEqual(1, job.id)
@@ -84,6 +96,8 @@ class TestJobApi(TestCase):
         self.assertEqual('', job.vm_instance_name)
         self.assertEqual('', job.vm_volume_name)
         self.assertEqual(True, job.cleanup_vm)
+        mock_vm_settings.assert_not_called()
+        self.assertEqual(mock_vm_settings.return_value, job.vm_settings)
         args, kwargs = mock_vm_settings.call_args
         # Should call VMSettings() with contents of data['vm_settings']
         self.assertEqual(args[0], 'mock_job_settings')
@@ -95,43 +109,91 @@ class TestJobApi(TestCase):
     def test_set_job_state(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         job_api = self.setup_job_api(2)
         mock_response = MagicMock()
-        mock_response.json.return_value = {}
-        mock_requests.put.return_value = mock_response
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
         job_api.set_job_state('E')
-        args, kwargs = mock_requests.put.call_args
+        args, kwargs = mock_requests.Session.return_value.put.call_args
         self.assertEqual(args[0], 'APIURL/admin/jobs/2/')
         self.assertEqual(kwargs.get('json'), {'state': 'E'})
 
     def test_set_job_step(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         job_api = self.setup_job_api(2)
         mock_response = MagicMock()
-        mock_response.json.return_value = {}
-        mock_requests.put.return_value = mock_response
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
         job_api.set_job_step('N')
-        args, kwargs = mock_requests.put.call_args
+        args, kwargs = mock_requests.Session.return_value.put.call_args
         self.assertEqual(args[0], 'APIURL/admin/jobs/2/')
         self.assertEqual(kwargs.get('json'), {'step': 'N'})
 
     def test_set_vm_instance_name(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         job_api = self.setup_job_api(3)
         mock_response = MagicMock()
-        mock_response.json.return_value = mock_response
-        mock_requests.put.return_value = mock_response
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
         job_api.set_vm_instance_name('worker_123')
-        args, kwargs = mock_requests.put.call_args
+        args, kwargs = mock_requests.Session.return_value.put.call_args
         self.assertEqual(args[0], 'APIURL/admin/jobs/3/')
         self.assertEqual(kwargs.get('json'), {'vm_instance_name': 'worker_123'})
 
     def test_set_vm_volume_name(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         job_api = self.setup_job_api(3)
         mock_response = MagicMock()
-        mock_response.json.return_value = mock_response
-        mock_requests.put.return_value = mock_response
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
         job_api.set_vm_volume_name('volume_765')
-        args, kwargs = mock_requests.put.call_args
+        args, kwargs = mock_requests.Session.return_value.put.call_args
         self.assertEqual(args[0], 'APIURL/admin/jobs/3/')
         self.assertEqual(kwargs.get('json'), {'vm_volume_name': 'volume_765'})
 
+    def test_get_job_uses_snapshot(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        job_api = self.setup_job_api(1)
+        mock_response = MagicMock()
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.get.return_value = mock_response
+        job = job_api.get_job()
+        self.assertEqual(job, job_api.get_job())
+        self.assertEqual(1, mock_requests.Session.return_value.get.call_count)
+
+        job_api.invalidate_job()
+        job_api.get_job()
+        self.assertEqual(2, mock_requests.Session.return_value.get.call_count)
+
+    def test_set_job_state_refreshes_snapshot(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        job_api = self.setup_job_api(1)
+        updated_job_payload = dict(self.job_response_payload)
+        updated_job_payload['state'] = 'R'
+        mock_response = MagicMock()
+        mock_response.json.return_value = updated_job_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
+        job_api.set_job_state('R')
+        job = job_api.get_job()
+        self.assertEqual('R', job.state)
+        mock_requests.Session.return_value.get.assert_not_called()
+
+    def test_job_update_sends_single_put(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        job_api = self.setup_job_api(2)
+        mock_response = MagicMock()
+        mock_response.json.return_value = self.job_response_payload
+        mock_requests.Session.return_value.put.return_value = mock_response
+        with job_api.job_update():
+            job_api.set_job_state('R')
+            with job_api.job_update():
+                job_api.set_job_step('V')
+            job_api.set_vm_instance_name('worker_123')
+            mock_requests.Session.return_value.put.assert_not_called()
+        mock_requests.Session.return_value.put.assert_called_once_with(
+            'APIURL/admin/jobs/2/', headers={}, timeout=None,
+            json={'state': 'R', 'step': 'V', 'vm_instance_name': 'worker_123'})
+
+    def test_job_update_discards_changes_on_error(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        job_api = self.setup_job_api(2)
+        with self.assertRaises(ValueError):
+            with job_api.job_update():
+                job_api.set_job_state('R')
+                raise ValueError("Launching VM failed")
+        mock_requests.Session.return_value.put.assert_not_called()
+
     def test_get_input_files(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         self.job_response_payload['stage_group'] = '4'
         stage_group_response_payload = {
@@ -155,13 +217,13 @@ class TestJobApi(TestCase):
         get_job_response.json.return_value = self.job_response_payload
         stage_group_response = MagicMock()
         stage_group_response.json.return_value = stage_group_response_payload
-        mock_requests.get.side_effect = [
+        mock_requests.Session.return_value.get.side_effect = [
             get_job_response,
             stage_group_response
         ]
         job_api = self.setup_job_api(4)
         files = job_api.get_input_files()
-        args, kwargs = mock_requests.get.call_args
+        args, kwargs = mock_requests.Session.return_value.get.call_args
         self.assertEqual(args[0], 'APIURL/admin/job-file-stage-groups/4')
 
         self.assertEqual(1, len(files.dds_files))
@@ -218,33 +280,66 @@ class TestJobApi(TestCase):
             'stage_group': None,
             'volume_size': 200,
         }
-        user_credentials_response = [
-            {
-                'id': 5,
-                'user': 1,
-                'token': '1239109',
-                'endpoint': {
-                    'id': 3,
-                    'name': 'dukeds',
-                    'agent_key': '2191230',
-                    'api_root': 'localhost/api/v1/',
-                }
+        user_credential_response = {
+            'id': 123,
+            'user': 1,
+            'token': '1239109',
+            'endpoint': {
+                'id': 3,
+                'name': 'dukeds',
+                'agent_key': '2191230',
+                'api_root': 'localhost/api/v1/',
             }
-        ]
+        }
         mock_response = MagicMock()
-        mock_response.json.side_effect = [job_response_payload, user_credentials_response]
-        mock_requests.get.return_value = mock_response
+        mock_response.json.side_effect = [job_response_payload, user_credential_response]
+        mock_requests.Session.return_value.get.return_value = mock_response
         job_api = self.setup_job_api(4)
 
         user_credentials = job_api.get_credentials()
-        args, kwargs = mock_requests.get.call_args
-        self.assertEqual(args[0], 'APIURL/admin/dds-user-credentials/')
+        args, kwargs = mock_requests.Session.return_value.get.call_args
+        self.assertEqual(args[0], 'APIURL/admin/dds-user-credentials/123/')
 
-        user_cred = user_credentials.dds_user_credentials[5]
+        self.assertEqual([123], list(user_credentials.dds_user_credentials.keys()))
+        user_cred = user_credentials.dds_user_credentials[123]
         self.assertEqual('1239109', user_cred.token)
         self.assertEqual('2191230', user_cred.endpoint_agent_key)
         self.assertEqual('localhost/api/v1/', user_cred.endpoint_api_root)
 
+        # credentials are cached
+        job_api.get_credentials()
+        self.assertEqual(2, mock_requests.Session.return_value.get.call_count)
+
+    def test_get_credentials_for_input_files(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        def make_credential_response(credential_id):
+            return {
+                'id': credential_id,
+                'user': 1,
+                'token': 'token{}'.format(credential_id),
+                'endpoint': {'agent_key': 'agentkey', 'api_root': 'localhost/api/v1/'},
+            }
+        mock_job_response = MagicMock()
+        mock_job_response.json.return_value = self.job_response_payload
+        mock_credential_response1 = MagicMock()
+        mock_credential_response1.json.return_value = make_credential_response(8)
+        mock_credential_response2 = MagicMock()
+        mock_credential_response2.json.return_value = make_credential_response(123)
+        mock_requests.Session.return_value.get.side_effect = [
+            mock_job_response, mock_credential_response1, mock_credential_response2
+        ]
+        job_api = self.setup_job_api(1)
+        input_files = Mock(dds_files=[Mock(user_id=8), Mock(user_id=8)])
+
+        user_credentials = job_api.get_credentials(input_files)
+
+        self.assertEqual({8, 123}, set(user_credentials.dds_user_credentials.keys()))
+        self.assertEqual('token8', user_credentials.dds_user_credentials[8].token)
+        self.assertEqual('token123', user_credentials.dds_user_credentials[123].token)
+        mock_requests.Session.return_value.get.assert_has_calls([
+            call('APIURL/admin/dds-user-credentials/8/', headers={}, timeout=None),
+            call('APIURL/admin/dds-user-credentials/123/', headers={}, timeout=None),
+        ], any_order=True)
+
     def test_get_jobs_for_vm_instance_name(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         jobs_response = [
             {
@@ -292,17 +387,32 @@ class TestJobApi(TestCase):
 
         mock_response = MagicMock()
         mock_response.json.side_effect = [jobs_response]
-        mock_requests.get.return_value = mock_response
+        mock_requests.Session.return_value.get.return_value = mock_response
         jobs = JobApi.get_jobs_for_vm_instance_name(mock_config, 'joe')
         self.assertEqual(1, len(jobs))
 
+    def test_get_results_follows_pages(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        mock_page1_response = MagicMock()
+        mock_page1_response.json.return_value = {'results': [{'id': 1}, {'id': 2}], 'next': 'APIURL/page2'}
+        mock_page2_response = MagicMock()
+        mock_page2_response.json.return_value = {'results': [{'id': 3}], 'next': None}
+        mock_requests.Session.return_value.get.side_effect = [mock_page1_response, mock_page2_response]
+        job_api = self.setup_job_api(1)
+        results = job_api.api._get_results('APIURL/page1')
+        mock_requests.Session.return_value.get.assert_not_called()
+        self.assertEqual([{'id': 1}, {'id': 2}, {'id': 3}], list(results))
+        mock_requests.Session.return_value.get.assert_has_calls([
+            call('APIURL/page1', headers={}, timeout=None),
+            call('APIURL/page2', headers={}, timeout=None),
+        ])
+
     def test_post_error(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         mock_response = MagicMock()
         mock_response.json.return_value = {}
-        mock_requests.get.return_value = mock_response
+        mock_requests.Session.return_value.get.return_value = mock_response
         job_api = self.setup_job_api(4)
         job_api.save_error_details('V', 'Out of memory')
-        args, kwargs = mock_requests.post.call_args
+        args, kwargs = mock_requests.Session.return_value.post.call_args
         self.assertEqual(args[0], 'APIURL/admin/job-errors/')
         self.assertEqual(kwargs['json']['job'], 4)
         self.assertEqual(kwargs['json']['job_step'], 'V')
@@ -333,7 +443,7 @@ class TestJobApi(TestCase):
             ]
         }
 
-        mock_requests.get.side_effect = [
+        mock_requests.Session.return_value.get.side_effect = [
             mock_job_get_response,
             mock_share_group_response
         ]
@@ -357,39 +467,48 @@ class TestJobApi(TestCase):
         mock_response1.json.return_value = self.job_response_payload
         mock_response2 = MagicMock()
         mock_response2.json.return_value = {'content': '#Markdown data'}
-        mock_requests.get.side_effect = [mock_response1, mock_response2]
+        mock_requests.Session.return_value.get.side_effect = [mock_response1, mock_response2]
         job_api = self.setup_job_api(4)
         run_job_data = job_api.get_run_job_data()
         self.assertEqual('myjob', run_job_data.name)
         self.assertEqual('#Markdown data', run_job_data.workflow_methods_document.content)
-        mock_requests.get.assert_has_calls([
-            call('APIURL/admin/jobs/4/', headers={}),
-            call('APIURL/admin/workflow-methods-documents/7', headers={})
+        mock_requests.Session.return_value.get.assert_has_calls([
+            call('APIURL/admin/jobs/4/', headers={}, timeout=None),
+            call('APIURL/admin/workflow-methods-documents/7', headers={}, timeout=None)
         ])
-        #args, kwargs = mock_requests.get.call_args
+        #args, kwargs = mock_requests.Session.return_value.get.call_args
         #self.assertEqual(args[0], 'APIURL/admin/workflow-methods-documents/123')
 
     def test_get_workflow_methods_document(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         mock_response = MagicMock()
         mock_response.json.return_value = {'content': '#Markdown'}
-        mock_requests.get.return_value = mock_response
+        mock_requests.Session.return_value.get.return_value = mock_response
         job_api = self.setup_job_api(4)
         workflow_methods_document = job_api.get_workflow_methods_document('123')
         self.assertEqual('#Markdown', workflow_methods_document.content)
-        args, kwargs = mock_requests.get.call_args
+        args, kwargs = mock_requests.Session.return_value.get.call_args
         self.assertEqual(args[0], 'APIURL/admin/workflow-methods-documents/123')
 
+    def test_get_workflow_methods_document_is_cached(self, mock_requests, mock_k8s_settings, mock_vm_settings):
+        mock_response = MagicMock()
+        mock_response.json.return_value = {'content': '#Markdown'}
+        mock_requests.Session.return_value.get.return_value = mock_response
+        self.setup_job_api(4).get_workflow_methods_document('123')
+        workflow_methods_document = self.setup_job_api(5).get_workflow_methods_document('123')
+        self.assertEqual('#Markdown', workflow_methods_document.content)
+        self.assertEqual(1, mock_requests.Session.return_value.get.call_count)
+
     def test_save_project_details(self, mock_requests, mock_k8s_settings, mock_vm_settings):
         mock_response = MagicMock()
         mock_response.json.return_value = self.job_response_payload
-        mock_requests.get.return_value = mock_response
+        mock_requests.Session.return_value.get.return_value = mock_response
         output_project_id = 5
         dds_project_id = '123'
         dds_readme_file_id = '456'
         job_api = self.setup_job_api(1)
         job_api.save_project_details(dds_project_id, dds_readme_file_id)
-        mock_requests.put.assert_has_calls([
-            call('APIURL/admin/job-dds-output-projects/{}/'.format(output_project_id), headers={},
+        mock_requests.Session.return_value.put.assert_has_calls([
+            call('APIURL/admin/job-dds-output-projects/{}/'.format(output_project_id), headers={}, timeout=None,
                  json={
                      'readme_file_id': dds_readme_file_id,
                      'job': 1,
@@ -399,6 +518,158 @@ class TestJobApi(TestCase):
         ])
 
 
+class TestBespinConnectionPool(TestCase):
+    def setUp(self):
+        self.settings = Mock(url='someurl', pool_size=3, keep_alive=True, timeout=None)
+
+    def tearDown(self):
+        BespinConnectionPool._shared_pools.clear()
+
+    @patch('lando.server.jobapi.requests')
+    def test_get_shared(self, mock_requests):
+        pool = BespinConnectionPool.get_shared(self.settings)
+        self.assertEqual(pool, BespinConnectionPool.get_shared(self.settings))
+        other_settings = Mock(url='otherurl', pool_size=3, keep_alive=True, timeout=None)
+        self.assertNotEqual(pool, BespinConnectionPool.get_shared(other_settings))
+        mock_requests.adapters.HTTPAdapter.assert_called_with(pool_connections=1, pool_maxsize=3)
+
+    @patch('lando.server.jobapi.requests')
+    def test_create_session(self, mock_requests):
+        pool = BespinConnectionPool(self.settings)
+        session = pool.create_session()
+        session.mount.assert_has_calls([
+            call('http://', pool.adapter),
+            call('https://', pool.adapter),
+        ])
+        session.headers.__setitem__.assert_not_called()
+
+    @patch('lando.server.jobapi.requests')
+    def test_create_session_without_keep_alive(self, mock_requests):
+        self.settings.keep_alive = False
+        pool = BespinConnectionPool(self.settings)
+        session = pool.create_session()
+        session.headers.__setitem__.assert_called_with('Connection', 'close')
+
+    @patch('lando.server.jobapi.requests')
+    def test_connection_stats(self, mock_requests):
+        pool = BespinConnectionPool(self.settings)
+        host_pools = {
+            'host1': Mock(num_requests=10, num_connections=2),
+            'host2': Mock(num_requests=1, num_connections=1),
+        }
+        pool.adapter.poolmanager.pools = host_pools
+        self.assertEqual({
+            'requests': 11,
+            'new_connections': 3,
+            'reused_connections': 8,
+        }, pool.connection_stats())
+
+    @patch('lando.server.jobapi.requests')
+    def test_shared_connection_stats(self, mock_requests):
+        pool = BespinConnectionPool.get_shared(self.settings)
+        pool.adapter.poolmanager.pools = {'host1': Mock(num_requests=4, num_connections=1)}
+        self.assertEqual({
+            'someurl': {'requests': 4, 'new_connections': 1, 'reused_connections': 3},
+        }, BespinConnectionPool.shared_connection_stats())
+
+
+class TestExpiringCache(TestCase):
+    @patch('lando.server.jobapi.time')
+    def test_get_and_set(self, mock_time):
+        mock_time.time.return_value = 100
+        cache = ExpiringCache()
+        self.assertEqual(None, cache.get('key1'))
+        cache.set('key1', 'value1', ttl_seconds=10)
+        self.assertEqual('value1', cache.get('key1'))
+        mock_time.time.return_value = 110
+        self.assertEqual(None, cache.get('key1'))
+
+    def test_clear(self):
+        cache = ExpiringCache()
+        cache.set('key1', 'value1', ttl_seconds=10)
+        cache.clear()
+        self.assertEqual(None, cache.get('key1'))
+
+    def test_evicts_least_recently_used(self):
+        cache = ExpiringCache(max_size=2)
+        cache.set('key1', 'value1', ttl_seconds=10)
+        cache.set('key2', 'value2', ttl_seconds=10)
+        cache.get('key1')
+        cache.set('key3', 'value3', ttl_seconds=10)
+        self.assertEqual('value1', cache.get('key1'))
+        self.assertEqual(None, cache.get('key2'))
+        self.assertEqual('value3', cache.get('key3'))
+        self.assertEqual({'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}, cache.stats())
+
+    def test_get_or_fetch(self):
+        cache = ExpiringCache()
+        fetch_func = Mock(return_value='value1')
+        self.assertEqual('value1', cache.get_or_fetch('key1', 10, fetch_func))
+        self.assertEqual('value1', cache.get_or_fetch('key1', 10, fetch_func))
+        fetch_func.assert_called_once_with()
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}, cache.stats())
+
+    def test_bespin_cache_stats(self):
+        stats = bespin_cache_stats()
+        self.assertEqual(['dds_user_credentials', 'methods_documents', 'share_groups'], sorted(stats.keys()))
+        self.assertEqual(share_group_cache.stats(), stats['share_groups'])
+
+    def test_get_or_fetch_raises(self):
+        cache = ExpiringCache()
+        fetch_func = Mock(side_effect=[ValueError('fetch failed'), 'value1'])
+        with self.assertRaises(ValueError):
+            cache.get_or_fetch('key1', 10, fetch_func)
+        self.assertEqual({}, cache._fetch_locks)
+        self.assertEqual('value1', cache.get_or_fetch('key1', 10, fetch_func))
+        self.assertEqual({}, cache._fetch_locks)
+
+    def test_get_or_fetch_concurrent_callers_share_fetch(self):
+        cache = ExpiringCache()
+        fetch_started = threading.Event()
+        finish_fetch = threading.Event()
+        fetch_count = []
+
+        def fetch_func():
+            fetch_count.append(1)
+            fetch_started.set()
+            finish_fetch.wait(5)
+            return 'value1'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('key1', 10, fetch_func)))
+                   for _ in range(3)]
+        threads[0].start()
+        fetch_started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # wait until the other callers are waiting on the lock held by the first fetch
+        while cache._fetch_locks['key1'][1] < 3:
+            time.sleep(0.01)
+        finish_fetch.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['value1'] * 3, results)
+        self.assertEqual(1, len(fetch_count))
+        self.assertEqual({}, cache._fetch_locks)
+
+
+class TestFileRecordList(TestCase):
+    def test_creates_records_when_accessed(self):
+        items = [
+            {'file_id': 1, 'destination_path': 'data1.txt', 'dds_user_credentials': 5, 'size': 100},
+            {'file_id': 2, 'destination_path': 'data2.txt', 'dds_user_credentials': 6, 'size': 200},
+        ]
+        records = FileRecordList(items, DukeDSFile)
+        self.assertEqual(2, len(records))
+        self.assertEqual((1, 2), records.columns[0])
+        record = records[1]
+        self.assertEqual(2, record.file_id)
+        self.assertEqual('data2.txt', record.destination_path)
+        self.assertEqual(6, record.user_id)
+        self.assertEqual(200, record.size)
+        self.assertEqual([1, 2], [record.file_id for record in records])
+
+
 class TestJob(TestCase):
     def setUp(self):
         job_data = {
@@ -552,6 +823,21 @@ class TestJob(TestCase):
         job = Job(self.vm_job_data)
         self.assertEqual(job.cleanup_vm, False)
 
+    def test_k8s_settings_parsed_when_accessed(self):
+        job = Job(self.k8s_job_data)
+        self.assertEqual(None, job.vm_settings)
+        self.assertEqual('dukegcb/calrissian:0.2.1', job.k8s_settings.run_workflow.image_name)
+        self.assertEqual(job.k8s_settings, job.k8s_settings)
+
+    def test_pickle_round_trip(self):
+        job = Job(self.k8s_job_data)
+        job.state = 'R'
+        job.workflow
+        loaded_job = pickle.loads(pickle.dumps(job, protocol=2))
+        self.assertEqual('R', loaded_job.state)
+        self.assertEqual(job.workflow.workflow_url, loaded_job.workflow.workflow_url)
+        self.assertEqual('calrissian', loaded_job.k8s_settings.run_workflow.base_command[0])
+
 
 class CWLCommandTests(TestCase):
 
@@ -5,10 +5,11 @@ perform the expected actions.
 
 from unittest import TestCase
 import json
-from lando.server.lando import Lando, JobActions, JobSettings, WORK_PROGRESS_EXCHANGE_NAME
+from lando.server.lando import Lando, JobActions, JobSettings, CloudQuotaReader, WORK_PROGRESS_EXCHANGE_NAME
+from lando.server.scheduler import AdmitJobPayload
 from lando.server.jobapi import JobStates, JobSteps, Job
 from lando_messaging.messaging import RestartJobPayload
-from unittest.mock import MagicMock, patch, Mock, call
+from unittest.mock import MagicMock, patch, Mock, call, ANY
 from shade import OpenStackCloudException
 
 
@@ -203,6 +204,9 @@ def make_mock_settings_and_report(job_id):
     settings.get_worker_client.return_value = worker_client
     settings.get_work_progress_queue.return_value = work_progress_queue
     settings.job_id = job_id
+    settings.provisioner = None
+    settings.warm_pool = None
+    settings.scheduler = None
     settings.config.make_worker_config_yml = MagicMock(return_value='config_file_content')
     return settings, report
 
@@ -219,11 +223,10 @@ class TestLando(TestCase):
         lando.start_job(MagicMock(job_id=job_id))
         expected_report = """
 Set job state to R.
-Send progress notification. Job:1 State:R Step:EMPTY
-Created vm name for job 1.
-Created volume name for job 1.
 Set job step to V.
 Send progress notification. Job:1 State:R Step:V
+Created vm name for job 1.
+Created volume name for job 1.
 Created volume volume_x.
 Launched vm worker_x.
 Set vm instance name to worker_x.
@@ -360,11 +363,10 @@ Send progress notification. Job:1 State:E Step:EMPTY
         lando.restart_job(RestartJobPayload(job_id=1))
         expected_report = """
 Set job state to R.
-Send progress notification. Job:1 State:R Step:EMPTY
-Created vm name for job 1.
-Created volume name for job 1.
 Set job step to V.
 Send progress notification. Job:1 State:R Step:V
+Created vm name for job 1.
+Created volume name for job 1.
 Created volume volume_x.
 Launched vm worker_x.
 Set vm instance name to worker_x.
@@ -489,11 +491,10 @@ Send progress notification. Job:1 State:F Step:EMPTY"""
         lando.start_job(MagicMock(job_id=job_id))
         expected_report = """
 Set job state to R.
-Send progress notification. Job:1 State:R Step:EMPTY
-Created vm name for job 1.
-Created volume name for job 1.
 Set job step to V.
 Send progress notification. Job:1 State:R Step:V
+Created vm name for job 1.
+Created volume name for job 1.
 Created volume volume_x.
 Set job state to E.
 Send progress notification. Job:1 State:E Step:V
@@ -534,11 +535,10 @@ Send progress notification. Job:1 State:C Step:EMPTY
         lando.start_job(MagicMock(job_id=job_id))
         expected_report = """
 Set job state to R.
-Send progress notification. Job:1 State:R Step:EMPTY
-Created vm name for job 1.
-Created volume name for job 1.
 Set job step to V.
 Send progress notification. Job:1 State:R Step:V
+Created vm name for job 1.
+Created volume name for job 1.
 Set job state to E.
 Send progress notification. Job:1 State:E Step:V
 """
@@ -569,6 +569,144 @@ Send progress notification. Job:1 State:E Step:V
             call('Additional error occurred while handling an error: StackTrace2')
         ])
 
+    def test_actions_use_dispatcher_while_listening(self):
+        lando = Lando(MagicMock())
+        lando._run_action = Mock()
+        lando.dispatcher = Mock()
+        lando.start_job(MagicMock(job_id=3))
+        lando._run_action.assert_not_called()
+        job_id, func = lando.dispatcher.dispatch.call_args[0]
+        self.assertEqual(3, job_id)
+        func()
+        lando._run_action.assert_called_once()
+
+    @patch('lando.server.lando.AdmissionScheduler')
+    @patch('lando.server.lando.WarmPool')
+    @patch('lando.server.lando.ProvisioningTracker')
+    @patch('lando.server.lando.JobMessageDispatcher')
+    def test_listen_for_messages(self, mock_dispatcher, mock_provisioning_tracker, mock_warm_pool,
+                                 mock_admission_scheduler):
+        mock_config = MagicMock(message_handler_threads=3, provisioning_poll_seconds=5,
+                                provisioning_timeout_seconds=60, provisioning_filename='/tmp/provisioning.json',
+                                warm_pool_settings=None, admission_scheduler_settings=None)
+        lando = Lando(mock_config)
+        lando._make_router = Mock()
+        lando.listen_for_messages()
+        mock_dispatcher.assert_called_with(max_workers=3)
+        lando._make_router.return_value.run.assert_called_with()
+        mock_dispatcher.return_value.shutdown.assert_called_with()
+        self.assertEqual(None, lando.dispatcher)
+        mock_provisioning_tracker.assert_called_with(lando._send_provisioning_event, poll_seconds=5,
+                                                     timeout_seconds=60, filename='/tmp/provisioning.json')
+        mock_provisioning_tracker.return_value.restore.assert_called_with(lando._make_provisioning_request_context)
+        mock_provisioning_tracker.return_value.start.assert_called_with()
+        mock_provisioning_tracker.return_value.stop.assert_called_with()
+        self.assertEqual(None, lando.provisioner)
+        mock_warm_pool.assert_not_called()
+        mock_admission_scheduler.assert_not_called()
+
+    @patch('lando.server.lando.logging')
+    @patch('lando.server.lando.bespin_cache_stats')
+    @patch('lando.server.lando.BespinConnectionPool')
+    @patch('lando.server.lando.JobMessageDispatcher')
+    def test_listen_for_messages_logs_stats(self, mock_dispatcher, mock_connection_pool, mock_bespin_cache_stats,
+                                            mock_logging):
+        mock_config = MagicMock(message_handler_threads=3, warm_pool_settings=None, admission_scheduler_settings=None)
+        mock_dispatcher.return_value.stats.return_value = {'queue_depth': 0, 'in_flight': 1, 'active_jobs': 1}
+        mock_connection_pool.shared_connection_stats.return_value = {'someurl': {'requests': 4}}
+        mock_bespin_cache_stats.return_value = {'share_groups': {'hits': 2}}
+        lando = Lando(mock_config)
+        lando._make_router = Mock()
+        lando._make_provisioner = Mock(return_value=None)
+        lando.listen_for_messages()
+        mock_logging.info.assert_has_calls([
+            call("Message dispatcher stats: {'queue_depth': 0, 'in_flight': 1, 'active_jobs': 1}"),
+            call("Bespin connection stats: {'someurl': {'requests': 4}}"),
+            call("Bespin cache stats: {'share_groups': {'hits': 2}}"),
+        ])
+
+    @patch('lando.server.lando.WarmPool')
+    @patch('lando.server.lando.ProvisioningTracker')
+    @patch('lando.server.lando.JobMessageDispatcher')
+    def test_listen_for_messages_with_warm_pool(self, mock_dispatcher, mock_provisioning_tracker, mock_warm_pool):
+        mock_config = MagicMock(message_handler_threads=3, admission_scheduler_settings=None)
+        lando = Lando(mock_config)
+        lando._make_router = Mock()
+        lando.listen_for_messages()
+        args, kwargs = mock_warm_pool.call_args
+        self.assertEqual((mock_config, mock_config.warm_pool_settings, mock_provisioning_tracker.return_value),
+                         args[:3])
+        mock_warm_pool.return_value.start.assert_called_with()
+        mock_warm_pool.return_value.stop.assert_called_with()
+        self.assertEqual(None, lando.warm_pool)
+
+    @patch('lando.server.lando.AdmissionScheduler')
+    @patch('lando.server.lando.ProvisioningTracker')
+    @patch('lando.server.lando.JobMessageDispatcher')
+    def test_listen_for_messages_with_admission_scheduler(self, mock_dispatcher, mock_provisioning_tracker,
+                                                          mock_admission_scheduler):
+        mock_config = MagicMock(message_handler_threads=3, warm_pool_settings=None)
+        lando = Lando(mock_config)
+        lando._make_router = Mock()
+        lando.listen_for_messages()
+        args, kwargs = mock_admission_scheduler.call_args
+        self.assertEqual(CloudQuotaReader, type(args[0]))
+        self.assertEqual((lando._admit_job, mock_config.admission_scheduler_settings), args[1:])
+        mock_admission_scheduler.return_value.restore.assert_called_with(ANY)
+        mock_admission_scheduler.return_value.start.assert_called_with()
+        mock_admission_scheduler.return_value.stop.assert_called_with()
+        self.assertEqual(None, lando.scheduler)
+
+    def test_admit_job_starts_job(self):
+        lando = Lando(MagicMock())
+        lando._run_action = Mock()
+        lando._admit_job(3, 12.5)
+        name, payload = lando._run_action.call_args[0]
+        self.assertEqual('start_job', name)
+        self.assertEqual(3, payload.job_id)
+        self.assertEqual(12.5, payload.wait_seconds)
+
+    def test_provisioning_event_without_job_goes_to_warm_pool(self):
+        lando = Lando(MagicMock())
+        lando._run_action = Mock()
+        lando.warm_pool = Mock()
+        payload = Mock(job_id=None)
+        lando._send_provisioning_event('vm_launch_error', payload)
+        lando.warm_pool.provisioning_event.assert_called_with('vm_launch_error', payload)
+        lando._run_action.assert_not_called()
+
+    @patch('lando.server.lando.JobApi')
+    def test_worker_started_for_warm_pool_vm(self, mock_job_api):
+        lando = Lando(MagicMock())
+        lando.warm_pool = Mock()
+        lando.warm_pool.worker_started.return_value = True
+        lando.worker_started(Mock(worker_queue_name='vm-pool_1'))
+        lando.warm_pool.worker_started.assert_called_with('vm-pool_1')
+        mock_job_api.get_jobs_for_vm_instance_name.assert_not_called()
+
+    @patch('lando.server.lando.make_worker_cloud_config_script')
+    @patch('lando.server.lando.CloudService')
+    @patch('lando.server.lando.JobApi')
+    def test_make_provisioning_request_context(self, mock_job_api, mock_cloud_service,
+                                               mock_make_worker_cloud_config_script):
+        mock_config = MagicMock(fake_cloud_service=False)
+        lando = Lando(mock_config)
+        job = mock_job_api.return_value.get_job.return_value
+        cloud_service, script_contents = lando._make_provisioning_request_context(4, 'vm4')
+        mock_job_api.assert_called_with(mock_config, 4)
+        mock_cloud_service.assert_called_with(mock_config, job.vm_settings)
+        mock_make_worker_cloud_config_script.assert_called_with(mock_config, 'vm4', job.vm_settings.cwl_commands,
+                                                                job.volume_mounts)
+        self.assertEqual(mock_cloud_service.return_value, cloud_service)
+        self.assertEqual(mock_make_worker_cloud_config_script.return_value.content, script_contents)
+
+    def test_provisioning_event_runs_action(self):
+        lando = Lando(MagicMock())
+        lando._run_action = Mock()
+        payload = Mock(job_id=4)
+        lando._send_provisioning_event('vm_terminate_complete', payload)
+        lando._run_action.assert_called_with('vm_terminate_complete', payload)
+
 
 class TestJobActions(TestCase):
     def test_store_job_output_complete_cleanup_vm_true(self):
@@ -579,6 +717,9 @@ class TestJobActions(TestCase):
         mock_settings = MagicMock()
         mock_settings.get_job_api.return_value = mock_job_api
         mock_settings.get_cloud_service.return_value = mock_cloud_service
+        mock_settings.provisioner = None
+        mock_settings.warm_pool = None
+        mock_settings.scheduler = None
         job_actions = JobActions(mock_settings)
         mock_output_project_info = Mock(project_id='123', readme_file_id='456')
         job_actions.store_job_output_complete(MagicMock(output_project_info=mock_output_project_info))
@@ -593,6 +734,9 @@ class TestJobActions(TestCase):
         mock_settings = MagicMock()
         mock_settings.get_job_api.return_value = mock_job_api
         mock_settings.get_cloud_service.return_value = mock_cloud_service
+        mock_settings.provisioner = None
+        mock_settings.warm_pool = None
+        mock_settings.scheduler = None
         job_actions = JobActions(mock_settings)
         job_actions.store_job_output_complete(MagicMock())
         mock_cloud_service.terminate_instance.assert_not_called()
@@ -605,6 +749,9 @@ class TestJobActions(TestCase):
         mock_settings = MagicMock()
         mock_settings.get_job_api.return_value = mock_job_api
         mock_settings.get_cloud_service.return_value = mock_cloud_service
+        mock_settings.provisioner = None
+        mock_settings.warm_pool = None
+        mock_settings.scheduler = None
         job_actions = JobActions(mock_settings)
         job_actions.cancel_job(MagicMock())
         mock_cloud_service.terminate_instance.assert_called_with('vm1', ['vol1'])
@@ -617,6 +764,9 @@ class TestJobActions(TestCase):
         mock_settings = MagicMock()
         mock_settings.get_job_api.return_value = mock_job_api
         mock_settings.get_cloud_service.return_value = mock_cloud_service
+        mock_settings.provisioner = None
+        mock_settings.warm_pool = None
+        mock_settings.scheduler = None
         job_actions = JobActions(mock_settings)
         job_actions.cancel_job(MagicMock())
         mock_cloud_service.terminate_instance.assert_not_called()
@@ -634,6 +784,9 @@ class TestJobActions(TestCase):
         mock_settings = MagicMock()
         mock_settings.get_job_api.return_value = mock_job_api
         mock_settings.get_cloud_service.return_value = mock_cloud_service
+        mock_settings.provisioner = None
+        mock_settings.warm_pool = None
+        mock_settings.scheduler = None
         mock_make_worker_config_yml = MagicMock()
         mock_make_worker_config_yml.return_value = LANDO_WORKER_CONFIG
         mock_settings.config.make_worker_config_yml = mock_make_worker_config_yml
@@ -654,6 +807,187 @@ class TestJobActions(TestCase):
         mock_job_api.set_vm_instance_name.assert_called_with('vm1')
         mock_job_api.set_vm_volume_name.assert_called_with('vol1')
 
+    def make_job_actions_with_provisioner(self, mock_job):
+        mock_job_api = MagicMock()
+        mock_job_api.get_job.return_value = mock_job
+        mock_settings = MagicMock()
+        mock_settings.get_job_api.return_value = mock_job_api
+        mock_settings.config.make_worker_config_yml.return_value = LANDO_WORKER_CONFIG
+        mock_settings.warm_pool.release.return_value = False
+        mock_settings.scheduler = None
+        return JobActions(mock_settings), mock_settings, mock_job_api
+
+    def test_launch_vm_with_provisioner(self):
+        mock_job = Mock(id='1', state='', step='', job_flavor_name='flavor1', volume_size=100,
+                        volume_mounts={'/dev/vdb1': '/work'}, vm_settings=Mock(cwl_commands=None))
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.launch_vm('vm1', 'vol1')
+        mock_settings.provisioner.submit_launch.assert_called_with(
+            mock_settings.job_id, mock_settings.get_cloud_service.return_value, 'vm1', 'flavor1',
+            CLOUD_CONFIG, 'vol1', 100)
+        mock_settings.get_cloud_service.return_value.launch_instance.assert_not_called()
+        mock_job_api.set_vm_instance_name.assert_called_with('vm1')
+        mock_job_api.set_vm_volume_name.assert_called_with('vol1')
+
+    def test_start_job_uses_warm_pool_vm(self):
+        mock_job = Mock(id='1', state='', step='')
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        mock_settings.warm_pool.acquire.return_value = Mock(vm_instance_name='vm-pool_1',
+                                                            vm_volume_name='vol-pool_1')
+        job_actions.start_job(Mock())
+        mock_settings.warm_pool.acquire.assert_called_with(mock_job)
+        mock_settings.provisioner.submit_launch.assert_not_called()
+        mock_job_api.set_vm_instance_name.assert_called_with('vm-pool_1')
+        mock_job_api.set_vm_volume_name.assert_called_with('vol-pool_1')
+        mock_job_api.set_job_step.assert_called_with(JobSteps.STAGING)
+        mock_settings.get_worker_client.assert_called_with(queue_name='vm-pool_1')
+        mock_settings.get_worker_client.return_value.stage_job.assert_called()
+        mock_settings.warm_pool.record_staging.assert_called_with(mock_settings.job_id)
+
+    def test_start_job_warm_pool_miss_launches_vm(self):
+        mock_job = Mock(id='1', state='', step='', job_flavor_name='flavor1', volume_size=100,
+                        volume_mounts={'/dev/vdb1': '/work'}, vm_settings=Mock(cwl_commands=None))
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        mock_settings.warm_pool.acquire.return_value = None
+        job_actions.start_job(Mock())
+        mock_settings.provisioner.submit_launch.assert_called()
+        mock_settings.warm_pool.record_launch.assert_called_with(
+            mock_settings.get_cloud_service.return_value.make_vm_name.return_value)
+        mock_settings.get_worker_client.return_value.stage_job.assert_not_called()
+
+    def make_job_actions_with_scheduler(self, mock_job):
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.scheduler = Mock()
+        job_actions.warm_pool = None
+        return job_actions, mock_job_api
+
+    def test_start_job_waits_in_queue(self):
+        mock_job = Mock(id=1, state=JobStates.AUTHORIZED, step=JobSteps.NONE)
+        job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+        job_actions.scheduler.submit.return_value = 2
+        job_actions.launch_vm = Mock()
+        job_actions.start_job(Mock())
+        job_actions.scheduler.submit.assert_called_with(mock_job)
+        mock_job_api.set_job_state.assert_not_called()
+        job_actions.launch_vm.assert_not_called()
+        notification = json.loads(job_actions.work_progress_queue.send.call_args[0][0])
+        self.assertEqual({'job': 1, 'state': 'A', 'step': '', 'queue_position': 2, 'queue_wait_seconds': 0},
+                         notification)
+
+    def test_start_job_admitted_immediately(self):
+        mock_job = Mock(id=1, state=JobStates.AUTHORIZED, step=JobSteps.NONE)
+        job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+        job_actions.scheduler.submit.return_value = 0
+        job_actions.launch_vm = Mock()
+        job_actions.start_job(Mock())
+        mock_job_api.set_job_state.assert_called_with(JobStates.RUNNING)
+        job_actions.launch_vm.assert_called()
+
+    def test_start_job_after_admission(self):
+        mock_job = Mock(id=1, state=JobStates.AUTHORIZED, step=JobSteps.NONE)
+        job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+        job_actions.launch_vm = Mock()
+        job_actions.start_job(AdmitJobPayload(1, 30.2))
+        job_actions.scheduler.submit.assert_not_called()
+        job_actions.launch_vm.assert_called()
+        notification = json.loads(job_actions.work_progress_queue.send.call_args[0][0])
+        self.assertEqual(30, notification['queue_wait_seconds'])
+
+    def test_start_job_admitted_after_cancel(self):
+        for state in [JobStates.CANCELING, JobStates.CANCELED, JobStates.ERRORED]:
+            mock_job = Mock(id=1, state=state, step=JobSteps.NONE)
+            job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+            job_actions.launch_vm = Mock()
+            job_actions.start_job(AdmitJobPayload(1, 30))
+            mock_job_api.set_job_state.assert_not_called()
+            job_actions.launch_vm.assert_not_called()
+            job_actions.scheduler.release.assert_called_with(job_actions.job_id)
+
+    def test_restarted_job_waits_in_queue_as_authorized(self):
+        mock_job = Mock(id=1, state=JobStates.ERRORED, step=JobSteps.NONE)
+        job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+        job_actions.scheduler.submit.return_value = 1
+        job_actions.launch_vm = Mock()
+        job_actions.start_job(Mock())
+        mock_job_api.set_job_state.assert_called_with(JobStates.AUTHORIZED)
+        job_actions.launch_vm.assert_not_called()
+
+    def test_finished_job_released_from_scheduler(self):
+        mock_job = Mock(id=1, state=JobStates.RUNNING, step=JobSteps.TERMINATE_VM)
+        job_actions, mock_job_api = self.make_job_actions_with_scheduler(mock_job)
+        job_actions._set_job_state(JobStates.RUNNING)
+        job_actions.scheduler.release.assert_not_called()
+        job_actions._set_job_state(JobStates.FINISHED)
+        job_actions.scheduler.release.assert_called_with(job_actions.job_id)
+
+    def test_terminate_vm_returns_vm_to_warm_pool(self):
+        mock_job = Mock(id='1', state='', step='', cleanup_vm=True, vm_instance_name='vm1', vm_volume_name='vol1')
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        mock_settings.warm_pool.release.return_value = True
+        job_actions.terminate_vm()
+        mock_settings.warm_pool.release.assert_called_with(mock_job)
+        mock_settings.provisioner.submit_terminate.assert_not_called()
+        mock_settings.get_worker_client.return_value.delete_queue.assert_not_called()
+        mock_job_api.set_job_state.assert_called_with(JobStates.FINISHED)
+
+    def test_terminate_vm_not_reused_forgets_vm(self):
+        mock_job = Mock(id='1', state='', step='', cleanup_vm=True, vm_instance_name='vm1', vm_volume_name='vol1')
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.terminate_vm()
+        mock_settings.warm_pool.forget.assert_called_with('vm1')
+        mock_settings.provisioner.submit_terminate.assert_called()
+
+    def test_vm_launch_error(self):
+        mock_job = Mock(id='1', state='', step=JobSteps.CREATE_VM)
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.vm_launch_error(Mock(message='VM vm1 has status ERROR.'))
+        mock_job_api.set_job_state.assert_called_with(JobStates.ERRORED)
+        mock_job_api.save_error_details.assert_called_with(JobSteps.CREATE_VM, 'VM vm1 has status ERROR.')
+
+    def test_terminate_vm_with_provisioner_waits_for_termination(self):
+        mock_job = Mock(id='1', state='', step='', cleanup_vm=True, vm_instance_name='vm1', vm_volume_name='vol1')
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.terminate_vm()
+        mock_settings.provisioner.submit_terminate.assert_called_with(
+            mock_settings.job_id, mock_settings.get_cloud_service.return_value, 'vm1', ['vol1'])
+        mock_settings.get_worker_client.return_value.delete_queue.assert_called_with()
+        mock_job_api.set_job_state.assert_not_called()
+
+    def test_terminate_vm_with_provisioner_no_cleanup(self):
+        mock_job = Mock(id='1', state='', step='', cleanup_vm=False, vm_instance_name='vm1', vm_volume_name='vol1')
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.terminate_vm()
+        mock_settings.provisioner.submit_terminate.assert_not_called()
+        mock_job_api.set_job_state.assert_called_with(JobStates.FINISHED)
+
+    def test_vm_terminate_complete_finishes_job(self):
+        mock_job = Mock(id='1', state=JobStates.RUNNING, step=JobSteps.TERMINATE_VM)
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.vm_terminate_complete(Mock(vm_instance_name='vm1'))
+        mock_job_api.set_job_step.assert_called_with(JobSteps.NONE)
+        mock_job_api.set_job_state.assert_called_with(JobStates.FINISHED)
+
+    def test_vm_terminate_complete_canceled_job(self):
+        mock_job = Mock(id='1', state=JobStates.CANCELED, step=JobSteps.NONE)
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.vm_terminate_complete(Mock(vm_instance_name='vm1'))
+        mock_job_api.set_job_state.assert_not_called()
+
+    def test_vm_terminate_error(self):
+        mock_job = Mock(id='1', state=JobStates.RUNNING, step=JobSteps.TERMINATE_VM)
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.vm_terminate_error(Mock(message='Volume vol1 has status error_deleting.'))
+        mock_job_api.set_job_state.assert_called_with(JobStates.ERRORED)
+        mock_job_api.save_error_details.assert_called_with(JobSteps.TERMINATE_VM,
+                                                           'Volume vol1 has status error_deleting.')
+
+    def test_vm_terminate_error_canceled_job(self):
+        mock_job = Mock(id='1', state=JobStates.CANCELED, step=JobSteps.NONE)
+        job_actions, mock_settings, mock_job_api = self.make_job_actions_with_provisioner(mock_job)
+        job_actions.vm_terminate_error(Mock(message='Timed out'))
+        mock_job_api.set_job_state.assert_not_called()
+        mock_job_api.save_error_details.assert_called_with(JobSteps.NONE, 'Timed out')
+
 
 class TestJobSettings(TestCase):
 
@@ -0,0 +1,259 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from lando.server.provisioning import ProvisioningTracker, ProvisioningStates, ProvisioningEvents, LaunchRequest, \
+    TerminateRequest
+import json
+import os
+import tempfile
+
+
+def make_cloud_service(project_name='project1', servers=None, volumes=None):
+    cloud_service = Mock(project_name=project_name)
+    cloud_service.start_create_volume.return_value = 'vol-id-123'
+    cloud_service.get_servers.return_value = servers if servers is not None else {}
+    cloud_service.get_volumes.return_value = volumes if volumes is not None else {}
+    return cloud_service
+
+
+class TestLaunchRequest(TestCase):
+    def setUp(self):
+        self.cloud_service = make_cloud_service()
+        self.request = LaunchRequest(1, self.cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 'vol-id-123')
+
+    def test_waits_for_volume(self):
+        self.assertIsNone(self.request.advance({}, {'vol1': {'status': 'creating'}}))
+        self.assertEqual(ProvisioningStates.CREATING_VOLUME, self.request.state)
+        self.cloud_service.start_launch_instance.assert_not_called()
+
+    def test_creates_server_once_volume_available(self):
+        self.assertIsNone(self.request.advance({}, {'vol1': {'status': 'available'}}))
+        self.assertEqual(ProvisioningStates.CREATING_SERVER, self.request.state)
+        self.cloud_service.start_launch_instance.assert_called_with('vm1', 'flavor1', 'script', ['vol-id-123'])
+
+    def test_volume_error(self):
+        with self.assertRaises(Exception):
+            self.request.advance({}, {'vol1': {'status': 'error'}})
+
+    def test_complete_once_server_active(self):
+        self.request.state = ProvisioningStates.CREATING_SERVER
+        self.assertIsNone(self.request.advance({'vm1': {'status': 'BUILD'}}, {}))
+        payload = self.request.advance({'vm1': {'status': 'ACTIVE', 'accessIPv4': '1.2.3.4'}}, {})
+        self.assertEqual(1, payload.job_id)
+        self.assertEqual('vm1', payload.vm_instance_name)
+        self.assertEqual('1.2.3.4', payload.ip_address)
+
+    def test_server_error(self):
+        self.request.state = ProvisioningStates.CREATING_SERVER
+        with self.assertRaises(Exception):
+            self.request.advance({'vm1': {'status': 'ERROR'}}, {})
+
+
+class TestTerminateRequest(TestCase):
+    def setUp(self):
+        self.cloud_service = make_cloud_service()
+        self.request = TerminateRequest(1, self.cloud_service, 'vm1', ['vol1'])
+
+    def test_waits_for_server_removal(self):
+        self.assertIsNone(self.request.advance({'vm1': {'status': 'ACTIVE'}}, {'vol1': {'status': 'in-use'}}))
+        self.assertEqual(ProvisioningStates.DELETING_SERVER, self.request.state)
+        self.cloud_service.start_delete_volume.assert_not_called()
+
+    def test_deletes_volumes_once_detached(self):
+        self.assertIsNone(self.request.advance({}, {'vol1': {'status': 'detaching'}}))
+        self.assertEqual(ProvisioningStates.DELETING_VOLUMES, self.request.state)
+        self.cloud_service.start_delete_volume.assert_not_called()
+        self.assertIsNone(self.request.advance({}, {'vol1': {'status': 'available'}}))
+        self.assertIsNone(self.request.advance({}, {'vol1': {'status': 'deleting'}}))
+        self.cloud_service.start_delete_volume.assert_called_once_with('vol1')
+        payload = self.request.advance({}, {})
+        self.assertEqual('vm1', payload.vm_instance_name)
+
+    def test_volume_delete_error(self):
+        with self.assertRaises(Exception):
+            self.request.advance({}, {'vol1': {'status': 'error_deleting'}})
+
+
+class TestProvisioningTracker(TestCase):
+    def setUp(self):
+        self.send_event = Mock()
+        self.tracker = ProvisioningTracker(self.send_event, poll_seconds=0.01, timeout_seconds=100)
+
+    def test_submit_launch(self):
+        cloud_service = make_cloud_service()
+        self.tracker.submit_launch(1, cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 100)
+        cloud_service.start_create_volume.assert_called_with(100, 'vol1')
+        self.assertEqual({ProvisioningStates.CREATING_VOLUME: 1}, self.tracker.stats())
+
+    def test_submit_terminate(self):
+        cloud_service = make_cloud_service()
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', ['vol1'])
+        cloud_service.start_terminate_instance.assert_called_with('vm1')
+        self.assertEqual({ProvisioningStates.DELETING_SERVER: 1}, self.tracker.stats())
+
+    def test_poll_fetches_once_per_project(self):
+        cloud_service1 = make_cloud_service(project_name='project1')
+        cloud_service2 = make_cloud_service(project_name='project1')
+        cloud_service3 = make_cloud_service(project_name='project2')
+        self.tracker.submit_terminate(1, cloud_service1, 'vm1', [])
+        self.tracker.submit_terminate(2, cloud_service2, 'vm2', [])
+        self.tracker.submit_terminate(3, cloud_service3, 'vm3', [])
+        self.tracker.poll()
+        self.assertEqual(1, cloud_service1.get_servers.call_count)
+        self.assertEqual(0, cloud_service2.get_servers.call_count)
+        self.assertEqual(1, cloud_service3.get_servers.call_count)
+        self.assertEqual(3, self.send_event.call_count)
+        self.assertEqual({}, self.tracker.stats())
+
+    def test_poll_sends_complete_event(self):
+        cloud_service = make_cloud_service(servers={'vm1': {'status': 'ACTIVE'}})
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', [])
+        self.tracker.poll()
+        self.send_event.assert_not_called()
+        cloud_service.get_servers.return_value = {}
+        self.tracker.poll()
+        event_name, payload = self.send_event.call_args[0]
+        self.assertEqual(ProvisioningEvents.VM_TERMINATE_COMPLETE, event_name)
+        self.assertEqual(1, payload.job_id)
+
+    def test_poll_sends_error_event(self):
+        cloud_service = make_cloud_service(volumes={'vol1': {'status': 'error'}})
+        self.tracker.submit_launch(1, cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 100)
+        self.tracker.poll()
+        event_name, payload = self.send_event.call_args[0]
+        self.assertEqual(ProvisioningEvents.VM_LAUNCH_ERROR, event_name)
+        self.assertIn('Volume vol1 has status error', payload.message)
+
+    @patch('lando.server.provisioning.time')
+    def test_poll_sends_error_event_on_timeout(self, mock_time):
+        mock_time.time.return_value = 1000
+        cloud_service = make_cloud_service(volumes={'vol1': {'status': 'creating'}})
+        self.tracker.submit_launch(1, cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 100)
+        self.tracker.poll()
+        self.send_event.assert_not_called()
+        mock_time.time.return_value = 1101
+        self.tracker.poll()
+        event_name, payload = self.send_event.call_args[0]
+        self.assertEqual(ProvisioningEvents.VM_LAUNCH_ERROR, event_name)
+        self.assertEqual('Timed out after 100 seconds while creating_volume vm1.', payload.message)
+
+    def test_cancel_while_creating_volume(self):
+        cloud_service = make_cloud_service(volumes={'vol1': {'status': 'creating'}})
+        self.tracker.submit_launch(1, cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 100)
+        self.tracker.poll()
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', ['vol1'])
+        cloud_service.start_terminate_instance.assert_not_called()
+        self.assertEqual({ProvisioningStates.DELETING_SERVER: 1}, self.tracker.stats())
+
+        cloud_service.get_volumes.return_value = {'vol1': {'status': 'available'}}
+        self.tracker.poll()
+        cloud_service.start_launch_instance.assert_not_called()
+        cloud_service.start_delete_volume.assert_called_with('vol1')
+        self.send_event.assert_not_called()
+        cloud_service.get_volumes.return_value = {}
+        self.tracker.poll()
+        self.assertEqual([ProvisioningEvents.VM_TERMINATE_COMPLETE],
+                         [call[0][0] for call in self.send_event.call_args_list])
+
+    def test_cancel_while_creating_server(self):
+        cloud_service = make_cloud_service(volumes={'vol1': {'status': 'available'}})
+        self.tracker.submit_launch(1, cloud_service, 'vm1', 'flavor1', 'script', 'vol1', 100)
+        self.tracker.poll()
+        cloud_service.start_launch_instance.assert_called_once()
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', ['vol1'])
+
+        # the VM is not listed yet so it is deleted once it appears
+        self.tracker.poll()
+        cloud_service.start_terminate_instance.assert_not_called()
+        cloud_service.start_delete_volume.assert_not_called()
+        cloud_service.get_servers.return_value = {'vm1': {'status': 'ACTIVE'}}
+        self.tracker.poll()
+        cloud_service.start_terminate_instance.assert_called_once_with('vm1')
+        cloud_service.get_servers.return_value = {}
+        self.tracker.poll()
+        cloud_service.start_delete_volume.assert_called_with('vol1')
+        cloud_service.get_volumes.return_value = {}
+        self.tracker.poll()
+        self.assertEqual([ProvisioningEvents.VM_TERMINATE_COMPLETE],
+                         [call[0][0] for call in self.send_event.call_args_list])
+
+    def test_poll_retries_when_fetch_fails(self):
+        cloud_service = make_cloud_service()
+        cloud_service.get_servers.side_effect = ValueError("unavailable")
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', [])
+        self.tracker.poll()
+        self.send_event.assert_not_called()
+        cloud_service.get_servers.side_effect = None
+        self.tracker.poll()
+        self.send_event.assert_called_once()
+
+    def test_start_and_stop(self):
+        cloud_service = make_cloud_service()
+        self.tracker.submit_terminate(1, cloud_service, 'vm1', [])
+        self.tracker.start()
+        self.tracker.stop()
+        self.assertIsNone(self.tracker.thread)
+
+    @patch('lando.server.provisioning.logging')
+    def test_restore_tracks_saved_requests(self, mock_logging):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'provisioning.json')
+            tracker = ProvisioningTracker(self.send_event, filename=filename)
+            tracker.submit_launch(1, make_cloud_service(), 'vm1', 'flavor1', 'script', 'vol1', 100)
+            tracker.submit_terminate(2, make_cloud_service(), 'vm2', ['vol2'])
+            tracker.submit_launch(None, make_cloud_service(), 'pool-vm', 'flavor1', 'script', 'pool-vol', 100)
+            tracker.submit_terminate(3, make_cloud_service(), 'vm3', ['vol3'])
+            with open(filename) as infile:
+                self.assertEqual(['vm1', 'vm2', 'pool-vm', 'vm3'], [data['server_name'] for data in json.load(infile)])
+
+            cloud_service = make_cloud_service(volumes={'vol1': {'status': 'available'}})
+            contexts = {1: (cloud_service, 'rebuilt script'), 2: (make_cloud_service(), None)}
+
+            def make_request_context(job_id, server_name):
+                return contexts[job_id]
+
+            tracker = ProvisioningTracker(self.send_event, filename=filename)
+            tracker.restore(make_request_context)
+            self.assertEqual({ProvisioningStates.CREATING_VOLUME: 1, ProvisioningStates.DELETING_SERVER: 1},
+                             tracker.stats())
+            # requests for VMs without a job and jobs that can not be read are logged
+            self.assertEqual(2, mock_logging.error.call_count)
+            tracker.poll()
+            cloud_service.start_launch_instance.assert_called_with('vm1', 'flavor1', 'rebuilt script',
+                                                                   ['vol-id-123'])
+            self.assertEqual([ProvisioningEvents.VM_TERMINATE_COMPLETE],
+                             [call[0][0] for call in self.send_event.call_args_list])
+            with open(filename) as infile:
+                saved_requests = json.load(infile)
+            self.assertEqual([(1, ProvisioningStates.CREATING_SERVER)],
+                             [(data['job_id'], data['state']) for data in saved_requests])
+
+    def test_restore_terminates_pool_vms(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'provisioning.json')
+            tracker = ProvisioningTracker(self.send_event, filename=filename)
+            launch_cloud_service = make_cloud_service(volumes={'pool-vol2': {'status': 'available'}})
+            tracker.submit_launch(None, launch_cloud_service, 'pool-vm1', 'flavor1', 'script', 'pool-vol1', 100,
+                                  settings_job_id=4)
+            tracker.submit_launch(None, launch_cloud_service, 'pool-vm2', 'flavor1', 'script', 'pool-vol2', 100,
+                                  settings_job_id=4)
+            tracker.poll()
+            tracker.submit_terminate(None, make_cloud_service(), 'pool-vm3', ['pool-vol3'], settings_job_id=5)
+
+            cloud_service = make_cloud_service(servers={'pool-vm2': {'status': 'BUILD'}, 'pool-vm3': {}},
+                                               volumes={'pool-vol1': {'status': 'available'},
+                                                        'pool-vol2': {'status': 'in-use'},
+                                                        'pool-vol3': {'status': 'in-use'}})
+            make_request_context = Mock(return_value=(cloud_service, 'rebuilt script'))
+            tracker = ProvisioningTracker(self.send_event, filename=filename)
+            tracker.restore(make_request_context)
+            self.assertEqual([4, 4, 5], [call[0][0] for call in make_request_context.call_args_list])
+            # pool launches become terminates since the warm pool that owned them is gone
+            self.assertEqual({ProvisioningStates.DELETING_SERVER: 3}, tracker.stats())
+            tracker.poll()
+            cloud_service.start_launch_instance.assert_not_called()
+            cloud_service.start_delete_volume.assert_called_once_with('pool-vol1')
+            cloud_service.start_terminate_instance.assert_called_once_with('pool-vm2')
+            with open(filename) as infile:
+                saved_requests = json.load(infile)
+            self.assertEqual([('pool-vm1', 4), ('pool-vm2', 4), ('pool-vm3', 5)],
+                             [(data['server_name'], data['settings_job_id']) for data in saved_requests])
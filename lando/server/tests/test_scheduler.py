@@ -0,0 +1,241 @@
+from unittest import TestCase
+from unittest.mock import Mock, patch, ANY
+from lando.server.scheduler import AdmissionScheduler, Quota, ResourceAmounts, UNLIMITED_QUOTA, parse_memory_gb, \
+    parse_cpus
+from lando.server.jobapi import JobStates
+import json
+import os
+import tempfile
+import threading
+
+
+def make_job(job_id, cpus=2, memory='4G', volume_size=10, project_name='project1', username='joe'):
+    return Mock(id=job_id, job_flavor_cpus=cpus, job_flavor_memory=memory, volume_size=volume_size,
+                project_name=project_name, username=username)
+
+
+def make_quota(cpus=8, memory_gb=16, volume_gb=100, used=None):
+    return Quota(ResourceAmounts(cpus=cpus, memory_gb=memory_gb, volume_gb=volume_gb), used or ResourceAmounts())
+
+
+class TestParsing(TestCase):
+    def test_parse_memory_gb(self):
+        self.assertEqual(1, parse_memory_gb('1G'))
+        self.assertEqual(0.2, parse_memory_gb('200MB'))
+        self.assertEqual(0.2, parse_memory_gb('200M'))
+        self.assertEqual(0.5, parse_memory_gb('512Mi'))
+        self.assertEqual(2, parse_memory_gb('2Gi'))
+        self.assertEqual(1, parse_memory_gb(1000 ** 3))
+
+    def test_parse_memory_gb_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_memory_gb('lots')
+
+    def test_parse_cpus(self):
+        self.assertEqual(4, parse_cpus('4'))
+        self.assertEqual(0.5, parse_cpus('500m'))
+
+
+class TestResourceAmounts(TestCase):
+    def test_fits_within(self):
+        amounts = ResourceAmounts(cpus=2, memory_gb=4, volume_gb=10)
+        self.assertTrue(amounts.fits_within(ResourceAmounts(cpus=2, memory_gb=4, volume_gb=10)))
+        self.assertFalse(amounts.fits_within(ResourceAmounts(cpus=1, memory_gb=4, volume_gb=10)))
+        self.assertTrue(amounts.fits_within(ResourceAmounts(cpus=None, memory_gb=None, volume_gb=None)))
+
+
+class TestAdmissionScheduler(TestCase):
+    def setUp(self):
+        self.quota_reader = Mock()
+        self.quota_reader.get_quota_key.side_effect = lambda job: job.project_name
+        self.quota_reader.read_quota.return_value = make_quota()
+        self.admit_job = Mock()
+        self.settings = Mock(retry_seconds=0.01, default_user_weight=1, user_weights={},
+                             max_running_jobs_per_user=0, user_max_running_jobs={}, queue_filename=None)
+        self.scheduler = AdmissionScheduler(self.quota_reader, self.admit_job, self.settings)
+
+    def test_submit_admits_job_that_fits(self):
+        self.assertEqual(0, self.scheduler.submit(make_job(1)))
+        self.admit_job.assert_not_called()
+        self.assertEqual({'pending': 0, 'running': 1, 'users': {'joe': {'pending': 0, 'running': 1}}},
+                         self.scheduler.stats())
+
+    def test_submit_queues_job_that_does_not_fit(self):
+        self.scheduler.submit(make_job(1, cpus=6))
+        self.assertEqual(1, self.scheduler.submit(make_job(2, cpus=4)))
+        self.assertEqual(2, self.scheduler.submit(make_job(3, cpus=1)))
+        self.assertEqual(2, self.scheduler.stats()['pending'])
+        self.assertEqual(1, self.scheduler.stats()['running'])
+
+    def test_reserved_resources_count_until_cloud_reports_usage(self):
+        self.scheduler.submit(make_job(1, memory='10G'))
+        self.assertEqual(1, self.scheduler.submit(make_job(2, memory='10G')))
+        # Cloud usage includes job 1 and more
+        self.quota_reader.read_quota.return_value = make_quota(used=ResourceAmounts(cpus=2, memory_gb=12))
+        self.assertEqual(2, self.scheduler.submit(make_job(3, memory='6G')))
+
+    def test_release_admits_queued_jobs_in_order(self):
+        self.scheduler.submit(make_job(1, volume_size=90))
+        self.scheduler.submit(make_job(2, volume_size=50))
+        self.scheduler.submit(make_job(3, volume_size=20))
+        self.scheduler.release(1)
+        self.assertEqual([2, 3], [call[0][0] for call in self.admit_job.call_args_list])
+        self.assertEqual({'joe': {'pending': 0, 'running': 2}}, self.scheduler.stats()['users'])
+
+    def test_release_pending_job(self):
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.scheduler.submit(make_job(2, cpus=8))
+        self.scheduler.release(2)
+        self.assertEqual(0, self.scheduler.queue_position(2))
+        self.scheduler.release(1)
+        self.admit_job.assert_not_called()
+
+    def test_release_unknown_job(self):
+        self.scheduler.release(5)
+        self.quota_reader.read_quota.assert_not_called()
+
+    def test_projects_are_admitted_independently(self):
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.assertEqual(1, self.scheduler.submit(make_job(2, cpus=8)))
+        self.assertEqual(0, self.scheduler.submit(make_job(3, cpus=8, project_name='project2')))
+
+    def test_priority(self):
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.scheduler.submit(make_job(2))
+        self.scheduler.submit(make_job(3), priority=-1)
+        self.assertEqual(1, self.scheduler.queue_position(3))
+        self.assertEqual(2, self.scheduler.queue_position(2))
+
+    def test_quota_read_error_leaves_job_queued(self):
+        self.quota_reader.read_quota.side_effect = ValueError("unavailable")
+        self.assertEqual(1, self.scheduler.submit(make_job(1)))
+        self.quota_reader.read_quota.side_effect = None
+        self.scheduler.admit()
+        self.admit_job.assert_called_once()
+
+    def test_quota_is_read_without_holding_lock(self):
+        lock_acquired = []
+
+        def acquire_lock():
+            lock_acquired.append(self.scheduler.lock.acquire(timeout=1))
+            self.scheduler.lock.release()
+
+        def read_quota(job):
+            # another thread, such as one releasing a job, can use the scheduler while quota is being read
+            thread = threading.Thread(target=acquire_lock)
+            thread.start()
+            thread.join()
+            return make_quota()
+
+        self.quota_reader.read_quota.side_effect = read_quota
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.scheduler.submit(make_job(2, cpus=8))
+        self.scheduler.release(1)
+        self.assertEqual([True, True, True], lock_acquired)
+        self.admit_job.assert_called_once_with(2, ANY)
+
+    @patch('lando.server.scheduler.time')
+    def test_admit_reports_wait_time(self, mock_time):
+        mock_time.time.return_value = 1000
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.scheduler.submit(make_job(2, cpus=8))
+        mock_time.time.return_value = 1030
+        self.scheduler.release(1)
+        self.admit_job.assert_called_with(2, 30)
+
+    def admitted_usernames(self):
+        return [self.jobs[call[0][0]].username for call in self.admit_job.call_args_list]
+
+    def submit_jobs(self, usernames):
+        self.jobs = {}
+        for job_id, username in enumerate(usernames):
+            job = make_job(job_id, cpus=1, username=username)
+            self.jobs[job_id] = job
+            self.scheduler.submit(job)
+
+    def test_users_take_turns(self):
+        self.quota_reader.read_quota.return_value = make_quota(cpus=0)
+        self.submit_jobs(['joe'] * 4 + ['ann'] * 2)
+        self.assertEqual(2, self.scheduler.queue_position(4))
+        self.quota_reader.read_quota.return_value = UNLIMITED_QUOTA
+        self.scheduler.admit()
+        self.assertEqual(['joe', 'ann', 'joe', 'ann', 'joe', 'joe'], self.admitted_usernames())
+
+    def test_user_weights(self):
+        self.settings.user_weights = {'ann': 2}
+        self.quota_reader.read_quota.return_value = make_quota(cpus=0)
+        self.submit_jobs(['joe'] * 3 + ['ann'] * 4)
+        self.quota_reader.read_quota.return_value = UNLIMITED_QUOTA
+        self.scheduler.admit()
+        self.assertEqual(['ann', 'joe', 'ann', 'ann', 'joe', 'ann', 'joe'], self.admitted_usernames())
+
+    def test_new_user_does_not_wait_behind_busy_user(self):
+        self.quota_reader.read_quota.return_value = make_quota(cpus=3)
+        self.submit_jobs(['joe'] * 6)
+        self.assertEqual(3, self.scheduler.stats()['users']['joe']['pending'])
+        job = make_job(10, cpus=1, username='ann')
+        self.assertEqual(1, self.scheduler.submit(job))
+
+    def test_user_max_running_jobs(self):
+        self.settings.max_running_jobs_per_user = 2
+        self.settings.user_max_running_jobs = {'ann': 1}
+        self.submit_jobs(['joe'] * 3 + ['ann'] * 2)
+        self.assertEqual({'joe': {'pending': 1, 'running': 2}, 'ann': {'pending': 1, 'running': 1}},
+                         self.scheduler.stats()['users'])
+        self.scheduler.release(0)
+        self.admit_job.assert_called_with(2, ANY)
+
+    def test_start_and_stop(self):
+        self.scheduler.start()
+        self.scheduler.stop()
+        self.assertIsNone(self.scheduler.thread)
+
+    @patch('lando.server.scheduler.logging')
+    def test_stop_logs_jobs_that_are_not_saved(self, mock_logging):
+        self.scheduler.submit(make_job(1, cpus=8))
+        self.scheduler.submit(make_job(2, cpus=8))
+        self.scheduler.stop()
+        mock_logging.error.assert_called_with("Jobs still queued will not be requeued when lando restarts: [2]")
+
+    def test_restore_requeues_saved_jobs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.settings.queue_filename = os.path.join(directory, 'queue.json')
+            jobs = {
+                1: make_job(1, cpus=6),
+                2: make_job(2, cpus=4),
+                3: make_job(3, cpus=1),
+                4: make_job(4, cpus=1),
+            }
+            for job_id in [1, 2, 3, 4]:
+                self.scheduler.submit(jobs[job_id])
+            self.scheduler.release(4)
+            with open(self.settings.queue_filename) as infile:
+                data = json.load(infile)
+            self.assertEqual([2, 3], [saved_job['job_id'] for saved_job in data['pending']])
+            self.assertEqual([1], data['running'])
+
+            # job 3 was canceled while lando was down
+            jobs[1].state = JobStates.RUNNING
+            jobs[2].state = JobStates.NEW
+            jobs[3].state = JobStates.CANCELED
+            scheduler = AdmissionScheduler(self.quota_reader, self.admit_job, self.settings)
+            scheduler.restore(lambda job_id: jobs[job_id])
+            self.assertEqual({'pending': 1, 'running': 1, 'users': {'joe': {'pending': 1, 'running': 1}}},
+                             scheduler.stats())
+            self.assertEqual(1, scheduler.queue_position(2))
+            self.admit_job.assert_not_called()
+
+            scheduler.release(1)
+            self.admit_job.assert_called_once_with(2, ANY)
+
+    @patch('lando.server.scheduler.logging')
+    def test_restore_skips_jobs_that_cannot_be_read(self, mock_logging):
+        with tempfile.TemporaryDirectory() as directory:
+            self.settings.queue_filename = os.path.join(directory, 'queue.json')
+            self.scheduler.restore(Mock())
+            self.scheduler.submit(make_job(1, cpus=8))
+            self.scheduler.submit(make_job(2, cpus=8))
+            scheduler = AdmissionScheduler(self.quota_reader, self.admit_job, self.settings)
+            scheduler.restore(Mock(side_effect=ValueError("not found")))
+            self.assertEqual(0, scheduler.stats()['pending'])
+            self.assertEqual(2, mock_logging.error.call_count)
@@ -0,0 +1,180 @@
+from unittest import TestCase
+from unittest.mock import Mock, MagicMock, patch
+from lando.server.warmpool import WarmPool, PooledVMStates, make_pool_key
+from lando.server.provisioning import ProvisioningEvents, ProvisioningEventPayload
+
+
+def make_job(job_id=1, flavor_name='flavor1', image_name='image1'):
+    cwl_commands = Mock(base_command=['cwl-runner'], pre_process_command=[], post_process_command=[])
+    vm_settings = Mock(vm_project_name='project1', image_name=image_name, cwl_commands=cwl_commands)
+    return Mock(id=job_id, job_flavor_name=flavor_name, volume_size=100, volume_mounts={'/dev/vdb1': '/work'},
+                vm_settings=vm_settings)
+
+
+class TestMakePoolKey(TestCase):
+    def test_same_settings_share_key(self):
+        self.assertEqual(make_pool_key(make_job(job_id=1)), make_pool_key(make_job(job_id=2)))
+
+    def test_different_flavor_or_image(self):
+        self.assertNotEqual(make_pool_key(make_job()), make_pool_key(make_job(flavor_name='flavor2')))
+        self.assertNotEqual(make_pool_key(make_job()), make_pool_key(make_job(image_name='image2')))
+
+
+@patch('lando.server.warmpool.LandoWorkerClient')
+class TestWarmPool(TestCase):
+    def setUp(self):
+        self.settings = Mock(min_size=0, max_size=2, idle_ttl_seconds=600, boot_timeout_seconds=900,
+                             maintain_seconds=0.01, max_jobs_per_vm=1, max_vm_lifetime_seconds=3600)
+        self.provisioner = Mock()
+        self.cloud_service = Mock()
+        self.cloud_service.make_pool_vm_name.side_effect = ['vm-pool_1', 'vm-pool_2', 'vm-pool_3']
+        self.cloud_service.make_pool_volume_name.side_effect = ['vol-pool_1', 'vol-pool_2', 'vol-pool_3']
+        config = MagicMock()
+        config.make_worker_config_yml.return_value = 'worker config'
+        self.warm_pool = WarmPool(config, self.settings, self.provisioner, lambda vm_settings: self.cloud_service)
+
+    def test_miss_grows_pool(self, mock_worker_client):
+        self.assertIsNone(self.warm_pool.acquire(make_job()))
+        self.warm_pool.maintain()
+        args, kwargs = self.provisioner.submit_launch.call_args
+        self.assertEqual((None, self.cloud_service, 'vm-pool_1', 'flavor1'), args[:4])
+        self.assertEqual(('vol-pool_1', 100), args[5:])
+        self.assertEqual({'settings_job_id': 1}, kwargs)
+        self.assertEqual({'hits': 0, 'misses': 1, 'hit_rate': 0.0, 'average_time_to_stage_seconds': None,
+                          'booting': 1, 'ready': 0}, self.warm_pool.stats())
+
+    def test_grows_up_to_max_size(self, mock_worker_client):
+        for job_id in range(4):
+            self.warm_pool.acquire(make_job(job_id=job_id))
+        self.warm_pool.maintain()
+        self.assertEqual(2, self.provisioner.submit_launch.call_count)
+
+    def test_hit_after_worker_started(self, mock_worker_client):
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.assertIsNone(self.warm_pool.acquire(make_job(job_id=2)))
+        self.assertTrue(self.warm_pool.worker_started('vm-pool_1'))
+        self.assertFalse(self.warm_pool.worker_started('vm-job3_1234'))
+        vm = self.warm_pool.acquire(make_job(job_id=3))
+        self.assertEqual('vm-pool_1', vm.vm_instance_name)
+        self.assertEqual('vol-pool_1', vm.vm_volume_name)
+        self.warm_pool.record_staging(3)
+        stats = self.warm_pool.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertIsNotNone(stats['average_time_to_stage_seconds'])
+        # VM handed to the job is replaced
+        self.warm_pool.maintain()
+        self.assertEqual(3, self.provisioner.submit_launch.call_count)
+
+    def test_other_kind_of_vm_is_a_miss(self, mock_worker_client):
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.warm_pool.worker_started('vm-pool_1')
+        self.assertIsNone(self.warm_pool.acquire(make_job(job_id=2, flavor_name='flavor2')))
+
+    @patch('lando.server.warmpool.time')
+    def test_idle_vm_terminated_and_pool_shrinks(self, mock_time, mock_worker_client):
+        mock_time.time.return_value = 1000
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.warm_pool.worker_started('vm-pool_1')
+        mock_time.time.return_value = 1601
+        self.warm_pool.maintain()
+        self.provisioner.submit_terminate.assert_called_with(None, self.cloud_service, 'vm-pool_1', ['vol-pool_1'],
+                                                            settings_job_id=1)
+        mock_worker_client.return_value.delete_queue.assert_called_with()
+        self.assertEqual(1, self.provisioner.submit_launch.call_count)
+        self.assertEqual({}, self.warm_pool.pools)
+
+    @patch('lando.server.warmpool.time')
+    def test_vm_that_never_starts_is_replaced(self, mock_time, mock_worker_client):
+        mock_time.time.return_value = 1000
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        mock_time.time.return_value = 1901
+        self.warm_pool.maintain()
+        self.provisioner.submit_terminate.assert_called_with(None, self.cloud_service, 'vm-pool_1', ['vol-pool_1'],
+                                                            settings_job_id=1)
+        mock_worker_client.return_value.delete_queue.assert_not_called()
+        self.assertEqual(2, self.provisioner.submit_launch.call_count)
+
+    def test_release_without_lease_mode(self, mock_worker_client):
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.warm_pool.worker_started('vm-pool_1')
+        self.warm_pool.acquire(make_job(job_id=2))
+        self.assertFalse(self.warm_pool.release(Mock(vm_instance_name='vm-pool_1')))
+        self.assertEqual({}, self.warm_pool.leased_vms)
+
+    def test_release_reuses_vm_until_max_jobs(self, mock_worker_client):
+        self.settings.max_jobs_per_vm = 2
+        job1 = make_job(job_id=1)
+        job1.vm_instance_name = 'vm-job1_1234'
+        job1.vm_volume_name = 'vol-job1_1234'
+        self.assertIsNone(self.warm_pool.acquire(job1))
+        self.warm_pool.record_launch('vm-job1_1234')
+        self.assertTrue(self.warm_pool.release(job1))
+        vm = self.warm_pool.acquire(make_job(job_id=2))
+        self.assertEqual('vm-job1_1234', vm.vm_instance_name)
+        self.assertEqual('vol-job1_1234', vm.vm_volume_name)
+        self.assertEqual(2, vm.jobs_run)
+        job2 = make_job(job_id=2)
+        job2.vm_instance_name = 'vm-job1_1234'
+        self.assertFalse(self.warm_pool.release(job2))
+
+    @patch('lando.server.warmpool.time')
+    def test_release_old_vm(self, mock_time, mock_worker_client):
+        self.settings.max_jobs_per_vm = 5
+        mock_time.time.return_value = 1000
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.warm_pool.worker_started('vm-pool_1')
+        job = make_job(job_id=2)
+        job.vm_instance_name = self.warm_pool.acquire(job).vm_instance_name
+        mock_time.time.return_value = 4601
+        self.assertFalse(self.warm_pool.release(job))
+
+    @patch('lando.server.warmpool.time')
+    def test_release_old_vm_launched_for_job(self, mock_time, mock_worker_client):
+        self.settings.max_jobs_per_vm = 5
+        mock_time.time.return_value = 1000
+        job = make_job(job_id=1)
+        job.vm_instance_name = 'vm-job1_1234'
+        job.vm_volume_name = 'vol-job1_1234'
+        self.assertIsNone(self.warm_pool.acquire(job))
+        self.warm_pool.record_launch('vm-job1_1234')
+        mock_time.time.return_value = 4601
+        self.assertFalse(self.warm_pool.release(job))
+        self.assertEqual({}, self.warm_pool.job_vm_launch_times)
+
+    def test_release_vm_launched_before_lando_started(self, mock_worker_client):
+        self.settings.max_jobs_per_vm = 5
+        job = make_job(job_id=1)
+        job.vm_instance_name = 'vm-job1_1234'
+        job.vm_volume_name = 'vol-job1_1234'
+        self.assertFalse(self.warm_pool.release(job))
+
+    def test_forget(self, mock_worker_client):
+        self.warm_pool.leased_vms['vm1'] = Mock()
+        self.warm_pool.forget('vm1')
+        self.assertEqual({}, self.warm_pool.leased_vms)
+
+    def test_launch_error_removes_vm(self, mock_worker_client):
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        payload = ProvisioningEventPayload(None, 'vm-pool_1', message='VM vm-pool_1 has status ERROR.')
+        self.warm_pool.provisioning_event(ProvisioningEvents.VM_LAUNCH_ERROR, payload)
+        self.provisioner.submit_terminate.assert_called_with(None, self.cloud_service, 'vm-pool_1', ['vol-pool_1'],
+                                                            settings_job_id=1)
+        self.assertEqual(0, self.warm_pool.stats()['booting'])
+
+    def test_stop_terminates_pool_vms(self, mock_worker_client):
+        self.warm_pool.acquire(make_job(job_id=1))
+        self.warm_pool.maintain()
+        self.warm_pool.worker_started('vm-pool_1')
+        self.warm_pool.start()
+        self.warm_pool.stop()
+        self.cloud_service.terminate_instance.assert_called_with('vm-pool_1', ['vol-pool_1'])
+        mock_worker_client.return_value.delete_queue.assert_called_with()
+        self.assertEqual({}, self.warm_pool.pools)
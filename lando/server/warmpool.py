@@ -0,0 +1,361 @@
+"""
+Keeps booted lando_worker VMs with attached volumes ready so jobs can skip waiting for a VM to boot.
+"""
+from collections import deque
+import threading
+import traceback
+import logging
+import json
+import time
+from lando.server.cloudconfigscript import make_worker_cloud_config_script
+from lando.server.provisioning import ProvisioningEvents
+from lando_messaging.clients import LandoWorkerClient
+
+TIME_TO_STAGE_SAMPLES = 100
+
+
+class PooledVMStates(object):
+    BOOTING = 'booting'
+    READY = 'ready'
+
+
+def make_pool_key(job):
+    """
+    Create a key for the kind of VM a job needs. VMs in a pool can only be used by jobs with the same key.
+    Along with project, image and flavor the key includes the volume and worker commands baked into the VM at boot.
+    :param job: Job: job that needs a VM
+    :return: tuple: hashable key
+    """
+    vm_settings = job.vm_settings
+    cwl_commands = vm_settings.cwl_commands
+    return (
+        vm_settings.vm_project_name,
+        vm_settings.image_name,
+        job.job_flavor_name,
+        job.volume_size,
+        json.dumps(job.volume_mounts, sort_keys=True),
+        json.dumps([cwl_commands.base_command, cwl_commands.pre_process_command, cwl_commands.post_process_command]),
+    )
+
+
+class PooledVM(object):
+    """
+    A VM and volume owned by the warm pool.
+    """
+    def __init__(self, key, vm_instance_name, vm_volume_name):
+        self.key = key
+        self.vm_instance_name = vm_instance_name
+        self.vm_volume_name = vm_volume_name
+        self.state = PooledVMStates.BOOTING
+        self.launch_time = time.time()
+        self.ready_time = None
+        self.jobs_run = 0
+
+    def is_stale(self, now, settings):
+        """
+        :return: bool: True when the VM has been idle too long, never finished booting or is too old to reuse
+        """
+        if now - self.launch_time > settings.max_vm_lifetime_seconds:
+            return True
+        if self.state == PooledVMStates.READY:
+            return now - self.ready_time > settings.idle_ttl_seconds
+        return now - self.launch_time > settings.boot_timeout_seconds
+
+
+class VMPool(object):
+    """
+    VMs for a single pool key along with the settings needed to launch more of them.
+    """
+    def __init__(self, key, job, min_size, max_size):
+        """
+        :param key: tuple: key created by make_pool_key
+        :param job: Job: job whose settings are used to launch VMs for this pool
+        :param min_size: int: number of VMs to always keep in this pool
+        :param max_size: int: maximum number of VMs to keep in this pool
+        """
+        self.key = key
+        self.job_id = job.id
+        self.vm_settings = job.vm_settings
+        self.flavor_name = job.job_flavor_name
+        self.volume_size = job.volume_size
+        self.volume_mounts = job.volume_mounts
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_size = min_size
+        self.vms = []
+
+    def grow(self):
+        self.target_size = min(self.target_size + 1, self.max_size)
+
+    def shrink(self):
+        self.target_size = max(self.target_size - 1, self.min_size)
+
+    def take_ready_vm(self):
+        for vm in self.vms:
+            if vm.state == PooledVMStates.READY:
+                self.vms.remove(vm)
+                return vm
+        return None
+
+
+class WarmPool(object):
+    """
+    Maintains pools of VMs for each kind of VM jobs have asked for.
+    A pool starts when a job asks for a kind of VM, grows by one VM each time a job finds no ready VM(up to max_size)
+    and shrinks by one VM each time a VM sits idle for idle_ttl_seconds(down to min_size).
+    VMs are handed to a job by setting the job's vm_instance_name to the VM's name, which is also the worker's queue.
+    When settings allow more than one job per VM(lease mode), VMs are returned to the pool once a job finishes.
+    """
+    def __init__(self, config, settings, provisioner, make_cloud_service):
+        """
+        :param config: ServerConfig: settings used to create the worker config file
+        :param settings: WarmPoolSettings: pool sizes and timing
+        :param provisioner: ProvisioningTracker: used to launch and terminate pool VMs
+        :param make_cloud_service: func(vm_settings): returns CloudService for the project in vm_settings
+        """
+        self.config = config
+        self.settings = settings
+        self.provisioner = provisioner
+        self.make_cloud_service = make_cloud_service
+        self.lock = threading.Lock()
+        self.pools = {}
+        # VMs from the pool currently running a job, vm_instance_name -> PooledVM
+        self.leased_vms = {}
+        # When each VM launched for a job rather than the pool was requested, vm_instance_name -> time
+        self.job_vm_launch_times = {}
+        self.hits = 0
+        self.misses = 0
+        self.job_start_times = {}
+        self.time_to_stage_seconds = deque(maxlen=TIME_TO_STAGE_SAMPLES)
+        self.stop_maintaining = threading.Event()
+        self.thread = None
+
+    def acquire(self, job):
+        """
+        Remove a ready VM suitable for job from the pool. Starts timing how long the job takes to begin staging.
+        :param job: Job: job that needs a VM
+        :return: PooledVM: VM the job should use or None if no VM is ready
+        """
+        key = make_pool_key(job)
+        with self.lock:
+            self.job_start_times[job.id] = time.time()
+            pool = self.pools.get(key)
+            if not pool:
+                pool = VMPool(key, job, self.settings.min_size, self.settings.max_size)
+                self.pools[key] = pool
+            vm = pool.take_ready_vm()
+            if vm:
+                self.hits += 1
+                vm.jobs_run += 1
+                self.leased_vms[vm.vm_instance_name] = vm
+            else:
+                self.misses += 1
+                pool.grow()
+            return vm
+
+    def release(self, job):
+        """
+        Return the VM a successfully finished job ran on to the pool so another job can use it.
+        The worker's data for the finished job is removed by the worker before it reports the job complete.
+        :param job: Job: finished job whose VM is no longer needed
+        :return: bool: True when the pool took the VM, False when the VM should be terminated
+        """
+        now = time.time()
+        with self.lock:
+            vm = self.leased_vms.pop(job.vm_instance_name, None)
+            launch_time = self.job_vm_launch_times.pop(job.vm_instance_name, None)
+            if self.settings.max_jobs_per_vm <= 1:
+                return False
+            if not vm:
+                if launch_time is None:
+                    # VM was launched before lando started so how long it has been running is unknown
+                    return False
+                vm = PooledVM(make_pool_key(job), job.vm_instance_name, job.vm_volume_name)
+                vm.launch_time = launch_time
+                vm.jobs_run = 1
+            if vm.jobs_run >= self.settings.max_jobs_per_vm or \
+                    now - vm.launch_time > self.settings.max_vm_lifetime_seconds:
+                return False
+            pool = self.pools.get(vm.key)
+            if not pool:
+                pool = VMPool(vm.key, job, self.settings.min_size, self.settings.max_size)
+                self.pools[vm.key] = pool
+            vm.state = PooledVMStates.READY
+            vm.ready_time = now
+            pool.vms.append(vm)
+            return True
+
+    def record_launch(self, vm_instance_name):
+        """
+        Record when a VM was launched for a job so its lifetime is limited if the pool takes it once the job finishes.
+        :param vm_instance_name: str: name of the VM
+        """
+        with self.lock:
+            self.job_vm_launch_times[vm_instance_name] = time.time()
+
+    def forget(self, vm_instance_name):
+        """
+        Stop tracking a VM that was handed to a job because it is being terminated.
+        :param vm_instance_name: str: name of the VM
+        """
+        with self.lock:
+            self.leased_vms.pop(vm_instance_name, None)
+            self.job_vm_launch_times.pop(vm_instance_name, None)
+
+    def record_staging(self, job_id):
+        """
+        Record the time between acquire and the job starting to stage data.
+        :param job_id: int: unique id for the job
+        """
+        with self.lock:
+            start_time = self.job_start_times.pop(job_id, None)
+            if start_time is not None:
+                self.time_to_stage_seconds.append(time.time() - start_time)
+
+    def worker_started(self, vm_instance_name):
+        """
+        Mark a pool VM as ready once lando_worker is listening on its queue.
+        :param vm_instance_name: str: name of the VM that started
+        :return: bool: True if the VM belongs to the pool
+        """
+        with self.lock:
+            vm = self._find_vm(vm_instance_name)
+            if vm:
+                vm.state = PooledVMStates.READY
+                vm.ready_time = time.time()
+                return True
+            return False
+
+    def provisioning_event(self, event_name, payload):
+        """
+        Handle a ProvisioningTracker event for a pool VM.
+        :param event_name: str: ProvisioningEvents name
+        :param payload: ProvisioningEventPayload: contains vm_instance_name and error message
+        """
+        if event_name == ProvisioningEvents.VM_LAUNCH_ERROR:
+            logging.error("Launching warm pool vm {} failed: {}".format(payload.vm_instance_name, payload.message))
+            with self.lock:
+                vm = self._find_vm(payload.vm_instance_name)
+                pool = self.pools[vm.key] if vm else None
+                if vm:
+                    pool.vms.remove(vm)
+            if vm:
+                self._terminate_vm(pool, vm)
+        elif event_name == ProvisioningEvents.VM_TERMINATE_ERROR:
+            logging.error("Terminating warm pool vm {} failed: {}".format(payload.vm_instance_name, payload.message))
+
+    def _find_vm(self, vm_instance_name):
+        for pool in self.pools.values():
+            for vm in pool.vms:
+                if vm.vm_instance_name == vm_instance_name:
+                    return vm
+        return None
+
+    def maintain(self):
+        """
+        Terminate VMs that have been idle too long or failed to boot and launch VMs to bring each pool up
+        to its target size.
+        """
+        stale_vms = []
+        vms_to_launch = []
+        now = time.time()
+        with self.lock:
+            for pool in self.pools.values():
+                for vm in list(pool.vms):
+                    if vm.is_stale(now, self.settings):
+                        pool.vms.remove(vm)
+                        if vm.state == PooledVMStates.READY:
+                            pool.shrink()
+                        stale_vms.append((pool, vm))
+                for _ in range(pool.target_size - len(pool.vms)):
+                    vms_to_launch.append(pool)
+            for key in [key for key, pool in self.pools.items() if not pool.target_size and not pool.vms]:
+                del self.pools[key]
+        for pool, vm in stale_vms:
+            self._terminate_vm(pool, vm)
+        for pool in vms_to_launch:
+            self._launch_vm(pool)
+
+    def _launch_vm(self, pool):
+        cloud_service = self.make_cloud_service(pool.vm_settings)
+        vm = PooledVM(pool.key, cloud_service.make_pool_vm_name(), cloud_service.make_pool_volume_name())
+        cloud_config_script = make_worker_cloud_config_script(self.config, vm.vm_instance_name,
+                                                              pool.vm_settings.cwl_commands, pool.volume_mounts)
+        try:
+            self.provisioner.submit_launch(None, cloud_service, vm.vm_instance_name, pool.flavor_name,
+                                           cloud_config_script.content, vm.vm_volume_name, pool.volume_size,
+                                           settings_job_id=pool.job_id)
+        except:  # The next call to maintain will try again
+            logging.error("Unable to launch warm pool vm: {}".format(traceback.format_exc()))
+            return
+        with self.lock:
+            pool.vms.append(vm)
+
+    def _terminate_vm(self, pool, vm):
+        cloud_service = self.make_cloud_service(pool.vm_settings)
+        try:
+            self._delete_worker_queue(vm)
+            self.provisioner.submit_terminate(None, cloud_service, vm.vm_instance_name, [vm.vm_volume_name],
+                                              settings_job_id=pool.job_id)
+        except:
+            logging.error("Unable to terminate warm pool vm {}: {}".format(vm.vm_instance_name,
+                                                                          traceback.format_exc()))
+
+    def _delete_worker_queue(self, vm):
+        if vm.state == PooledVMStates.READY:
+            LandoWorkerClient(self.config, queue_name=vm.vm_instance_name).delete_queue()
+
+    def stats(self):
+        """
+        :return: dict: hit rate, average seconds from start_job to staging and number of booting/ready VMs
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            vm_states = [vm.state for pool in self.pools.values() for vm in pool.vms]
+            time_to_stage = list(self.time_to_stage_seconds)
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / requests if requests else None,
+                'average_time_to_stage_seconds': sum(time_to_stage) / len(time_to_stage) if time_to_stage else None,
+                'booting': vm_states.count(PooledVMStates.BOOTING),
+                'ready': vm_states.count(PooledVMStates.READY),
+            }
+
+    def start(self):
+        """
+        Start maintaining pools on a background thread.
+        """
+        self.stop_maintaining.clear()
+        self.thread = threading.Thread(target=self._maintain_loop, name='warm-pool')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _maintain_loop(self):
+        while not self.stop_maintaining.wait(self.settings.maintain_seconds):
+            try:
+                self.maintain()
+            except:  # Keep maintaining so the pool recovers from cloud errors
+                logging.error("Error maintaining warm pool: {}".format(traceback.format_exc()))
+            logging.info("Warm pool stats: {}".format(self.stats()))
+
+    def stop(self):
+        """
+        Stop maintaining pools and terminate all pool VMs, waiting for them to be deleted.
+        """
+        self.stop_maintaining.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            cloud_service = self.make_cloud_service(pool.vm_settings)
+            for vm in pool.vms:
+                try:
+                    self._delete_worker_queue(vm)
+                    cloud_service.terminate_instance(vm.vm_instance_name, [vm.vm_volume_name])
+                except:
+                    logging.error("Unable to terminate warm pool vm {}: {}".format(vm.vm_instance_name,
+                                                                                  traceback.format_exc()))
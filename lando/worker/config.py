@@ -4,6 +4,7 @@ Configuration for for use with lando_worker.
 import yaml
 from lando.exceptions import InvalidConfigException, get_or_raise_config_exception
 from lando.server.config import CommandsConfig
+from lando.common.commands import CommandFileFormats
 import logging
 
 
@@ -27,7 +28,13 @@ class WorkerConfig(object):
             self.cwl_pre_process_command = data.get('cwl_pre_process_command', None)
             self.cwl_post_process_command = data.get('cwl_post_process_command', None)
             self.log_level = data.get('log_level', logging.WARNING)
+            # Remove a job's working directory once its output is saved so the VM can run another job
+            self.cleanup_job_data = data.get('cleanup_job_data', False)
             self.commands = CommandsConfig(data)
+            # Format of the stage data command file, ndjson writes one input file per line as it is read
+            self.command_file_format = data.get('command_file_format', CommandFileFormats.JSON)
+            if self.command_file_format not in [CommandFileFormats.JSON, CommandFileFormats.NDJSON]:
+                raise InvalidConfigException("Invalid command_file_format {}.".format(self.command_file_format))
 
 
 class WorkQueue(object):
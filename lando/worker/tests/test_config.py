@@ -43,6 +43,8 @@ class TestWorkerConfig(TestCase):
         self.assertEqual(["cwltoil"], config.cwl_base_command)
         self.assertEqual(['rm', 'bad.data'], config.cwl_post_process_command)
         self.assertEqual(logging.WARNING, config.log_level)
+        self.assertEqual(False, config.cleanup_job_data)
+        self.assertEqual('json', config.command_file_format)
 
     def test_empty_config(self):
         filename = write_temp_return_filename("")
@@ -61,3 +63,14 @@ class TestWorkerConfig(TestCase):
         config = WorkerConfig(filename)
         os.unlink(filename)
         self.assertEqual('INFO', config.log_level)
+
+    def test_command_file_format(self):
+        filename = write_temp_return_filename('{}\ncommand_file_format: ndjson'.format(GOOD_CONFIG))
+        config = WorkerConfig(filename)
+        os.unlink(filename)
+        self.assertEqual('ndjson', config.command_file_format)
+
+        filename = write_temp_return_filename('{}\ncommand_file_format: xml'.format(GOOD_CONFIG))
+        with self.assertRaises(InvalidConfigException):
+            WorkerConfig(filename)
+        os.unlink(filename)
@@ -6,7 +6,7 @@ from lando.common.names import WorkflowTypes
 
 class LandoWorkerActionsTestCase(TestCase):
     def setUp(self):
-        self.config = Mock()
+        self.config = Mock(cleanup_job_data=False)
         self.client = Mock()
         self.paths = Mock()
         self.names = Mock()
@@ -35,7 +35,8 @@ class LandoWorkerActionsTestCase(TestCase):
         mock_stage_data_command.return_value.run.assert_called_with(
             self.config.commands.stage_data_command,
             'credentials',
-            self.payload.input_files
+            self.payload.input_files,
+            command_file_format=self.config.command_file_format
         )
         self.client.job_step_complete.assert_called_with(self.payload)
 
@@ -89,6 +90,20 @@ class LandoWorkerActionsTestCase(TestCase):
         )
         self.client.job_step_store_output_complete.assert_called_with(self.payload, mock_project_details.return_value)
 
+    @patch('lando.worker.worker.os')
+    @patch('lando.worker.worker.shutil')
+    @patch('lando.worker.worker.SaveOutputCommand')
+    @patch('lando.worker.worker.ProjectDetails')
+    def test_save_output_cleanup_job_data(self, mock_project_details, mock_save_output_command, mock_shutil,
+                                          mock_os):
+        self.config.cleanup_job_data = True
+        self.payload.job_id = 42
+        self.client.job_step_store_output_complete.side_effect = lambda *args: mock_shutil.rmtree.assert_called()
+        actions = LandoWorkerActions(self.config, self.client)
+        actions.save_output(self.paths, self.names, self.payload)
+        mock_shutil.rmtree.assert_called_with('data_for_job_42', ignore_errors=True)
+        self.client.job_step_store_output_complete.assert_called_with(self.payload, mock_project_details.return_value)
+
 
 @patch('lando.worker.worker.os')
 @patch('lando.worker.worker.LandoClient')
@@ -5,6 +5,7 @@ Run via script with no arguments: lando_worker
 """
 
 import os
+import shutil
 import traceback
 import logging
 from lando_messaging.clients import LandoClient
@@ -39,7 +40,8 @@ class LandoWorkerActions(object):
         single_user_id = self.get_single_dds_user_id(payload.input_files)
         dds_credentials = payload.credentials.dds_user_credentials[single_user_id]
         command = StageDataCommand(payload.job_details.workflow, names, paths)
-        command.run(self.commands.stage_data_command, dds_credentials, payload.input_files)
+        command.run(self.commands.stage_data_command, dds_credentials, payload.input_files,
+                    command_file_format=self.config.command_file_format)
         self.client.job_step_complete(payload)
 
     @staticmethod
@@ -85,6 +87,8 @@ class LandoWorkerActions(object):
         project_details = command.get_project_details()
         output_project_info = ProjectDetails(project_id=project_details["project_id"],
                                              readme_file_id=project_details["readme_file_id"])
+        if self.config.cleanup_job_data:
+            shutil.rmtree(WORKING_DIR_FORMAT.format(payload.job_id), ignore_errors=True)
         self.client.job_step_store_output_complete(payload, output_project_info)
 
 